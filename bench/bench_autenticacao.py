@@ -0,0 +1,89 @@
+"""
+🔐 BENCHMARK - verificação de token
+
+Mede, sem rede, os três caminhos de verificar_token_supabase:
+  1. token já em cache (caminho quente de toda mensagem autenticada);
+  2. token novo verificado localmente (assinatura HS256 + exp + aud);
+  3. token recusado, que fica no cache negativo.
+A referência é a ida ao Supabase (auth.get_user + select em user_accounts),
+que em produção custa dezenas de ms — aqui ela só é contada, nunca feita.
+
+Precisa do PyJWT instalado.
+
+Uso:
+    python bench/bench_autenticacao.py --repeticoes 20000
+"""
+
+import argparse
+import os
+import sys
+import time
+
+SEGREDO = 'segredo-do-bench-0123456789-abcdefghij'
+os.environ['SUPABASE_JWT_SECRET'] = SEGREDO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+# =============================================================================
+# 🔧 MONTAGEM
+# =============================================================================
+
+class SupabaseContado:
+    """Conta as idas ao Supabase; toda verificação remota recusa o token"""
+
+    def __init__(self):
+        self.chamadas = 0
+        self.auth = self
+
+    def get_user(self, token):
+        self.chamadas += 1
+        erro = Exception('token recusado')
+        erro.status = 401
+        raise erro
+
+def criar_token(sub, validade=3600):
+    claims = {'sub': sub, 'email': f'{sub}@exemplo.com', 'aud': 'authenticated',
+              'exp': int(time.time()) + validade, 'user_metadata': {'name': sub}}
+    return 'Bearer ' + main.jwt.encode(claims, SEGREDO, algorithm='HS256')
+
+def cronometrar(funcao, repeticoes):
+    inicio = time.perf_counter()
+    for i in range(repeticoes):
+        funcao(i)
+    return (time.perf_counter() - inicio) / repeticoes * 1e6
+
+# =============================================================================
+# ⏱️ MEDIÇÃO
+# =============================================================================
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Benchmark da verificação de token")
+    parser.add_argument('--repeticoes', type=int, default=20000)
+    args = parser.parse_args()
+
+    if main.jwt is None:
+        sys.exit("PyJWT não instalado (pip install PyJWT)")
+
+    supabase = SupabaseContado()
+    main.supabase = supabase
+
+    token = criar_token('quente')
+    main.verificar_token_supabase(token)
+    quente = cronometrar(lambda i: main.verificar_token_supabase(token), args.repeticoes)
+
+    frios = [criar_token(f'u{i}') for i in range(min(args.repeticoes, 5000))]
+    frio = cronometrar(lambda i: main.verificar_token_supabase(frios[i]), len(frios))
+
+    recusado = criar_token('expirado', validade=-10)
+    negativo = cronometrar(lambda i: main.verificar_token_supabase(recusado), args.repeticoes)
+
+    print(f"🔥 token em cache:        {quente:8.2f} µs")
+    print(f"🔐 token novo (JWT local): {frio:8.2f} µs")
+    print(f"🚫 token recusado:        {negativo:8.2f} µs")
+    print(f"🌐 idas ao Supabase:      {supabase.chamadas}")
+    print(main.obter_estatisticas_autenticacao()['cache_tokens'])
+
+if __name__ == '__main__':
+    main_bench()
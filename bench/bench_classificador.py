@@ -0,0 +1,109 @@
+"""
+⏱️ MICROBENCHMARK - classificação de mensagens
+
+Compara a detecção antiga (um `any(kw in msg_lower ...)` por lista: categorias,
+refinamento Starter/Professional e intenções da resposta alternativa) com o
+classificador compilado do main.py (uma regex, uma passada por mensagem).
+Também lista as mensagens em que os dois discordam — em geral falsos acertos
+de substring da versão antiga ("oi" em "noite", "ia" em "dia").
+
+Uso:
+    python bench/bench_classificador.py --repeticoes 2000
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+MENSAGENS = [
+    'oi', 'Olá, boa noite!', 'bom dia', 'e ai, tudo bem?', 'tchau, obrigado!', 'valeu demais',
+    'quanto custa o plano starter?', 'Qual o preço do plano professional?',
+    'me explica como funciona a hospedagem e o domínio', 'vocês fazem e-commerce com checkout e pix?',
+    'quero um site para minha padaria, quanto tempo demora para ficar pronto?',
+    'qual a diferença entre os planos starter e professional?', 'dá pra integrar com a API do Stripe?',
+    'o site fica responsivo no celular? e a otimização de SEO para o Google?',
+    'preciso de dois sites, um blog e uma landing page', 'vocês usam React, Next.js e TypeScript?',
+    'tem inteligência artificial no atendimento?', 'me mostra o portfólio com os projetos feitos',
+    'qual o whatsapp para falar com o Natan?', 'meu site está com problema depois da atualização',
+    'ok', 'sim, pode ser', 'não entendi, me fala sobre o processo completo',
+    'Como criar uma loja virtual com pagamento no cartão e automação de CRM?',
+    'ensina passo a passo como fazer o cadastro', 'tenho interesse no design personalizado',
+    'Boa tarde! Gostaria de detalhes sobre o plano e a mensalidade.',
+]
+
+# =============================================================================
+# 🐢 DETECÇÃO ANTIGA (substring, sem normalizar acentos)
+# =============================================================================
+
+def categoria_antiga(mensagem):
+    msg_lower = mensagem.lower().strip()
+    categorias = main.CATEGORIAS_MENSAGEM
+    if len(msg_lower.split()) <= 3:
+        for categoria, config in categorias.items():
+            if any(kw in msg_lower for kw in config['keywords']):
+                return categoria
+        return 'casual'
+    for cat in main.ORDEM_PRIORIDADE_CATEGORIAS:
+        if any(kw in msg_lower for kw in categorias[cat]['keywords']):
+            return cat
+    return 'explicacao_simples'
+
+def analisar_antiga(mensagem):
+    msg_lower = mensagem.lower().strip()
+    refinamento = {plano for plano, palavras in main.PALAVRAS_REFINAMENTO.items()
+                   if any(kw in msg_lower for kw in palavras)}
+    intencao = next((nome for nome, palavras in main.INTENCOES_RESPOSTA_ALTERNATIVA.items()
+                     if any(kw in msg_lower for kw in palavras)), None)
+    return {'categoria': categoria_antiga(mensagem), 'refinamento': refinamento, 'intencao': intencao}
+
+# =============================================================================
+# ⏱️ MEDIÇÃO
+# =============================================================================
+
+def cronometrar(funcao, mensagens, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        for mensagem in mensagens:
+            funcao(mensagem)
+    return (time.perf_counter() - inicio) / (repeticoes * len(mensagens)) * 1e6
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Microbenchmark do classificador de mensagens")
+    parser.add_argument('--repeticoes', type=int, default=2000)
+    parser.add_argument('--semente', type=int, default=42)
+    args = parser.parse_args()
+
+    random.seed(args.semente)
+    # Mensagens longas (várias frases juntas) pesam mais na versão antiga
+    mensagens = MENSAGENS + [' '.join(random.sample(MENSAGENS, 4)) for _ in range(len(MENSAGENS))]
+
+    cronometrar(main.analisar_mensagem, mensagens, 50)
+    antiga = cronometrar(analisar_antiga, mensagens, args.repeticoes)
+    nova = cronometrar(main.analisar_mensagem, mensagens, args.repeticoes)
+
+    print(f"📨 {len(mensagens)} mensagens x {args.repeticoes} repetições")
+    print(f"🐢 substring (antiga):  {antiga:8.2f} µs/mensagem")
+    print(f"⚡ regex compilada:     {nova:8.2f} µs/mensagem")
+    print(f"🚀 aceleração:          {antiga / nova:8.2f}x")
+
+    divergencias = []
+    for mensagem in MENSAGENS:
+        velha, atual = analisar_antiga(mensagem), main.analisar_mensagem(mensagem)
+        diferencas = [campo for campo in ('categoria', 'refinamento', 'intencao') if velha[campo] != atual[campo]]
+        if diferencas:
+            divergencias.append((mensagem, {c: (velha[c], atual[c]) for c in diferencas}))
+
+    print(f"\n🔍 {len(divergencias)} de {len(MENSAGENS)} mensagens classificadas de forma diferente (antiga -> nova):")
+    for mensagem, diferencas in divergencias:
+        print(f"   {mensagem!r}")
+        for campo, (velha, atual) in diferencas.items():
+            print(f"      {campo}: {velha} -> {atual}")
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,141 @@
+"""
+🧹 BENCHMARK + VERIFICAÇÃO - expiração das conversas na RAM
+
+Compara a limpeza antiga (varre todos os usuários de uma vez, segurando o
+usuarios_lock) com a ConversasLRU do main.py (rodadas de até `lote_fundo`
+vencidas, lock solto entre elas), com N usuários e metade das conversas
+paradas além do TTL:
+  1. tempo máximo com o lock preso numa varredura / numa rodada;
+  2. latência de registrar_pergunta_memoria enquanto a limpeza roda em outra
+     thread (p50 / p99 / máx);
+e verifica que:
+  3. todas as vencidas saem e nenhuma ativa sai;
+  4. com mais usuários que `max_usuarios`, a RAM fica no teto (LRU).
+
+Uso:
+    python bench/bench_conversas.py --usuarios 100000
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+# =============================================================================
+# 🔧 MONTAGEM
+# =============================================================================
+
+def montar(usuarios, paradas):
+    """N conversas; as `paradas` mais antigas ficam além do TTL"""
+    with main.usuarios_lock:
+        main.USUARIOS.clear()
+        main.CONVERSAS.limpar()
+    main.CONVERSAS.max_usuarios = usuarios
+    for i in range(usuarios):
+        main.registrar_pergunta_memoria(f'u{i}', 'quanto custa o plano starter?')
+    vencimento = main.CONVERSAS.ttl_segundos + 60
+    with main.usuarios_lock:
+        for user_id in list(main.CONVERSAS.ordem)[:paradas]:
+            main.USUARIOS[user_id].atualizado_em -= vencimento
+
+def conversas_na_ram():
+    with main.usuarios_lock:
+        return sum(1 for estado in main.USUARIOS.values() if estado.turnos is not None)
+
+# =============================================================================
+# 🐢 LIMPEZA ANTIGA (referência)
+# =============================================================================
+
+def varredura_completa(lock_preso):
+    """Como antes: todos os usuários de uma vez, sob o lock"""
+    limite = time.monotonic() - main.CONVERSAS.ttl_segundos
+    with main.usuarios_lock:
+        inicio = time.perf_counter()
+        remover = [user_id for user_id, estado in main.USUARIOS.items()
+                   if estado.turnos is not None and estado.atualizado_em < limite]
+        for user_id in remover:
+            main.CONVERSAS.esquecer(user_id)
+            main.CONVERSAS.descartar(user_id)
+        lock_preso.append(time.perf_counter() - inicio)
+
+# =============================================================================
+# 🧹 LIMPEZA INCREMENTAL
+# =============================================================================
+
+def rodadas_lru(lock_preso):
+    """O mesmo laço de limpar_memoria_antiga, cronometrando cada rodada"""
+    lote = main.MEMORIA_CONFIG['lote_fundo']
+    while True:
+        with main.usuarios_lock:
+            inicio = time.perf_counter()
+            removidas = main.CONVERSAS.expirar(lote)
+            lock_preso.append(time.perf_counter() - inicio)
+        if removidas < lote:
+            return
+        time.sleep(0)
+
+# =============================================================================
+# ⏱️ MEDIÇÃO
+# =============================================================================
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+def medir(nome, limpeza, usuarios, ativos_por_rodada):
+    paradas = usuarios // 2
+    montar(usuarios, paradas)
+
+    lock_preso, latencias = [], []
+    limpador = threading.Thread(target=limpeza, args=(lock_preso,))
+    limpador.start()
+    i = 0
+    while limpador.is_alive() or i < ativos_por_rodada:
+        user_id = f'u{usuarios - 1 - (i % paradas)}'  # só usuários ativos
+        inicio = time.perf_counter()
+        main.registrar_pergunta_memoria(user_id, 'e a hospedagem?')
+        latencias.append(time.perf_counter() - inicio)
+        i += 1
+    limpador.join()
+
+    restantes = conversas_na_ram()
+    print(f"{nome}: lock preso máx {max(lock_preso) * 1000:7.2f} ms em {len(lock_preso)} rodada(s) | "
+          f"mensagem p50 {percentil(latencias, 0.5) * 1e6:6.1f} µs, p99 {percentil(latencias, 0.99) * 1e6:8.1f} µs, "
+          f"máx {max(latencias) * 1000:7.2f} ms ({len(latencias)} mensagens)")
+    ok = restantes == usuarios - paradas
+    print(f"{'✅' if ok else '❌'} {restantes} conversas na RAM (esperado {usuarios - paradas})")
+    return ok
+
+def verificar_teto(usuarios, teto):
+    montar(0, 0)
+    main.CONVERSAS.max_usuarios = teto
+    for i in range(usuarios):
+        main.registrar_pergunta_memoria(f't{i}', 'oi')
+    na_ram = conversas_na_ram()
+    with main.usuarios_lock:
+        mais_recente = next(reversed(main.CONVERSAS.ordem))
+    ok = na_ram == teto and mais_recente == f't{usuarios - 1}'
+    print(f"{'✅' if ok else '❌'} teto LRU: {usuarios} usuários → {na_ram} conversas na RAM (teto {teto}), "
+          f"{main.CONVERSAS.despejadas} despejadas")
+    return ok
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Expiração das conversas: varredura completa vs LRU incremental")
+    parser.add_argument('--usuarios', type=int, default=100000)
+    parser.add_argument('--mensagens', type=int, default=2000, help="mínimo de mensagens medidas por cenário")
+    parser.add_argument('--teto', type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"👥 {args.usuarios} conversas, metade paradas além do TTL")
+    ok = medir("🐢 varredura completa", varredura_completa, args.usuarios, args.mensagens)
+    ok &= medir("🧹 LRU incremental   ", rodadas_lru, args.usuarios, args.mensagens)
+    ok &= verificar_teto(args.teto * 3, args.teto)
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main_bench()
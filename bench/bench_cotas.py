@@ -0,0 +1,225 @@
+"""
+🎟️ BENCHMARK + VERIFICAÇÃO - reserva atômica de cota
+
+Compara o fluxo antigo (verifica o limite → chama a IA → incrementa) com o
+MotorCotas do main.py (reserva → chama a IA → confirma/libera):
+  1. N threads disparando ao mesmo tempo para um usuário a 1 mensagem do
+     limite: quantas passam em cada fluxo (o certo é passar só o que falta);
+  2. falhas da IA devolvem a reserva (a cota não é consumida);
+  3. N processos contra o mesmo SQLite: o total admitido é exatamente o limite;
+  4. vazão de reservar+confirmar com 1 shard de lock vs 64 shards.
+
+Redis só entra com --redis-url apontando para um servidor acessível.
+
+Uso:
+    python bench/bench_cotas.py --threads 32 --processos 4
+    python bench/bench_cotas.py --redis-url redis://localhost:6379/15
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+TTL_TABELAS = {'mensagens': None}
+
+# =============================================================================
+# 🔧 MONTAGEM
+# =============================================================================
+
+def criar_backend(nome, caminho=None, redis_url=None, prefixo='bench_cotas'):
+    if nome == 'sqlite':
+        return main.BackendEstadoSQLite(caminho, TTL_TABELAS)
+    if nome == 'redis':
+        return main.BackendEstadoRedis(redis_url, prefixo, TTL_TABELAS)
+    return main.BackendEstadoMemoria()
+
+def criar_motor(backend, shards=64):
+    """Armazém + motor próprios (não os do main.py)"""
+    armazem = main.ArmazemEstado(backend, intervalo_gravacao=0.2, validade_leitura=1.0)
+    contadores, lock = {}, threading.Lock()
+    armazem.registrar_tabela('mensagens', contadores, lock)
+    if armazem.ativo:
+        threading.Thread(target=armazem.executar, daemon=True).start()
+    return main.MotorCotas(armazem, shards, validade_reserva=60), armazem, contadores, lock
+
+def incrementar(motor, armazem, contadores, lock, chave, reserva):
+    """Mesmo padrão de incrementar_contador: backend primeiro, local depois, confirma"""
+    somado_no_backend = motor.confirmar_no_backend(reserva, {'total': 0})
+    with lock:
+        contador = contadores.setdefault(chave, {'total': 0})
+        contador['total'] += 1
+        if not somado_no_backend:
+            armazem.atualizar('mensagens', chave, somar={'total': 1}, iniciais={'total': 0})
+    motor.confirmar(reserva)
+
+def disparar(threads, funcao):
+    barreira = threading.Barrier(threads)
+    resultados = []
+
+    def alvo():
+        barreira.wait()
+        resultados.append(funcao())
+
+    trabalhadores = [threading.Thread(target=alvo) for _ in range(threads)]
+    for t in trabalhadores:
+        t.start()
+    for t in trabalhadores:
+        t.join()
+    return resultados
+
+# =============================================================================
+# ✅ VERIFICAÇÃO EM THREADS
+# =============================================================================
+
+def verificar_sobreadmissao(threads, limite, latencia):
+    # Fluxo antigo: verifica, chama a IA, incrementa
+    contadores, lock = {'u': {'total': limite - 1}}, threading.Lock()
+
+    def antigo():
+        if contadores['u']['total'] >= limite:
+            return False
+        time.sleep(latencia)
+        with lock:
+            contadores['u']['total'] += 1
+        return True
+
+    antigos = sum(disparar(threads, antigo))
+
+    # Fluxo novo: reserva, chama a IA, confirma
+    motor, armazem, contadores, lock = criar_motor(criar_backend('memoria'))
+    contadores['u'] = {'total': limite - 1}
+
+    def novo():
+        reserva, _, _ = motor.reservar('mensagens', 'u', limite)
+        if reserva is None:
+            return False
+        time.sleep(latencia)
+        incrementar(motor, armazem, contadores, lock, 'u', reserva)
+        return True
+
+    novos = sum(disparar(threads, novo))
+    print(f"🐢 verifica→incrementa: {antigos}/{threads} passaram a 1 do limite (total {limite - 1 + antigos}/{limite})")
+    print(f"🎟️ reserva→confirma:    {novos}/{threads} passaram a 1 do limite (total {contadores['u']['total']}/{limite})")
+    ok = novos == 1 and contadores['u']['total'] == limite
+    print(f"{'✅' if ok else '❌'} sem sobreadmissão")
+    return ok
+
+def verificar_liberacao(threads, limite):
+    """Metade das chamadas falha: a cota devolvida volta a ser usável"""
+    motor, armazem, contadores, lock = criar_motor(criar_backend('memoria'))
+    rng = random.Random(3)
+    admitidas = 0
+    while True:
+        reserva, _, _ = motor.reservar('mensagens', 'u', limite)
+        if reserva is None:
+            break
+        if rng.random() < 0.5:
+            motor.liberar(reserva)
+            motor.liberar(reserva)  # idempotente
+        else:
+            incrementar(motor, armazem, contadores, lock, 'u', reserva)
+            admitidas += 1
+    ok = admitidas == limite == contadores['u']['total']
+    print(f"{'✅' if ok else '❌'} liberação: {admitidas} confirmadas com metade das chamadas falhando (limite {limite})")
+    return ok
+
+# =============================================================================
+# ✅ VERIFICAÇÃO ENTRE PROCESSOS
+# =============================================================================
+
+def trabalhador(nome, kwargs, tentativas, limite, fila):
+    motor, armazem, contadores, lock = criar_motor(criar_backend(nome, **kwargs))
+    admitidas = 0
+    for _ in range(tentativas):
+        reserva, _, _ = motor.reservar('mensagens', 'compartilhado', limite)
+        if reserva is not None:
+            incrementar(motor, armazem, contadores, lock, 'compartilhado', reserva)
+            admitidas += 1
+    armazem.descarregar()
+    fila.put(admitidas)
+
+def verificar_processos(nome, processos, tentativas, limite, **kwargs):
+    contexto = multiprocessing.get_context('spawn')
+    fila = contexto.Queue()
+    filhos = [contexto.Process(target=trabalhador, args=(nome, kwargs, tentativas, limite, fila))
+              for _ in range(processos)]
+    for filho in filhos:
+        filho.start()
+    admitidas = sum(fila.get() for _ in filhos)
+    for filho in filhos:
+        filho.join()
+
+    backend = criar_backend(nome, **kwargs)
+    registro = backend.ler([('mensagens', 'compartilhado')]).get(('mensagens', 'compartilhado'), {})
+    ok = admitidas == limite == registro.get('total')
+    print(f"{'✅' if ok else '❌'} {nome}: {processos} processos x {tentativas} tentativas → "
+          f"{admitidas} admitidas, total {registro.get('total')} (limite {limite})")
+    return ok
+
+# =============================================================================
+# ⏱️ MEDIÇÃO
+# =============================================================================
+
+def medir_vazao(nome, shards, threads, operacoes, usuarios, **kwargs):
+    motor, armazem, contadores, lock = criar_motor(criar_backend(nome, **kwargs), shards)
+    por_thread = operacoes // threads
+
+    def rodada():
+        rng = random.Random()
+        for _ in range(por_thread):
+            chave = f'u{rng.randrange(usuarios)}'
+            reserva, _, _ = motor.reservar('mensagens', chave, float('inf'))
+            incrementar(motor, armazem, contadores, lock, chave, reserva)
+
+    inicio = time.perf_counter()
+    disparar(threads, rodada)
+    duracao = time.perf_counter() - inicio
+    armazem.descarregar()
+    print(f"⏱️ {nome:8s} {shards:3d} shard(s), {threads} threads: "
+          f"{por_thread * threads / duracao:9.0f} reservas+confirmações/s")
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Benchmark da reserva atômica de cota")
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--limite', type=int, default=100)
+    parser.add_argument('--latencia', type=float, default=0.05, help="segundos da chamada simulada à IA")
+    parser.add_argument('--processos', type=int, default=4)
+    parser.add_argument('--tentativas', type=int, default=200, help="por processo, na verificação")
+    parser.add_argument('--operacoes', type=int, default=40000)
+    parser.add_argument('--usuarios', type=int, default=1000)
+    parser.add_argument('--redis-url', default=None)
+    args = parser.parse_args()
+
+    ok = verificar_sobreadmissao(args.threads, args.limite, args.latencia)
+    ok &= verificar_liberacao(args.threads, args.limite)
+
+    print()
+    with tempfile.TemporaryDirectory() as pasta:
+        ok &= verificar_processos('sqlite', args.processos, args.tentativas, args.limite,
+                                  caminho=os.path.join(pasta, 'processos.db'))
+        print()
+        for shards in (1, 64):
+            medir_vazao('memoria', shards, args.threads, args.operacoes, args.usuarios)
+        medir_vazao('sqlite', 64, args.threads, args.operacoes // 10, args.usuarios,
+                    caminho=os.path.join(pasta, 'vazao.db'))
+
+    if args.redis_url:
+        backend = criar_backend('redis', redis_url=args.redis_url)
+        backend.limpar('mensagens')
+        ok &= verificar_processos('redis', args.processos, args.tentativas, args.limite, redis_url=args.redis_url)
+        backend.limpar('mensagens')
+        medir_vazao('redis', 64, args.threads, args.operacoes // 10, args.usuarios, redis_url=args.redis_url)
+
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main_bench()
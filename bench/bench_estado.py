@@ -0,0 +1,210 @@
+"""
+💾 BENCHMARK + VERIFICAÇÃO - estado persistente (memória / SQLite-WAL / Redis)
+
+Mede o custo que o ArmazemEstado acrescenta ao caminho quente de uma mensagem
+(sincronizar o usuário + incrementar o contador + registrar tokens) em cada
+backend e verifica que N processos incrementando o mesmo usuário em paralelo
+chegam exatamente ao total esperado (incrementos, não sobrescrita). Verifica
+também que a leitura da requisição não espera a gravação do lote e que, lendo
+enquanto um lote grava, o contador local nunca recua.
+
+Redis só entra com --redis-url apontando para um servidor acessível.
+
+Uso:
+    python bench/bench_estado.py --operacoes 20000 --processos 4
+    python bench/bench_estado.py --redis-url redis://localhost:6379/15
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+TTL_TABELAS = {'mensagens': None, 'tokens': None}
+
+# =============================================================================
+# 🔧 MONTAGEM
+# =============================================================================
+
+def criar_backend(nome, caminho=None, redis_url=None, prefixo='bench_estado'):
+    if nome == 'sqlite':
+        return main.BackendEstadoSQLite(caminho, TTL_TABELAS)
+    if nome == 'redis':
+        return main.BackendEstadoRedis(redis_url, prefixo, TTL_TABELAS)
+    return main.BackendEstadoMemoria()
+
+def criar_armazem(backend, validade_leitura=1.0):
+    """Armazém próprio (não o do main.py), com dicionários e locks próprios"""
+    armazem = main.ArmazemEstado(backend, intervalo_gravacao=0.2, validade_leitura=validade_leitura)
+    tabelas = {}
+    for nome in ('mensagens', 'tokens'):
+        tabelas[nome] = ({}, threading.Lock())
+        armazem.registrar_tabela(nome, *tabelas[nome])
+    return armazem, tabelas
+
+def mensagem(armazem, tabelas, user_id):
+    """O que uma mensagem faz no estado: 1 leitura em lote + 2 incrementos"""
+    armazem.sincronizar(user_id, ('mensagens', 'tokens'))
+
+    contadores, lock = tabelas['mensagens']
+    with lock:
+        contador = contadores.setdefault(user_id, {'total': 0})
+        contador['total'] += 1
+        armazem.atualizar('mensagens', user_id, somar={'total': 1}, iniciais={'total': 0})
+
+    tokens, lock = tabelas['tokens']
+    with lock:
+        contador = tokens.setdefault(user_id, {'total_geral': 0, 'mensagens_processadas': 0})
+        contador['total_geral'] += 150
+        contador['mensagens_processadas'] += 1
+        armazem.atualizar('tokens', user_id, somar={'total_geral': 150, 'mensagens_processadas': 1},
+                          iniciais={'total_geral': 0, 'mensagens_processadas': 0})
+
+# =============================================================================
+# ⏱️ MEDIÇÃO
+# =============================================================================
+
+def medir(nome, operacoes, usuarios, **kwargs):
+    armazem, tabelas = criar_armazem(criar_backend(nome, **kwargs))
+    if armazem.ativo:
+        threading.Thread(target=armazem.executar, daemon=True).start()
+
+    duracoes = []
+    for i in range(operacoes):
+        inicio = time.perf_counter()
+        mensagem(armazem, tabelas, f'u{i % usuarios}')
+        duracoes.append(time.perf_counter() - inicio)
+    armazem.descarregar()
+
+    duracoes.sort()
+    media = sum(duracoes) / len(duracoes) * 1e6
+    p99 = duracoes[int(len(duracoes) * 0.99)] * 1e6
+    print(f"💾 {nome:8s}: média {media:7.1f} µs | p99 {p99:7.1f} µs | "
+          f"{armazem.gravacoes} lotes, {armazem.leituras} leituras em lote")
+
+# =============================================================================
+# ✅ VERIFICAÇÃO ENTRE PROCESSOS
+# =============================================================================
+
+def trabalhador(nome, kwargs, incrementos):
+    armazem, tabelas = criar_armazem(criar_backend(nome, **kwargs))
+    threading.Thread(target=armazem.executar, daemon=True).start()
+    for _ in range(incrementos):
+        mensagem(armazem, tabelas, 'compartilhado')
+    armazem.descarregar()
+
+def verificar_processos(nome, processos, incrementos, **kwargs):
+    contexto = multiprocessing.get_context('spawn')
+    filhos = [contexto.Process(target=trabalhador, args=(nome, kwargs, incrementos)) for _ in range(processos)]
+    for filho in filhos:
+        filho.start()
+    for filho in filhos:
+        filho.join()
+
+    backend = criar_backend(nome, **kwargs)
+    registro = backend.ler([('mensagens', 'compartilhado')]).get(('mensagens', 'compartilhado'), {})
+    esperado = processos * incrementos
+    ok = registro.get('total') == esperado
+    print(f"{'✅' if ok else '❌'} {nome}: {processos} processos x {incrementos} = {registro.get('total')} (esperado {esperado})")
+    return ok
+
+# =============================================================================
+# ✅ LEITURA x GRAVAÇÃO DO LOTE
+# =============================================================================
+
+def verificar_leitura_com_lote(nome, escritores=4, incrementos=300, atraso_lote=0.05, **kwargs):
+    """Lotes lentos gravando sem parar; leitores relendo o tempo todo"""
+    armazem, tabelas = criar_armazem(criar_backend(nome, **kwargs), validade_leitura=0.0)
+    aplicar = armazem.backend.aplicar
+    armazem.backend.aplicar = lambda operacoes: (time.sleep(atraso_lote), aplicar(operacoes))[1]
+
+    parar = threading.Event()
+    recuos, leituras_outra_chave = [0], []
+
+    def gravar():
+        while not parar.is_set():
+            armazem.descarregar()
+
+    def ler_mesma_chave():
+        contadores, lock = tabelas['mensagens']
+        maior = 0
+        while not parar.is_set():
+            armazem.sincronizar('compartilhado', ('mensagens',))
+            with lock:
+                atual = contadores.get('compartilhado', {}).get('total', 0)
+            recuos[0] += atual < maior
+            maior = max(maior, atual)
+
+    def ler_outra_chave():
+        i = 0
+        while not parar.is_set():
+            inicio = time.perf_counter()
+            armazem.sincronizar(f'leitor{i}', ('mensagens', 'tokens'))
+            leituras_outra_chave.append(time.perf_counter() - inicio)
+            i += 1
+
+    def escrever():
+        for _ in range(incrementos):
+            mensagem(armazem, tabelas, 'compartilhado')
+
+    fundo = [threading.Thread(target=alvo) for alvo in (gravar, ler_mesma_chave, ler_outra_chave)]
+    for thread in fundo:
+        thread.start()
+    threads = [threading.Thread(target=escrever) for _ in range(escritores)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    parar.set()
+    for thread in fundo:
+        thread.join()
+    armazem.descarregar()
+
+    esperado = escritores * incrementos
+    total = armazem.backend.ler([('mensagens', 'compartilhado')])[('mensagens', 'compartilhado')]['total']
+    maior_leitura = max(leituras_outra_chave) * 1000
+    ok = recuos[0] == 0 and total == esperado and maior_leitura < atraso_lote * 1000
+    print(f"{'✅' if ok else '❌'} {nome}: leitura com lote de {atraso_lote * 1000:.0f} ms gravando: "
+          f"{recuos[0]} recuos do contador local, total {total} (esperado {esperado}), "
+          f"leitura de outra chave máx {maior_leitura:.1f} ms")
+    return ok
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Benchmark do estado persistente")
+    parser.add_argument('--operacoes', type=int, default=20000)
+    parser.add_argument('--usuarios', type=int, default=500)
+    parser.add_argument('--processos', type=int, default=4)
+    parser.add_argument('--incrementos', type=int, default=500, help="por processo, na verificação")
+    parser.add_argument('--redis-url', default=None)
+    args = parser.parse_args()
+
+    ok = True
+    with tempfile.TemporaryDirectory() as pasta:
+        medir('memoria', args.operacoes, args.usuarios)
+        medir('sqlite', args.operacoes, args.usuarios, caminho=os.path.join(pasta, 'bench.db'))
+        ok &= verificar_processos('sqlite', args.processos, args.incrementos, caminho=os.path.join(pasta, 'processos.db'))
+        ok &= verificar_leitura_com_lote('sqlite', caminho=os.path.join(pasta, 'leitura.db'))
+
+    if args.redis_url:
+        backend = criar_backend('redis', redis_url=args.redis_url)
+        for tabela in TTL_TABELAS:
+            backend.limpar(tabela)
+        medir('redis', args.operacoes, args.usuarios, redis_url=args.redis_url)
+        for tabela in TTL_TABELAS:
+            backend.limpar(tabela)
+        ok &= verificar_processos('redis', args.processos, args.incrementos, redis_url=args.redis_url)
+        for tabela in TTL_TABELAS:
+            backend.limpar(tabela)
+        ok &= verificar_leitura_com_lote('redis', redis_url=args.redis_url)
+
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main_bench()
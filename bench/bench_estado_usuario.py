@@ -0,0 +1,131 @@
+"""
+👤 BENCHMARK - memória por usuário (registro compacto vs dicts aninhados)
+
+Monta N usuários com contador de mensagens, contador de tokens e memória de
+conversa cheia (MAX_MENSAGENS_MEMORIA turnos) nos dois formatos:
+  - antigo: três dicionários (CONTADOR_MENSAGENS, CONTADOR_TOKENS,
+    MEMORIA_USUARIOS) com dicts aninhados e datas ISO (uma por mensagem);
+  - novo: um EstadoUsuario do main.py por usuário (__slots__, deque, array).
+Mede a memória com tracemalloc e o custo de olhar a idade de cada conversa
+numa varredura completa (antes: datetime.fromisoformat; agora: float). A
+expiração de verdade nem varre mais: ver bench/bench_conversas.py.
+O texto das mensagens é o mesmo objeto nos dois formatos, então não entra na
+conta: o que se mede é o custo da estrutura.
+
+Uso:
+    python bench/bench_estado_usuario.py --usuarios 100000
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+# =============================================================================
+# 🐢 FORMATO ANTIGO (referência)
+# =============================================================================
+
+def usuario_antigo(conteudos, tokens, janela_inicio):
+    contador = {
+        'total': len(conteudos),
+        'resetado_em': datetime.now().isoformat(),
+        'janela_inicio': janela_inicio,
+        'tipo_plano': 'starter'
+    }
+    contador_tokens = dict(zip(main.CAMPOS_TOKENS, tokens), modelo='gpt-4o-mini')
+    memoria = {
+        'mensagens': [
+            {'role': role, 'content': content, 'timestamp': datetime.now().isoformat()}
+            for role, content in conteudos
+        ],
+        'resumo': '',
+        'nao_resumidas': [],
+        'ultima_atualizacao': datetime.now().isoformat(),
+        'contador_mensagens': len(conteudos)
+    }
+    return contador, contador_tokens, memoria
+
+def montar_antigo(usuarios, conteudos, tokens, janela_inicio):
+    tabelas = ({}, {}, {})
+    for user_id in usuarios:
+        for tabela, registro in zip(tabelas, usuario_antigo(conteudos, tokens, janela_inicio)):
+            tabela[user_id] = registro
+    return tabelas
+
+def varrer_antigo(memorias):
+    agora = datetime.now()
+    return [user_id for user_id, memoria in memorias.items()
+            if (agora - datetime.fromisoformat(memoria['ultima_atualizacao'])).total_seconds() > 3600]
+
+# =============================================================================
+# 👤 FORMATO NOVO
+# =============================================================================
+
+def varrer_novo(usuarios):
+    limite = time.monotonic() - 3600
+    return [user_id for user_id, estado in usuarios.items()
+            if estado.turnos is not None and estado.atualizado_em < limite]
+
+def montar_novo(usuarios, conteudos, tokens):
+    for user_id in usuarios:
+        estado = main.estado_usuario(user_id)
+        estado.iniciar_contador('starter')
+        estado.total = len(conteudos)
+        estado.somar_tokens(tokens, 'gpt-4o-mini')
+        for role, content in conteudos:
+            estado.adicionar_turno(role, content)
+        del estado.nao_resumidas[:]  # já resumidas, como no formato antigo
+    return main.USUARIOS
+
+# =============================================================================
+# ⏱️ MEDIÇÃO
+# =============================================================================
+
+def medir_memoria(funcao, *args):
+    gc.collect()
+    tracemalloc.start()
+    resultado = funcao(*args)
+    atual, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return resultado, atual
+
+def cronometrar(funcao, repeticoes=3):
+    melhor = float('inf')
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao()
+        melhor = min(melhor, time.perf_counter() - inicio)
+    return melhor * 1000
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Memória por usuário: registro compacto vs dicts aninhados")
+    parser.add_argument('--usuarios', type=int, default=100000)
+    args = parser.parse_args()
+
+    usuarios = [f'usuario-{i:08d}' for i in range(args.usuarios)]
+    conteudos = [('user' if i % 2 == 0 else 'assistant', f'mensagem {i} ' * 8)
+                 for i in range(main.MAX_MENSAGENS_MEMORIA)]
+    tokens = (9000, 4000, 13000, 2500, main.MAX_MENSAGENS_MEMORIA // 2, 1)
+    janela_inicio = main.janela_vigente('starter')[0]
+
+    antigo, bytes_antigo = medir_memoria(montar_antigo, usuarios, conteudos, tokens, janela_inicio)
+    novo, bytes_novo = medir_memoria(montar_novo, usuarios, conteudos, tokens)
+
+    print(f"👥 {args.usuarios} usuários, {main.MAX_MENSAGENS_MEMORIA} turnos cada (texto não contado)")
+    print(f"🐢 3 dicts aninhados + ISO: {bytes_antigo / 1024 / 1024:7.1f} MB | {bytes_antigo / args.usuarios:6.0f} B/usuário")
+    print(f"👤 EstadoUsuario:            {bytes_novo / 1024 / 1024:7.1f} MB | {bytes_novo / args.usuarios:6.0f} B/usuário")
+    print(f"📉 {bytes_antigo / bytes_novo:.1f}x menos memória")
+
+    varredura_antiga = cronometrar(lambda: varrer_antigo(antigo[2]))
+    varredura_nova = cronometrar(lambda: varrer_novo(novo))
+    print(f"🧹 varredura de conversas paradas: ISO {varredura_antiga:7.1f} ms | float {varredura_nova:7.1f} ms")
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,178 @@
+"""
+✨ BENCHMARK + VERIFICAÇÃO - limpeza de markdown
+
+Compara a limpeza antiga (7 re.sub + 4 str.replace em sequência) com o
+tokenizador de uma passada do main.py em respostas de 1 a 4 KB, e verifica
+por propriedades (entradas aleatórias) que:
+  1. em markdown bem formado as duas dão o mesmo texto;
+  2. URLs, e-mails e identificador_com_underscore saem intactos;
+  3. o LimpadorMarkdownIncremental, com o texto picado em pedaços aleatórios
+     (como chega do streaming), entrega o mesmo que a limpeza do texto inteiro.
+
+Uso:
+    python bench/bench_markdown.py --casos 2000 --repeticoes 200
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+PALAVRAS = (
+    'site plano starter professional hospedagem domínio suporte prazo design responsivo '
+    'página cliente contato projeto entrega valor mensal anual SEO Google integração '
+    'formulário blog loja vitrine pagamento Pix cartão atendimento Natan'
+).split()
+
+URLS = ['https://natansites.com.br', 'https://mathworkftv.netlify.app', 'www.tafsemtabu.com.br',
+        'https://exemplo.com/~natan/pagina_1?ref=a_b', 'https://api.site.dev/v1/itens_ativos']
+EMAILS = ['borgesnatan09@gmail.com', 'contato_site@natansites.com.br', 'suporte+pix@exemplo.dev']
+IDENTIFICADORES = ['snake_case', 'arquivo_principal.py', 'meu_site_v2', 'NEXT_PUBLIC_URL', 'user_accounts']
+
+# =============================================================================
+# 🐢 LIMPEZA ANTIGA (referência)
+# =============================================================================
+
+def limpar_antiga(texto):
+    if not texto:
+        return texto
+    texto = re.sub(r'\*\*([^*]+)\*\*', r'\1', texto)
+    texto = re.sub(r'\*([^*]+)\*', r'\1', texto)
+    texto = re.sub(r'__([^_]+)__', r'\1', texto)
+    texto = re.sub(r'_([^_]+)_', r'\1', texto)
+    texto = re.sub(r'`([^`]+)`', r'\1', texto)
+    texto = texto.replace('´', '').replace('~', '').replace('^', '').replace('¨', '')
+    texto = re.sub(r'\n{3,}', '\n\n', texto)
+    return texto.strip()
+
+# =============================================================================
+# 🎲 GERADORES
+# =============================================================================
+
+def frase(rng, n=None):
+    return ' '.join(rng.choice(PALAVRAS) for _ in range(n or rng.randint(1, 5)))
+
+def trecho_bem_formado(rng):
+    """Ênfase/código em volta de palavras inteiras, sem marcadores soltos"""
+    tipo = rng.randrange(7)
+    if tipo == 0:
+        return f'**{frase(rng)}**'
+    if tipo == 1:
+        return f'*{frase(rng)}*'
+    if tipo == 2:
+        return f'__{frase(rng)}__'
+    if tipo == 3:
+        return f'_{frase(rng)}_'
+    if tipo == 4:
+        return f'`{frase(rng, 1)}`'
+    return frase(rng)
+
+def resposta_bem_formada(rng, tamanho):
+    partes = []
+    while sum(len(p) for p in partes) < tamanho:
+        linha = ' '.join(trecho_bem_formado(rng) for _ in range(rng.randint(3, 10)))
+        partes.append(linha + rng.choice(['.', '!', ':', '']))
+        partes.append(rng.choice(['\n', '\n\n', '\n\n\n\n', ' ']))
+    return ''.join(partes)
+
+def resposta_com_links(rng, tamanho):
+    """Resposta realista: markdown + URLs, e-mails e identificadores com _ e ~"""
+    partes = []
+    while sum(len(p) for p in partes) < tamanho:
+        escolha = rng.random()
+        if escolha < 0.1:
+            partes.append(rng.choice(URLS))
+        elif escolha < 0.15:
+            partes.append(rng.choice(EMAILS))
+        elif escolha < 0.2:
+            partes.append(rng.choice(IDENTIFICADORES))
+        else:
+            partes.append(trecho_bem_formado(rng))
+        partes.append(rng.choice([' ', ' ', ' ', '\n', '\n\n']))
+    return ''.join(partes)
+
+def picar(rng, texto):
+    """Divide o texto em pedaços de 1 a 12 caracteres, como deltas de streaming"""
+    pedacos, i = [], 0
+    while i < len(texto):
+        n = rng.randint(1, 12)
+        pedacos.append(texto[i:i + n])
+        i += n
+    return pedacos
+
+def limpar_em_stream(pedacos):
+    limpador = main.LimpadorMarkdownIncremental()
+    saida = [limpador.alimentar(p) for p in pedacos]
+    saida.append(limpador.finalizar())
+    return ''.join(saida)
+
+# =============================================================================
+# ✅ VERIFICAÇÃO
+# =============================================================================
+
+def verificar(casos, semente):
+    rng = random.Random(semente)
+    falhas = {'equivalencia': 0, 'preservacao': 0, 'stream': 0}
+    exemplos = {}
+
+    for _ in range(casos):
+        texto = resposta_bem_formada(rng, rng.randint(40, 600))
+        if main.limpar_formatacao_markdown(texto) != limpar_antiga(texto):
+            falhas['equivalencia'] += 1
+            exemplos.setdefault('equivalencia', texto)
+
+        texto = resposta_com_links(rng, rng.randint(40, 600))
+        limpo = main.limpar_formatacao_markdown(texto)
+        protegidos = [p for p in URLS + EMAILS + IDENTIFICADORES if p in texto]
+        if any(p not in limpo for p in protegidos):
+            falhas['preservacao'] += 1
+            exemplos.setdefault('preservacao', texto)
+
+        if limpar_em_stream(picar(rng, texto)) != limpo:
+            falhas['stream'] += 1
+            exemplos.setdefault('stream', texto)
+
+    for nome, total in falhas.items():
+        print(f"{'✅' if not total else '❌'} {nome}: {casos - total}/{casos}")
+        if nome in exemplos:
+            print(f"   exemplo: {exemplos[nome][:200]!r}")
+    return not any(falhas.values())
+
+# =============================================================================
+# ⏱️ MEDIÇÃO
+# =============================================================================
+
+def cronometrar(funcao, textos, repeticoes):
+    inicio = time.perf_counter()
+    for _ in range(repeticoes):
+        for texto in textos:
+            funcao(texto)
+    return (time.perf_counter() - inicio) / (repeticoes * len(textos)) * 1e6
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Benchmark e verificação da limpeza de markdown")
+    parser.add_argument('--casos', type=int, default=2000, help="entradas aleatórias por propriedade")
+    parser.add_argument('--repeticoes', type=int, default=200)
+    parser.add_argument('--semente', type=int, default=7)
+    args = parser.parse_args()
+
+    ok = verificar(args.casos, args.semente)
+
+    rng = random.Random(args.semente)
+    print()
+    for kb in (1, 2, 4):
+        textos = [resposta_com_links(rng, kb * 1024) for _ in range(20)]
+        antiga = cronometrar(limpar_antiga, textos, args.repeticoes)
+        nova = cronometrar(main.limpar_formatacao_markdown, textos, args.repeticoes)
+        print(f"📄 {kb} KB: antiga {antiga:8.1f} µs | uma passada {nova:8.1f} µs | {antiga / nova:5.2f}x")
+
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,155 @@
+"""
+🪃 BENCHMARK - hedge de chamadas OpenAI sob concorrência
+
+Troca o client do main.py por um falso (latência fixa + cauda lenta) e dispara
+C requisições simultâneas em criar_completion_com_prazo, com o p95 já
+aprendido, comparando:
+  - o hedge antigo: principal e cópia no mesmo pool de 32 threads (a espera na
+    fila conta como lentidão e dispara cópias à toa);
+  - o hedge do main.py: principal numa thread própria, só a cópia no pool.
+Relata p50 / máx da latência vista pela requisição e as cópias disparadas. O
+p50 deve ficar no patamar da latência do upstream com 8 ou com 96 simultâneas.
+
+Uso:
+    python bench/bench_prazo.py --concorrencia 8 96 --latencia 1.0
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+MODELO = 'gpt-4o-mini'
+
+# =============================================================================
+# 🧪 UPSTREAM FALSO
+# =============================================================================
+
+class CompletionsFalso:
+    """Responde depois de `latencia` s; uma fração `cauda` demora `lenta` s"""
+
+    def __init__(self, latencia, lenta, cauda, semente=7):
+        self.latencia = latencia
+        self.lenta = lenta
+        self.cauda = cauda
+        self.gerador = random.Random(semente)
+        self.lock = threading.Lock()
+        self.chamadas = 0
+
+    def create(self, model, messages, max_tokens, temperature, timeout):
+        with self.lock:
+            self.chamadas += 1
+            lenta = self.gerador.random() < self.cauda
+        time.sleep(self.lenta if lenta else self.latencia * random.uniform(0.9, 1.1))
+        uso = SimpleNamespace(total_tokens=100, prompt_tokens=80, completion_tokens=20)
+        return SimpleNamespace(usage=uso, model=model)
+
+def instalar_upstream(args):
+    completions = CompletionsFalso(args.latencia, args.lenta, args.cauda)
+    main.client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+    return completions
+
+# =============================================================================
+# 🐢 HEDGE ANTIGO (referência)
+# =============================================================================
+
+EXECUTOR_ANTIGO = ThreadPoolExecutor(max_workers=32, thread_name_prefix='hedge-antigo')
+
+def criar_completion_antiga(modelo, messages, max_tokens, prazo):
+    """Como antes: principal e cópia no mesmo pool limitado"""
+    p95 = main.historico_latencia(modelo).percentil(main.HEDGE_CONFIG['percentil'])
+    atraso = max(p95, main.HEDGE_CONFIG['atraso_minimo'])
+    principal = EXECUTOR_ANTIGO.submit(main.executar_chamada_cronometrada, modelo, messages, max_tokens, prazo)
+    feitas, _ = wait([principal], timeout=atraso)
+    if feitas or not main.SEMAFORO_HEDGE.acquire(blocking=False):
+        return principal.result(timeout=prazo.restante())
+    main.contar_metrica_prazo('hedges_disparados')
+    copia = EXECUTOR_ANTIGO.submit(main.executar_chamada_cronometrada, modelo, messages, max_tokens, prazo)
+    copia.add_done_callback(lambda _: main.SEMAFORO_HEDGE.release())
+    feitas, _ = wait({principal, copia}, timeout=prazo.restante(), return_when=FIRST_COMPLETED)
+    return next(iter(feitas)).result()
+
+# =============================================================================
+# ⏱️ MEDIÇÃO
+# =============================================================================
+
+def percentil(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+def preparar(args):
+    """p95 aprendido com a latência real do upstream, métricas zeradas"""
+    with main.latencias_lock:
+        main.LATENCIAS_MODELOS.clear()
+    historico = main.historico_latencia(MODELO)
+    gerador = random.Random(3)
+    for _ in range(200):
+        lenta = gerador.random() < args.cauda
+        historico.registrar(args.lenta if lenta else args.latencia * gerador.uniform(0.9, 1.1))
+    with main.metricas_prazo_lock:
+        for nome in ('hedges_disparados', 'hedges_vencedores', 'tokens_hedge_descartados'):
+            main.METRICAS_PRAZO[nome] = 0
+
+def medir(nome, criar_completion, concorrencia, args):
+    preparar(args)
+    messages = [{'role': 'user', 'content': 'quanto custa um site?'}]
+    latencias, latencias_lock = [], threading.Lock()
+
+    def requisicao():
+        for _ in range(args.rodadas):
+            prazo = main.Prazo(args.prazo)
+            inicio = time.monotonic()
+            criar_completion(MODELO, messages, 50, prazo)
+            with latencias_lock:
+                latencias.append(time.monotonic() - inicio)
+
+    threads = [threading.Thread(target=requisicao) for _ in range(concorrencia)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    hedges = main.obter_metricas_prazo()['hedges_disparados']
+    p50 = percentil(latencias, 0.5)
+    print(f"{nome} C={concorrencia:3d}: p50 {p50:5.2f}s | p95 {percentil(latencias, 0.95):5.2f}s | "
+          f"máx {max(latencias):5.2f}s | {hedges:3d} cópias em {len(latencias)} chamadas")
+    return p50
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Hedge de chamadas OpenAI sob concorrência")
+    parser.add_argument('--concorrencia', type=int, nargs='+', default=[8, 96])
+    parser.add_argument('--rodadas', type=int, default=3, help="chamadas seguidas por requisição simultânea")
+    parser.add_argument('--latencia', type=float, default=1.0, help="latência normal do upstream (s)")
+    parser.add_argument('--lenta', type=float, default=4.0, help="latência da cauda (s)")
+    parser.add_argument('--cauda', type=float, default=0.03, help="fração de chamadas lentas")
+    parser.add_argument('--prazo', type=float, default=20.0)
+    parser.add_argument('--sem-antigo', action='store_true', help="mede só o hedge do main.py")
+    args = parser.parse_args()
+
+    instalar_upstream(args)
+    main.HEDGE_CONFIG['ativo'] = True
+    print(f"🧪 upstream: {args.latencia:.1f}s, {args.cauda:.0%} em {args.lenta:.1f}s | "
+          f"{main.HEDGE_CONFIG['max_simultaneos']} cópias no máximo")
+
+    p50s = []
+    for concorrencia in args.concorrencia:
+        if not args.sem_antigo:
+            medir("🐢 pool único  ", criar_completion_antiga, concorrencia, args)
+        p50s.append(medir("🪃 só a cópia  ", main.criar_completion_com_prazo, concorrencia, args))
+
+    # p50 estável: a concorrência não vira fila (tolerância de 25% da latência)
+    ok = max(p50s) - min(p50s) <= args.latencia * 0.25
+    print(f"{'✅' if ok else '❌'} p50 estável entre concorrências: "
+          + ', '.join(f"C={c} {p:.2f}s" for c, p in zip(args.concorrencia, p50s)))
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main_bench()
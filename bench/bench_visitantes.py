@@ -0,0 +1,151 @@
+"""
+🌊 BENCHMARK + VERIFICAÇÃO - limitador de visitantes sob enxurrada de browser_id
+
+Simula um script mandando uma mensagem por browser_id aleatório e compara:
+  - a tabela antiga (um dict com duas datas ISO por id, sem expiração);
+  - o LimitadorVisitantes do main.py (teto de contadores exatos + sketch).
+Mede a memória (tracemalloc) e o custo de verificar+incrementar ao longo de
+uma segunda enxurrada (com a tabela já no teto), e verifica que:
+  1. a tabela exata nunca passa de max_exatos;
+  2. um visitante com contador exato para exatamente no limite;
+  3. um id do transbordo (tabela cheia) também para, no máximo, no limite;
+  4. contadores vencidos saem pela roda de expiração;
+  5. um IP só passa `rajada_ip` requisições seguidas.
+
+Uso:
+    python bench/bench_visitantes.py --ids 300000 --max-exatos 50000
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+# =============================================================================
+# 🐢 TABELA ANTIGA (referência)
+# =============================================================================
+
+def contador_antigo():
+    agora = datetime.now()
+    return {
+        'total': 0,
+        'primeiro_uso': agora.isoformat(),
+        'expira_em': (agora + timedelta(hours=24)).isoformat(),
+        'tipo': 'visitante_anonimo'
+    }
+
+def enxurrada_antiga(ids):
+    tabela = {}
+    for browser_id in ids:
+        if browser_id not in tabela:
+            tabela[browser_id] = contador_antigo()
+        tabela[browser_id]['total'] += 1
+    return tabela
+
+# =============================================================================
+# 🌊 LIMITADOR NOVO
+# =============================================================================
+
+def mensagem(browser_id):
+    pode_enviar, _, _, _ = main.verificar_limite_visitante(browser_id)
+    if pode_enviar:
+        main.incrementar_contador_visitante(browser_id)
+    return pode_enviar
+
+def enxurrada_nova(ids, amostras=10):
+    duracoes = []
+    passo = max(1, len(ids) // amostras)
+    inicio = time.perf_counter()
+    for i, browser_id in enumerate(ids, 1):
+        mensagem(browser_id)
+        if i % passo == 0:
+            duracoes.append((i, (time.perf_counter() - inicio) / passo * 1e6))
+            inicio = time.perf_counter()
+    return duracoes
+
+def medir_memoria(funcao, *args):
+    tracemalloc.start()
+    resultado = funcao(*args)
+    atual, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return resultado, atual / 1024 / 1024
+
+# =============================================================================
+# ✅ VERIFICAÇÕES
+# =============================================================================
+
+def verificar_limite(browser_id, tentativas):
+    limite = main.VISITANTE_ANONIMO_CONFIG['limite_mensagens']
+    aceitas = sum(mensagem(browser_id) for _ in range(tentativas))
+    return aceitas, limite
+
+def verificar_expiracao():
+    limitador = main.LIMITADOR_VISITANTES
+    agora = time.time()
+    with main.visitantes_lock:
+        antes = len(main.CONTADOR_VISITANTES)
+        # Todos os contadores vencem agora: a roda deve esvaziar a tabela ao girar um dia
+        for contador in main.CONTADOR_VISITANTES.values():
+            contador['expira_em'] = agora - 1
+        limitador.expirar(agora + main.DURACAO_JANELA_VISITANTE + 120)
+        depois = len(main.CONTADOR_VISITANTES)
+    return antes, depois
+
+def verificar_rajada(tentativas):
+    rajada = main.LimiteRajadaIP(1000, main.LIMITADOR_VISITANTES_CONFIG['rajada_ip'],
+                                 main.LIMITADOR_VISITANTES_CONFIG['reposicao_ip_segundos'])
+    aceitas = sum(1 for _ in range(tentativas) if rajada.permitir('203.0.113.7') == 0)
+    return aceitas, rajada.rajada
+
+def main_bench():
+    parser = argparse.ArgumentParser(description="Limitador de visitantes sob enxurrada de ids")
+    parser.add_argument('--ids', type=int, default=300000)
+    parser.add_argument('--max-exatos', type=int, default=50000)
+    args = parser.parse_args()
+
+    main.LIMITADOR_VISITANTES.max_exatos = args.max_exatos
+    ids = [uuid.uuid4().hex for _ in range(args.ids)]
+
+    _, memoria_antiga = medir_memoria(enxurrada_antiga, ids)
+    _, memoria_nova = medir_memoria(enxurrada_nova, ids)
+    # Segunda enxurrada sem tracemalloc (que distorce o tempo), já com a tabela cheia
+    duracoes = enxurrada_nova([uuid.uuid4().hex for _ in range(args.ids)])
+
+    print(f"🌊 {args.ids} browser_ids aleatórios (teto exato {args.max_exatos})")
+    print(f"🐢 tabela antiga: {memoria_antiga:7.1f} MB, {args.ids} contadores")
+    print(f"🌊 limitador:     {memoria_nova:7.1f} MB, {len(main.CONTADOR_VISITANTES)} exatos + sketch "
+          f"({main.LIMITADOR_VISITANTES.estatisticas()['sketch_bytes'] // 1024} KB)")
+    print("⏱️ verificar+incrementar na 2ª enxurrada (µs): "
+          + ', '.join(f"{i // 1000}k={d:.1f}" for i, d in duracoes))
+
+    ok = len(main.CONTADOR_VISITANTES) <= args.max_exatos
+    print(f"{'✅' if ok else '❌'} tabela exata dentro do teto")
+
+    # Transbordo: tabela cheia, id novo
+    aceitas, limite = verificar_limite('transbordo-' + uuid.uuid4().hex, limite_tentativas := 80)
+    ok_transbordo = aceitas <= limite
+    print(f"{'✅' if ok_transbordo else '❌'} transbordo: {aceitas}/{limite_tentativas} aceitas (limite {limite}, sketch só erra para mais)")
+
+    antes, depois = verificar_expiracao()
+    ok_expiracao = depois == 0
+    print(f"{'✅' if ok_expiracao else '❌'} roda de expiração: {antes} -> {depois} contadores")
+
+    aceitas, limite = verificar_limite('exato-' + uuid.uuid4().hex, 80)
+    ok_exato = aceitas == limite
+    print(f"{'✅' if ok_exato else '❌'} contador exato: {aceitas}/80 aceitas (limite {limite})")
+
+    aceitas, rajada = verificar_rajada(100)
+    ok_rajada = aceitas == rajada
+    print(f"{'✅' if ok_rajada else '❌'} rajada por IP: {aceitas}/100 seguidas (rajada {rajada})")
+
+    sys.exit(0 if ok and ok_transbordo and ok_expiracao and ok_exato and ok_rajada else 1)
+
+if __name__ == '__main__':
+    main_bench()
@@ -0,0 +1,350 @@
+"""
+📈 TESTE DE CARGA - /api/chat com carga mista por plano
+
+Dispara requisições concorrentes contra o main.py (de preferência apontado para o
+upstream simulado, ver bench/upstream_simulado.py) e relata vazão, latência
+p50/p95/p99 por plano, tempo até o 1º trecho no streaming e o tempo de cada
+etapa do servidor (header Server-Timing: preparo, memoria, ia, finalizacao).
+
+Uso:
+    python bench/upstream_simulado.py --silencioso &
+    OPENAI_BASE_URL=http://127.0.0.1:8787/v1 ... python main.py &
+    python bench/teste_carga.py --url http://127.0.0.1:5000 --duracao 60 --concorrencia 32 \\
+        --mix visitante=40,free=20,starter=20,professional=15,admin=5 --json resultado.json
+
+Com --autenticacao token os usuários são autenticados pelo Supabase simulado
+(token "simulado.<plano>.<número>"); o padrão manda user_data no corpo.
+O resultado em JSON serve de linha de base para comparar mudanças de desempenho.
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# =============================================================================
+# 🔧 CARGA PADRÃO
+# =============================================================================
+MIX_PADRAO = 'visitante=40,free=20,starter=20,professional=15,admin=5'
+EMAIL_ADMIN = 'natan@natandev.com'  # mesmo ADMIN_EMAIL do main.py
+MENSAGENS_POR_VISITANTE = 40        # abaixo do limite de 50/24h do main.py
+
+# Perguntas que chegam repetidas (link de campanha, dúvidas frequentes)
+MENSAGENS_POPULARES = [
+    "Oi, quanto custa um site?",
+    "Quais são os planos?",
+    "Como funciona a hospedagem?",
+    "Qual o prazo de entrega?",
+    "Vocês fazem loja virtual?",
+    "Como falo com o suporte?"
+]
+
+# Perguntas únicas montadas a partir de partes (quase nunca se repetem)
+NEGOCIOS = ['padaria', 'clínica odontológica', 'escritório de advocacia', 'pet shop', 'academia',
+            'loja de roupas', 'restaurante japonês', 'estúdio de tatuagem', 'imobiliária', 'escola de idiomas']
+PEDIDOS = [
+    "Preciso de um site para minha {negocio}, qual plano vocês recomendam e por quê?",
+    "Minha {negocio} precisa aparecer no Google, como o site ajuda nisso? Explique em detalhes.",
+    "Qual a diferença entre o Starter e o Professional para uma {negocio}?",
+    "Dá para integrar agendamento online no site da minha {negocio}?",
+    "Compare um site próprio com só ter Instagram para uma {negocio}."
+]
+
+# =============================================================================
+# 🧮 ESTATÍSTICAS
+# =============================================================================
+
+def percentil(valores, p):
+    """Percentil por posição (nearest-rank) de uma lista de valores"""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, max(0, int(round(p / 100 * len(ordenados))) - 1))]
+
+def resumo_latencias(valores):
+    if not valores:
+        return {'n': 0}
+    return {
+        'n': len(valores),
+        'media_ms': round(sum(valores) / len(valores), 1),
+        'p50_ms': round(percentil(valores, 50), 1),
+        'p95_ms': round(percentil(valores, 95), 1),
+        'p99_ms': round(percentil(valores, 99), 1),
+        'max_ms': round(max(valores), 1)
+    }
+
+def ler_server_timing(cabecalho):
+    """'preparo;dur=1.2, ia;dur=530.0' -> {'preparo': 1.2, 'ia': 530.0}"""
+    etapas = {}
+    for item in (cabecalho or '').split(','):
+        nome, _, parametros = item.strip().partition(';')
+        for parametro in parametros.split(';'):
+            chave, _, valor = parametro.strip().partition('=')
+            if nome and chave == 'dur':
+                etapas[nome] = float(valor)
+    return etapas
+
+class Resultados:
+    """Amostras coletadas pelas threads (tudo protegido por um lock)"""
+
+    def __init__(self):
+        self.latencias = defaultdict(list)      # perfil -> [ms]
+        self.primeiro_trecho = defaultdict(list)  # perfil -> [ms] (streaming)
+        self.etapas = defaultdict(list)         # etapa -> [ms]
+        self.status = Counter()
+        self.modelos = Counter()
+        self.erros = Counter()
+        self.tokens = 0
+        self.lock = threading.Lock()
+
+    def registrar(self, perfil, latencia_ms, status, payload=None, etapas=None, primeiro_trecho_ms=None):
+        with self.lock:
+            self.status[status] += 1
+            if status != 200:
+                self.erros[f"{perfil}:{status}"] += 1
+                return
+            self.latencias[perfil].append(latencia_ms)
+            if primeiro_trecho_ms is not None:
+                self.primeiro_trecho[perfil].append(primeiro_trecho_ms)
+            for nome, duracao in (etapas or {}).items():
+                self.etapas[nome].append(duracao)
+            if payload:
+                self.modelos[payload.get('modelo_usado', 'N/A')] += 1
+                self.tokens += payload.get('tokens_usados') or 0
+
+    def registrar_falha(self, perfil, erro):
+        with self.lock:
+            self.status['excecao'] += 1
+            self.erros[f"{perfil}:{type(erro).__name__}"] += 1
+
+    def relatorio(self, segundos):
+        with self.lock:
+            todas = [v for valores in self.latencias.values() for v in valores]
+            total = sum(self.status.values())
+            return {
+                'duracao_segundos': round(segundos, 2),
+                'requisicoes': total,
+                'sucesso': self.status.get(200, 0),
+                'vazao_rps': round(total / segundos, 2) if segundos else 0,
+                'latencia': resumo_latencias(todas),
+                'latencia_por_perfil': {perfil: resumo_latencias(v) for perfil, v in sorted(self.latencias.items())},
+                'primeiro_trecho_stream': {perfil: resumo_latencias(v) for perfil, v in sorted(self.primeiro_trecho.items())},
+                'etapas_servidor': {nome: resumo_latencias(v) for nome, v in self.etapas.items()},
+                'status': {str(k): v for k, v in self.status.items()},
+                'erros': dict(self.erros),
+                'modelos': dict(self.modelos.most_common()),
+                'tokens_usados': self.tokens,
+                'tokens_por_requisicao': round(self.tokens / len(todas), 1) if todas else 0
+            }
+
+# =============================================================================
+# 👥 GERADOR DE REQUISIÇÕES
+# =============================================================================
+
+def ler_mix(texto):
+    """'visitante=40,free=20' -> ([perfis], [pesos])"""
+    perfis, pesos = [], []
+    for item in texto.split(','):
+        perfil, peso = item.split('=')
+        perfis.append(perfil.strip())
+        pesos.append(float(peso))
+    return perfis, pesos
+
+def escolher_mensagem(gerador, fracao_populares):
+    if gerador.random() < fracao_populares:
+        return gerador.choice(MENSAGENS_POPULARES)
+    return gerador.choice(PEDIDOS).format(negocio=gerador.choice(NEGOCIOS))
+
+class Trabalhador:
+    """Uma thread de carga: sessão HTTP própria e visitante que se renova antes do limite"""
+
+    def __init__(self, args, indice):
+        self.args = args
+        self.sessao = requests.Session()
+        self.gerador = random.Random(args.semente + indice if args.semente is not None else None)
+        self.browser_id = None
+        self.mensagens_visitante = 0
+
+    def novo_browser_id(self):
+        if self.browser_id is None or self.mensagens_visitante >= MENSAGENS_POR_VISITANTE:
+            self.browser_id = f"carga-{uuid.uuid4().hex[:12]}"
+            self.mensagens_visitante = 0
+        self.mensagens_visitante += 1
+        return self.browser_id
+
+    def montar_requisicao(self, perfil, stream):
+        """Retorna (corpo, cabecalhos) da requisição para o perfil"""
+        corpo = {'message': escolher_mensagem(self.gerador, self.args.fracao_populares)}
+        cabecalhos = {}
+        if stream:
+            corpo['stream'] = True
+
+        if perfil == 'visitante':
+            corpo['browser_id'] = self.novo_browser_id()
+            return corpo, cabecalhos
+
+        numero = self.gerador.randrange(self.args.usuarios_por_plano)
+        if self.args.autenticacao == 'token':
+            cabecalhos['Authorization'] = f"Bearer simulado.{perfil}.{numero}"
+            return corpo, cabecalhos
+
+        corpo['user_data'] = {
+            'user_id': f"{perfil}-{numero}",
+            'email': EMAIL_ADMIN if perfil == 'admin' else f"{perfil}-{numero}@carga.dev",
+            'name': f"Cliente {numero}",
+            'plan': 'starter' if perfil in ('free', 'admin') else perfil,
+            'plan_type': 'free' if perfil == 'free' else 'paid'
+        }
+        return corpo, cabecalhos
+
+    def executar(self, perfil, resultados):
+        stream = self.gerador.random() < self.args.fracao_stream
+        corpo, cabecalhos = self.montar_requisicao(perfil, stream)
+        inicio = time.perf_counter()
+
+        try:
+            resposta = self.sessao.post(f"{self.args.url}/api/chat", json=corpo, headers=cabecalhos,
+                                        timeout=self.args.timeout, stream=stream)
+            if not stream or resposta.status_code != 200:
+                payload = resposta.json() if resposta.headers.get('Content-Type', '').startswith('application/json') else None
+                latencia = (time.perf_counter() - inicio) * 1000
+                resultados.registrar(perfil, latencia, resposta.status_code, payload,
+                                     ler_server_timing(resposta.headers.get('Server-Timing')))
+                return
+
+            primeiro_trecho, payload, evento = None, None, None
+            for linha in resposta.iter_lines(decode_unicode=True):
+                if linha.startswith('event: '):
+                    evento = linha[7:]
+                elif linha.startswith('data: '):
+                    if primeiro_trecho is None:
+                        primeiro_trecho = (time.perf_counter() - inicio) * 1000
+                    if evento == 'fim':
+                        payload = json.loads(linha[6:])
+                    elif evento == 'erro':
+                        raise RuntimeError(linha[6:])
+            latencia = (time.perf_counter() - inicio) * 1000
+            resultados.registrar(perfil, latencia, 200 if payload else 'stream_incompleto', payload,
+                                 primeiro_trecho_ms=primeiro_trecho)
+
+        except Exception as e:
+            resultados.registrar_falha(perfil, e)
+
+# =============================================================================
+# 🚀 CLI
+# =============================================================================
+
+def imprimir_relatorio(relatorio):
+    print("\n" + "=" * 80)
+    print(f"📈 {relatorio['requisicoes']} requisições em {relatorio['duracao_segundos']}s "
+          f"→ {relatorio['vazao_rps']} req/s ({relatorio['sucesso']} com sucesso)")
+    print("=" * 80)
+
+    def linha(nome, r):
+        if not r.get('n'):
+            return f"  {nome:<14} -"
+        return (f"  {nome:<14} n={r['n']:<6} p50={r['p50_ms']:>8.1f}ms  p95={r['p95_ms']:>8.1f}ms  "
+                f"p99={r['p99_ms']:>8.1f}ms  max={r['max_ms']:>8.1f}ms")
+
+    print("⏱️ Latência total")
+    print(linha('geral', relatorio['latencia']))
+    for perfil, r in relatorio['latencia_por_perfil'].items():
+        print(linha(perfil, r))
+
+    if relatorio['primeiro_trecho_stream']:
+        print("📡 Streaming: tempo até o 1º trecho")
+        for perfil, r in relatorio['primeiro_trecho_stream'].items():
+            print(linha(perfil, r))
+
+    if relatorio['etapas_servidor']:
+        print("🧩 Etapas no servidor (Server-Timing)")
+        for etapa, r in relatorio['etapas_servidor'].items():
+            print(linha(etapa, r))
+
+    print(f"🤖 Modelos: {relatorio['modelos']}")
+    print(f"📊 Tokens: {relatorio['tokens_usados']} ({relatorio['tokens_por_requisicao']}/requisição)")
+    print(f"📮 Status: {relatorio['status']}")
+    if relatorio['erros']:
+        print(f"❌ Erros: {relatorio['erros']}")
+
+def criar_parser():
+    parser = argparse.ArgumentParser(description="Teste de carga do /api/chat com carga mista por plano")
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help="endereço do main.py")
+    parser.add_argument('--concorrencia', type=int, default=16, help="requisições simultâneas")
+    parser.add_argument('--duracao', type=float, default=30.0, help="segundos de carga")
+    parser.add_argument('--requisicoes', type=int, default=None, help="para após N requisições (ignora --duracao)")
+    parser.add_argument('--aquecimento', type=float, default=0.0, help="segundos iniciais fora das estatísticas")
+    parser.add_argument('--mix', default=MIX_PADRAO, help="pesos por perfil: visitante, free, starter, professional, admin")
+    parser.add_argument('--fracao-stream', type=float, default=0.0, help="fração das requisições em SSE")
+    parser.add_argument('--fracao-populares', type=float, default=0.3, help="fração de perguntas repetidas")
+    parser.add_argument('--usuarios-por-plano', type=int, default=200)
+    parser.add_argument('--autenticacao', choices=('corpo', 'token'), default='corpo',
+                        help="user_data no corpo ou token do Supabase simulado")
+    parser.add_argument('--timeout', type=float, default=90.0)
+    parser.add_argument('--semente', type=int, default=None, help="torna a sequência de perguntas reprodutível")
+    parser.add_argument('--json', dest='arquivo_json', default=None, help="salva o relatório neste arquivo")
+    return parser
+
+def main():
+    args = criar_parser().parse_args()
+    perfis, pesos = ler_mix(args.mix)
+    args.url = args.url.rstrip('/')
+
+    try:
+        requests.get(f"{args.url}/ping", timeout=5).raise_for_status()
+    except requests.RequestException as e:
+        sys.exit(f"❌ main.py não respondeu em {args.url}: {e}")
+
+    resultados = Resultados()
+    descartados = Resultados()  # amostras do aquecimento
+    emitidas = 0
+    emitidas_lock = threading.Lock()
+    inicio = time.perf_counter()
+    fim = inicio + args.aquecimento + args.duracao
+    inicio_medicao = inicio + args.aquecimento
+
+    def proxima():
+        nonlocal emitidas
+        with emitidas_lock:
+            if args.requisicoes is not None:
+                if emitidas >= args.requisicoes:
+                    return False
+            elif time.perf_counter() >= fim:
+                return False
+            emitidas += 1
+            return True
+
+    def laco(indice):
+        trabalhador = Trabalhador(args, indice)
+        while proxima():
+            perfil = trabalhador.gerador.choices(perfis, pesos)[0]
+            destino = resultados if time.perf_counter() >= inicio_medicao else descartados
+            trabalhador.executar(perfil, destino)
+
+    print(f"🚀 {args.concorrencia} clientes simultâneos contra {args.url} (mix: {args.mix})")
+    with ThreadPoolExecutor(max_workers=args.concorrencia) as executor:
+        for indice in range(args.concorrencia):
+            executor.submit(laco, indice)
+
+    relatorio = resultados.relatorio(time.perf_counter() - inicio_medicao)
+    relatorio['configuracao'] = {k: v for k, v in vars(args).items() if k != 'arquivo_json'}
+    try:
+        relatorio['health'] = requests.get(f"{args.url}/health", timeout=10).json()
+    except (requests.RequestException, ValueError):
+        relatorio['health'] = None
+
+    imprimir_relatorio(relatorio)
+    if args.arquivo_json:
+        with open(args.arquivo_json, 'w', encoding='utf-8') as arquivo:
+            json.dump(relatorio, arquivo, ensure_ascii=False, indent=2)
+        print(f"💾 Relatório salvo em {args.arquivo_json}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,449 @@
+"""
+🧪 UPSTREAM SIMULADO - OpenAI + Supabase offline para benchmark do main.py
+
+Servidor local (só biblioteca padrão) que fala o subconjunto de APIs que o
+main.py usa, com latência, tokens, erros e streaming configuráveis:
+
+- OpenAI:   POST /v1/chat/completions (normal e stream SSE com include_usage)
+            POST /v1/embeddings
+- Supabase: GET  /auth/v1/user                (token "simulado.<plano>.<número>")
+            GET  /rest/v1/user_accounts?user_id=eq.<id>
+- Controle: GET  /_simulado/estatisticas      (chamadas, tokens e erros injetados)
+
+Uso:
+    python bench/upstream_simulado.py --porta 8787 --taxa-429 0.02 --taxa-500 0.01
+
+    OPENAI_API_KEY=sk-simulado-000000000000000000000000 \\
+    OPENAI_BASE_URL=http://127.0.0.1:8787/v1 \\
+    SUPABASE_URL=http://127.0.0.1:8787 \\
+    SUPABASE_KEY=simulado.simulado.simulado \\
+    python main.py
+
+Distribuições de latência (--latencia MODELO=DIST, repetível):
+    fixa:0.3 | uniforme:0.2:0.8 | normal:0.5:0.1 | lognormal:MEDIANA:SIGMA | exp:MEDIA
+A latência sorteada é o tempo até o 1º token; depois cada token leva
+1/--tokens-por-segundo do modelo (stream e não-stream).
+"""
+
+import argparse
+import json
+import math
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# =============================================================================
+# 🔧 CONFIGURAÇÃO PADRÃO
+# =============================================================================
+LATENCIA_PADRAO = {
+    'gpt-4o-mini': 'lognormal:0.45:0.35',
+    'gpt-4o': 'lognormal:1.2:0.4',
+    'text-embedding-3-small': 'fixa:0.08'
+}
+TOKENS_POR_SEGUNDO_PADRAO = {
+    'gpt-4o-mini': 90.0,
+    'gpt-4o': 45.0
+}
+EMAIL_ADMIN = 'natan@natandev.com'  # mesmo ADMIN_EMAIL do main.py
+PLANOS_SIMULADOS = ('free', 'starter', 'professional', 'admin')
+TAMANHO_BLOCO_CACHE = 128           # a OpenAI cacheia o prefixo em blocos de 128 tokens
+MINIMO_CACHE_PROMPT = 1024
+
+PALAVRAS_RESPOSTA = (
+    "o site fica pronto em poucos dias com hospedagem inclusa e suporte pelo "
+    "whatsapp você pode escolher o plano starter ou professional conforme o "
+    "tamanho do projeto todas as páginas são responsivas e otimizadas para "
+    "aparecer bem no google qualquer dúvida é só chamar"
+).split()
+
+# =============================================================================
+# 🎲 DISTRIBUIÇÕES DE LATÊNCIA
+# =============================================================================
+
+def criar_distribuicao(especificacao):
+    """Converte 'tipo:p1:p2' em uma função sem argumentos que sorteia segundos"""
+    tipo, *parametros = especificacao.split(':')
+    valores = [float(p) for p in parametros]
+
+    if tipo == 'fixa':
+        return lambda: valores[0]
+    if tipo == 'uniforme':
+        return lambda: random.uniform(valores[0], valores[1])
+    if tipo == 'normal':
+        return lambda: max(0.0, random.gauss(valores[0], valores[1]))
+    if tipo == 'lognormal':
+        mu = math.log(valores[0])
+        return lambda: random.lognormvariate(mu, valores[1])
+    if tipo == 'exp':
+        return lambda: random.expovariate(1 / valores[0])
+    raise ValueError(f"Distribuição desconhecida: {especificacao}")
+
+def ler_pares(itens, conversor):
+    """['modelo=valor', ...] -> {modelo: conversor(valor)}"""
+    pares = {}
+    for item in itens or []:
+        modelo, valor = item.split('=', 1)
+        pares[modelo.strip()] = conversor(valor.strip())
+    return pares
+
+# =============================================================================
+# 📊 ESTADO DO SIMULADOR
+# =============================================================================
+
+class Simulador:
+    """Configuração + contadores compartilhados pelas threads do servidor"""
+
+    def __init__(self, args):
+        latencias = dict(LATENCIA_PADRAO)
+        latencias.update(ler_pares(args.latencia, str))
+        self.latencias = {modelo: criar_distribuicao(d) for modelo, d in latencias.items()}
+        self.latencia_padrao = criar_distribuicao(args.latencia_padrao)
+
+        self.tokens_por_segundo = dict(TOKENS_POR_SEGUNDO_PADRAO)
+        self.tokens_por_segundo.update(ler_pares(args.tokens_por_segundo, float))
+
+        self.tokens_resposta = tuple(int(v) for v in args.tokens_resposta.split(':'))
+        self.taxa_acerto_cache = args.taxa_acerto_cache
+        self.taxa_429 = args.taxa_429
+        self.taxa_500 = args.taxa_500
+        self.taxa_travada = args.taxa_travada
+        self.segundos_travada = args.segundos_travada
+        self.retry_after = args.retry_after
+        self.latencia_supabase = criar_distribuicao(args.latencia_supabase)
+        self.email_admin = args.email_admin
+        self.silencioso = args.silencioso
+
+        self.contadores = Counter()
+        self.lock = threading.Lock()
+
+    def contar(self, **incrementos):
+        with self.lock:
+            self.contadores.update(incrementos)
+
+    def sortear_latencia(self, modelo):
+        return self.latencias.get(modelo, self.latencia_padrao)()
+
+    def sortear_falha(self):
+        """None, '429', '500' ou 'travada' conforme as taxas configuradas"""
+        sorteio = random.random()
+        for falha, taxa in (('429', self.taxa_429), ('500', self.taxa_500), ('travada', self.taxa_travada)):
+            if sorteio < taxa:
+                return falha
+            sorteio -= taxa
+        return None
+
+    def estatisticas(self):
+        with self.lock:
+            return dict(self.contadores)
+
+# =============================================================================
+# 🔢 TOKENS E TEXTO
+# =============================================================================
+
+def estimar_tokens(texto):
+    return max(1, len(texto) // 4)
+
+def contar_tokens_prompt(messages):
+    return sum(estimar_tokens(str(m.get('content', ''))) + 4 for m in messages) + 3
+
+def calcular_tokens_cache(simulador, messages, prompt_tokens):
+    """Prefixo estável (1ª mensagem de sistema) cacheado em blocos de 128, como a OpenAI"""
+    if prompt_tokens < MINIMO_CACHE_PROMPT or random.random() >= simulador.taxa_acerto_cache:
+        return 0
+    prefixo = contar_tokens_prompt(messages[:1]) if messages and messages[0].get('role') == 'system' else 0
+    return (min(prefixo, prompt_tokens) // TAMANHO_BLOCO_CACHE) * TAMANHO_BLOCO_CACHE
+
+def gerar_pedacos(modelo, quantidade):
+    """~1 token por pedaço, como no streaming real"""
+    pedacos = [f"Resposta simulada ({modelo}):"]
+    while len(pedacos) < quantidade:
+        pedacos.append(' ' + random.choice(PALAVRAS_RESPOSTA))
+    return pedacos[:max(1, quantidade)]
+
+def montar_uso(prompt_tokens, completion_tokens, cached_tokens):
+    return {
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'total_tokens': prompt_tokens + completion_tokens,
+        'prompt_tokens_details': {'cached_tokens': cached_tokens}
+    }
+
+# =============================================================================
+# 🌐 SERVIDOR HTTP
+# =============================================================================
+
+class ManipuladorSimulado(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive: o httpx do SDK reaproveita conexões
+    simulador = None
+
+    def log_message(self, formato, *args):
+        if not self.simulador.silencioso:
+            sys.stderr.write(f"🧪 {self.address_string()} {formato % args}\n")
+
+    # ---------------------------------------------------------------- helpers
+    def ler_json(self):
+        tamanho = int(self.headers.get('Content-Length') or 0)
+        corpo = self.rfile.read(tamanho) if tamanho else b'{}'
+        return json.loads(corpo or b'{}')
+
+    def responder_json(self, status, dados, cabecalhos=None):
+        corpo = json.dumps(dados, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(corpo)))
+        for nome, valor in (cabecalhos or {}).items():
+            self.send_header(nome, valor)
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def enviar_bloco(self, dados):
+        """Transfer-Encoding: chunked (o stream SSE não tem tamanho conhecido)"""
+        self.wfile.write(f"{len(dados):X}\r\n".encode() + dados + b"\r\n")
+        self.wfile.flush()
+
+    def injetar_falha(self, rota):
+        """Responde com o erro sorteado; retorna True se a requisição já foi respondida"""
+        falha = self.simulador.sortear_falha()
+        if falha is None:
+            return False
+
+        self.simulador.contar(**{f'erros_{falha}': 1, f'erros_{rota}': 1})
+        if falha == 'travada':
+            time.sleep(self.simulador.segundos_travada)  # cliente deve estourar o timeout antes
+            self.responder_json(504, {'error': {'message': 'Upstream travado (simulado)', 'type': 'server_error'}})
+        elif falha == '429':
+            self.responder_json(429, {
+                'error': {'message': 'Rate limit reached (simulado)', 'type': 'requests', 'code': 'rate_limit_exceeded'}
+            }, {'retry-after': str(self.simulador.retry_after)})
+        else:
+            self.responder_json(500, {'error': {'message': 'Internal server error (simulado)', 'type': 'server_error'}})
+        return True
+
+    # ---------------------------------------------------------------- rotas
+    def do_POST(self):
+        rota = urlparse(self.path).path
+        corpo = self.ler_json()
+
+        if rota.endswith('/chat/completions'):
+            return self.chat_completions(corpo)
+        if rota.endswith('/embeddings'):
+            return self.embeddings(corpo)
+        self.responder_json(404, {'error': {'message': f'Rota não simulada: {rota}'}})
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.ler_json()  # o postgrest manda "{}" até no GET: sobra no keep-alive se não for lido
+
+        if url.path == '/auth/v1/user':
+            return self.auth_usuario()
+        if url.path == '/rest/v1/user_accounts':
+            return self.user_accounts(parse_qs(url.query))
+        if url.path == '/_simulado/estatisticas':
+            return self.responder_json(200, self.simulador.estatisticas())
+        self.responder_json(404, {'message': f'Rota não simulada: {url.path}'})
+
+    # ---------------------------------------------------------------- OpenAI
+    def chat_completions(self, corpo):
+        modelo = corpo.get('model', 'gpt-4o-mini')
+        messages = corpo.get('messages', [])
+        stream = bool(corpo.get('stream'))
+        self.simulador.contar(**{'chat_completions': 1, f'modelo_{modelo}': 1, 'stream' if stream else 'nao_stream': 1})
+
+        if self.injetar_falha('chat'):
+            return
+
+        prompt_tokens = contar_tokens_prompt(messages)
+        minimo, maximo = self.simulador.tokens_resposta
+        completion_tokens = min(random.randint(minimo, maximo), corpo.get('max_tokens') or maximo)
+        cached_tokens = calcular_tokens_cache(self.simulador, messages, prompt_tokens)
+        pedacos = gerar_pedacos(modelo, completion_tokens)
+        completion_tokens = len(pedacos)
+        uso = montar_uso(prompt_tokens, completion_tokens, cached_tokens)
+        self.simulador.contar(tokens_entrada=prompt_tokens, tokens_saida=completion_tokens, tokens_cache=cached_tokens)
+
+        intervalo_token = 1 / self.simulador.tokens_por_segundo.get(modelo, 60.0)
+        time.sleep(self.simulador.sortear_latencia(modelo))
+
+        identificador = f"chatcmpl-sim{uuid.uuid4().hex[:20]}"
+        criado = int(time.time())
+
+        if not stream:
+            time.sleep(intervalo_token * completion_tokens)
+            return self.responder_json(200, {
+                'id': identificador,
+                'object': 'chat.completion',
+                'created': criado,
+                'model': modelo,
+                'choices': [{
+                    'index': 0,
+                    'message': {'role': 'assistant', 'content': ''.join(pedacos)},
+                    'finish_reason': 'stop',
+                    'logprobs': None
+                }],
+                'usage': uso
+            })
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def evento(choices, usage=None):
+            chunk = {
+                'id': identificador,
+                'object': 'chat.completion.chunk',
+                'created': criado,
+                'model': modelo,
+                'choices': choices,
+                'usage': usage
+            }
+            self.enviar_bloco(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+
+        try:
+            for pedaco in pedacos:
+                evento([{'index': 0, 'delta': {'content': pedaco}, 'finish_reason': None}])
+                time.sleep(intervalo_token)
+            evento([{'index': 0, 'delta': {}, 'finish_reason': 'stop'}])
+            if (corpo.get('stream_options') or {}).get('include_usage'):
+                evento([], uso)
+            self.enviar_bloco(b"data: [DONE]\n\n")
+            self.enviar_bloco(b"")
+        except (BrokenPipeError, ConnectionResetError):
+            self.simulador.contar(streams_cancelados=1)  # main.py fechou o stream (especulativo/prazo)
+            self.close_connection = True
+
+    def embeddings(self, corpo):
+        modelo = corpo.get('model', 'text-embedding-3-small')
+        entradas = corpo.get('input', [])
+        entradas = [entradas] if isinstance(entradas, str) else entradas
+        dimensoes = corpo.get('dimensions') or 256
+        self.simulador.contar(embeddings=1)
+
+        if self.injetar_falha('embeddings'):
+            return
+        time.sleep(self.simulador.sortear_latencia(modelo))
+
+        dados = []
+        for indice, texto in enumerate(entradas):
+            gerador = random.Random(str(texto))  # mesmo texto, mesmo vetor
+            vetor = [gerador.gauss(0, 1) for _ in range(dimensoes)]
+            norma = math.sqrt(sum(v * v for v in vetor)) or 1.0
+            dados.append({'object': 'embedding', 'index': indice, 'embedding': [v / norma for v in vetor]})
+
+        tokens = sum(estimar_tokens(str(t)) for t in entradas)
+        self.responder_json(200, {
+            'object': 'list',
+            'data': dados,
+            'model': modelo,
+            'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}
+        })
+
+    # ---------------------------------------------------------------- Supabase
+    def ler_token_simulado(self):
+        """'Bearer simulado.<plano>.<número>' -> (plano, '<plano>-<número>') ou None"""
+        autorizacao = self.headers.get('Authorization', '')
+        token = autorizacao[7:] if autorizacao.startswith('Bearer ') else autorizacao
+        partes = token.split('.')
+        if len(partes) != 3 or partes[0] != 'simulado' or partes[1] not in PLANOS_SIMULADOS:
+            return None
+        return partes[1], f"{partes[1]}-{partes[2]}"
+
+    def dados_conta(self, plano, identificador):
+        email = self.simulador.email_admin if plano == 'admin' else f"{identificador}@simulado.dev"
+        return {
+            'user_id': identificador,
+            'email': email,
+            'name': f"Cliente {identificador[-4:]}",
+            'user_name': f"Cliente {identificador[-4:]}",
+            'plan': 'starter' if plano in ('free', 'admin') else plano,
+            'plan_type': 'free' if plano == 'free' else 'paid'
+        }
+
+    def auth_usuario(self):
+        self.simulador.contar(supabase_auth=1)
+        time.sleep(self.simulador.latencia_supabase())
+
+        token = self.ler_token_simulado()
+        if token is None:
+            return self.responder_json(401, {'code': 401, 'msg': 'invalid JWT (simulado)'})
+
+        plano, identificador = token
+        conta = self.dados_conta(plano, identificador)
+        self.responder_json(200, {
+            'id': identificador,
+            'aud': 'authenticated',
+            'role': 'authenticated',
+            'email': conta['email'],
+            'app_metadata': {'provider': 'email'},
+            'user_metadata': {'name': conta['name']},
+            'created_at': datetime.now(timezone.utc).isoformat()
+        })
+
+    def user_accounts(self, consulta):
+        self.simulador.contar(supabase_rest=1)
+        time.sleep(self.simulador.latencia_supabase())
+
+        filtro = (consulta.get('user_id') or [''])[0]
+        identificador = filtro[3:] if filtro.startswith('eq.') else filtro
+        plano = identificador.split('-')[0]
+        if plano not in PLANOS_SIMULADOS:
+            return self.responder_json(406, {'code': 'PGRST116', 'message': 'JSON object requested, multiple (or no) rows returned'})
+        linha = self.dados_conta(plano, identificador)
+
+        # .single() pede um objeto; sem ele o PostgREST devolve uma lista
+        if 'vnd.pgrst.object' in self.headers.get('Accept', ''):
+            return self.responder_json(200, linha)
+        self.responder_json(200, [linha])
+
+# =============================================================================
+# 🚀 CLI
+# =============================================================================
+
+def criar_parser():
+    parser = argparse.ArgumentParser(description="OpenAI + Supabase simulados para benchmark do main.py")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--porta', type=int, default=8787)
+    parser.add_argument('--latencia', action='append', metavar='MODELO=DIST',
+                        help="tempo até o 1º token por modelo (ex.: gpt-4o=lognormal:1.2:0.4)")
+    parser.add_argument('--latencia-padrao', default='lognormal:0.6:0.4', help="modelos sem --latencia")
+    parser.add_argument('--tokens-por-segundo', action='append', metavar='MODELO=N',
+                        help="velocidade de geração (ex.: gpt-4o-mini=90)")
+    parser.add_argument('--tokens-resposta', default='40:220', metavar='MIN:MAX',
+                        help="tokens gerados por resposta (limitado pelo max_tokens do pedido)")
+    parser.add_argument('--taxa-acerto-cache', type=float, default=0.7,
+                        help="probabilidade do prefixo (prompt >= 1024 tokens) vir como cached_tokens")
+    parser.add_argument('--taxa-429', type=float, default=0.0)
+    parser.add_argument('--taxa-500', type=float, default=0.0)
+    parser.add_argument('--taxa-travada', type=float, default=0.0, help="chamadas que não respondem")
+    parser.add_argument('--segundos-travada', type=float, default=120.0)
+    parser.add_argument('--retry-after', type=float, default=1.0, help="header retry-after dos 429")
+    parser.add_argument('--latencia-supabase', default='lognormal:0.04:0.3')
+    parser.add_argument('--email-admin', default=EMAIL_ADMIN)
+    parser.add_argument('--silencioso', action='store_true', help="não loga cada requisição")
+    return parser
+
+def main():
+    args = criar_parser().parse_args()
+    ManipuladorSimulado.simulador = Simulador(args)
+
+    servidor = ThreadingHTTPServer((args.host, args.porta), ManipuladorSimulado)
+    servidor.daemon_threads = True
+    print(f"🧪 Upstream simulado em http://{args.host}:{args.porta}")
+    print(f"   OPENAI_BASE_URL=http://{args.host}:{args.porta}/v1")
+    print(f"   SUPABASE_URL=http://{args.host}:{args.porta}  SUPABASE_KEY=simulado.simulado.simulado")
+    try:
+        servidor.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        servidor.server_close()
+        print(f"📊 {json.dumps(ManipuladorSimulado.simulador.estatisticas(), ensure_ascii=False)}")
+
+if __name__ == '__main__':
+    main()
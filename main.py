@@ -1,16 +1,64 @@
 import os
+import sys
 import time
 import requests
 import warnings
 import hashlib
+import json
 import random
 import re
 import threading
-from datetime import datetime, timedelta
-from flask import Flask, request, jsonify, render_template_string
+import queue
+import asyncio
+import unicodedata
+import math
+import zlib
+import itertools
+import sqlite3
+import atexit
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from flask import Flask, request, jsonify, render_template_string, Response, stream_with_context
 from flask_cors import CORS
-from openai import OpenAI
-from supabase import create_client, Client
+from openai import (
+    OpenAI, AsyncOpenAI, APITimeoutError, APIConnectionError, RateLimitError,
+    InternalServerError, NOT_GIVEN
+)
+from supabase import Client
+from supabase._sync.client import SyncClient as ClienteSupabaseBase
+from supabase._async.client import AsyncClient as ClienteSupabaseAsyncBase
+from supabase._sync.auth_client import SyncSupabaseAuthClient
+from supabase._async.auth_client import AsyncSupabaseAuthClient
+from postgrest import SyncPostgrestClient, AsyncPostgrestClient, APIError
+import httpx
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+except ImportError:
+    WsgiToAsgi = None
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+try:
+    import jwt
+except ImportError:
+    jwt = None
 
 warnings.filterwarnings('ignore')
 
@@ -22,6 +70,7 @@ CORS(app)
 # ============================================
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET", "")  # Settings > API > JWT Secret (tokens HS256)
 ADMIN_EMAIL = "natan@natandev.com"
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
 RENDER_URL = os.getenv("RENDER_URL", "")
@@ -46,6 +95,15 @@ LIMITES_MENSAGENS = {
     'admin': float('inf') # 👑 Ilimitado
 }
 
+# Janela de cada limite: 'dia', 'semana' (renova segunda 00:00), 'mes' (renova dia 1º)
+# ou um timedelta (janelas fixas contadas a partir de uma segunda-feira)
+JANELAS_MENSAGENS = {
+    'free': 'semana',
+    'starter': 'mes',
+    'professional': 'mes'
+}
+FUSO_COTAS = timezone(timedelta(hours=-3))  # horário de Brasília (sem horário de verão)
+
 # ============================================
 # 🌐 SISTEMA DE VISITANTES ANÔNIMOS (50 MENSAGENS)
 # ============================================
@@ -60,21 +118,253 @@ VISITANTE_ANONIMO_CONFIG = {
 CONTADOR_VISITANTES = {}
 visitantes_lock = threading.Lock()
 
+# O browser_id vem do cliente: um script com ids aleatórios criaria um contador
+# por requisição. A memória do limitador é fixa: até `max_exatos` contadores
+# exatos (vencidos saem por uma roda de expiração), e os ids que chegam com a
+# tabela cheia contam num count-min sketch de tamanho fixo. Antes de tudo, cada
+# IP tem um balde de rajada.
+LIMITADOR_VISITANTES_CONFIG = {
+    'max_exatos': 50000,             # Contadores exatos (~250 bytes cada)
+    'resolucao_roda_segundos': 60,   # Granularidade da expiração
+    'largura_sketch': 1 << 15,       # Contadores por linha do count-min (potência de 2)
+    'profundidade_sketch': 4,        # Linhas (hashes) do count-min: 2 x 512 KB
+    'max_ips': 20000,                # IPs lembrados pelo limite de rajada (LRU)
+    'rajada_ip': 20,                 # Requisições seguidas por IP
+    'reposicao_ip_segundos': 3.0,    # +1 requisição a cada N segundos
+    'proxies_confiaveis': 1          # Proxies (Render) que acrescentam ao X-Forwarded-For
+}
+
 # =============================================================================
 # 🌐 CONTROLE DE VISITANTES ANÔNIMOS
 # =============================================================================
 
+class RodaExpiracao:
+    """
+    Timing wheel: cada chave fica no slot do instante em que vence; girar()
+    devolve só as chaves dos slots que já passaram. Chave com vencimento além
+    de uma volta cai num slot antes da hora e quem chama a reagenda.
+    """
+    
+    def __init__(self, duracao, resolucao):
+        self.resolucao = resolucao
+        self.slots = [[] for _ in range(int(duracao // resolucao) + 2)]
+        self.tick = int(time.time() // resolucao)  # próximo slot a girar
+    
+    def agendar(self, chave, vence_em):
+        tick = max(int(vence_em // self.resolucao), self.tick)
+        self.slots[tick % len(self.slots)].append(chave)
+    
+    def girar(self, agora):
+        atual = int(agora // self.resolucao)
+        passos = min(atual - self.tick, len(self.slots))
+        vencidas = []
+        for tick in range(self.tick, self.tick + passos):
+            indice = tick % len(self.slots)
+            if self.slots[indice]:
+                vencidas.extend(self.slots[indice])
+                self.slots[indice] = []
+        self.tick = max(self.tick, atual)
+        return vencidas
+
+class SketchJanela:
+    """
+    Count-min com duas gerações (atual + anterior) que viram a cada `janela`
+    segundos: a estimativa cobre entre 1 e 2 janelas e só erra para mais.
+    """
+    
+    def __init__(self, largura, profundidade, janela):
+        self.largura = largura
+        self.mascara = largura - 1
+        self.profundidade = profundidade
+        self.janela = janela
+        self.atual = array('I', bytes(4 * largura * profundidade))
+        self.anterior = array('I', bytes(4 * largura * profundidade))
+        self.vira_em = time.time() + janela
+    
+    def _virar(self, agora):
+        if agora < self.vira_em:
+            return
+        vazio = array('I', bytes(4 * self.largura * self.profundidade))
+        self.anterior = self.atual if agora < self.vira_em + self.janela else vazio
+        self.atual = array('I', vazio)
+        self.vira_em = agora + self.janela
+    
+    def _indices(self, chave):
+        h = hash(chave)
+        h1, h2 = h & 0xFFFFFFFF, ((h >> 32) & 0xFFFFFFFF) | 1
+        return [linha * self.largura + ((h1 + linha * h2) & self.mascara) for linha in range(self.profundidade)]
+    
+    def estimar(self, chave, agora):
+        self._virar(agora)
+        return min(self.atual[i] + self.anterior[i] for i in self._indices(chave))
+    
+    def somar(self, chave, agora):
+        """Atualização conservadora: só sobem as células no mínimo"""
+        self._virar(agora)
+        indices = self._indices(chave)
+        minimo = min(self.atual[i] for i in indices)
+        for i in indices:
+            if self.atual[i] == minimo:
+                self.atual[i] = minimo + 1
+    
+    def segundos_para_virar(self, agora):
+        return max(0, self.vira_em - agora)
+
+class LimitadorVisitantes:
+    """Tabela exata com teto + roda de expiração + sketch para o transbordo. Chamar com visitantes_lock."""
+    
+    def __init__(self, contadores, duracao, config):
+        self.contadores = contadores
+        self.max_exatos = config['max_exatos']
+        self.roda = RodaExpiracao(duracao, config['resolucao_roda_segundos'])
+        self.agendados = set()   # chaves que estão em algum slot da roda
+        self.sketch = SketchJanela(config['largura_sketch'], config['profundidade_sketch'], duracao)
+        self.mensagens = 0       # mensagens nos contadores exatos vivos (deste processo)
+        self.coalescidas = 0
+        self.expirados = 0
+        self.transbordo_consultas = 0
+        self.transbordo_mensagens = 0
+    
+    def expirar(self, agora):
+        for chave in self.roda.girar(agora):
+            contador = self.contadores.get(chave)
+            if contador is None:
+                self.agendados.discard(chave)
+            elif expiracao_visitante(contador) <= agora:
+                self.descartar(chave)
+                self.expirados += 1
+            else:
+                self.roda.agendar(chave, expiracao_visitante(contador))
+    
+    def descartar(self, chave):
+        contador = self.contadores.pop(chave, None)
+        self.agendados.discard(chave)
+        if contador is not None:
+            self.mensagens -= contador.get('total', 0)
+            self.coalescidas -= contador.get('coalescidas', 0)
+    
+    def lotado(self):
+        return len(self.contadores) >= self.max_exatos
+    
+    def acompanhar(self, chave, contador):
+        """Garante que a chave está na roda (criada aqui ou trazida do backend)"""
+        if chave not in self.agendados:
+            self.agendados.add(chave)
+            self.roda.agendar(chave, expiracao_visitante(contador))
+    
+    def reindexar(self, agora=None):
+        """Depois de carregar o backend: agenda tudo e corta o que passar do teto"""
+        agora = agora or time.time()
+        for chave in list(self.contadores):
+            contador = self.contadores[chave]
+            if expiracao_visitante(contador) <= agora or len(self.agendados) >= self.max_exatos:
+                del self.contadores[chave]
+                continue
+            self.mensagens += contador.get('total', 0)
+            self.coalescidas += contador.get('coalescidas', 0)
+            self.acompanhar(chave, contador)
+    
+    def estatisticas(self):
+        return {
+            'exatos': len(self.contadores),
+            'max_exatos': self.max_exatos,
+            'mensagens': self.mensagens,
+            'coalescidas': self.coalescidas,
+            'expirados': self.expirados,
+            'transbordo_consultas': self.transbordo_consultas,
+            'transbordo_mensagens': self.transbordo_mensagens,
+            'sketch_bytes': 2 * self.sketch.atual.itemsize * len(self.sketch.atual)
+        }
+
+class LimiteRajadaIP:
+    """Balde de fichas por IP (LRU com teto): O(1) por requisição, memória fixa"""
+    
+    def __init__(self, max_ips, rajada, reposicao_segundos):
+        self.max_ips = max_ips
+        self.rajada = rajada
+        self.reposicao_segundos = reposicao_segundos
+        self.baldes = OrderedDict()  # ip -> [fichas, atualizado_em]
+        self.lock = threading.Lock()
+        self.negadas = 0
+    
+    def permitir(self, ip):
+        """Retorna 0 se pode seguir, ou os segundos até a próxima ficha"""
+        agora = time.monotonic()
+        with self.lock:
+            balde = self.baldes.get(ip)
+            if balde is None:
+                balde = self.baldes[ip] = [self.rajada, agora]
+                if len(self.baldes) > self.max_ips:
+                    self.baldes.popitem(last=False)
+            else:
+                self.baldes.move_to_end(ip)
+                balde[0] = min(self.rajada, balde[0] + (agora - balde[1]) / self.reposicao_segundos)
+                balde[1] = agora
+            
+            if balde[0] >= 1:
+                balde[0] -= 1
+                return 0
+            self.negadas += 1
+            return (1 - balde[0]) * self.reposicao_segundos
+    
+    def estatisticas(self):
+        with self.lock:
+            return {'ips': len(self.baldes), 'max_ips': self.max_ips, 'negadas': self.negadas}
+
+def ip_da_requisicao(cabecalho_encaminhado, endereco_remoto):
+    """IP do cliente: o que o proxy confiável acrescentou ao X-Forwarded-For (o início é do cliente)"""
+    confiaveis = LIMITADOR_VISITANTES_CONFIG['proxies_confiaveis']
+    if cabecalho_encaminhado and confiaveis:
+        enderecos = [parte.strip() for parte in cabecalho_encaminhado.split(',') if parte.strip()]
+        if enderecos:
+            return enderecos[-min(confiaveis, len(enderecos))]
+    return endereco_remoto or 'desconhecido'
+
+DURACAO_JANELA_VISITANTE = VISITANTE_ANONIMO_CONFIG['duracao_limite_horas'] * 3600
+LIMITADOR_VISITANTES = LimitadorVisitantes(CONTADOR_VISITANTES, DURACAO_JANELA_VISITANTE, LIMITADOR_VISITANTES_CONFIG)
+RAJADA_IP = LimiteRajadaIP(
+    LIMITADOR_VISITANTES_CONFIG['max_ips'],
+    LIMITADOR_VISITANTES_CONFIG['rajada_ip'],
+    LIMITADOR_VISITANTES_CONFIG['reposicao_ip_segundos']
+)
+
+def novo_contador_visitante(agora=None):
+    return {
+        'total': 0,
+        'expira_em': (agora or time.time()) + DURACAO_JANELA_VISITANTE
+    }
+
+def expiracao_visitante(contador):
+    """Epoch do fim da janela (contadores antigos guardavam o ISO)"""
+    expira_em = contador['expira_em']
+    if isinstance(expira_em, str):
+        expira_em = contador['expira_em'] = datetime.fromisoformat(expira_em).timestamp()
+    return expira_em
+
 def obter_contador_visitante(browser_id):
-    """Retorna o contador de mensagens de um visitante anônimo"""
+    """
+    Retorna o contador exato de um visitante anônimo, ou None quando a tabela
+    está cheia e o id é novo (conta no sketch).
+    """
+    agora = time.time()
     with visitantes_lock:
-        if browser_id not in CONTADOR_VISITANTES:
-            CONTADOR_VISITANTES[browser_id] = {
-                'total': 0,
-                'primeiro_uso': datetime.now().isoformat(),
-                'expira_em': (datetime.now() + timedelta(hours=VISITANTE_ANONIMO_CONFIG['duracao_limite_horas'])).isoformat(),
-                'tipo': 'visitante_anonimo'
-            }
-        return CONTADOR_VISITANTES[browser_id]
+        LIMITADOR_VISITANTES.expirar(agora)
+        if browser_id not in CONTADOR_VISITANTES and LIMITADOR_VISITANTES.lotado():
+            return None
+    
+    ARMAZEM_ESTADO.sincronizar(browser_id, ('visitantes',))
+    with visitantes_lock:
+        contador = CONTADOR_VISITANTES.get(browser_id)
+        if contador is None:
+            if LIMITADOR_VISITANTES.lotado():
+                return None
+            contador = CONTADOR_VISITANTES[browser_id] = novo_contador_visitante(agora)
+            ARMAZEM_ESTADO.atualizar('visitantes', browser_id, iniciais=contador)
+        LIMITADOR_VISITANTES.acompanhar(browser_id, contador)
+        return contador
+
+def visitante_exato(browser_id):
+    return browser_id in CONTADOR_VISITANTES
 
 def verificar_limite_visitante(browser_id):
     """
@@ -83,41 +373,69 @@ def verificar_limite_visitante(browser_id):
     """
     contador = obter_contador_visitante(browser_id)
     limite = VISITANTE_ANONIMO_CONFIG['limite_mensagens']
+    agora = time.time()
+    
+    if contador is None:
+        # Transbordo: contagem aproximada (só para mais) no sketch
+        with visitantes_lock:
+            LIMITADOR_VISITANTES.transbordo_consultas += 1
+            mensagens_usadas = LIMITADOR_VISITANTES.sketch.estimar(browser_id, agora)
+            restante = LIMITADOR_VISITANTES.sketch.segundos_para_virar(agora)
+        return mensagens_usadas < limite, mensagens_usadas, limite, formatar_tempo_restante(restante)
     
     # Verifica se já expirou (24h)
-    expira_em = datetime.fromisoformat(contador['expira_em'])
-    agora = datetime.now()
+    expira_em = expiracao_visitante(contador)
     
     if agora > expira_em:
         # Resetar contador após 24h
         with visitantes_lock:
-            CONTADOR_VISITANTES[browser_id] = {
-                'total': 0,
-                'primeiro_uso': agora.isoformat(),
-                'expira_em': (agora + timedelta(hours=VISITANTE_ANONIMO_CONFIG['duracao_limite_horas'])).isoformat(),
-                'tipo': 'visitante_anonimo'
-            }
-        contador = CONTADOR_VISITANTES[browser_id]
+            anterior = CONTADOR_VISITANTES.get(browser_id, {})
+            LIMITADOR_VISITANTES.mensagens -= anterior.get('total', 0)
+            LIMITADOR_VISITANTES.coalescidas -= anterior.get('coalescidas', 0)
+            contador = CONTADOR_VISITANTES[browser_id] = novo_contador_visitante(agora)
+            ARMAZEM_ESTADO.substituir('visitantes', browser_id, contador)
+            LIMITADOR_VISITANTES.acompanhar(browser_id, contador)
+        expira_em = contador['expira_em']
     
     mensagens_usadas = contador['total']
     pode_enviar = mensagens_usadas < limite
     
-    # Calcula tempo restante
-    tempo_restante_delta = expira_em - agora
-    horas_restantes = int(tempo_restante_delta.total_seconds() // 3600)
-    minutos_restantes = int((tempo_restante_delta.total_seconds() % 3600) // 60)
-    tempo_restante = f"{horas_restantes}h {minutos_restantes}min"
-    
-    return pode_enviar, mensagens_usadas, limite, tempo_restante
+    return pode_enviar, mensagens_usadas, limite, formatar_tempo_restante(expira_em - agora)
 
-def incrementar_contador_visitante(browser_id):
-    """Incrementa o contador de mensagens de um visitante"""
+def incrementar_contador_visitante(browser_id, coalescida=False, reserva=None):
+    """
+    Incrementa o contador de mensagens de um visitante (coalescida = dividiu a
+    chamada de outro), confirmando a reserva de cota feita antes da chamada.
+    """
+    agora = time.time()
+    with visitantes_lock:
+        if reserva is None and browser_id not in CONTADOR_VISITANTES and LIMITADOR_VISITANTES.lotado():
+            # Visitante do transbordo (sem contador exato nem reserva)
+            LIMITADOR_VISITANTES.sketch.somar(browser_id, agora)
+            LIMITADOR_VISITANTES.transbordo_mensagens += 1
+            return LIMITADOR_VISITANTES.sketch.estimar(browser_id, agora)
+    
+    iniciais = novo_contador_visitante(agora)
+    somado_no_backend = MOTOR_COTAS.confirmar_no_backend(reserva, iniciais)
+    
     with visitantes_lock:
         if browser_id not in CONTADOR_VISITANTES:
-            obter_contador_visitante(browser_id)
+            CONTADOR_VISITANTES[browser_id] = novo_contador_visitante(agora)
+        contador = CONTADOR_VISITANTES[browser_id]
+        LIMITADOR_VISITANTES.acompanhar(browser_id, contador)
         
-        CONTADOR_VISITANTES[browser_id]['total'] += 1
-        return CONTADOR_VISITANTES[browser_id]['total']
+        somar = {'total': 1, 'coalescidas': 1} if coalescida else {'total': 1}
+        for campo, valor in somar.items():
+            contador[campo] = contador.get(campo, 0) + valor
+        LIMITADOR_VISITANTES.mensagens += 1
+        LIMITADOR_VISITANTES.coalescidas += int(coalescida)
+        if somado_no_backend:
+            del somar['total']
+        ARMAZEM_ESTADO.atualizar('visitantes', browser_id, somar=somar, iniciais=iniciais)
+        total = contador['total']
+    
+    MOTOR_COTAS.confirmar(reserva)
+    return total
 
 def gerar_mensagem_limite_visitante(mensagens_usadas, limite, tempo_restante):
     """Gera mensagem quando visitante atinge limite de 50 mensagens"""
@@ -148,28 +466,7 @@ Cadastre-se ou entre em contato:
 
 Vibrações Positivas! ✨"""
 
-def processar_mensagem_visitante_anonimo(mensagem):
-    """
-    Processa mensagem de visitante anônimo com GPT-4O-MINI.
-    Respostas curtas e focadas em apresentar a NatanSites.
-    """
-    if not verificar_openai():
-        return {
-            'resposta': "⚠️ Sistema de IA temporariamente indisponível. Tente novamente em alguns instantes.",
-            'tokens_usados': 0,
-            'modelo_usado': 'N/A',
-            'cached': False
-        }
-        
-    
-    try:
-        modelo = VISITANTE_ANONIMO_CONFIG['modelo']
-        max_tokens = VISITANTE_ANONIMO_CONFIG['max_tokens_resposta']
-        
-        # Detecta categoria para otimizar tokens
-        categoria, config = detectar_categoria_mensagem(mensagem)
-        
-        system_prompt = f"""Você é NatanAI, assistente virtual da NatanSites (natansites.com.br).
+PROMPT_SISTEMA_VISITANTE = """Você é NatanAI, assistente virtual da NatanSites (natansites.com.br).
 
 **VOCÊ ESTÁ CONVERSANDO COM UM VISITANTE ANÔNIMO:**
 Esta pessoa está testando gratuitamente sem cadastro! Tem apenas 50 mensagens nas próximas 24h.
@@ -216,38 +513,89 @@ Responder de forma BREVE, CLARA e sempre INCENTIVANDO o cadastro nos planos.
 
 **REGRAS IMPORTANTES:**
 - Respostas CURTAS (máximo 4-5 frases)
-- {config['instrucao']}
+- Siga a INSTRUÇÃO DE RESPOSTA do contexto da conversa
 - Sem asteriscos ou formatação markdown
 - Sempre mencione que tem planos gratuitos E pagos
 - Incentive cadastro quando apropriado
-- Tom amigável e prestativo
+- Tom amigável e prestativo"""
+
+# Perfil usado pelo sistema alternativo quando o visitante fica sem resposta da IA
+TIPO_USUARIO_VISITANTE = {'tipo': 'visitante', 'nome_real': 'Visitante'}
 
-Você está conversando com: Visitante Anônimo (Teste Gratuito - 50 mensagens/24h)"""
+def preparar_chamada_visitante(mensagem):
+    """
+    Monta a chamada OpenAI de um visitante anônimo (modelo, mensagens e limite de tokens).
+    Compartilhada pelo modo normal e pelo modo streaming.
+    """
+    modelo = VISITANTE_ANONIMO_CONFIG['modelo']
+    max_tokens = VISITANTE_ANONIMO_CONFIG['max_tokens_resposta']
+    
+    # Detecta categoria para otimizar tokens
+    categoria, config = detectar_categoria_mensagem(mensagem)
+    
+    messages = montar_mensagens_prompt(
+        'visitante',
+        montar_contexto_dinamico('Visitante Anônimo (Teste Gratuito - 50 mensagens/24h)', config),
+        [],
+        mensagem
+    )
+    
+    return anotar_tamanho_prompt({
+        'modelo': modelo,
+        'messages': messages,
+        'max_tokens': max_tokens,
+        'categoria': categoria,
+        'modelo_usado': f'{modelo} (visitante)'
+    })
 
-        messages = [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": mensagem}
-        ]
+def processar_mensagem_visitante_anonimo(mensagem, prazo=None):
+    """
+    Processa mensagem de visitante anônimo com GPT-4O-MINI.
+    Respostas curtas e focadas em apresentar a NatanSites.
+    """
+    prazo = prazo or criar_prazo('visitante')
+    
+    # 💾 Perguntas repetidas (preços, contato...) saem do cache
+    chave_cache = chave_cache_resposta(mensagem, 'visitante')
+    resultado_cache = buscar_resposta_cache(chave_cache)
+    if resultado_cache:
+        return resultado_cache
+    
+    if not verificar_openai():
+        return {
+            'resposta': "⚠️ Sistema de IA temporariamente indisponível. Tente novamente em alguns instantes.",
+            'tokens_usados': 0,
+            'modelo_usado': 'N/A',
+            'cached': False
+        }
         
-        response = client.chat.completions.create(
-            model=modelo,
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=0.7
-        )
+    
+    try:
+        chamada = preparar_chamada_visitante(mensagem)
+        
+        response = criar_completion_com_prazo(chamada['modelo'], chamada['messages'], chamada['max_tokens'], prazo)
         
         resposta = response.choices[0].message.content.strip()
         resposta = limpar_formatacao_markdown(resposta)
         
-        return {
+        resultado = {
             'resposta': resposta,
             'tokens_usados': response.usage.total_tokens,
             'tokens_entrada': response.usage.prompt_tokens,
             'tokens_saida': response.usage.completion_tokens,
-            'modelo_usado': f'{modelo} (visitante)',
+            'tokens_cache': tokens_em_cache(response.usage),
+            'modelo_usado': chamada['modelo_usado'],
             'cached': False,
-            'categoria': categoria
+            'categoria': chamada['categoria']
         }
+        guardar_resposta_cache(chave_cache, resultado)
+        return resultado
+    
+    except PrazoExpirado:
+        return resultado_prazo_alternativo(mensagem, TIPO_USUARIO_VISITANTE)
+    
+    except ERROS_OPENAI_INDISPONIVEL:
+        return resultado_prazo_alternativo(mensagem, TIPO_USUARIO_VISITANTE, motivo='instavel')
         
     except Exception as e:
         print(f"❌ Erro ao processar visitante: {e}")
@@ -259,6 +607,79 @@ Você está conversando com: Visitante Anônimo (Teste Gratuito - 50 mensagens/2
             'erro': str(e)
         }
 
+def processar_mensagem_visitante_anonimo_stream(mensagem, prazo=None):
+    """
+    Versão streaming de processar_mensagem_visitante_anonimo.
+    Gera ('delta', texto) conforme os tokens chegam e termina com ('fim', resultado).
+    """
+    prazo = prazo or criar_prazo('visitante')
+    
+    chave_cache = chave_cache_resposta(mensagem, 'visitante')
+    resultado_cache = buscar_resposta_cache(chave_cache)
+    if resultado_cache:
+        yield ('delta', resultado_cache['resposta'])
+        yield ('fim', resultado_cache)
+        return
+    
+    if not verificar_openai():
+        yield ('fim', {
+            'resposta': "⚠️ Sistema de IA temporariamente indisponível. Tente novamente em alguns instantes.",
+            'tokens_usados': 0,
+            'modelo_usado': 'N/A',
+            'cached': False
+        })
+        return
+    
+    limpador = LimpadorMarkdownIncremental()
+    partes = []
+    
+    try:
+        chamada = preparar_chamada_visitante(mensagem)
+        uso = {}
+        
+        for pedaco in transmitir_completion(chamada['modelo'], chamada['messages'], chamada['max_tokens'], uso, prazo):
+            partes.append(pedaco)
+            texto = limpador.alimentar(pedaco)
+            if texto:
+                yield ('delta', texto)
+        
+        texto = limpador.finalizar()
+        if texto:
+            yield ('delta', texto)
+        
+        resultado = {
+            'resposta': limpar_formatacao_markdown(''.join(partes).strip()),
+            'tokens_usados': uso.get('total_tokens', 0),
+            'tokens_entrada': uso.get('prompt_tokens', 0),
+            'tokens_saida': uso.get('completion_tokens', 0),
+            'tokens_cache': uso.get('cached_tokens', 0),
+            'modelo_usado': chamada['modelo_usado'],
+            'cached': False,
+            'categoria': chamada['categoria']
+        }
+        guardar_resposta_cache(chave_cache, resultado)
+        yield ('fim', resultado)
+    
+    except (PrazoExpirado, APITimeoutError):
+        resultado = resultado_prazo_alternativo(mensagem, TIPO_USUARIO_VISITANTE)
+        yield ('delta', resultado['resposta'])
+        yield ('fim', resultado)
+    
+    except ERROS_OPENAI_INDISPONIVEL:
+        resultado = resultado_prazo_alternativo(mensagem, TIPO_USUARIO_VISITANTE, motivo='instavel')
+        yield ('delta', resultado['resposta'])
+        yield ('fim', resultado)
+        
+    except Exception as e:
+        print(f"❌ Erro ao processar visitante (stream): {e}")
+        yield ('fim', {
+            'resposta': "⚠️ Erro ao processar sua mensagem. Tente novamente ou contate: (21) 99282-6074",
+            'tokens_usados': 0,
+            'modelo_usado': 'erro',
+            'cached': False,
+            'erro': str(e)
+        })
+
 # ============================================
 # 🎯 SISTEMA DE OTIMIZAÇÃO DE TOKENS v8.0
 # ============================================
@@ -305,740 +726,2254 @@ CATEGORIAS_MENSAGEM = {
     }
 }
 
+# Palavras que pedem refinamento com GPT-4O nos planos híbridos
+PALAVRAS_REFINAMENTO = {
+    'starter': [
+        'como funciona', 'me explica', 'detalhes', 'completo', 'diferença', 'comparar',
+        'qual escolher', 'melhor', 'processo', 'etapas', 'passo a passo', 'tecnologia',
+        'stack', 'framework', 'prazo', 'tempo', 'quanto tempo', 'seo', 'otimização',
+        'google', 'hospedagem', 'domínio', 'servidor', 'blog', 'e-commerce', 'loja virtual',
+        'design', 'layout', 'personalização', 'upgrade', 'professional', 'diferença planos'
+    ],
+    # Professional tem critérios mais amplos
+    'professional': [
+        'como funciona', 'me explica', 'detalhes', 'completo', 'diferença', 'comparar',
+        'melhor', 'processo', 'etapas', 'tecnologia', 'stack', 'framework', 'prazo',
+        'seo', 'hospedagem', 'blog', 'e-commerce', 'design', 'personalização', 'ia',
+        'inteligência artificial', 'api', 'integração', 'cms', 'performance', 'otimização',
+        'mobile', 'responsivo', 'analytics', 'conversão', 'landing page', 'checkout',
+        'pagamento', 'stripe', 'crm', 'automação', 'webhook', 'graphql', 'react',
+        'next.js', 'typescript', 'advanced', 'avançado', 'custom', 'customização'
+    ]
+}
+
+# Intenções da resposta alternativa (sem API), em ordem de prioridade
+INTENCOES_RESPOSTA_ALTERNATIVA = {
+    'saudacao': ['oi', 'olá', 'ola', 'hey', 'bom dia', 'boa tarde', 'boa noite', 'e ai', 'eai'],
+    'despedida': ['tchau', 'até', 'falou', 'obrigado', 'obrigada', 'valeu'],
+    'planos': ['plano', 'preço', 'valor', 'custo', 'quanto custa', 'mensalidade', 'contratar'],
+    'contato': ['contato', 'whatsapp', 'telefone', 'email', 'falar'],
+    'portfolio': ['portfolio', 'portfólio', 'projetos', 'trabalhos']
+}
+
+ORDEM_PRIORIDADE_CATEGORIAS = ['saudacao', 'despedida', 'confirmacao', 'casual',
+                               'planos_valores', 'explicacao_simples', 'tecnico', 'complexo']
+
+def normalizar_texto_busca(texto):
+    """
+    Minúsculas e só ASCII (ç -> c, ã -> a; emojis e outros símbolos somem).
+    Serve para casar palavras-chave, que são todas ASCII depois de normalizadas.
+    """
+    texto = texto.lower()
+    if texto.isascii():
+        return texto
+    return unicodedata.normalize('NFKD', texto).encode('ascii', 'ignore').decode('ascii')
+
+PADRAO_PALAVRA_BUSCA = re.compile(r'\w+', re.ASCII)
+
+def regex_trie(chaves):
+    """
+    Alternância em forma de árvore de prefixos ("plano|planos|prazo" ->
+    "p(?:lano(?:s)?|razo)"): cada caractere da mensagem é testado uma vez só.
+    Espaço dentro de uma expressão casa qualquer separador ("e-commerce").
+    """
+    raiz = {}
+    for chave in chaves:
+        no = raiz
+        for caractere in chave:
+            no = no.setdefault(caractere, {})
+        no[''] = {}
+    
+    def gerar(no):
+        ramos = [(r'\W+' if c == ' ' else re.escape(c)) + gerar(filho)
+                 for c, filho in sorted(no.items()) if c]
+        if not ramos:
+            return ''
+        corpo = ramos[0] if len(ramos) == 1 else '(?:' + '|'.join(ramos) + ')'
+        return f'(?:{corpo})?' if '' in no else corpo
+    
+    return gerar(raiz)
+
+class ClassificadorMensagem:
+    """
+    Todas as listas de palavras-chave (categorias, refinamento por plano e
+    intenções da resposta alternativa) compiladas numa única regex (árvore de
+    prefixos) de palavras inteiras, sem acentos e com plural opcional.
+    Cada palavra-chave vale uma máscara de bits dos rótulos dela, e uma
+    passada pela mensagem devolve o OR de todos os rótulos encontrados.
+    """
+    
+    def __init__(self, grupos):
+        self.bits = {}
+        mascaras = {}
+        for grupo, listas in grupos.items():
+            for nome, palavras in listas.items():
+                bit = self.bits.setdefault((grupo, nome), 1 << len(self.bits))
+                for palavra in palavras:
+                    chave = self._chave(palavra)
+                    mascaras[chave] = mascaras.get(chave, 0) | bit
+        
+        # Plurais entram no índice (e na regex) como formas da mesma palavra
+        formas = {}
+        for chave, mascara in mascaras.items():
+            for forma in (chave, chave + 's', chave + 'es'):
+                formas[forma] = formas.get(forma, 0) | mascara
+        
+        # A regex casa a expressão mais longa ("quanto custa"); ela herda os
+        # rótulos das palavras contidas nela ("quanto"), como o `in` fazia
+        self.mascaras = {}
+        for forma in formas:
+            partes = forma.split()
+            mascara = 0
+            for i in range(len(partes)):
+                for j in range(i + 1, len(partes) + 1):
+                    mascara |= formas.get(' '.join(partes[i:j]), 0)
+            self.mascaras[forma] = mascara
+        
+        self.regex = re.compile(r'\b' + regex_trie(self.mascaras) + r'\b', re.ASCII)
+    
+    @staticmethod
+    def _chave(texto):
+        return ' '.join(PADRAO_PALAVRA_BUSCA.findall(normalizar_texto_busca(texto)))
+    
+    def bit(self, grupo, nome):
+        return self.bits[(grupo, nome)]
+    
+    def mascara(self, texto):
+        """OR dos bits de todas as palavras-chave presentes no texto"""
+        encontrados = 0
+        mascaras = self.mascaras
+        for trecho in self.regex.findall(normalizar_texto_busca(texto)):
+            mascara = mascaras.get(trecho)
+            if mascara is None:
+                # Separador diferente de um espaço ("e-commerce", "boa  noite")
+                mascara = mascaras[self._chave(trecho)]
+            encontrados |= mascara
+        return encontrados
+
+CLASSIFICADOR_MENSAGEM = ClassificadorMensagem({
+    'categoria': {nome: config['keywords'] for nome, config in CATEGORIAS_MENSAGEM.items()},
+    'refinamento': PALAVRAS_REFINAMENTO,
+    'intencao': INTENCOES_RESPOSTA_ALTERNATIVA
+})
+
+# (nome, bit) na ordem em que cada decisão é tomada
+BITS_CATEGORIAS_CURTAS = [(c, CLASSIFICADOR_MENSAGEM.bit('categoria', c)) for c in CATEGORIAS_MENSAGEM]
+BITS_CATEGORIAS_PRIORIDADE = [(c, CLASSIFICADOR_MENSAGEM.bit('categoria', c)) for c in ORDEM_PRIORIDADE_CATEGORIAS]
+BITS_REFINAMENTO = [(p, CLASSIFICADOR_MENSAGEM.bit('refinamento', p)) for p in PALAVRAS_REFINAMENTO]
+BITS_INTENCOES = [(i, CLASSIFICADOR_MENSAGEM.bit('intencao', i)) for i in INTENCOES_RESPOSTA_ALTERNATIVA]
+
+def decidir_analise(mascara, curta):
+    # Mensagens muito curtas são casuais
+    if curta:
+        ordem, categoria = BITS_CATEGORIAS_CURTAS, 'casual'
+    else:
+        ordem, categoria = BITS_CATEGORIAS_PRIORIDADE, 'explicacao_simples'
+    categoria = next((c for c, bit in ordem if mascara & bit), categoria)
+    
+    return (
+        categoria,
+        frozenset(p for p, bit in BITS_REFINAMENTO if mascara & bit),
+        next((i for i, bit in BITS_INTENCOES if mascara & bit), None)
+    )
+
+# (máscara, curta) -> decisão; poucas combinações aparecem na prática
+DECISOES_ANALISE = {}
+
+def analisar_mensagem(mensagem):
+    """
+    Uma passada pela mensagem: categoria (+ config), planos em que ela pede
+    refinamento e intenção da resposta alternativa (None = resposta padrão).
+    """
+    mascara = CLASSIFICADOR_MENSAGEM.mascara(mensagem)
+    chave = (mascara, len(mensagem.split()) <= 3)
+    
+    decisao = DECISOES_ANALISE.get(chave)
+    if decisao is None:
+        decisao = DECISOES_ANALISE[chave] = decidir_analise(*chave)
+    categoria, refinamento, intencao = decisao
+    
+    return {
+        'categoria': categoria,
+        'config': CATEGORIAS_MENSAGEM[categoria],
+        'refinamento': refinamento,
+        'intencao': intencao
+    }
+
 def detectar_categoria_mensagem(mensagem):
     """Detecta categoria da mensagem para otimizar tokens"""
-    msg_lower = mensagem.lower().strip()
+    analise = analisar_mensagem(mensagem)
+    return analise['categoria'], analise['config']
+
+# =============================================================================
+# 🔌 SUPABASE COM UM POOL HTTP SÓ
+# =============================================================================
+# Auth (gotrue) e banco (postgrest) abriam cada um seu cliente HTTP: conexões
+# e handshakes TLS separados para o mesmo host. Aqui os dois usam o mesmo
+# transporte (um pool de conexões keep-alive, HTTP/2) por modo (sync/async).
+# Depende de métodos internos do supabase-py 2.10 (versão fixada no requirements).
+SUPABASE_HTTP_CONFIG = {
+    'max_conexoes': 20,
+    'max_ociosas': 10,
+    'ociosa_segundos': 60,   # Conexão parada por mais tempo é fechada
+    'timeout': 10,
+    'http2': True
+}
+
+def criar_transporte_supabase(classe):
+    return classe(
+        http2=SUPABASE_HTTP_CONFIG['http2'],
+        limits=httpx.Limits(
+            max_connections=SUPABASE_HTTP_CONFIG['max_conexoes'],
+            max_keepalive_connections=SUPABASE_HTTP_CONFIG['max_ociosas'],
+            keepalive_expiry=SUPABASE_HTTP_CONFIG['ociosa_segundos']
+        ),
+        retries=1  # só reconexão (conexão do pool fechada pelo servidor), nunca a requisição
+    )
+
+TRANSPORTE_SUPABASE = criar_transporte_supabase(httpx.HTTPTransport)
+TRANSPORTE_SUPABASE_ASYNC = None  # criado dentro do loop, no primeiro uso assíncrono
+
+class SessaoHTTPSupabase(httpx.Client):
+    """httpx.Client no pool compartilhado (o gotrue chama aclose() ao sair)"""
     
-    # Mensagens muito curtas são casuais
-    if len(msg_lower.split()) <= 3:
-        for categoria, config in CATEGORIAS_MENSAGEM.items():
-            if any(kw in msg_lower for kw in config['keywords']):
-                return categoria, config
-        return 'casual', CATEGORIAS_MENSAGEM['casual']
+    def __init__(self, **kwargs):
+        super().__init__(transport=TRANSPORTE_SUPABASE, timeout=SUPABASE_HTTP_CONFIG['timeout'], **kwargs)
     
-    # Verifica categorias por ordem de prioridade
-    ordem_prioridade = ['saudacao', 'despedida', 'confirmacao', 'casual', 
-                        'planos_valores', 'explicacao_simples', 'tecnico', 'complexo']
+    def aclose(self):
+        self.close()
+
+class SessaoHTTPSupabaseAsync(httpx.AsyncClient):
+    def __init__(self, **kwargs):
+        super().__init__(transport=TRANSPORTE_SUPABASE_ASYNC, timeout=SUPABASE_HTTP_CONFIG['timeout'], **kwargs)
+
+class PostgrestSupabase(SyncPostgrestClient):
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None):
+        return SessaoHTTPSupabase(base_url=base_url, headers=headers, follow_redirects=True)
+
+class PostgrestSupabaseAsync(AsyncPostgrestClient):
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None):
+        return SessaoHTTPSupabaseAsync(base_url=base_url, headers=headers, follow_redirects=True)
+
+class ClienteSupabase(ClienteSupabaseBase):
+    @staticmethod
+    def _init_supabase_auth_client(auth_url, client_options, verify=True, proxy=None):
+        return SyncSupabaseAuthClient(
+            url=auth_url,
+            auto_refresh_token=client_options.auto_refresh_token,
+            persist_session=client_options.persist_session,
+            storage=client_options.storage,
+            headers=client_options.headers,
+            flow_type=client_options.flow_type,
+            http_client=SessaoHTTPSupabase()
+        )
     
-    for cat in ordem_prioridade:
-        config = CATEGORIAS_MENSAGEM[cat]
-        if any(kw in msg_lower for kw in config['keywords']):
-            return cat, config
+    @staticmethod
+    def _init_postgrest_client(rest_url, headers, schema, timeout=None, verify=True, proxy=None):
+        return PostgrestSupabase(rest_url, headers=headers, schema=schema)
+
+class ClienteSupabaseAsync(ClienteSupabaseAsyncBase):
+    @staticmethod
+    def _init_supabase_auth_client(auth_url, client_options, verify=True, proxy=None):
+        return AsyncSupabaseAuthClient(
+            url=auth_url,
+            auto_refresh_token=client_options.auto_refresh_token,
+            persist_session=client_options.persist_session,
+            storage=client_options.storage,
+            headers=client_options.headers,
+            flow_type=client_options.flow_type,
+            http_client=SessaoHTTPSupabaseAsync()
+        )
     
-    # Padrão: explicação simples
-    return 'explicacao_simples', CATEGORIAS_MENSAGEM['explicacao_simples']
+    @staticmethod
+    def _init_postgrest_client(rest_url, headers, schema, timeout=None, verify=True, proxy=None):
+        return PostgrestSupabaseAsync(rest_url, headers=headers, schema=schema)
 
 # Inicializa Supabase
 supabase: Client = None
 try:
-    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
+    supabase = ClienteSupabase.create(SUPABASE_URL, SUPABASE_KEY)
     print("✅ Supabase conectado")
 except Exception as e:
     print(f"⚠️ Erro Supabase: {e}")
 
 # Inicializa OpenAI
 client = None
+async_client = None  # ⚡ Usado apenas no modo assíncrono (ASGI)
 if OPENAI_API_KEY:
     try:
-        client = OpenAI(api_key=OPENAI_API_KEY)
+        # Repetições ficam com o disjuntor por modelo (backoff + Retry-After), não com o SDK
+        client = OpenAI(api_key=OPENAI_API_KEY, max_retries=0)
+        async_client = AsyncOpenAI(api_key=OPENAI_API_KEY, max_retries=0)
         print("✅ OpenAI conectado")
     except Exception as e:
         print(f"⚠️ Erro OpenAI: {e}")
 
-# Cache e Memória
-CACHE_RESPOSTAS = {}
-HISTORICO_CONVERSAS = []
-historico_lock = threading.Lock()
+# =============================================================================
+# 💾 CACHE DE RESPOSTAS (LRU + TTL)
+# =============================================================================
+CACHE_RESPOSTAS_CONFIG = {
+    'max_itens': 2000,        # Respostas guardadas no máximo (LRU remove as mais antigas)
+    'ttl_segundos': 6 * 3600  # Validade de cada resposta
+}
 
-# 🧠 SISTEMA DE MEMÓRIA INTELIGENTE
-MEMORIA_USUARIOS = {}
-memoria_lock = threading.Lock()
-MAX_MENSAGENS_MEMORIA = 10
-INTERVALO_RESUMO = 5
+# Substitui o nome do usuário na resposta guardada (reposto no acerto)
+MARCADOR_NOME_CACHE = '\x00nome\x00'
 
-# 📊 CONTADOR DE MENSAGENS POR USUÁRIO
-CONTADOR_MENSAGENS = {}
-contador_lock = threading.Lock()
+class CacheRespostas:
+    """Cache LRU com expiração (TTL) e contadores de acerto, seguro entre threads"""
+    
+    def __init__(self, max_itens, ttl_segundos):
+        self.max_itens = max_itens
+        self.ttl_segundos = ttl_segundos
+        self.itens = OrderedDict()  # chave -> (expira_em, valor)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirados = 0
+    
+    def obter(self, chave):
+        agora = time.monotonic()
+        with self.lock:
+            item = self.itens.get(chave)
+            if item is None:
+                self.misses += 1
+                return None
+            
+            expira_em, valor = item
+            if agora >= expira_em:
+                del self.itens[chave]
+                self.expirados += 1
+                self.misses += 1
+                return None
+            
+            self.itens.move_to_end(chave)
+            self.hits += 1
+            return valor
+    
+    def armazenar(self, chave, valor, ttl=None):
+        """`ttl` opcional substitui a validade padrão só para este item"""
+        with self.lock:
+            self.itens[chave] = (time.monotonic() + (self.ttl_segundos if ttl is None else ttl), valor)
+            self.itens.move_to_end(chave)
+            while len(self.itens) > self.max_itens:
+                self.itens.popitem(last=False)
+                self.evictions += 1
+    
+    def remover(self, chave):
+        with self.lock:
+            return self.itens.pop(chave, None) is not None
+    
+    def limpar(self):
+        with self.lock:
+            self.itens.clear()
+    
+    def estatisticas(self):
+        with self.lock:
+            consultas = self.hits + self.misses
+            return {
+                'itens': len(self.itens),
+                'max_itens': self.max_itens,
+                'ttl_segundos': self.ttl_segundos,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirados': self.expirados,
+                'taxa_acerto': round(self.hits / consultas, 4) if consultas > 0 else 0
+            }
 
-# 📊 CONTADOR DE TOKENS POR USUÁRIO
-CONTADOR_TOKENS = {}
-tokens_lock = threading.Lock()
+def normalizar_mensagem_cache(mensagem):
+    """Minúsculas, sem acentos, espaços colapsados e sem pontuação final"""
+    texto = unicodedata.normalize('NFKD', mensagem.lower())
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    texto = ' '.join(texto.split())
+    return texto.rstrip('?!.,;: ')
 
-# Auto-ping
-def auto_ping():
-    while True:
-        try:
-            if RENDER_URL:
-                url = RENDER_URL if RENDER_URL.startswith('http') else f"https://{RENDER_URL}"
-                requests.get(f"{url}/health", timeout=10)
-                print(f"🏓 Ping OK: {datetime.now().strftime('%H:%M:%S')}")
-            else:
-                requests.get("https://natanai-dev.onrender.com/health", timeout=5)
-        except:
-            pass
-        time.sleep(300)
+def chave_cache_resposta(mensagem, tipo, historico_memoria=None):
+    """
+    Chave do cache: (tipo de plano, categoria, mensagem normalizada).
+    Retorna None quando a resposta não deve ser cacheada: admin, ou conversa
+    que já tem contexto (respostas anteriores/resumo mudam o sentido da pergunta).
+    """
+    if tipo == 'admin':
+        return None
+    if historico_memoria and any(m['role'] in ('assistant', 'system') for m in historico_memoria):
+        return None
+    
+    categoria, _ = detectar_categoria_mensagem(mensagem)
+    return (tipo, categoria, normalizar_mensagem_cache(mensagem))
 
-threading.Thread(target=auto_ping, daemon=True).start()
+def buscar_resposta_cache(chave, nome=None):
+    """Retorna o resultado cacheado (com 'cached': True e 0 tokens) ou None"""
+    if chave is None:
+        return None
+    
+    valor = CACHE_RESPOSTAS.obter(chave)
+    camada = 'exato'
+    similaridade = 1.0
+    
+    # 🧭 Segunda camada: pergunta parecida já respondida no mesmo plano/categoria.
+    # O acerto não vai para a camada exata: uma paráfrase errada ficaria 6h
+    # respondendo como se fosse a pergunta exata.
+    if valor is None and CACHE_SEMANTICO is not None:
+        tipo, categoria, texto = chave
+        valor, similaridade = CACHE_SEMANTICO.buscar(tipo, categoria, texto)
+        camada = 'semantico'
+    
+    if valor is None:
+        return None
+    
+    resultado = dict(valor)
+    resultado['resposta'] = resultado['resposta'].replace(MARCADOR_NOME_CACHE, nome or 'Cliente')
+    resultado['tokens_usados'] = 0
+    resultado['tokens_entrada'] = 0
+    resultado['tokens_saida'] = 0
+    resultado['tokens_cache'] = 0
+    resultado['cached'] = True
+    resultado['cache_camada'] = camada
+    resultado['similaridade'] = round(similaridade, 4)
+    return resultado
+
+def guardar_resposta_cache(chave, resultado, nome=None):
+    """Guarda um resultado bem-sucedido no cache (erros nunca são cacheados)"""
+    if chave is None or resultado.get('erro') or resultado.get('modelo_usado') in ('erro', 'N/A'):
+        return
+    
+    valor = {k: resultado[k] for k in ('resposta', 'modelo_usado', 'categoria', 'sistema_hibrido') if k in resultado}
+    if nome:
+        valor['resposta'] = re.sub(rf'\b{re.escape(nome)}\b', MARCADOR_NOME_CACHE, valor['resposta'])
+    CACHE_RESPOSTAS.armazenar(chave, valor)
+    
+    if CACHE_SEMANTICO is not None:
+        tipo, categoria, texto = chave
+        CACHE_SEMANTICO.armazenar(tipo, categoria, texto, valor)
 
 # =============================================================================
-# 📊 SISTEMA DE CONTROLE DE MENSAGENS
+# 🧭 CACHE SEMÂNTICO (SIMILARIDADE DE EMBEDDINGS)
 # =============================================================================
+# Segunda camada do cache: perguntas parafraseadas ("qual o preço do starter" x
+# "quanto custa o plano starter") reaproveitam a resposta quando a similaridade
+# de cosseno passa do limiar da categoria. Um índice por (plano, categoria).
+CACHE_SEMANTICO_CONFIG = {
+    'backend': os.getenv('CACHE_SEMANTICO_BACKEND', 'local'),  # 'local' (offline) ou 'openai'
+    'dimensoes': 256,
+    'max_itens_por_indice': 10000,
+    'ttl_segundos': 6 * 3600
+}
 
-def obter_contador_mensagens(user_id):
-    """Retorna o contador de mensagens do usuário"""
-    with contador_lock:
-        if user_id not in CONTADOR_MENSAGENS:
-            CONTADOR_MENSAGENS[user_id] = {
-                'total': 0,
-                'resetado_em': datetime.now().isoformat(),
-                'tipo_plano': 'starter'
-            }
-        return CONTADOR_MENSAGENS[user_id]
-
-def incrementar_contador(user_id, tipo_plano):
-    """Incrementa o contador de mensagens do usuário"""
-    with contador_lock:
-        if user_id not in CONTADOR_MENSAGENS:
-            CONTADOR_MENSAGENS[user_id] = {
-                'total': 0,
-                'resetado_em': datetime.now().isoformat(),
-                'tipo_plano': tipo_plano
-            }
-        
-        CONTADOR_MENSAGENS[user_id]['total'] += 1
-        CONTADOR_MENSAGENS[user_id]['tipo_plano'] = tipo_plano
-        
-        return CONTADOR_MENSAGENS[user_id]['total']
+# Limiar mínimo de similaridade por categoria (cada backend tem sua escala).
+# Os do 'local' foram ajustados com os pares rotulados de tests/test_cache.py.
+CACHE_SEMANTICO_LIMIARES = {
+    'local': {
+        'saudacao': 0.90,
+        'despedida': 0.90,
+        'casual': 0.92,
+        'confirmacao': 0.97,
+        'explicacao_simples': 0.85,
+        'planos_valores': 0.80,
+        'tecnico': 0.90,
+        'complexo': 0.92
+    },
+    'openai': {
+        'saudacao': 0.90,
+        'despedida': 0.90,
+        'casual': 0.92,
+        'confirmacao': 0.96,
+        'explicacao_simples': 0.90,
+        'planos_valores': 0.88,
+        'tecnico': 0.92,
+        'complexo': 0.93
+    }
+}
 
-def verificar_limite_mensagens(user_id, tipo_plano):
+# Palavras sem peso na comparação e sinônimos do domínio. Cada canal de
+# contato fica com seu próprio token: "qual o email?" não é "qual o telefone?".
+STOPWORDS_SEMANTICO = {
+    'o', 'a', 'os', 'as', 'de', 'do', 'da', 'dos', 'das', 'e', 'um', 'uma', 'uns', 'umas',
+    'que', 'para', 'pra', 'pro', 'com', 'no', 'na', 'nos', 'nas', 'em', 'me', 'eu', 'voce',
+    'vc', 'voces', 'te', 'se', 'ao', 'aos', 'por', 'pelo', 'pela', 'mais', 'muito', 'qual',
+    'quais', 'quanto', 'quanta', 'como', 'onde', 'ser', 'sao', 'esta', 'isso', 'esse', 'essa',
+    'meu', 'minha', 'seu', 'sua', 'fica', 'sai', 'tem', 'tenho', 'ter', 'vem'
+}
+
+SINONIMOS_SEMANTICO = {
+    'preco': 'preco', 'precos': 'preco', 'valor': 'preco', 'valores': 'preco', 'custa': 'preco',
+    'custo': 'preco', 'mensalidade': 'preco', 'cobra': 'preco', 'cobram': 'preco', 'quanto': 'preco',
+    'whatsapp': 'whatsapp', 'whats': 'whatsapp', 'zap': 'whatsapp', 'wpp': 'whatsapp',
+    'telefone': 'telefone', 'fone': 'telefone', 'celular': 'telefone', 'ligar': 'telefone',
+    'email': 'email', 'mail': 'email', 'emails': 'email',
+    'entregar': 'entrega', 'entregam': 'entrega', 'entregue': 'entrega',
+    'ola': 'oi', 'oie': 'oi', 'eai': 'oi', 'hey': 'oi',
+    'profissional': 'professional', 'pro': 'professional',
+    'sites': 'site', 'planos': 'plano', 'contatos': 'contato', 'numeros': 'numero'
+}
+
+# Genéricas no domínio: só contam quando a pergunta não tem mais nada
+# ("quais são os planos?"); senão "plano"/"site" aproximariam perguntas diferentes
+PALAVRAS_FRACAS_SEMANTICO = {'plano', 'site', 'contato', 'numero'}
+
+class VetorizadorNgramHash:
     """
-    Verifica se o usuário atingiu o limite de mensagens.
-    Retorna: (pode_enviar: bool, mensagens_usadas: int, limite: int, mensagens_restantes: int)
+    Embedding local (offline): palavras + n-gramas de caracteres com hashing
+    assinado em um vetor de tamanho fixo, normalizado (cosseno = produto escalar).
     """
-    tipo = tipo_plano.lower().strip()
-    limite = LIMITES_MENSAGENS.get(tipo, LIMITES_MENSAGENS['starter'])
     
-    # Admin tem ilimitado
-    if tipo == 'admin':
-        return True, 0, float('inf'), float('inf')
+    nome = 'local'
     
-    contador = obter_contador_mensagens(user_id)
-    mensagens_usadas = contador['total']
-    mensagens_restantes = limite - mensagens_usadas
+    def __init__(self, dimensoes=256, n=3):
+        self.dimensoes = dimensoes
+        self.n = n
     
-    pode_enviar = mensagens_usadas < limite
+    def _palavras(self, texto):
+        brutas = re.findall(r'\w+', normalizar_mensagem_cache(texto))
+        palavras, fracas = {}, {}  # dicts: sem repetição, na ordem
+        for palavra in brutas:
+            palavra = SINONIMOS_SEMANTICO.get(palavra, palavra)
+            if palavra in PALAVRAS_FRACAS_SEMANTICO:
+                fracas[palavra] = None
+            elif palavra not in STOPWORDS_SEMANTICO:
+                palavras[palavra] = None
+        return list(palavras or fracas) or brutas
     
-    return pode_enviar, mensagens_usadas, limite, max(0, mensagens_restantes)
-
-def resetar_contador_usuario(user_id):
-    """Reseta o contador de mensagens de um usuário"""
-    with contador_lock:
-        if user_id in CONTADOR_MENSAGENS:
-            CONTADOR_MENSAGENS[user_id]['total'] = 0
-            CONTADOR_MENSAGENS[user_id]['resetado_em'] = datetime.now().isoformat()
-            print(f"🔄 Contador resetado para user: {user_id[:8]}...")
-            return True
-        return False
-
-def gerar_mensagem_limite_atingido(tipo_plano, mensagens_usadas, limite):
-    """Gera mensagem personalizada quando o limite é atingido"""
-    tipo = tipo_plano.lower().strip()
+    def _vetorizar(self, texto):
+        vetor = np.zeros(self.dimensoes, dtype=np.float32)
+        for palavra in self._palavras(texto):
+            # Palavra inteira pesa mais que cada n-grama (diferencia "starter" de "professional")
+            atributos = [('w:' + palavra, 2.0)]
+            marcada = f' {palavra} '
+            atributos.extend((marcada[i:i + self.n], 0.5) for i in range(max(1, len(marcada) - self.n + 1)))
+            
+            for atributo, peso in atributos:
+                h = zlib.crc32(atributo.encode('utf-8'))
+                vetor[h % self.dimensoes] += peso if h & 0x80000000 else -peso
+        
+        norma = np.linalg.norm(vetor)
+        return vetor / norma if norma else vetor
     
-    if tipo == 'free':
-        return f"""Você atingiu o limite de {limite} mensagens por semana do seu teste grátis.
-
-Para continuar conversando comigo, contrate um dos planos:
-
-STARTER - R$320 (setup) + R$39,99/mês
-- 1.250 mensagens/mês comigo
-- Site profissional até 5 páginas
-- Hospedagem inclusa
-
-PROFESSIONAL - R$530 (setup) + R$79,99/mês
-- 5.000 mensagens/mês comigo
-- Site 100% personalizado
-- Recursos avançados
-
-Entre em contato:
-WhatsApp: (21) 99282-6074
-Email: borgesnatan09@gmail.com
+    def vetorizar(self, textos):
+        return np.vstack([self._vetorizar(t) for t in textos])
 
-Vibrações Positivas! ✨"""
+class EmbeddingsOpenAI:
+    """Embeddings da OpenAI (text-embedding-3-small) com dimensões reduzidas"""
     
-    elif tipo == 'starter':
-        return f"""Você atingiu o limite de {limite} mensagens do plano Starter este mês.
-
-Opções:
-1. Upgrade para Professional (5.000 msgs/mês)
-2. Aguardar renovação mensal
-
-Acesse a página Suporte para falar com Natan pessoalmente!
-
-Vibrações Positivas! ✨"""
+    nome = 'openai'
     
-    elif tipo == 'professional':
-        return f"""Você atingiu o limite de {limite} mensagens do plano Professional este mês.
-
-Para soluções personalizadas ou aumento de limite, acesse a página Suporte para falar com Natan!
-
-Vibrações Positivas! ✨"""
+    def __init__(self, dimensoes=256, modelo='text-embedding-3-small'):
+        self.dimensoes = dimensoes
+        self.modelo = modelo
     
-    return "Limite de mensagens atingido. Entre em contato com o suporte."
-
-# =============================================================================
-# 📊 SISTEMA DE CONTAGEM DE TOKENS
-# =============================================================================
+    def vetorizar(self, textos):
+        response = client.embeddings.create(model=self.modelo, input=textos, dimensions=self.dimensoes)
+        vetores = np.array([d.embedding for d in response.data], dtype=np.float32)
+        return vetores / np.linalg.norm(vetores, axis=1, keepdims=True)
+
+# Backends disponíveis: qualquer classe com `nome`, `dimensoes` e vetorizar(textos)
+BACKENDS_EMBEDDING = {
+    'local': VetorizadorNgramHash,
+    'openai': EmbeddingsOpenAI
+}
 
-def registrar_tokens_usados(user_id, tokens_entrada, tokens_saida, tokens_total, modelo_usado):
-    """Registra tokens usados por um usuário"""
-    with tokens_lock:
-        if user_id not in CONTADOR_TOKENS:
-            CONTADOR_TOKENS[user_id] = {
-                'total_entrada': 0,
-                'total_saida': 0,
-                'total_geral': 0,
-                'mensagens_processadas': 0,
-                'modelo': modelo_usado
-            }
+class IndiceSemantico:
+    """
+    Vizinho mais próximo em matrizes NumPy compactas (float32, linhas normalizadas).
+    Até IVF_MIN_ITENS faz busca exata na matriz inteira; acima disso usa índice
+    invertido (IVF): os vetores são agrupados em ~sqrt(n) centróides, cada grupo
+    guardado em uma matriz contígua, e a busca só varre os NPROBE grupos mais
+    próximos, mantendo a consulta abaixo de 1 ms com 100 mil itens.
+    Cheio, sobrescreve o item mais antigo (buffer circular).
+    """
+    
+    IVF_MIN_ITENS = 4096
+    NPROBE = 4
+    
+    def __init__(self, dimensoes, max_itens, ttl_segundos):
+        self.dimensoes = dimensoes
+        self.max_itens = max_itens
+        self.ttl_segundos = ttl_segundos
+        self.vetores = np.zeros((min(64, max_itens), dimensoes), dtype=np.float32)
+        self.expira_em = np.zeros(max_itens, dtype=np.float64)
+        self.valores = [None] * max_itens
+        self.total = 0
+        self.proximo = 0  # próximo slot a sobrescrever quando cheio
+        self.total_no_treino = 0
+        # IVF (após o treino os vetores passam a viver só nas matrizes dos grupos)
+        self.centroides = None
+        self.grupo_vetores = []
+        self.grupo_slots = []
+        self.grupo_tamanho = []
+        self.grupo_de = np.full(max_itens, -1, dtype=np.int64)
+        self.posicao = np.zeros(max_itens, dtype=np.int64)
+        self.lock = threading.Lock()
+    
+    def _todos_vetores(self):
+        """Matriz (total x dimensoes) indexada por slot"""
+        if self.centroides is None:
+            return self.vetores[:self.total]
+        todos = np.zeros((self.total, self.dimensoes), dtype=np.float32)
+        for g, tamanho in enumerate(self.grupo_tamanho):
+            todos[self.grupo_slots[g][:tamanho]] = self.grupo_vetores[g][:tamanho]
+        return todos
+    
+    def _treinar(self):
+        """(Re)constrói o IVF com k-means esférico sobre uma amostra"""
+        vetores = self._todos_vetores()
+        n = len(vetores)
+        qtd_grupos = max(1, int(math.sqrt(n)))
+        amostra = vetores[np.random.choice(n, min(n, qtd_grupos * 32), replace=False)]
+        centroides = amostra[np.random.choice(len(amostra), qtd_grupos, replace=False)].copy()
         
-        CONTADOR_TOKENS[user_id]['total_entrada'] += tokens_entrada
-        CONTADOR_TOKENS[user_id]['total_saida'] += tokens_saida
-        CONTADOR_TOKENS[user_id]['total_geral'] += tokens_total
-        CONTADOR_TOKENS[user_id]['mensagens_processadas'] += 1
-        CONTADOR_TOKENS[user_id]['modelo'] = modelo_usado
-
-def obter_estatisticas_tokens(user_id):
-    """Retorna estatísticas de tokens de um usuário"""
-    with tokens_lock:
-        if user_id not in CONTADOR_TOKENS:
-            return {
-                'total_entrada': 0,
-                'total_saida': 0,
-                'total_geral': 0,
-                'mensagens_processadas': 0,
-                'media_por_mensagem': 0,
-                'modelo': 'N/A'
-            }
+        for _ in range(4):
+            rotulos = np.argmax(amostra @ centroides.T, axis=1)
+            for g in range(qtd_grupos):
+                membros = amostra[rotulos == g]
+                if len(membros):
+                    centroides[g] = membros.sum(axis=0)
+            centroides /= np.maximum(np.linalg.norm(centroides, axis=1, keepdims=True), 1e-12)
         
-        stats = CONTADOR_TOKENS[user_id].copy()
-        if stats['mensagens_processadas'] > 0:
-            stats['media_por_mensagem'] = round(stats['total_geral'] / stats['mensagens_processadas'], 2)
-        else:
-            stats['media_por_mensagem'] = 0
+        rotulos = np.concatenate([
+            np.argmax(vetores[inicio:inicio + 8192] @ centroides.T, axis=1)
+            for inicio in range(0, n, 8192)
+        ])
         
-        return stats
+        self.centroides = centroides
+        self.grupo_vetores, self.grupo_slots, self.grupo_tamanho = [], [], []
+        for g in range(qtd_grupos):
+            slots = np.flatnonzero(rotulos == g)
+            capacidade = max(16, 2 * len(slots))
+            matriz = np.zeros((capacidade, self.dimensoes), dtype=np.float32)
+            matriz[:len(slots)] = vetores[slots]
+            slots_grupo = np.zeros(capacidade, dtype=np.int64)
+            slots_grupo[:len(slots)] = slots
+            self.grupo_vetores.append(matriz)
+            self.grupo_slots.append(slots_grupo)
+            self.grupo_tamanho.append(len(slots))
+            self.grupo_de[slots] = g
+            self.posicao[slots] = np.arange(len(slots))
+        
+        self.vetores = None
+        self.total_no_treino = n
     
-# =============================================================================
-# 🆘 SISTEMA DE RESPOSTA ALTERNATIVA (SEM IA)
-# =============================================================================
+    def _inserir_no_grupo(self, slot, vetor):
+        g = int(np.argmax(self.centroides @ vetor))
+        tamanho = self.grupo_tamanho[g]
+        if tamanho == len(self.grupo_slots[g]):
+            self.grupo_vetores[g] = np.vstack([self.grupo_vetores[g], np.zeros_like(self.grupo_vetores[g])])
+            self.grupo_slots[g] = np.concatenate([self.grupo_slots[g], np.zeros_like(self.grupo_slots[g])])
+        self.grupo_vetores[g][tamanho] = vetor
+        self.grupo_slots[g][tamanho] = slot
+        self.grupo_de[slot] = g
+        self.posicao[slot] = tamanho
+        self.grupo_tamanho[g] = tamanho + 1
+    
+    def _remover_do_grupo(self, slot):
+        # Troca com o último do grupo para manter a matriz contígua
+        g = self.grupo_de[slot]
+        pos = self.posicao[slot]
+        ultimo = self.grupo_tamanho[g] - 1
+        slot_ultimo = self.grupo_slots[g][ultimo]
+        self.grupo_vetores[g][pos] = self.grupo_vetores[g][ultimo]
+        self.grupo_slots[g][pos] = slot_ultimo
+        self.posicao[slot_ultimo] = pos
+        self.grupo_tamanho[g] = ultimo
+    
+    def adicionar(self, vetor, valor):
+        with self.lock:
+            if self.total < self.max_itens:
+                slot = self.total
+                self.total += 1
+            else:
+                slot = self.proximo
+                self.proximo = (self.proximo + 1) % self.max_itens
+                if self.centroides is not None:
+                    self._remover_do_grupo(slot)
+            
+            self.expira_em[slot] = time.monotonic() + self.ttl_segundos
+            self.valores[slot] = valor
+            
+            if self.centroides is not None:
+                self._inserir_no_grupo(slot, vetor)
+            else:
+                if slot >= len(self.vetores):
+                    capacidade = min(len(self.vetores) * 2, self.max_itens)
+                    self.vetores = np.vstack([
+                        self.vetores, np.zeros((capacidade - len(self.vetores), self.dimensoes), dtype=np.float32)
+                    ])
+                self.vetores[slot] = vetor
+            
+            if self.total >= self.IVF_MIN_ITENS and self.total >= 2 * self.total_no_treino:
+                self._treinar()
+    
+    def buscar(self, vetor, limiar):
+        """Retorna (valor, similaridade) do vizinho mais próximo válido, ou (None, melhor_similaridade)"""
+        agora = time.monotonic()
+        with self.lock:
+            if self.total == 0:
+                return None, 0.0
+            
+            if self.centroides is None:
+                blocos = [(self.vetores[:self.total], np.arange(self.total))]
+            else:
+                nprobe = min(self.NPROBE, len(self.grupo_tamanho))
+                proximos = np.argpartition(-(self.centroides @ vetor), nprobe - 1)[:nprobe]
+                blocos = [
+                    (self.grupo_vetores[g][:self.grupo_tamanho[g]], self.grupo_slots[g][:self.grupo_tamanho[g]])
+                    for g in proximos if self.grupo_tamanho[g]
+                ]
+            
+            melhor_slot, melhor_similaridade = -1, -1.0
+            for matriz, slots in blocos:
+                similaridades = np.where(self.expira_em[slots] > agora, matriz @ vetor, -1.0)
+                i = int(np.argmax(similaridades))
+                if similaridades[i] > melhor_similaridade:
+                    melhor_slot, melhor_similaridade = int(slots[i]), float(similaridades[i])
+            
+            if melhor_similaridade < limiar:
+                return None, max(melhor_similaridade, 0.0)
+            return self.valores[melhor_slot], melhor_similaridade
 
-def gerar_resposta_alternativa_inteligente(pergunta, tipo_usuario):
-    """
-    Sistema de respostas automáticas quando limite de IA acaba.
-    Usa padrões e keywords para responder sem consumir API.
-    """
-    msg_lower = pergunta.lower().strip()
-    nome = tipo_usuario.get('nome_real', 'Cliente')
-    tipo = tipo_usuario.get('tipo', 'starter')
+class CacheSemantico:
+    """Cache por similaridade com um IndiceSemantico por (escopo/plano, categoria)"""
     
-    # 🎯 RESPOSTAS POR CATEGORIA
+    def __init__(self, backend, limiares, max_itens_por_indice, ttl_segundos):
+        self.backend = backend
+        self.limiares = limiares
+        self.max_itens_por_indice = max_itens_por_indice
+        self.ttl_segundos = ttl_segundos
+        self.indices = {}
+        self.vetores_recentes = OrderedDict()  # evita recalcular o embedding ao guardar
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.erros = 0
     
-    # SAUDAÇÕES
-    if any(kw in msg_lower for kw in ['oi', 'olá', 'ola', 'hey', 'bom dia', 'boa tarde', 'boa noite', 'e ai', 'eai']):
-        return f"Oi {nome}! Seus créditos de IA acabaram este mês, mas posso te ajudar com informações básicas. Como posso ajudar?"
+    def _vetor(self, texto):
+        with self.lock:
+            vetor = self.vetores_recentes.get(texto)
+        if vetor is None:
+            vetor = self.backend.vetorizar([texto])[0]
+            with self.lock:
+                self.vetores_recentes[texto] = vetor
+                if len(self.vetores_recentes) > 1024:
+                    self.vetores_recentes.popitem(last=False)
+        return vetor
     
-    # DESPEDIDAS
-    if any(kw in msg_lower for kw in ['tchau', 'até', 'falou', 'obrigado', 'obrigada', 'valeu']):
-        return f"Até logo {nome}! Seus créditos de IA renovam no próximo mês. Vibrações Positivas! ✨"
+    def buscar(self, escopo, categoria, texto):
+        """Retorna (valor, similaridade) ou (None, 0.0). Erros do backend contam como miss."""
+        indice = self.indices.get((escopo, categoria))
+        if indice is None:
+            with self.lock:
+                self.misses += 1
+            return None, 0.0
+        
+        try:
+            valor, similaridade = indice.buscar(self._vetor(texto), self.limiares.get(categoria, 0.95))
+        except Exception as e:
+            print(f"⚠️ Erro no cache semântico: {e}")
+            with self.lock:
+                self.erros += 1
+                self.misses += 1
+            return None, 0.0
+        
+        with self.lock:
+            if valor is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return valor, similaridade
     
-    # PLANOS E PREÇOS
-    if any(kw in msg_lower for kw in ['plano', 'preço', 'valor', 'custo', 'quanto custa', 'mensalidade', 'contratar']):
-        return f"""Olá {nome}! Aqui estão nossos planos:
+    def armazenar(self, escopo, categoria, texto, valor):
+        try:
+            vetor = self._vetor(texto)
+        except Exception as e:
+            print(f"⚠️ Erro no cache semântico: {e}")
+            with self.lock:
+                self.erros += 1
+            return
+        
+        with self.lock:
+            indice = self.indices.get((escopo, categoria))
+            if indice is None:
+                indice = IndiceSemantico(self.backend.dimensoes, self.max_itens_por_indice, self.ttl_segundos)
+                self.indices[(escopo, categoria)] = indice
+        indice.adicionar(vetor, valor)
+    
+    def estatisticas(self):
+        with self.lock:
+            consultas = self.hits + self.misses
+            return {
+                'backend': self.backend.nome,
+                'indices': len(self.indices),
+                'itens': sum(i.total for i in self.indices.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'erros': self.erros,
+                'taxa_acerto': round(self.hits / consultas, 4) if consultas > 0 else 0
+            }
 
-FREE - R$0,00 (teste 1 ano)
-- 100 mensagens/semana comigo
-- Sites básicos sem uso comercial
+def criar_cache_semantico():
+    """Cria o cache semântico com o backend configurado (None se NumPy indisponível)"""
+    if np is None:
+        print("⚠️ NumPy não instalado: cache semântico desativado")
+        return None
+    
+    nome_backend = CACHE_SEMANTICO_CONFIG['backend']
+    if nome_backend not in BACKENDS_EMBEDDING:
+        print(f"⚠️ Backend de embedding desconhecido '{nome_backend}', usando 'local'")
+        nome_backend = 'local'
+    
+    backend = BACKENDS_EMBEDDING[nome_backend](dimensoes=CACHE_SEMANTICO_CONFIG['dimensoes'])
+    return CacheSemantico(
+        backend,
+        CACHE_SEMANTICO_LIMIARES[nome_backend],
+        CACHE_SEMANTICO_CONFIG['max_itens_por_indice'],
+        CACHE_SEMANTICO_CONFIG['ttl_segundos']
+    )
 
-STARTER - R$320 (setup) + R$39,99/mês
-- 1.250 mensagens/mês comigo
-- Site até 5 páginas
-- Hospedagem inclusa
-- Uso comercial
+# Cache e Memória
+CACHE_RESPOSTAS = CacheRespostas(
+    max_itens=CACHE_RESPOSTAS_CONFIG['max_itens'],
+    ttl_segundos=CACHE_RESPOSTAS_CONFIG['ttl_segundos']
+)
+CACHE_SEMANTICO = criar_cache_semantico()
+HISTORICO_CONVERSAS = []
+historico_lock = threading.Lock()
 
-PROFESSIONAL - R$530 (setup) + R$79,99/mês
-- 5.000 mensagens/mês comigo
-- Páginas ilimitadas
-- Design personalizado
-- SEO avançado
+# =============================================================================
+# 👤 ESTADO POR USUÁRIO - UM REGISTRO COMPACTO
+# =============================================================================
+# Contador de mensagens, contador de tokens e memória da conversa de um usuário
+# ficam num único EstadoUsuario (__slots__) em USUARIOS, sob um único lock: uma
+# consulta ao dicionário em vez de três, em três locks. Os turnos ficam num
+# deque de tamanho fixo (o mais antigo sai sozinho) como tuplas (role, content),
+# os tokens num array de inteiros e os instantes em float — monotônico para a
+# idade na RAM, epoch no que vai para o backend —, nada de datas ISO refeitas a
+# cada verificação. Seção que o usuário não usou fica None (quem só consultou a
+# cota não paga o deque da memória).
+# No backend de estado as tabelas continuam as de antes ('mensagens', 'tokens',
+# 'memoria', cada uma com seu TTL): TabelaUsuarios é a visão de uma delas sobre
+# USUARIOS, convertendo de/para o registro gravado.
 
-Contato:
-WhatsApp: (21) 99282-6074
-Site: https://natansites.com.br"""
-    
-    # CONTATO
-    if any(kw in msg_lower for kw in ['contato', 'whatsapp', 'telefone', 'email', 'falar']):
-        return f"""Fale com Natan diretamente:
+MAX_MENSAGENS_MEMORIA = 10
+MENSAGENS_RECENTES_CONTEXTO = 3
+
+# 🧹 Conversas na RAM: vencem `ttl_segundos` depois do último acesso e são no
+# máximo `max_usuarios` (a menos usada sai primeiro)
+MEMORIA_CONFIG = {
+    'ttl_segundos': int(os.getenv('MEMORIA_TTL_SEGUNDOS', '3600')),
+    'max_usuarios': int(os.getenv('MEMORIA_MAX_USUARIOS', '50000')),
+    'lote_por_acesso': 4,       # vencidas tiradas a cada mensagem
+    'lote_fundo': 256,          # por rodada da thread (o lock é solto entre rodadas)
+    'intervalo_fundo': 10.0
+}
 
-WhatsApp: (21) 99282-6074
-Email: borgesnatan09@gmail.com
-Site: https://natansites.com.br
+# Ordem dos contadores no array de tokens
+CAMPOS_TOKENS = ('total_entrada', 'total_saida', 'total_geral', 'total_cache',
+                 'mensagens_processadas', 'mensagens_coalescidas')
 
-Atendimento pessoal para clientes!"""
-    
-    # PORTFÓLIO
-    if any(kw in msg_lower for kw in ['portfolio', 'portfólio', 'projetos', 'trabalhos', 'sites feitos']):
-        return f"""Confira alguns projetos do Natan:
+def epoch_de_monotonico(instante):
+    return time.time() - (time.monotonic() - instante)
 
-1. Espaço Familiares - espacofamiliares.com.br
-2. NatanSites - natansites.com.br
-3. MathWork - mathworkftv.netlify.app
-4. TAF Sem Tabu - tafsemtabu.com.br
+def monotonico_de_epoch(instante):
+    return time.monotonic() - max(0.0, time.time() - instante)
 
-E mais! Visite natansites.com.br para ver todos."""
-    
-    # COMO FUNCIONA
-    if any(kw in msg_lower for kw in ['como funciona', 'processo', 'etapas', 'passo a passo']):
-        return f"""Processo simples:
+def turnos_como_mensagens(turnos):
+    return [{'role': role, 'content': content} for role, content in turnos]
 
-1. Escolha seu plano
-2. Preencha formulário de cadastro
-3. Efetue pagamento PIX
-4. Aguarde 10min a 2h para criação da conta
-5. Comece a usar!
+def mensagens_como_turnos(mensagens):
+    return [(sys.intern(m['role']), m['content']) for m in mensagens]
 
-WhatsApp: (21) 99282-6074"""
+class EstadoUsuario:
+    """Tudo o que o processo guarda de um usuário autenticado"""
     
-    # TECNOLOGIAS
-    if any(kw in msg_lower for kw in ['tecnologia', 'stack', 'linguagem', 'framework', 'código']):
-        return f"""Stack do Natan:
-
-Front-end: HTML5, CSS3, JavaScript, React, Vue, TypeScript, Tailwind
-Back-end: Node.js, Python, Express.js, APIs
-Mobile: React Native
-Banco: Supabase, PostgreSQL
-IA: OpenAI, Claude
-
-Especialidades: IA, SEO, Animações Web"""
+    __slots__ = (
+        # 📊 Mensagens (janela_inicio None = sem contador)
+        'total', 'janela_inicio', 'tipo_plano', 'resetado_em',
+        # 📊 Tokens (None = nada registrado), na ordem de CAMPOS_TOKENS
+        'tokens', 'modelo',
+        # 🧠 Memória (turnos None = sem conversa na RAM)
+        'turnos', 'nao_resumidas', 'resumo', 'contador_memoria', 'atualizado_em'
+    )
     
-    # SUPORTE
-    if any(kw in msg_lower for kw in ['suporte', 'ajuda', 'problema', 'bug', 'erro', 'não funciona']):
-        if tipo == 'free':
-            return f"""Para suporte, entre em contato:
-WhatsApp: (21) 99282-6074
+    def __init__(self):
+        self.total = 0
+        self.janela_inicio = None
+        self.tipo_plano = None
+        self.resetado_em = 0.0
+        self.tokens = None
+        self.modelo = None
+        self.turnos = None
+        self.nao_resumidas = None
+        self.resumo = ''
+        self.contador_memoria = 0
+        self.atualizado_em = 0.0
+    
+    def vazio(self):
+        return self.janela_inicio is None and self.tokens is None and self.turnos is None
+    
+    # 📊 Mensagens
+    
+    def iniciar_contador(self, tipo_plano):
+        if self.janela_inicio is None:
+            self.total = 0
+            self.janela_inicio = janela_vigente(tipo_plano)[0]
+            self.tipo_plano = tipo_plano
+            self.resetado_em = time.time()
+    
+    def renovar_contador(self, inicio):
+        self.total = 0
+        self.janela_inicio = inicio
+        self.resetado_em = time.time()
+    
+    def exportar_mensagens(self):
+        if self.janela_inicio is None:
+            return None
+        return {'total': self.total, 'resetado_em': self.resetado_em,
+                'janela_inicio': self.janela_inicio, 'tipo_plano': self.tipo_plano}
+    
+    def importar_mensagens(self, registro):
+        resetado_em = registro.get('resetado_em') or 0.0
+        if isinstance(resetado_em, str):  # registros antigos guardavam o ISO
+            resetado_em = datetime.fromisoformat(resetado_em).timestamp()
+        self.total = registro.get('total', 0)
+        self.janela_inicio = sys.intern(registro.get('janela_inicio', ''))
+        self.tipo_plano = sys.intern(registro.get('tipo_plano') or 'starter')
+        self.resetado_em = resetado_em
+    
+    def descartar_mensagens(self):
+        self.total, self.janela_inicio, self.tipo_plano = 0, None, None
+    
+    # 📊 Tokens
+    
+    def somar_tokens(self, valores, modelo):
+        if self.tokens is None:
+            self.tokens = array('q', bytes(8 * len(CAMPOS_TOKENS)))
+        for i, valor in enumerate(valores):
+            self.tokens[i] += valor
+        self.modelo = modelo
+    
+    def exportar_tokens(self):
+        if self.tokens is None:
+            return None
+        return dict(zip(CAMPOS_TOKENS, self.tokens), modelo=self.modelo)
+    
+    def importar_tokens(self, registro):
+        self.tokens = array('q', (int(registro.get(campo, 0)) for campo in CAMPOS_TOKENS))
+        self.modelo = registro.get('modelo')
+    
+    def descartar_tokens(self):
+        self.tokens = self.modelo = None
+    
+    # 🧠 Memória
+    
+    def iniciar_memoria(self):
+        if self.turnos is None:
+            self.turnos = deque(maxlen=MAX_MENSAGENS_MEMORIA)
+            self.nao_resumidas = []
+            self.resumo = ''
+            self.contador_memoria = 0
+            self.atualizado_em = time.monotonic()
+    
+    def adicionar_turno(self, role, content):
+        self.iniciar_memoria()
+        self.turnos.append((role, content))
+        self.contador_memoria += 1
+        self.atualizado_em = time.monotonic()
+        # O turno que sai da janela recente entra na fila do resumo incremental;
+        # assim o deque, ao descartar o mais antigo, nunca perde nada não resumido
+        if len(self.turnos) > MENSAGENS_RECENTES_CONTEXTO:
+            self.nao_resumidas.append(self.turnos[-MENSAGENS_RECENTES_CONTEXTO - 1])
+    
+    def exportar_memoria(self):
+        if self.turnos is None:
+            return None
+        return {
+            'mensagens': turnos_como_mensagens(self.turnos),
+            'resumo': self.resumo,
+            'nao_resumidas': turnos_como_mensagens(self.nao_resumidas),
+            'ultima_atualizacao': epoch_de_monotonico(self.atualizado_em),
+            'contador_mensagens': self.contador_memoria
+        }
+    
+    def importar_memoria(self, registro):
+        self.turnos = deque(mensagens_como_turnos(registro.get('mensagens', ())), maxlen=MAX_MENSAGENS_MEMORIA)
+        self.nao_resumidas = mensagens_como_turnos(registro.get('nao_resumidas', ()))
+        self.resumo = registro.get('resumo', '')
+        self.contador_memoria = registro.get('contador_mensagens', 0)
+        # Idade real da conversa (o acesso pode ter sido em outro worker)
+        ultima_atualizacao = registro.get('ultima_atualizacao')
+        if isinstance(ultima_atualizacao, str):  # registros antigos guardavam o ISO
+            ultima_atualizacao = datetime.fromisoformat(ultima_atualizacao).timestamp()
+        self.atualizado_em = monotonico_de_epoch(ultima_atualizacao) if ultima_atualizacao else time.monotonic()
+    
+    def descartar_memoria(self):
+        self.turnos = self.nao_resumidas = None
+        self.resumo = ''
+        self.contador_memoria = 0
 
-Clientes pagos têm acesso à página Suporte com chat direto!"""
-        else:
-            return f"""Acesse a página SUPORTE no menu para falar diretamente com o Natan!
+class TabelaUsuarios:
+    """
+    Uma tabela do estado ('mensagens' | 'tokens' | 'memoria') vista como um
+    dicionário de registros sobre USUARIOS: é o que o ArmazemEstado (carregar,
+    sincronizar) e o MotorCotas (total usado) enxergam. Chamar com o
+    usuarios_lock, como os dicionários que ela substituiu. A da memória avisa
+    as ConversasLRU do que chega e sai do backend.
+    """
+    
+    def __init__(self, usuarios, secao, conversas=None):
+        self.usuarios = usuarios
+        self.conversas = conversas
+        self.exportar = getattr(EstadoUsuario, 'exportar_' + secao)
+        self.importar = getattr(EstadoUsuario, 'importar_' + secao)
+        self.descartar = getattr(EstadoUsuario, 'descartar_' + secao)
+    
+    def get(self, chave, padrao=None):
+        estado = self.usuarios.get(chave)
+        registro = self.exportar(estado) if estado is not None else None
+        return padrao if registro is None else registro
+    
+    def __setitem__(self, chave, registro):
+        estado = self.usuarios.get(chave)
+        if estado is None:
+            estado = self.usuarios[chave] = EstadoUsuario()
+        self.importar(estado, registro)
+        if self.conversas is not None:
+            self.conversas.tocar(chave)
+    
+    def pop(self, chave, padrao=None):
+        estado = self.usuarios.get(chave)
+        if estado is None:
+            return padrao
+        registro = self.exportar(estado)
+        self.descartar(estado)
+        if self.conversas is not None:
+            self.conversas.esquecer(chave)
+        if estado.vazio():
+            del self.usuarios[chave]
+        return padrao if registro is None else registro
+    
+    def update(self, dados):
+        for chave, registro in dados.items():
+            self[chave] = registro
 
-Você tem suporte prioritário como cliente {tipo.upper()}."""
+class ConversasLRU:
+    """
+    Usuários com conversa na RAM, do acesso mais antigo ao mais recente
+    (OrderedDict). As vencidas ficam na frente: saem de lá poucas por vez e a
+    primeira ainda válida encerra a busca, então o custo acompanha o que vence,
+    nunca o total de usuários. Passando de `max_usuarios`, a menos usada sai
+    mesmo sem ter vencido. Só a conversa sai da RAM: os contadores de cota
+    ficam, e com backend persistente a conversa volta na próxima leitura.
+    Chamar com o usuarios_lock.
+    """
     
-    # CADASTRO
-    if any(kw in msg_lower for kw in ['cadastro', 'cadastrar', 'registrar', 'criar conta', 'sign up']):
-        return f"""Para se cadastrar:
+    def __init__(self, usuarios, ttl_segundos, max_usuarios):
+        self.usuarios = usuarios
+        self.ttl_segundos = ttl_segundos
+        self.max_usuarios = max_usuarios
+        self.ordem = OrderedDict()  # user_id -> None
+        self.expiradas = 0
+        self.despejadas = 0
+        self.rodadas = 0
+    
+    def vencida(self, estado, agora=None):
+        return (agora or time.monotonic()) - estado.atualizado_em > self.ttl_segundos
+    
+    def tocar(self, user_id):
+        """Conversa acessada agora: vai para o fim (a mais recente)"""
+        if user_id in self.ordem:
+            self.ordem.move_to_end(user_id)
+            return
+        self.ordem[user_id] = None
+        while len(self.ordem) > self.max_usuarios:
+            self.descartar(self.ordem.popitem(last=False)[0])
+            self.despejadas += 1
+    
+    def esquecer(self, user_id):
+        self.ordem.pop(user_id, None)
+    
+    def expirar(self, lote, agora=None):
+        """Tira da frente até `lote` conversas vencidas; retorna quantas saíram"""
+        agora = agora or time.monotonic()
+        removidas = 0
+        while self.ordem and removidas < lote:
+            user_id = next(iter(self.ordem))
+            estado = self.usuarios.get(user_id)
+            if estado is not None and estado.turnos is not None and not self.vencida(estado, agora):
+                break
+            del self.ordem[user_id]
+            self.descartar(user_id)
+            removidas += 1
+        self.expiradas += removidas
+        return removidas
+    
+    def descartar(self, user_id):
+        estado = self.usuarios.get(user_id)
+        if estado is None:
+            return
+        estado.descartar_memoria()
+        if estado.vazio():
+            del self.usuarios[user_id]
+    
+    def limpar(self):
+        self.ordem.clear()
+    
+    def estatisticas(self):
+        return {
+            'conversas': len(self.ordem),
+            'max_usuarios': self.max_usuarios,
+            'ttl_segundos': self.ttl_segundos,
+            'expiradas': self.expiradas,
+            'despejadas': self.despejadas,
+            'rodadas_fundo': self.rodadas
+        }
 
-1. Escolha STARTER ou PROFESSIONAL
-2. Acesse a página do plano escolhido
-3. Preencha: Nome, Data Nasc, CPF
-4. Pague via PIX (R$320 Starter ou R$530 Pro)
-5. Aguarde criação da conta (10min a 2h)
+USUARIOS = {}   # user_id -> EstadoUsuario
+usuarios_lock = threading.Lock()
+CONVERSAS = ConversasLRU(USUARIOS, MEMORIA_CONFIG['ttl_segundos'], MEMORIA_CONFIG['max_usuarios'])
 
-WhatsApp para dúvidas: (21) 99282-6074"""
-    
-    # HOSPEDAGEM/DOMÍNIO
-    if any(kw in msg_lower for kw in ['hospedagem', 'domínio', 'dominio', 'hosting', 'servidor']):
-        return f"""Hospedagem e Domínio:
+def estado_usuario(user_id):
+    """Registro do usuário (criado vazio se não existir). Chamar com o usuarios_lock."""
+    estado = USUARIOS.get(user_id)
+    if estado is None:
+        estado = USUARIOS[user_id] = EstadoUsuario()
+    return estado
 
-STARTER: Hospedagem inclusa por 1 ano
-PROFESSIONAL: Hospedagem + Domínio inclusos
+# =============================================================================
+# 💾 ESTADO PERSISTENTE - MEMÓRIA / SQLITE (WAL) / REDIS
+# =============================================================================
+# Contadores (mensagens, tokens, visitantes) e memória das conversas continuam
+# em dicionários do processo, lidos sem ir à rede. O armazém só os persiste e
+# sincroniza entre workers:
+# - escrita atrasada (write-behind): cada alteração vira uma operação pendente,
+#   gravada em lote por uma thread a cada `intervalo_gravacao`. Somas seguem
+#   como incrementos, então dois workers nunca sobrescrevem a conta um do outro.
+# - leitura em lote: a primeira consulta de um usuário traz todas as tabelas
+#   dele numa ida ao backend; a cópia local vale por `validade_leitura` segundos
+#   (mais as operações deste worker que ainda não foram gravadas).
+# ESTADO_BACKEND=memoria (padrão, só o processo, como antes), sqlite (um host,
+# vários processos/workers) ou redis (vários hosts).
+
+ESTADO_CONFIG = {
+    'backend': os.getenv('ESTADO_BACKEND', 'memoria').lower(),
+    'sqlite_caminho': os.getenv('ESTADO_SQLITE_CAMINHO', 'natanai_estado.db'),
+    'redis_url': os.getenv('ESTADO_REDIS_URL', 'redis://localhost:6379/0'),
+    'prefixo_redis': os.getenv('ESTADO_REDIS_PREFIXO', 'natanai'),
+    'intervalo_gravacao': float(os.getenv('ESTADO_INTERVALO_GRAVACAO', '0.2')),
+    'validade_leitura': float(os.getenv('ESTADO_VALIDADE_LEITURA', '1.0')),
+    'intervalo_expiracao': 300,      # SQLite: apaga registros vencidos a cada 5 min
+    'max_leituras_lembradas': 100000,
+    # Segundos sem escrita até o registro sumir do backend (None = permanente)
+    'ttl_tabelas': {
+        'mensagens': None,
+        'tokens': None,
+        'visitantes': 48 * 3600,
+        'memoria': MEMORIA_CONFIG['ttl_segundos']
+    }
+}
 
-Renovação após 1 ano é à parte.
-WhatsApp: (21) 99282-6074"""
+def aplicar_operacao_estado(registro, operacao):
+    """
+    Aplica uma operação pendente a um registro (dict ou None = inexistente):
+    ('atualizar', somar, definir, iniciais) | ('substituir', registro) | ('apagar',)
+    | ('renovar', campo, inicio, redefinir)
+    """
+    tipo = operacao[0]
+    if tipo == 'apagar':
+        return None
+    if tipo == 'substituir':
+        return dict(operacao[1])
     
-    # PRAZO/TEMPO
-    if any(kw in msg_lower for kw in ['prazo', 'tempo', 'demora', 'quanto tempo', 'quando fica pronto']):
-        return f"""Prazos:
+    if tipo == 'renovar':
+        # Só zera se o registro existe e ainda está numa janela anterior
+        _, campo, inicio, redefinir = operacao
+        if registro is not None and registro.get(campo, '') < inicio:
+            registro.update(redefinir)
+        return registro
+    
+    _, somar, definir, iniciais = operacao
+    registro = dict(iniciais) if registro is None else registro
+    for campo, valor in somar.items():
+        registro[campo] = registro.get(campo, 0) + valor
+    registro.update(definir)
+    return registro
+
+def copiar_registro_estado(registro):
+    """Cópia até o 2º nível: listas/dicts internos podem mudar antes da gravação"""
+    return {
+        campo: list(valor) if isinstance(valor, list) else dict(valor) if isinstance(valor, dict) else valor
+        for campo, valor in registro.items()
+    }
 
-Criação de conta: 10min a 2h após pagamento
-Desenvolvimento do site: 
-- Sites simples: 3 a 7 dias
-- Sites complexos: 10 a 20 dias
+class BackendEstadoMemoria:
+    """Os próprios dicionários do processo são o estado: nada a gravar nem ler"""
+    
+    nome = 'memoria'
+    persistente = False
+    
+    def ler(self, pares):
+        return {}
+    
+    def aplicar(self, operacoes):
+        pass
+    
+    def reabrir(self):
+        pass
+    
+    def carregar(self, tabela):
+        return {}
+    
+    def limpar(self, tabela):
+        pass
+    
+    def expirar(self):
+        return 0
 
-Depende da complexidade e fila de projetos.
-WhatsApp: (21) 99282-6074"""
+class BackendEstadoSQLite:
+    """
+    SQLite em modo WAL: leitores não bloqueiam o escritor e vários processos do
+    mesmo host (workers do gunicorn) compartilham o arquivo. Cada lote de
+    operações roda numa transação BEGIN IMMEDIATE (ler-somar-gravar atômico
+    entre processos). Uma conexão por thread: leituras da requisição não
+    esperam a gravação do lote; as transações de escrita do processo fazem fila
+    no lock_escrita (o arquivo só tem um escritor por vez) em vez de girar no
+    busy timeout do SQLite.
+    """
     
-    # SEO
-    if any(kw in msg_lower for kw in ['seo', 'google', 'ranquear', 'primeiro lugar', 'posicionamento']):
-        return f"""SEO (Otimização para Google):
+    nome = 'sqlite'
+    persistente = True
+    
+    def __init__(self, caminho, ttl_tabelas):
+        self.caminho = caminho
+        self.ttl_tabelas = ttl_tabelas
+        self.reabrir()
+        self.conexao.execute("""
+            CREATE TABLE IF NOT EXISTS estado (
+                tabela TEXT NOT NULL,
+                chave TEXT NOT NULL,
+                valor TEXT NOT NULL,
+                expira_em REAL,
+                PRIMARY KEY (tabela, chave)
+            ) WITHOUT ROWID
+        """)
+        self.conexao.execute("""
+            CREATE TABLE IF NOT EXISTS reservas (
+                tabela TEXT NOT NULL,
+                chave TEXT NOT NULL,
+                id TEXT NOT NULL,
+                expira_em REAL NOT NULL,
+                PRIMARY KEY (tabela, chave, id)
+            ) WITHOUT ROWID
+        """)
+    
+    def reabrir(self):
+        """Conexões novas (também no processo filho depois de um fork)"""
+        self.local = threading.local()
+        self.lock_escrita = threading.Lock()
+        self.conexao.execute('PRAGMA journal_mode=WAL')  # fica gravado no arquivo
+    
+    @property
+    def conexao(self):
+        """Conexão da thread atual (aberta no 1º uso, fechada quando a thread termina)"""
+        conexao = getattr(self.local, 'conexao', None)
+        if conexao is None:
+            conexao = self.local.conexao = sqlite3.connect(self.caminho, timeout=10, isolation_level=None)
+            conexao.execute('PRAGMA synchronous=NORMAL')  # WAL + NORMAL: sem fsync a cada transação
+        return conexao
+    
+    def _selecionar(self, pares):
+        if not pares:
+            return {}
+        valores = ', '.join(['(?, ?)'] * len(pares))
+        linhas = self.conexao.execute(
+            f"SELECT tabela, chave, valor FROM estado WHERE (tabela, chave) IN (VALUES {valores}) "
+            f"AND (expira_em IS NULL OR expira_em > ?)",
+            [item for par in pares for item in par] + [time.time()]
+        )
+        return {(tabela, chave): json.loads(valor) for tabela, chave, valor in linhas}
+    
+    def ler(self, pares):
+        """Vários (tabela, chave) numa consulta só"""
+        return self._selecionar(pares)
+    
+    def aplicar(self, operacoes):
+        conexao = self.conexao
+        pares = list(dict.fromkeys((tabela, chave) for tabela, chave, _ in operacoes))
+        agora = time.time()
+        
+        with self.lock_escrita:
+            conexao.execute('BEGIN IMMEDIATE')
+            try:
+                registros = self._selecionar(pares)
+                for tabela, chave, operacao in operacoes:
+                    registros[(tabela, chave)] = aplicar_operacao_estado(registros.get((tabela, chave)), operacao)
+                
+                apagar = []
+                for (tabela, chave) in pares:
+                    registro = registros.get((tabela, chave))
+                    if registro is None:
+                        apagar.append((tabela, chave))
+                    else:
+                        self._gravar_registro(tabela, chave, registro, agora)
+                conexao.executemany('DELETE FROM estado WHERE tabela = ? AND chave = ?', apagar)
+                conexao.execute('COMMIT')
+            except BaseException:
+                conexao.execute('ROLLBACK')
+                raise
+    
+    def _gravar_registro(self, tabela, chave, registro, agora):
+        ttl = self.ttl_tabelas.get(tabela)
+        self.conexao.execute(
+            'INSERT OR REPLACE INTO estado (tabela, chave, valor, expira_em) VALUES (?, ?, ?, ?)',
+            (tabela, chave, json.dumps(registro, ensure_ascii=False), agora + ttl if ttl else None)
+        )
+    
+    def reservar_cota(self, tabela, chave, campo, limite, id_reserva, validade, renovacao=None):
+        """
+        Reserva se usados + reservas vigentes < limite. Retorna (ok, usados, reservados).
+        `renovacao` = operação 'renovar' aplicada antes, na mesma transação.
+        """
+        conexao = self.conexao
+        agora = time.time()
+        with self.lock_escrita:
+            conexao.execute('BEGIN IMMEDIATE')
+            try:
+                conexao.execute('DELETE FROM reservas WHERE tabela = ? AND chave = ? AND expira_em <= ?', (tabela, chave, agora))
+                registro = self._selecionar([(tabela, chave)]).get((tabela, chave))
+                if renovacao and registro is not None:
+                    antes = registro.get(renovacao[1])
+                    registro = aplicar_operacao_estado(registro, renovacao)
+                    if registro.get(renovacao[1]) != antes:
+                        self._gravar_registro(tabela, chave, registro, agora)
+                usados = (registro or {}).get(campo, 0)
+                reservados = conexao.execute(
+                    'SELECT COUNT(*) FROM reservas WHERE tabela = ? AND chave = ?', (tabela, chave)
+                ).fetchone()[0]
+                ok = usados + reservados < limite
+                if ok:
+                    conexao.execute('INSERT INTO reservas VALUES (?, ?, ?, ?)', (tabela, chave, id_reserva, agora + validade))
+                    reservados += 1
+                conexao.execute('COMMIT')
+            except BaseException:
+                conexao.execute('ROLLBACK')
+                raise
+            return ok, usados, reservados
+    
+    def confirmar_cota(self, tabela, chave, campo, id_reserva, iniciais):
+        """A reserva vira +1 em `campo` na mesma transação"""
+        conexao = self.conexao
+        agora = time.time()
+        with self.lock_escrita:
+            conexao.execute('BEGIN IMMEDIATE')
+            try:
+                conexao.execute('DELETE FROM reservas WHERE tabela = ? AND chave = ? AND id = ?', (tabela, chave, id_reserva))
+                registro = self._selecionar([(tabela, chave)]).get((tabela, chave)) or dict(iniciais)
+                registro[campo] = registro.get(campo, 0) + 1
+                self._gravar_registro(tabela, chave, registro, agora)
+                conexao.execute('COMMIT')
+            except BaseException:
+                conexao.execute('ROLLBACK')
+                raise
+    
+    def liberar_cota(self, tabela, chave, id_reserva):
+        with self.lock_escrita:
+            self.conexao.execute('DELETE FROM reservas WHERE tabela = ? AND chave = ? AND id = ?', (tabela, chave, id_reserva))
+    
+    def carregar(self, tabela):
+        linhas = self.conexao.execute(
+            "SELECT chave, valor FROM estado WHERE tabela = ? AND (expira_em IS NULL OR expira_em > ?)",
+            (tabela, time.time())
+        )
+        return {chave: json.loads(valor) for chave, valor in linhas}
+    
+    def limpar(self, tabela):
+        with self.lock_escrita:
+            self.conexao.execute("DELETE FROM estado WHERE tabela = ?", (tabela,))
+    
+    def expirar(self):
+        agora = time.time()
+        with self.lock_escrita:
+            self.conexao.execute("DELETE FROM reservas WHERE expira_em <= ?", (agora,))
+            return self.conexao.execute("DELETE FROM estado WHERE expira_em <= ?", (agora,)).rowcount
+
+# Renovação condicional da janela: só zera se registro[campo] < início da janela.
+# KEYS: registro
+# ARGV: campo da janela, início, [campo, valor JSON]...
+LUA_RENOVAR_JANELA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+local atual = redis.call('HGET', KEYS[1], ARGV[1])
+if atual and cjson.decode(atual) >= ARGV[2] then
+    return 0
+end
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+return 1
+"""
+
+# Reserva: descarta reservas vencidas e só reserva se usados + reservas < limite.
+# KEYS: registro (hash), reservas (zset id -> expira_em)
+# ARGV: campo, limite, agora, id, validade, [campo da janela, início, [campo, valor JSON]...]
+LUA_RESERVAR_COTA = """
+local agora = tonumber(ARGV[3])
+if #ARGV > 5 and redis.call('EXISTS', KEYS[1]) == 1 then
+    local atual = redis.call('HGET', KEYS[1], ARGV[6])
+    if not atual or cjson.decode(atual) < ARGV[7] then
+        for i = 8, #ARGV, 2 do
+            redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+        end
+    end
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', agora)
+local usados = tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0')
+local reservados = redis.call('ZCARD', KEYS[2])
+if usados + reservados >= tonumber(ARGV[2]) then
+    return {0, usados, reservados}
+end
+redis.call('ZADD', KEYS[2], agora + tonumber(ARGV[5]), ARGV[4])
+redis.call('EXPIRE', KEYS[2], math.ceil(tonumber(ARGV[5])))
+return {1, usados, reservados + 1}
+"""
+
+# Confirmação: a reserva sai do zset e vira +1 no campo, atomicamente.
+# KEYS: registro, reservas, índice da tabela
+# ARGV: campo, id, ttl do registro (0 = permanente), chave, [campo inicial, valor JSON]...
+LUA_CONFIRMAR_COTA = """
+redis.call('ZREM', KEYS[2], ARGV[2])
+for i = 5, #ARGV, 2 do
+    redis.call('HSETNX', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('HINCRBY', KEYS[1], ARGV[1], 1)
+redis.call('SADD', KEYS[3], ARGV[4])
+if tonumber(ARGV[3]) > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[3])
+end
+return 1
+"""
+
+class BackendEstadoRedis:
+    """
+    Qualquer servidor com protocolo Redis (Redis, Valkey, KeyDB, Dragonfly).
+    Um hash por registro (`prefixo:tabela:chave`, campos em JSON) e um set por
+    tabela com as chaves. Cada lote vai num pipeline MULTI/EXEC; somas viram
+    HINCRBY/HINCRBYFLOAT, então incrementos de vários workers se acumulam.
+    """
+    
+    nome = 'redis'
+    persistente = True
+    
+    def __init__(self, url, prefixo, ttl_tabelas):
+        if redis is None:
+            raise RuntimeError("pacote 'redis' não instalado (pip install redis)")
+        self.cliente = redis.Redis.from_url(url)  # pool de conexões compartilhado entre threads
+        self.prefixo = prefixo
+        self.ttl_tabelas = ttl_tabelas
+        self.cliente.ping()
+        self.script_reservar = self.cliente.register_script(LUA_RESERVAR_COTA)
+        self.script_confirmar = self.cliente.register_script(LUA_CONFIRMAR_COTA)
+        self.script_renovar = self.cliente.register_script(LUA_RENOVAR_JANELA)
+    
+    def reabrir(self):
+        pass  # o pool do redis-py já recria as conexões num processo filho
+    
+    def _chave(self, tabela, chave):
+        return f"{self.prefixo}:{tabela}:{chave}"
+    
+    def _indice(self, tabela):
+        return f"{self.prefixo}:{tabela}"
+    
+    @staticmethod
+    def _decodificar(campos):
+        return {campo.decode(): json.loads(valor) for campo, valor in campos.items()}
+    
+    def ler(self, pares):
+        pipe = self.cliente.pipeline(transaction=False)
+        for tabela, chave in pares:
+            pipe.hgetall(self._chave(tabela, chave))
+        return {par: self._decodificar(campos) for par, campos in zip(pares, pipe.execute()) if campos}
+    
+    def aplicar(self, operacoes):
+        pipe = self.cliente.pipeline(transaction=True)
+        for tabela, chave, operacao in operacoes:
+            nome = self._chave(tabela, chave)
+            tipo = operacao[0]
+            
+            if tipo == 'apagar':
+                pipe.delete(nome)
+                pipe.srem(self._indice(tabela), chave)
+                continue
+            
+            if tipo == 'renovar':
+                _, campo, inicio, redefinir = operacao
+                self.script_renovar(keys=[nome], args=[campo, inicio, *self._pares_json(redefinir)], client=pipe)
+                continue
+            
+            if tipo == 'substituir':
+                pipe.delete(nome)
+                definir, somar, iniciais = operacao[1], {}, {}
+            else:
+                _, somar, definir, iniciais = operacao
+            
+            for campo, valor in iniciais.items():
+                pipe.hsetnx(nome, campo, json.dumps(valor, ensure_ascii=False))
+            for campo, valor in somar.items():
+                if isinstance(valor, int):
+                    pipe.hincrby(nome, campo, valor)
+                else:
+                    pipe.hincrbyfloat(nome, campo, valor)
+            if definir:
+                pipe.hset(nome, mapping={campo: json.dumps(valor, ensure_ascii=False) for campo, valor in definir.items()})
+            pipe.sadd(self._indice(tabela), chave)
+            ttl = self.ttl_tabelas.get(tabela)
+            if ttl:
+                pipe.expire(nome, int(ttl))
+        pipe.execute()
+    
+    @staticmethod
+    def _pares_json(campos):
+        return [item for campo, valor in campos.items() for item in (campo, json.dumps(valor, ensure_ascii=False))]
+    
+    def _chave_reservas(self, tabela, chave):
+        return f"{self.prefixo}:reservas:{tabela}:{chave}"
+    
+    def reservar_cota(self, tabela, chave, campo, limite, id_reserva, validade, renovacao=None):
+        args = [campo, limite, time.time(), id_reserva, validade]
+        if renovacao:
+            _, campo_janela, inicio, redefinir = renovacao
+            args += [campo_janela, inicio, *self._pares_json(redefinir)]
+        ok, usados, reservados = self.script_reservar(
+            keys=[self._chave(tabela, chave), self._chave_reservas(tabela, chave)],
+            args=args
+        )
+        return bool(ok), int(usados), int(reservados)
+    
+    def confirmar_cota(self, tabela, chave, campo, id_reserva, iniciais):
+        args = [campo, id_reserva, int(self.ttl_tabelas.get(tabela) or 0), chave, *self._pares_json(iniciais)]
+        self.script_confirmar(
+            keys=[self._chave(tabela, chave), self._chave_reservas(tabela, chave), self._indice(tabela)],
+            args=args
+        )
+    
+    def liberar_cota(self, tabela, chave, id_reserva):
+        self.cliente.zrem(self._chave_reservas(tabela, chave), id_reserva)
+    
+    def carregar(self, tabela):
+        chaves = [chave.decode() for chave in self.cliente.smembers(self._indice(tabela))]
+        dados = self.ler([(tabela, chave) for chave in chaves])
+        
+        # Registros vencidos pelo TTL deixam a chave no índice: limpa aqui
+        vencidas = [chave for chave in chaves if (tabela, chave) not in dados]
+        if vencidas:
+            self.cliente.srem(self._indice(tabela), *vencidas)
+        return {chave: registro for (_, chave), registro in dados.items()}
+    
+    def limpar(self, tabela):
+        chaves = [self._chave(tabela, chave.decode()) for chave in self.cliente.smembers(self._indice(tabela))]
+        self.cliente.delete(self._indice(tabela), *chaves)
+    
+    def expirar(self):
+        return 0  # o próprio Redis expira os hashes (EXPIRE)
 
-STARTER: SEO básico incluso
-PROFESSIONAL: SEO avançado incluso
+class ArmazemEstado:
+    """
+    Escrita atrasada + leitura em lote sobre um backend de estado.
+    Com o backend em memória todas as operações retornam na hora (sem custo).
+    """
+    
+    def __init__(self, backend, intervalo_gravacao, validade_leitura):
+        self.backend = backend
+        self.ativo = backend.persistente
+        self.intervalo_gravacao = intervalo_gravacao
+        self.validade_leitura = validade_leitura
+        self.tabelas = {}       # nome -> (dicionário local, lock do dicionário)
+        self.pendentes = {}     # (tabela, chave) -> [operações ainda não gravadas]
+        self.lidos_em = {}      # (tabela, chave) -> time.monotonic() da última leitura
+        self.lock = threading.Lock()
+        # Gravação do lote, limpeza e expiração (lado do lote) nunca se intercalam.
+        # A leitura da requisição não usa este lock: confere a `versao_gravacao`
+        # (ímpar = lote em gravação) antes e depois de ler, e descarta a leitura
+        # se o lote em voo tem a mesma chave ou se outro começou/terminou no meio.
+        self.lock_gravacao = threading.Lock()
+        self.versao_gravacao = 0
+        self.lote_em_gravacao = None  # pendências do lote em voo ((tabela, chave) -> operações)
+        self.gravacoes = 0
+        self.operacoes_gravadas = 0
+        self.leituras = 0
+        self.falhas = 0
+        self.ultimo_erro = None
+    
+    def registrar_tabela(self, nome, dicionario, lock):
+        self.tabelas[nome] = (dicionario, lock)
+    
+    def carregar(self):
+        """Preenche os dicionários com o que já está no backend (início do processo)"""
+        if not self.ativo:
+            return
+        for nome, (dicionario, lock) in self.tabelas.items():
+            dados = self.backend.carregar(nome)
+            with lock:
+                dicionario.update(dados)
+            print(f"💾 Estado: {len(dados)} registros de '{nome}' carregados ({self.backend.nome})")
+    
+    def _enfileirar(self, tabela, chave, operacao, substitui=False):
+        with self.lock:
+            if substitui:
+                self.pendentes[(tabela, chave)] = [operacao]
+            else:
+                self.pendentes.setdefault((tabela, chave), []).append(operacao)
+    
+    def atualizar(self, tabela, chave, somar=None, definir=None, iniciais=None):
+        """Soma/define campos (cria com `iniciais` se não existir). Chamar com o lock da tabela."""
+        if self.ativo:
+            self._enfileirar(tabela, chave, ('atualizar', somar or {}, definir or {}, iniciais or {}))
+    
+    def substituir(self, tabela, chave, registro):
+        """Grava o registro inteiro. Chamar com o lock da tabela (a cópia é feita aqui)."""
+        if self.ativo:
+            self._enfileirar(tabela, chave, ('substituir', copiar_registro_estado(registro)), substitui=True)
+    
+    def apagar(self, tabela, chave):
+        if self.ativo:
+            self._enfileirar(tabela, chave, ('apagar',), substitui=True)
+    
+    def renovar(self, tabela, chave, campo, inicio, redefinir):
+        """
+        Aplica `redefinir` se registro[campo] < inicio. Condicional no backend:
+        um worker atrasado não zera o que outro já contou na janela nova.
+        """
+        if self.ativo:
+            self._enfileirar(tabela, chave, ('renovar', campo, inicio, dict(redefinir)))
+    
+    def limpar(self, tabela):
+        """Apaga a tabela inteira no backend (reset do admin)"""
+        if not self.ativo:
+            return
+        with self.lock_gravacao:
+            with self.lock:
+                self.versao_gravacao += 1
+                self.lote_em_gravacao = None  # nenhuma chave da tabela é lida com segurança
+                for par in [par for par in self.pendentes if par[0] == tabela]:
+                    del self.pendentes[par]
+            try:
+                self.backend.limpar(tabela)
+            finally:
+                with self.lock:
+                    self.versao_gravacao += 1
+    
+    def sincronizar(self, chave, tabelas):
+        """
+        Atualiza a cópia local de `chave` nas tabelas dadas, numa ida ao backend,
+        se a última leitura tiver mais de `validade_leitura` segundos.
+        Chamar SEM segurar os locks das tabelas.
+        """
+        if not self.ativo:
+            return
+        agora = time.monotonic()
+        vencidas = [tabela for tabela in tabelas
+                    if agora - self.lidos_em.get((tabela, chave), float('-inf')) > self.validade_leitura]
+        if not vencidas:
+            return
+        
+        with self.lock:
+            versao = self.versao_gravacao
+            em_voo = self.lote_em_gravacao if versao % 2 else {}
+        if em_voo is None or any((tabela, chave) in em_voo for tabela in vencidas):
+            return  # a chave está sendo gravada: segue com a cópia local, lê na próxima
+        
+        try:
+            dados = self.backend.ler([(tabela, chave) for tabela in vencidas])
+        except Exception as e:
+            self._registrar_falha(e)
+            return  # segue com a cópia local
+        
+        lidas = []
+        for tabela in vencidas:
+            dicionario, lock = self.tabelas[tabela]
+            with lock:
+                with self.lock:
+                    if self.versao_gravacao != versao:
+                        break  # um lote mexeu no backend durante a leitura
+                    pendentes = list(self.pendentes.get((tabela, chave), ()))
+                registro = dados.get((tabela, chave))
+                for operacao in pendentes:
+                    registro = aplicar_operacao_estado(registro, operacao)
+                if registro is None:
+                    dicionario.pop(chave, None)
+                else:
+                    dicionario[chave] = registro
+            lidas.append(tabela)
+        
+        with self.lock:
+            self.leituras += 1
+            if len(self.lidos_em) > ESTADO_CONFIG['max_leituras_lembradas']:
+                self.lidos_em.clear()
+            for tabela in lidas:
+                self.lidos_em[(tabela, chave)] = agora
+    
+    def descarregar(self):
+        """Grava todas as operações pendentes num lote; em falha elas voltam para a fila"""
+        if not self.ativo:
+            return 0
+        with self.lock_gravacao:
+            with self.lock:
+                lote, self.pendentes = self.pendentes, {}
+                if not lote:
+                    return 0
+                self.versao_gravacao += 1
+                self.lote_em_gravacao = lote
+            
+            operacoes = [(tabela, chave, operacao) for (tabela, chave), lista in lote.items() for operacao in lista]
+            try:
+                self.backend.aplicar(operacoes)
+            except Exception as e:
+                with self.lock:
+                    for par, lista in self.pendentes.items():
+                        lote.setdefault(par, []).extend(lista)
+                    self.pendentes = lote
+                    self.versao_gravacao += 1
+                    self.lote_em_gravacao = None
+                self._registrar_falha(e)
+                return 0
+            
+            with self.lock:
+                self.versao_gravacao += 1
+                self.lote_em_gravacao = None
+                self.gravacoes += 1
+                self.operacoes_gravadas += len(operacoes)
+        return len(operacoes)
+    
+    def _registrar_falha(self, erro):
+        with self.lock:
+            self.falhas += 1
+            self.ultimo_erro = f"{type(erro).__name__}: {erro}"
+        print(f"⚠️ Estado ({self.backend.nome}): {erro}")
+    
+    def iniciar(self):
+        self.carregar()
+        threading.Thread(target=self.executar, daemon=True, name='estado-write-behind').start()
+    
+    def reiniciar_apos_fork(self):
+        """
+        Worker criado por fork (gunicorn --preload): as pendências copiadas são
+        do processo pai, que as grava; a thread e a conexão precisam ser novas.
+        """
+        self.pendentes = {}
+        self.lidos_em = {}
+        self.lock = threading.Lock()
+        self.lock_gravacao = threading.Lock()
+        self.versao_gravacao = 0
+        self.lote_em_gravacao = None
+        self.backend.reabrir()
+        threading.Thread(target=self.executar, daemon=True, name='estado-write-behind').start()
+    
+    def executar(self):
+        """Thread de escrita atrasada (e expiração periódica no SQLite)"""
+        proxima_expiracao = time.monotonic() + ESTADO_CONFIG['intervalo_expiracao']
+        while True:
+            time.sleep(self.intervalo_gravacao)
+            self.descarregar()
+            if time.monotonic() >= proxima_expiracao:
+                proxima_expiracao = time.monotonic() + ESTADO_CONFIG['intervalo_expiracao']
+                try:
+                    with self.lock_gravacao:
+                        self.backend.expirar()
+                except Exception as e:
+                    self._registrar_falha(e)
+    
+    def estatisticas(self):
+        with self.lock:
+            return {
+                'backend': self.backend.nome,
+                'operacoes_pendentes': sum(len(lista) for lista in self.pendentes.values()),
+                'gravacoes_em_lote': self.gravacoes,
+                'operacoes_gravadas': self.operacoes_gravadas,
+                'leituras_em_lote': self.leituras,
+                'falhas': self.falhas,
+                'ultimo_erro': self.ultimo_erro
+            }
 
-O Natan otimiza seu site para aparecer melhor no Google!
-Mas não garantimos posições específicas (ninguém pode garantir isso).
+def criar_backend_estado():
+    """Backend conforme ESTADO_BACKEND; se o configurado falhar, volta para a memória"""
+    nome = ESTADO_CONFIG['backend']
+    try:
+        if nome == 'sqlite':
+            return BackendEstadoSQLite(ESTADO_CONFIG['sqlite_caminho'], ESTADO_CONFIG['ttl_tabelas'])
+        if nome == 'redis':
+            return BackendEstadoRedis(ESTADO_CONFIG['redis_url'], ESTADO_CONFIG['prefixo_redis'], ESTADO_CONFIG['ttl_tabelas'])
+    except Exception as e:
+        print(f"⚠️ Backend de estado '{nome}' indisponível ({e}): usando memória do processo")
+    return BackendEstadoMemoria()
+
+ARMAZEM_ESTADO = ArmazemEstado(
+    criar_backend_estado(),
+    intervalo_gravacao=ESTADO_CONFIG['intervalo_gravacao'],
+    validade_leitura=ESTADO_CONFIG['validade_leitura']
+)
+ARMAZEM_ESTADO.registrar_tabela('mensagens', TabelaUsuarios(USUARIOS, 'mensagens'), usuarios_lock)
+ARMAZEM_ESTADO.registrar_tabela('tokens', TabelaUsuarios(USUARIOS, 'tokens'), usuarios_lock)
+ARMAZEM_ESTADO.registrar_tabela('visitantes', CONTADOR_VISITANTES, visitantes_lock)
+ARMAZEM_ESTADO.registrar_tabela('memoria', TabelaUsuarios(USUARIOS, 'memoria', CONVERSAS), usuarios_lock)
+
+if ARMAZEM_ESTADO.ativo:
+    ARMAZEM_ESTADO.iniciar()
+    with visitantes_lock:
+        LIMITADOR_VISITANTES.reindexar()
+    atexit.register(ARMAZEM_ESTADO.descarregar)  # desligamento limpo não perde o último lote
+    os.register_at_fork(after_in_child=ARMAZEM_ESTADO.reiniciar_apos_fork)
 
-WhatsApp: (21) 99282-6074"""
+# Tabelas de um usuário autenticado lidas juntas na 1ª consulta da requisição
+TABELAS_USUARIO = ('mensagens', 'tokens', 'memoria')
+
+# =============================================================================
+# 🎟️ RESERVA DE COTA - RESERVAR → CONFIRMAR | LIBERAR
+# =============================================================================
+# Verificar o limite no início e incrementar só depois da resposta (segundos
+# depois) deixa 20 requisições paralelas a 99/100 passarem todas. Agora cada
+# mensagem reserva 1 unidade da cota antes de chamar a OpenAI: a reserva só sai
+# se usados + reservas em andamento < limite. Resposta entregue → confirmar
+# (vira +1 no contador); erro/desconexão → liberar. Uma reserva esquecida
+# (worker que morreu) vence sozinha em `validade_reserva`.
+# Em memória: reservas em shards, cada um com seu lock (usuários diferentes não
+# disputam o mesmo lock). Com SQLite/Redis a reserva e a confirmação são uma
+# transação/script no backend, então valem entre workers; elas vão direto ao
+# backend (conexão da thread / pool do Redis), sem esperar a gravação do lote.
+
+COTAS_CONFIG = {
+    'shards': 64,
+    'validade_reserva': 180  # segundos; acima do maior prazo (SLO) de uma mensagem
+}
+
+class ReservaCota:
+    __slots__ = ('tabela', 'chave', 'id', 'expira_em', 'estado')
     
-    # PAGAMENTO
-    if any(kw in msg_lower for kw in ['pagamento', 'pagar', 'pix', 'forma de pagamento', 'cartão']):
-        return f"""Formas de Pagamento:
+    def __init__(self, tabela, chave, id_reserva, expira_em):
+        self.tabela = tabela
+        self.chave = chave
+        self.id = id_reserva
+        self.expira_em = expira_em
+        self.estado = 'ativa'  # ativa | confirmada | liberada
+
+class MotorCotas:
+    """Reserva atômica de cota por (tabela, chave) sobre o campo 'total' dos contadores"""
+    
+    campo = 'total'
+    
+    def __init__(self, armazem, shards, validade_reserva):
+        self.armazem = armazem
+        self.no_backend = armazem.ativo
+        self.validade_reserva = validade_reserva
+        self.shards = [{} for _ in range(shards)]   # (tabela, chave) -> {id: expira_em}
+        self.locks = [threading.Lock() for _ in range(shards)]
+        self.metricas = [dict.fromkeys(('reservadas', 'negadas', 'confirmadas', 'liberadas', 'vencidas'), 0)
+                         for _ in range(shards)]
+        self.sequencia = itertools.count()
+    
+    def _indice(self, tabela, chave):
+        return hash((tabela, chave)) % len(self.shards)
+    
+    def _novo_id(self):
+        return f"{os.getpid()}-{next(self.sequencia)}"
+    
+    def reservar(self, tabela, chave, limite, renovacao=None):
+        """
+        Reserva 1 unidade se usados + reservas vigentes < limite.
+        Retorna (reserva ou None, usados, reservados). `renovacao` (operação
+        'renovar' da janela de cota) é aplicada no backend na mesma transação;
+        na memória local quem chama já renovou.
+        """
+        indice = self._indice(tabela, chave)
+        id_reserva = self._novo_id()
+        
+        if self.no_backend:
+            try:
+                ok, usados, reservados = self.armazem.backend.reservar_cota(
+                    tabela, chave, self.campo, limite, id_reserva, self.validade_reserva, renovacao
+                )
+            except Exception as e:
+                # Backend fora: segue com a reserva local (limite por worker) em vez de derrubar o chat
+                self.armazem._registrar_falha(e)
+                return self._reservar_local(indice, tabela, chave, limite, id_reserva)
+            with self.locks[indice]:
+                self.metricas[indice]['reservadas' if ok else 'negadas'] += 1
+            reserva = ReservaCota(tabela, chave, id_reserva, None) if ok else None
+            return reserva, usados, reservados
+        
+        return self._reservar_local(indice, tabela, chave, limite, id_reserva)
+    
+    def _reservar_local(self, indice, tabela, chave, limite, id_reserva):
+        dicionario, _ = self.armazem.tabelas[tabela]
+        agora = time.monotonic()
+        with self.locks[indice]:
+            reservas = self.shards[indice].setdefault((tabela, chave), {})
+            vencidas = [id_antigo for id_antigo, expira_em in reservas.items() if expira_em <= agora]
+            for id_antigo in vencidas:
+                del reservas[id_antigo]
+            self.metricas[indice]['vencidas'] += len(vencidas)
+            
+            registro = dicionario.get(chave)
+            usados = registro.get(self.campo, 0) if registro else 0
+            if usados + len(reservas) >= limite:
+                self.metricas[indice]['negadas'] += 1
+                if not reservas:
+                    del self.shards[indice][(tabela, chave)]
+                return None, usados, len(reservas)
+            
+            expira_em = agora + self.validade_reserva
+            reservas[id_reserva] = expira_em
+            self.metricas[indice]['reservadas'] += 1
+            return ReservaCota(tabela, chave, id_reserva, expira_em), usados, len(reservas)
+    
+    def confirmar_no_backend(self, reserva, iniciais):
+        """
+        Backend compartilhado: reserva → +1 no total numa única transação, ANTES
+        do incremento local. Retorna True se o total já foi somado no backend.
+        """
+        if reserva is None or reserva.expira_em is not None or reserva.estado != 'ativa':
+            return False
+        try:
+            self.armazem.backend.confirmar_cota(reserva.tabela, reserva.chave, self.campo, reserva.id, iniciais)
+        except Exception as e:
+            self.armazem._registrar_falha(e)
+            return False  # o +1 segue pela escrita atrasada; a reserva vence sozinha
+        self._encerrar(reserva, 'confirmada')
+        return True
+    
+    def confirmar(self, reserva):
+        """Em memória: chamar DEPOIS do incremento local (nunca há janela sem a mensagem contada)"""
+        if reserva is not None and reserva.estado == 'ativa':
+            self._encerrar(reserva, 'confirmada')
+    
+    def liberar(self, reserva):
+        """Devolve a unidade reservada (idempotente: nada acontece se já confirmada)"""
+        if reserva is None or reserva.estado != 'ativa':
+            return
+        if reserva.expira_em is None:
+            try:
+                self.armazem.backend.liberar_cota(reserva.tabela, reserva.chave, reserva.id)
+            except Exception as e:
+                self.armazem._registrar_falha(e)  # a reserva vence sozinha
+        self._encerrar(reserva, 'liberada')
+    
+    def _encerrar(self, reserva, estado):
+        indice = self._indice(reserva.tabela, reserva.chave)
+        with self.locks[indice]:
+            if reserva.estado != 'ativa':
+                return
+            reserva.estado = estado
+            self.metricas[indice]['confirmadas' if estado == 'confirmada' else 'liberadas'] += 1
+            if reserva.expira_em is not None:
+                reservas = self.shards[indice].get((reserva.tabela, reserva.chave))
+                if reservas is not None:
+                    reservas.pop(reserva.id, None)
+                    if not reservas:
+                        del self.shards[indice][(reserva.tabela, reserva.chave)]
+    
+    def estatisticas(self):
+        totais = dict.fromkeys(self.metricas[0], 0)
+        em_andamento = 0
+        for indice, lock in enumerate(self.locks):
+            with lock:
+                for nome, valor in self.metricas[indice].items():
+                    totais[nome] += valor
+                em_andamento += sum(len(reservas) for reservas in self.shards[indice].values())
+        totais['em_andamento_local'] = em_andamento
+        totais['no_backend'] = self.no_backend
+        return totais
+
+MOTOR_COTAS = MotorCotas(ARMAZEM_ESTADO, COTAS_CONFIG['shards'], COTAS_CONFIG['validade_reserva'])
 
-Setup (inicial): PIX
-- Starter: R$320,00
-- Professional: R$530,00
+# Auto-ping
+def auto_ping():
+    while True:
+        try:
+            if RENDER_URL:
+                url = RENDER_URL if RENDER_URL.startswith('http') else f"https://{RENDER_URL}"
+                requests.get(f"{url}/health", timeout=10)
+                print(f"🏓 Ping OK: {datetime.now().strftime('%H:%M:%S')}")
+            else:
+                requests.get("https://natanai-dev.onrender.com/health", timeout=5)
+        except:
+            pass
+        time.sleep(300)
 
-Mensalidade: PIX mensal
-- Starter: R$39,99/mês
-- Professional: R$79,99/mês
+threading.Thread(target=auto_ping, daemon=True).start()
 
-Sem cartão de crédito por enquanto.
-WhatsApp: (21) 99282-6074"""
+# =============================================================================
+# 📊 SISTEMA DE CONTROLE DE MENSAGENS
+# =============================================================================
+
+# Início de referência das janelas em timedelta (uma segunda-feira, 00:00)
+ANCORA_JANELAS = datetime(2024, 1, 1, tzinfo=FUSO_COTAS)
+
+# Período atual e o próximo, para os textos de limite
+TEXTOS_JANELA = {
+    'dia': ('hoje', 'amanhã'),
+    'semana': ('esta semana', 'na segunda-feira'),
+    'mes': ('este mês', 'no próximo mês')
+}
+
+# tipo do plano -> (início ISO, fim) da janela vigente; recalcula só ao cruzar o fim
+_janelas_vigentes = {}
+
+def calcular_janela(duracao, agora):
+    """(início, fim) da janela que contém `agora`"""
+    if duracao == 'dia':
+        inicio = agora.replace(hour=0, minute=0, second=0, microsecond=0)
+        return inicio, inicio + timedelta(days=1)
+    if duracao == 'semana':
+        inicio = agora.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=agora.weekday())
+        return inicio, inicio + timedelta(weeks=1)
+    if duracao == 'mes':
+        inicio = agora.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        proximo = inicio.replace(year=inicio.year + 1, month=1) if inicio.month == 12 else inicio.replace(month=inicio.month + 1)
+        return inicio, proximo
+    inicio = ANCORA_JANELAS + duracao * ((agora - ANCORA_JANELAS) // duracao)
+    return inicio, inicio + duracao
+
+def janela_vigente(tipo_plano):
+    """(início ISO, fim) da janela de cota do plano. O(1): só recalcula quando a janela vira."""
+    agora = datetime.now(FUSO_COTAS)
+    janela = _janelas_vigentes.get(tipo_plano)
+    if janela is None or agora >= janela[1]:
+        inicio, fim = calcular_janela(JANELAS_MENSAGENS.get(tipo_plano, 'mes'), agora)
+        janela = _janelas_vigentes[tipo_plano] = (inicio.isoformat(), fim)
+    return janela
+
+def formatar_tempo_restante(segundos):
+    segundos = max(0, int(segundos))
+    dias, resto = divmod(segundos, 86400)
+    horas, minutos = resto // 3600, (resto % 3600) // 60
+    if dias:
+        return f"{dias}d {horas}h {minutos}min"
+    return f"{horas}h {minutos}min"
+
+def tempo_para_renovar_mensagens(tipo_plano):
+    """Tempo até a próxima renovação da cota do plano ('2d 5h 10min')"""
+    _, fim = janela_vigente(tipo_plano)
+    return formatar_tempo_restante((fim - datetime.now(FUSO_COTAS)).total_seconds())
+
+def renovacao_janela(tipo_plano):
+    """Operação 'renovar' que zera o contador se ele for de uma janela anterior"""
+    inicio, _ = janela_vigente(tipo_plano)
+    return ('renovar', 'janela_inicio', inicio, {
+        'total': 0,
+        'janela_inicio': inicio,
+        'resetado_em': time.time()
+    })
+
+def novo_contador_mensagens(tipo_plano='starter'):
+    """Registro inicial gravado no backend (o local é o EstadoUsuario)"""
+    return {
+        'total': 0,
+        'resetado_em': time.time(),
+        'janela_inicio': janela_vigente(tipo_plano)[0],
+        'tipo_plano': tipo_plano
+    }
+
+def obter_contador_mensagens(user_id, tipo_plano='starter'):
+    """Retorna uma cópia do contador de mensagens do usuário (janela do plano dele)"""
+    # 1ª consulta da requisição: traz mensagens, tokens e memória do usuário de uma vez
+    ARMAZEM_ESTADO.sincronizar(user_id, TABELAS_USUARIO)
+    with usuarios_lock:
+        estado = estado_usuario(user_id)
+        estado.iniciar_contador(tipo_plano)
+        return estado.exportar_mensagens()
+
+def contar_mensagem_usuario(user_id, estado, tipo_plano, somado_no_backend, iniciais):
+    """+1 no contador local (e no backend, se a reserva não o somou lá). Chamar com o usuarios_lock."""
+    estado.iniciar_contador(tipo_plano)
+    estado.total += 1
+    estado.tipo_plano = tipo_plano
+    ARMAZEM_ESTADO.atualizar(
+        'mensagens', user_id, somar={} if somado_no_backend else {'total': 1},
+        definir={'tipo_plano': tipo_plano}, iniciais=iniciais
+    )
+    return estado.total
+
+def incrementar_contador(user_id, tipo_plano, reserva=None):
+    """Incrementa o contador de mensagens do usuário, confirmando a reserva de cota (se houver)"""
+    iniciais = novo_contador_mensagens(tipo_plano)
+    somado_no_backend = MOTOR_COTAS.confirmar_no_backend(reserva, iniciais)
     
-    # DIFERENÇA ENTRE PLANOS
-    if any(kw in msg_lower for kw in ['diferença', 'diferenca', 'comparar', 'qual escolher', 'melhor plano']):
-        return f"""Diferenças principais:
+    with usuarios_lock:
+        total = contar_mensagem_usuario(user_id, estado_usuario(user_id), tipo_plano, somado_no_backend, iniciais)
+    
+    MOTOR_COTAS.confirmar(reserva)
+    return total
 
-STARTER (R$320 + R$39,99/mês):
-- Site até 5 páginas
-- Design moderno padrão
+def situacao_limite_mensagens(tipo_plano, mensagens_usadas):
+    """(pode_enviar, mensagens_usadas, limite, mensagens_restantes) para um total já lido"""
+    tipo = tipo_plano.lower().strip()
+    
+    # Admin tem ilimitado
+    if tipo == 'admin':
+        return True, 0, float('inf'), float('inf')
+    
+    limite = LIMITES_MENSAGENS.get(tipo, LIMITES_MENSAGENS['starter'])
+    return mensagens_usadas < limite, mensagens_usadas, limite, max(0, limite - mensagens_usadas)
+
+def verificar_limite_mensagens(user_id, tipo_plano):
+    """
+    Verifica se o usuário atingiu o limite de mensagens.
+    Retorna: (pode_enviar: bool, mensagens_usadas: int, limite: int, mensagens_restantes: int)
+    """
+    tipo = tipo_plano.lower().strip()
+    if tipo == 'admin':
+        return situacao_limite_mensagens(tipo, 0)
+    
+    # 1ª consulta da requisição: traz mensagens, tokens e memória do usuário de uma vez
+    ARMAZEM_ESTADO.sincronizar(user_id, TABELAS_USUARIO)
+    
+    # 🗓️ Renovação preguiçosa: o 1º acesso depois da virada da janela zera o contador
+    renovacao = renovacao_janela(tipo)
+    with usuarios_lock:
+        estado = estado_usuario(user_id)
+        estado.iniciar_contador(tipo)
+        if estado.janela_inicio < renovacao[2]:
+            print(f"🗓️ Cota renovada para {user_id[:8]}... (janela de {renovacao[2][:10]})")
+            estado.renovar_contador(renovacao[2])
+            ARMAZEM_ESTADO.renovar('mensagens', user_id, *renovacao[1:])
+        mensagens_usadas = estado.total
+    
+    return situacao_limite_mensagens(tipo, mensagens_usadas)
+
+def resetar_contador_usuario(user_id):
+    """Reseta o contador de mensagens de um usuário"""
+    with usuarios_lock:
+        estado = USUARIOS.get(user_id)
+        if estado is not None and estado.janela_inicio is not None:
+            estado.total = 0
+            estado.resetado_em = time.time()
+            ARMAZEM_ESTADO.substituir('mensagens', user_id, estado.exportar_mensagens())
+            print(f"🔄 Contador resetado para user: {user_id[:8]}...")
+            return True
+        return False
+
+def gerar_mensagem_limite_atingido(tipo_plano, mensagens_usadas, limite):
+    """Gera mensagem personalizada quando o limite é atingido"""
+    tipo = tipo_plano.lower().strip()
+    
+    if tipo == 'free':
+        return f"""Você atingiu o limite de {limite} mensagens por semana do seu teste grátis.
+
+Para continuar conversando comigo, contrate um dos planos:
+
+STARTER - R$320 (setup) + R$39,99/mês
 - 1.250 mensagens/mês comigo
-- SEO básico
+- Site profissional até 5 páginas
+- Hospedagem inclusa
 
-PROFESSIONAL (R$530 + R$79,99/mês):
-- Páginas ilimitadas
-- Design 100% personalizado
+PROFESSIONAL - R$530 (setup) + R$79,99/mês
 - 5.000 mensagens/mês comigo
-- SEO avançado
-- Blog/E-commerce opcionais
+- Site 100% personalizado
+- Recursos avançados
 
-Para maioria: STARTER é suficiente!
-WhatsApp: (21) 99282-6074"""
+Entre em contato:
+WhatsApp: (21) 99282-6074
+Email: borgesnatan09@gmail.com
+
+Vibrações Positivas! ✨"""
     
-    # RESPOSTA PADRÃO (quando não reconhece a pergunta)
-    return f"""Olá {nome}!
+    elif tipo == 'starter':
+        return f"""Você atingiu o limite de {limite} mensagens do plano Starter este mês.
 
-Seus créditos de IA acabaram este mês. Para informações detalhadas:
+Opções:
+1. Upgrade para Professional (5.000 msgs/mês)
+2. Aguardar renovação mensal
 
-📞 WhatsApp: (21) 99282-6074
-📧 Email: borgesnatan09@gmail.com
-🌐 Site: https://natansites.com.br
+Acesse a página Suporte para falar com Natan pessoalmente!
 
-Posso responder sobre:
-- Planos e preços
-- Contato
-- Portfólio
-- Como funciona
-- Cadastro
+Vibrações Positivas! ✨"""
+    
+    elif tipo == 'professional':
+        return f"""Você atingiu o limite de {limite} mensagens do plano Professional este mês.
 
-Seus créditos renovam no próximo mês!
+Para soluções personalizadas ou aumento de limite, acesse a página Suporte para falar com Natan!
 
 Vibrações Positivas! ✨"""
+    
+    return "Limite de mensagens atingido. Entre em contato com o suporte."
 
 # =============================================================================
-# 🔐 AUTENTICAÇÃO E DADOS DO USUÁRIO
+# 📊 SISTEMA DE CONTAGEM DE TOKENS
 # =============================================================================
 
-def verificar_token_supabase(token):
-    try:
-        if not token or not supabase:
-            return None
-        if token.startswith("Bearer "):
-            token = token[7:]
-        response = supabase.auth.get_user(token)
-        return response.user if response and response.user else None
-    except:
-        return None
+TOKENS_ZERADOS = dict.fromkeys(CAMPOS_TOKENS, 0)
 
-def obter_dados_usuario_completos(user_id):
-    try:
-        if not supabase:
-            return None
-        response = supabase.table('user_accounts').select('*').eq('user_id', user_id).single().execute()
-        return response.data if response.data else None
-    except:
-        return None
+def valores_tokens(tokens_entrada, tokens_saida, tokens_total, tokens_cache=0, coalescida=False):
+    """Uma mensagem nos contadores de tokens, na ordem de CAMPOS_TOKENS"""
+    return (tokens_entrada, tokens_saida, tokens_total, tokens_cache, 1, 1 if coalescida else 0)
 
-def extrair_nome_usuario(user_info, user_data=None):
-    try:
-        if user_data and user_data.get('user_name'):
-            nome = user_data['user_name'].strip()
-            if nome and len(nome) > 1:
-                return nome
-        
-        if user_data and user_data.get('name'):
-            nome = user_data['name'].strip()
-            if nome and len(nome) > 1:
-                return nome
-        
-        if user_info and user_info.user_metadata:
-            nome = user_info.user_metadata.get('name', '').strip()
-            if nome and len(nome) > 1:
-                return nome
-        
-        if user_info and user_info.email:
-            nome = user_info.email.split('@')[0].strip()
-            return nome.capitalize()
-        
-        if user_data and user_data.get('email'):
-            nome = user_data['email'].split('@')[0].strip()
-            return nome.capitalize()
-        
-        return "Cliente"
-        
-    except Exception as e:
-        print(f"⚠️ Erro ao extrair nome: {e}")
-        return "Cliente"
-
-def determinar_tipo_usuario(user_data, user_info=None):
-    try:
-        email = user_data.get('email', '').lower().strip()
-        plan = str(user_data.get('plan', 'starter')).lower().strip()
-        plan_type = str(user_data.get('plan_type', 'paid')).lower().strip()
-        nome = extrair_nome_usuario(user_info, user_data)
-        
-        # ADMIN
-        if email == ADMIN_EMAIL.lower():
-            return {
-                'tipo': 'admin',
-                'nome_display': 'Admin',
-                'plano': 'Admin',
-                'nome_real': 'Natan',
-                'modelo': MODELOS_POR_PLANO['admin']
-            }
-        
-        # FREE ACCESS
-        if plan_type == 'free':
-            return {
-                'tipo': 'free',
-                'nome_display': 'Free Access',
-                'plano': 'Free (teste)',
-                'nome_real': nome,
-                'modelo': MODELOS_POR_PLANO['free']
-            }
-        
-        # PROFESSIONAL
-        if plan == 'professional':
-            return {
-                'tipo': 'professional',
-                'nome_display': 'Professional',
-                'plano': 'Professional',
-                'nome_real': nome,
-                'modelo': MODELOS_POR_PLANO['professional']
-            }
-        
-        # STARTER (padrão)
-        return {
-            'tipo': 'starter',
-            'nome_display': 'Starter',
-            'plano': 'Starter',
-            'nome_real': nome,
-            'modelo': MODELOS_POR_PLANO['starter']
-        }
-        
-    except Exception as e:
-        print(f"⚠️ Erro em determinar_tipo_usuario: {e}")
-        return {
-            'tipo': 'starter',
-            'nome_display': 'Starter',
-            'plano': 'Starter',
-            'nome_real': 'Cliente',
-            'modelo': MODELOS_POR_PLANO['starter']
-        }
-
-# =============================================================================
-# 🧠 SISTEMA DE MEMÓRIA INTELIGENTE
-# =============================================================================
-
-def obter_user_id(user_info, user_data):
-    if user_info and hasattr(user_info, 'id'):
-        return user_info.id
-    if user_data and user_data.get('user_id'):
-        return user_data['user_id']
-    if user_data and user_data.get('email'):
-        return hashlib.md5(user_data['email'].encode()).hexdigest()
-    return 'anonimo'
-
-def inicializar_memoria_usuario(user_id):
-    with memoria_lock:
-        if user_id not in MEMORIA_USUARIOS:
-            MEMORIA_USUARIOS[user_id] = {
-                'mensagens': [],
-                'resumo': '',
-                'ultima_atualizacao': datetime.now().isoformat(),
-                'contador_mensagens': 0
-            }
-
-def adicionar_mensagem_memoria(user_id, role, content):
-    with memoria_lock:
-        if user_id not in MEMORIA_USUARIOS:
-            inicializar_memoria_usuario(user_id)
-        
-        memoria = MEMORIA_USUARIOS[user_id]
-        memoria['mensagens'].append({
-            'role': role,
-            'content': content,
-            'timestamp': datetime.now().isoformat()
-        })
-        memoria['contador_mensagens'] += 1
-        memoria['ultima_atualizacao'] = datetime.now().isoformat()
-        
-        if len(memoria['mensagens']) > MAX_MENSAGENS_MEMORIA:
-            memoria['mensagens'] = memoria['mensagens'][-MAX_MENSAGENS_MEMORIA:]
-
-def gerar_resumo_conversa(mensagens, modelo='gpt-4o-mini'):
-    if not client or not mensagens or len(mensagens) < 3:
-        return ""
-    
-    try:
-        texto_conversa = "\n".join([
-            f"{'Usuário' if m['role'] == 'user' else 'Assistente'}: {m['content']}"
-            for m in mensagens
-        ])
-        
-        prompt_resumo = f"""Resuma esta conversa em 2-3 frases curtas, focando nos tópicos principais:
-
-{texto_conversa}
-
-Resumo objetivo (máx 50 palavras):"""
-
-        response = client.chat.completions.create(
-            model=modelo,
-            messages=[{"role": "user", "content": prompt_resumo}],
-            max_tokens=80,
-            temperature=0.3
-        )
-        
-        resumo = response.choices[0].message.content.strip()
-        return resumo
-        
-    except Exception as e:
-        print(f"⚠️ Erro ao gerar resumo: {e}")
-        return ""
-
-def obter_contexto_memoria(user_id):
-    with memoria_lock:
-        if user_id not in MEMORIA_USUARIOS:
-            return []
-        
-        memoria = MEMORIA_USUARIOS[user_id]
-        mensagens = memoria['mensagens']
-        
-        if not mensagens:
-            return []
-        
-        if len(mensagens) <= 5:
-            return [{'role': m['role'], 'content': m['content']} for m in mensagens]
-        
-        if memoria['contador_mensagens'] % INTERVALO_RESUMO == 0 and not memoria['resumo']:
-            msgs_antigas = mensagens[:-3]
-            if msgs_antigas:
-                memoria['resumo'] = gerar_resumo_conversa(msgs_antigas)
-        
-        contexto = []
-        
-        if memoria['resumo']:
-            contexto.append({
-                'role': 'system',
-                'content': f"Contexto anterior: {memoria['resumo']}"
-            })
-        
-        mensagens_recentes = mensagens[-3:]
-        for m in mensagens_recentes:
-            contexto.append({
-                'role': m['role'],
-                'content': m['content']
-            })
-        
-        return contexto
-
-def limpar_memoria_antiga():
-    with memoria_lock:
-        agora = datetime.now()
-        usuarios_remover = []
-        
-        for user_id, memoria in MEMORIA_USUARIOS.items():
-            ultima_atualizacao = datetime.fromisoformat(memoria['ultima_atualizacao'])
-            diferenca = (agora - ultima_atualizacao).total_seconds()
-            
-            if diferenca > 3600:
-                usuarios_remover.append(user_id)
-        
-        for user_id in usuarios_remover:
-            del MEMORIA_USUARIOS[user_id]
-
-def thread_limpeza_memoria():
-    while True:
-        time.sleep(1800)
-        limpar_memoria_antiga()
-
-threading.Thread(target=thread_limpeza_memoria, daemon=True).start()
+def somar_tokens_usuario(user_id, estado, valores, modelo_usado):
+    """Soma os tokens no registro local e no backend. Chamar com o usuarios_lock."""
+    estado.somar_tokens(valores, modelo_usado)
+    ARMAZEM_ESTADO.atualizar(
+        'tokens', user_id, somar=dict(zip(CAMPOS_TOKENS, valores)),
+        definir={'modelo': modelo_usado}, iniciais=TOKENS_ZERADOS
+    )
 
-# =============================================================================
-# 🛡️ VALIDAÇÃO ANTI-ALUCINAÇÃO
-# =============================================================================
-
-PALAVRAS_PROIBIDAS = [
-    "garantimos primeiro lugar", "100% de conversão", "sucesso garantido",
-    "site pronto em 1 hora", "empresa com 10 anos"
-]
+def registrar_tokens_usados(user_id, tokens_entrada, tokens_saida, tokens_total, modelo_usado, tokens_cache=0, coalescida=False):
+    """Registra tokens usados por um usuário (mensagem coalescida chega com 0 tokens)"""
+    valores = valores_tokens(tokens_entrada, tokens_saida, tokens_total, tokens_cache, coalescida)
+    with usuarios_lock:
+        somar_tokens_usuario(user_id, estado_usuario(user_id), valores, modelo_usado)
 
-PADROES_SUSPEITOS = [
-    r'garantimos?\s+\d+%',
-    r'\d+\s+anos\s+de\s+experiência',
-    r'certificação\s+ISO'
-]
-
-def validar_resposta(resposta, tipo_usuario='starter'):
-    """Validação RELAXADA para Free Access"""
-    tipo = tipo_usuario.lower().strip()
-    
-    # FREE ACCESS: Validação super relaxada
-    if tipo == 'free':
-        resp_lower = resposta.lower()
-        if "garantimos 100%" in resp_lower or "sucesso garantido" in resp_lower:
-            return False, ["Promessa não realista"]
-        return True, []
-    
-    # ADMIN: Sem validação
-    if tipo == 'admin':
-        return True, []
-    
-    # PAGOS: Validação normal
-    problemas = []
-    resp_lower = resposta.lower()
-    
-    for palavra in PALAVRAS_PROIBIDAS:
-        if palavra.lower() in resp_lower:
-            problemas.append(f"Proibida: {palavra}")
+def obter_estatisticas_tokens(user_id):
+    """Retorna estatísticas de tokens de um usuário"""
+    ARMAZEM_ESTADO.sincronizar(user_id, ('tokens',))
+    with usuarios_lock:
+        estado = USUARIOS.get(user_id)
+        stats = estado.exportar_tokens() if estado is not None else None
     
-    for padrao in PADROES_SUSPEITOS:
-        if re.search(padrao, resp_lower):
-            problemas.append(f"Padrão suspeito")
+    if stats is None:
+        return dict(TOKENS_ZERADOS, media_por_mensagem=0, modelo='N/A')
     
-    if "whatsapp" in resp_lower or "telefone" in resp_lower:
-        if "99282-6074" not in resposta and "(21) 9" in resposta:
-            problemas.append("WhatsApp incorreto")
+    if stats['mensagens_processadas'] > 0:
+        stats['media_por_mensagem'] = round(stats['total_geral'] / stats['mensagens_processadas'], 2)
+    else:
+        stats['media_por_mensagem'] = 0
     
-    return len(problemas) == 0, problemas
-
-# =============================================================================
-# ✨ LIMPEZA DE FORMATAÇÃO
-# =============================================================================
+    return stats
 
-def limpar_formatacao_markdown(texto):
-    """Remove asteriscos e caracteres especiais de formatação"""
-    if not texto:
-        return texto
+def totais_usuarios():
+    """
+    Somatórios de todos os usuários numa passada (painel do admin e /health).
+    Sob o lock só a cópia da lista de registros; a soma é feita fora dele.
+    """
+    with usuarios_lock:
+        estados = list(USUARIOS.values())
+        usuarios_memoria = len(CONVERSAS.ordem)
     
-    texto = re.sub(r'\*\*([^*]+)\*\*', r'\1', texto)
-    texto = re.sub(r'\*([^*]+)\*', r'\1', texto)
-    texto = re.sub(r'__([^_]+)__', r'\1', texto)
-    texto = re.sub(r'_([^_]+)_', r'\1', texto)
-    texto = re.sub(r'`([^`]+)`', r'\1', texto)
-    texto = texto.replace('´', '').replace('~', '').replace('^', '').replace('¨', '')
-    texto = re.sub(r'\n{3,}', '\n\n', texto)
+    por_plano = {}
+    tokens = array('q', bytes(8 * len(CAMPOS_TOKENS)))
+    usuarios_contador = turnos_memoria = 0
+    for estado in estados:
+        if estado.janela_inicio is not None:
+            usuarios_contador += 1
+            plano = por_plano.setdefault(estado.tipo_plano, {'usuarios': 0, 'mensagens': 0})
+            plano['usuarios'] += 1
+            plano['mensagens'] += estado.total
+        contadores_tokens = estado.tokens
+        if contadores_tokens is not None:
+            for i, valor in enumerate(contadores_tokens):
+                tokens[i] += valor
+        turnos = estado.turnos
+        if turnos is not None:
+            turnos_memoria += len(turnos)
+    usuarios_registrados = len(estados)
+    
+    return {
+        'usuarios': usuarios_registrados,
+        'usuarios_com_contador': usuarios_contador,
+        'mensagens_enviadas': sum(plano['mensagens'] for plano in por_plano.values()),
+        'por_plano': por_plano,
+        'tokens': dict(zip(CAMPOS_TOKENS, tokens)),
+        'usuarios_com_memoria': usuarios_memoria,
+        'mensagens_memoria': turnos_memoria
+    }
     
-    return texto.strip()
-
 # =============================================================================
 # 🆘 SISTEMA DE RESPOSTA ALTERNATIVA (SEM IA)
 # =============================================================================
@@ -1052,6 +2987,8 @@ def gerar_resposta_alternativa_inteligente(pergunta, tipo_usuario):
     nome = tipo_usuario.get('nome_real', 'Cliente')
     tipo = tipo_usuario.get('tipo', 'starter')
     
+    # 🎯 RESPOSTAS POR CATEGORIA
+    
     # SAUDAÇÕES
     if any(kw in msg_lower for kw in ['oi', 'olá', 'ola', 'hey', 'bom dia', 'boa tarde', 'boa noite', 'e ai', 'eai']):
         return f"Oi {nome}! Seus créditos de IA acabaram este mês, mas posso te ajudar com informações básicas. Como posso ajudar?"
@@ -1072,11 +3009,13 @@ STARTER - R$320 (setup) + R$39,99/mês
 - 1.250 mensagens/mês comigo
 - Site até 5 páginas
 - Hospedagem inclusa
+- Uso comercial
 
 PROFESSIONAL - R$530 (setup) + R$79,99/mês
 - 5.000 mensagens/mês comigo
 - Páginas ilimitadas
 - Design personalizado
+- SEO avançado
 
 Contato:
 WhatsApp: (21) 99282-6074
@@ -1093,7 +3032,7 @@ Site: https://natansites.com.br
 Atendimento pessoal para clientes!"""
     
     # PORTFÓLIO
-    if any(kw in msg_lower for kw in ['portfolio', 'portfólio', 'projetos', 'trabalhos']):
+    if any(kw in msg_lower for kw in ['portfolio', 'portfólio', 'projetos', 'trabalhos', 'sites feitos']):
         return f"""Confira alguns projetos do Natan:
 
 1. Espaço Familiares - espacofamiliares.com.br
@@ -1101,1219 +3040,4743 @@ Atendimento pessoal para clientes!"""
 3. MathWork - mathworkftv.netlify.app
 4. TAF Sem Tabu - tafsemtabu.com.br
 
-Visite natansites.com.br para ver todos!"""
+E mais! Visite natansites.com.br para ver todos."""
     
-    # RESPOSTA PADRÃO
-    return f"""Olá {nome}!
-
-Seus créditos de IA acabaram este mês. Para informações detalhadas:
+    # COMO FUNCIONA
+    if any(kw in msg_lower for kw in ['como funciona', 'processo', 'etapas', 'passo a passo']):
+        return f"""Processo simples:
 
-📞 WhatsApp: (21) 99282-6074
-📧 Email: borgesnatan09@gmail.com
-🌐 Site: https://natansites.com.br
+1. Escolha seu plano
+2. Preencha formulário de cadastro
+3. Efetue pagamento PIX
+4. Aguarde 10min a 2h para criação da conta
+5. Comece a usar!
 
-Posso responder sobre:
-- Planos e preços
-- Contato
-- Portfólio
-- Cadastro
+WhatsApp: (21) 99282-6074"""
+    
+    # TECNOLOGIAS
+    if any(kw in msg_lower for kw in ['tecnologia', 'stack', 'linguagem', 'framework', 'código']):
+        return f"""Stack do Natan:
 
-Seus créditos renovam no próximo mês!
+Front-end: HTML5, CSS3, JavaScript, React, Vue, TypeScript, Tailwind
+Back-end: Node.js, Python, Express.js, APIs
+Mobile: React Native
+Banco: Supabase, PostgreSQL
+IA: OpenAI, Claude
 
-Vibrações Positivas! ✨"""
+Especialidades: IA, SEO, Animações Web"""
+    
+    # SUPORTE
+    if any(kw in msg_lower for kw in ['suporte', 'ajuda', 'problema', 'bug', 'erro', 'não funciona']):
+        if tipo == 'free':
+            return f"""Para suporte, entre em contato:
+WhatsApp: (21) 99282-6074
 
-# =============================================================================
-# 🤖 PROCESSAMENTO OPENAI v8.2 - SISTEMA HÍBRIDO OTIMIZADO COM CONTEXTO COMPLETO
-# =============================================================================
+Clientes pagos têm acesso à página Suporte com chat direto!"""
+        else:
+            return f"""Acesse a página SUPORTE no menu para falar diretamente com o Natan!
 
-def processar_mensagem_openai(mensagem, tipo_usuario, historico_memoria):
-    """
-    Sistema híbrido OTIMIZADO v8.2 com contexto completo da plataforma:
-    - FREE: gpt-4o-mini (básico) - Acesso gratuito permanente
-    - STARTER: gpt-4o-mini (base) + gpt-4o (refinamento inteligente)
-    - PROFESSIONAL: gpt-4o-mini (base) + gpt-4o (refinamento inteligente)
-    - ADMIN: gpt-4o puro + conhecimento total do sistema
-    """
+Você tem suporte prioritário como cliente {tipo.upper()}."""
     
-    if not verificar_openai():
-        return {
-            'resposta': "⚠️ Sistema de IA temporariamente indisponível. Tente novamente em alguns instantes.",
-            'tokens_usados': 0,
-            'modelo_usado': 'N/A',
-            'cached': False
-        }
+    # CADASTRO
+    if any(kw in msg_lower for kw in ['cadastro', 'cadastrar', 'registrar', 'criar conta', 'sign up']):
+        return f"""Para se cadastrar:
+
+1. Escolha STARTER ou PROFESSIONAL
+2. Acesse a página do plano escolhido
+3. Preencha: Nome, Data Nasc, CPF
+4. Pague via PIX (R$320 Starter ou R$530 Pro)
+5. Aguarde criação da conta (10min a 2h)
+
+WhatsApp para dúvidas: (21) 99282-6074"""
     
-    try:
-        tipo = tipo_usuario.get('tipo', 'starter').lower()
-        nome = tipo_usuario.get('nome_real', 'Cliente')
-        plano = tipo_usuario.get('plano', 'Starter')
-        
-        # Detecta categoria da mensagem
-        categoria, config = detectar_categoria_mensagem(mensagem)
-        
-        # ==================================================================
-        # 🎁 FREE ACCESS - GPT-4O-MINI (BÁSICO) - ACESSO GRATUITO PERMANENTE
-        # ==================================================================
-        if tipo == 'free':
-            modelo = 'gpt-4o-mini'
-            max_tokens = config['max_tokens']
-            
-            system_prompt = f"""Você é NatanAI, assistente virtual da NatanSites (natansites.com.br).
+    # HOSPEDAGEM/DOMÍNIO
+    if any(kw in msg_lower for kw in ['hospedagem', 'domínio', 'dominio', 'hosting', 'servidor']):
+        return f"""Hospedagem e Domínio:
 
-**SOBRE SEU PLANO FREE:**
-Você está usando o ACESSO GRATUITO PERMANENTE da plataforma! 🎉
+STARTER: Hospedagem inclusa por 1 ano
+PROFESSIONAL: Hospedagem + Domínio inclusos
 
-**CARACTERÍSTICAS DO SEU PLANO FREE:**
-- 🎁 TOTALMENTE GRATUITO e PERMANENTE
-- 💬 100 mensagens por semana comigo (reseta toda segunda-feira)
-- 🌐 Acesso COMPLETO ao dashboard da plataforma
-- 🤖 NatanAI inclusa (você está conversando comigo agora!)
-- 💬 Suporte via plataforma disponível
-- ⚙️ Configurações de personalização ativadas
-- 📊 Estatísticas de uso visíveis
+Renovação após 1 ano é à parte.
+WhatsApp: (21) 99282-6074"""
+    
+    # PRAZO/TEMPO
+    if any(kw in msg_lower for kw in ['prazo', 'tempo', 'demora', 'quanto tempo', 'quando fica pronto']):
+        return f"""Prazos:
 
-**LIMITAÇÕES DO PLANO FREE:**
-- 🚫 NÃO pode criar sites para uso comercial
-- 🚫 NÃO inclui hospedagem profissional
-- 🚫 NÃO inclui domínio personalizado
-- 🚫 Sites demo apenas para testes/portfólio pessoal
-- 📝 Conversas comigo NÃO são salvas (desaparecem ao fechar)
+Criação de conta: 10min a 2h após pagamento
+Desenvolvimento do site: 
+- Sites simples: 3 a 7 dias
+- Sites complexos: 10 a 20 dias
 
-**PLANOS PAGOS DISPONÍVEIS (UPGRADE):**
+Depende da complexidade e fila de projetos.
+WhatsApp: (21) 99282-6074"""
+    
+    # SEO
+    if any(kw in msg_lower for kw in ['seo', 'google', 'ranquear', 'primeiro lugar', 'posicionamento']):
+        return f"""SEO (Otimização para Google):
 
-📦 STARTER - R$320 (setup único) + R$39,99/mês
-- 1.250 mensagens/mês comigo (12.5x mais que Free!)
-- Site profissional até 5 páginas
-- Hospedagem incluída por 1 ano
-- Domínio .com.br ou .com (seu ou fornecido)
-- SEO básico otimizado
-- Design moderno responsivo
-- Uso comercial PERMITIDO
-- Conversas salvas e persistentes
-- Suporte via plataforma 24/7
-- Contrato de 1 ano
+STARTER: SEO básico incluso
+PROFESSIONAL: SEO avançado incluso
 
-💎 PROFESSIONAL - R$530 (setup único) + R$79,99/mês
-- 5.000 mensagens/mês comigo (50x mais que Free!)
-- Páginas ILIMITADAS
-- Design 100% PERSONALIZADO (exclusivo)
-- Hospedagem + Domínio inclusos por 1 ano
-- SEO AVANÇADO com keywords
-- Animações e interatividade premium
-- Blog ou E-commerce OPCIONAIS
-- Integração de APIs customizadas
-- 5 revisões de design inclusas
-- Formulários de contato avançados
-- Suporte PRIORITÁRIO 24/7
-- IA Inclusa opcional no site
-- Conversas salvas e persistentes
-- Uso comercial PERMITIDO
-- Contrato de 1 ano
+O Natan otimiza seu site para aparecer melhor no Google!
+Mas não garantimos posições específicas (ninguém pode garantir isso).
 
-**PROCESSO DE UPGRADE:**
-1. Escolha seu plano (Starter ou Professional)
-2. Acesse a página do plano no menu lateral
-3. Preencha o formulário com: Nome completo, Data de nascimento, CPF
-4. Efetue o pagamento via PIX (R$320 Starter ou R$530 Professional)
-5. Aguarde 10 minutos a 2 horas para criação da conta
-6. Você receberá confirmação por email quando estiver pronto!
+WhatsApp: (21) 99282-6074"""
+    
+    # PAGAMENTO
+    if any(kw in msg_lower for kw in ['pagamento', 'pagar', 'pix', 'forma de pagamento', 'cartão']):
+        return f"""Formas de Pagamento:
 
-**CONTATO PARA DÚVIDAS:**
-- 📱 WhatsApp: (21) 99282-6074
-- 📧 Email: borgesnatan09@gmail.com
-- 🌐 Site: https://natansites.com.br
+Setup (inicial): PIX
+- Starter: R$320,00
+- Professional: R$530,00
 
-**PORTFÓLIO (TRABALHOS DO NATAN):**
-- Espaço Familiares - espacofamiliares.com.br
-- NatanSites - natansites.com.br
-- MathWork - mathworkftv.netlify.app
-- TAF Sem Tabu - tafsemtabu.com.br
+Mensalidade: PIX mensal
+- Starter: R$39,99/mês
+- Professional: R$79,99/mês
 
-**TECNOLOGIAS QUE O NATAN DOMINA:**
-- Frontend: HTML5, CSS3, JavaScript, React, Vue.js, Next.js, TypeScript, Tailwind CSS
-- Backend: Node.js, Python, Express.js, Django, Flask, APIs RESTful
-- Mobile: React Native (apps iOS/Android)
-- Banco de Dados: Supabase, PostgreSQL, MongoDB, MySQL
-- Inteligência Artificial: OpenAI GPT-4, Claude, integração de IA em sites
-- SEO: Otimização completa para Google (técnico e on-page)
-- DevOps: Git, GitHub, CI/CD, Vercel, Netlify, Render
+Sem cartão de crédito por enquanto.
+WhatsApp: (21) 99282-6074"""
+    
+    # DIFERENÇA ENTRE PLANOS
+    if any(kw in msg_lower for kw in ['diferença', 'diferenca', 'comparar', 'qual escolher', 'melhor plano']):
+        return f"""Diferenças principais:
 
-REGRAS DE COMPORTAMENTO:
-- Seja direto e objetivo
-- Incentive upgrade para planos pagos quando relevante
-- {config['instrucao']}
-- Sem asteriscos ou formatação markdown
-- Tom amigável e prestativo
-- SEMPRE mencione que o plano FREE é PERMANENTE e GRATUITO
-- Explique claramente as limitações do Free vs benefícios dos pagos
-- Seja transparente sobre preços e processos
+STARTER (R$320 + R$39,99/mês):
+- Site até 5 páginas
+- Design moderno padrão
+- 1.250 mensagens/mês comigo
+- SEO básico
+
+PROFESSIONAL (R$530 + R$79,99/mês):
+- Páginas ilimitadas
+- Design 100% personalizado
+- 5.000 mensagens/mês comigo
+- SEO avançado
+- Blog/E-commerce opcionais
 
-Você está conversando com: {nome} (Plano {plano} - Gratuito Permanente)"""
+Para maioria: STARTER é suficiente!
+WhatsApp: (21) 99282-6074"""
+    
+    # RESPOSTA PADRÃO (quando não reconhece a pergunta)
+    return f"""Olá {nome}!
 
-            messages = [{"role": "system", "content": system_prompt}]
-            messages.extend(historico_memoria[-3:])
-            messages.append({"role": "user", "content": mensagem})
-            
-            response = client.chat.completions.create(
-                model=modelo,
-                messages=messages,
-                max_tokens=max_tokens,
-                temperature=0.7
+Seus créditos de IA acabaram este mês. Para informações detalhadas:
+
+📞 WhatsApp: (21) 99282-6074
+📧 Email: borgesnatan09@gmail.com
+🌐 Site: https://natansites.com.br
+
+Posso responder sobre:
+- Planos e preços
+- Contato
+- Portfólio
+- Como funciona
+- Cadastro
+
+Seus créditos renovam no próximo mês!
+
+Vibrações Positivas! ✨"""
+
+# =============================================================================
+# 🔐 AUTENTICAÇÃO E DADOS DO USUÁRIO
+# =============================================================================
+
+AUTENTICACAO_CONFIG = {
+    'max_tokens': 10000,            # Tokens verificados lembrados (LRU)
+    'ttl_token': 300,               # Validade máxima de um token em cache (nunca passa do `exp`)
+    'ttl_token_invalido': 60,       # Cache negativo: token recusado não volta ao Supabase
+    'max_contas': 5000,             # Linhas de user_accounts em cache
+    'ttl_conta': 120,               # Mudança de plano sem invalidar_cache_usuario: vale em até 2 min
+    'audiencia': 'authenticated',
+    'jwks_url': f"{SUPABASE_URL.rstrip('/')}/auth/v1/.well-known/jwks.json" if SUPABASE_URL else None
+}
+
+# Guardado no lugar do usuário quando o token foi recusado
+TOKEN_INVALIDO = False
+
+class UsuarioToken:
+    """O que o resto do código usa de `supabase.auth.get_user(...).user`, lido das claims do JWT"""
+    
+    __slots__ = ('id', 'email', 'user_metadata', 'app_metadata', 'expira_em')
+    
+    def __init__(self, claims):
+        self.id = claims['sub']
+        self.expira_em = claims['exp']
+        self.email = claims.get('email') or ''
+        self.user_metadata = claims.get('user_metadata') or {}
+        self.app_metadata = claims.get('app_metadata') or {}
+
+class VerificadorJWT:
+    """
+    Verifica assinatura, expiração e audiência do token sem ida ao Supabase:
+    HS256 com o JWT secret do projeto, ou ES256/RS256 com as chaves públicas
+    do JWKS (baixadas uma vez e guardadas pelo PyJWKClient).
+    verificar() retorna UsuarioToken, TOKEN_INVALIDO, ou None quando só o
+    Supabase pode decidir (sem PyJWT/segredo, JWKS fora do ar, assinatura
+    que não bate com o segredo configurado).
+    """
+    
+    def __init__(self, segredo, jwks_url, audiencia):
+        self.segredo = segredo
+        self.audiencia = audiencia
+        self.jwks = jwt.PyJWKClient(jwks_url, cache_keys=True) if jwt and jwks_url else None
+        self.locais = 0
+        self.recusados = 0
+        self.indecisos = 0
+        self.lock = threading.Lock()
+    
+    @property
+    def ativo(self):
+        return jwt is not None and bool(self.segredo or self.jwks)
+    
+    def _contar(self, campo):
+        with self.lock:
+            setattr(self, campo, getattr(self, campo) + 1)
+    
+    def verificar(self, token):
+        if not self.ativo:
+            return None
+        try:
+            algoritmo = jwt.get_unverified_header(token).get('alg')
+            if algoritmo == 'HS256' and self.segredo:
+                chave = self.segredo
+            elif algoritmo in ('ES256', 'RS256') and self.jwks:
+                chave = self.jwks.get_signing_key_from_jwt(token).key
+            else:
+                self._contar('indecisos')
+                return None
+            claims = jwt.decode(
+                token, chave, algorithms=[algoritmo], audience=self.audiencia,
+                options={'require': ['exp', 'sub']}
             )
-            
-            resposta = response.choices[0].message.content.strip()
-            resposta = limpar_formatacao_markdown(resposta)
-            
+        except jwt.InvalidSignatureError:
+            self._contar('indecisos')  # segredo errado/rotacionado: o Supabase decide
+            return None
+        except (jwt.ExpiredSignatureError, jwt.InvalidAudienceError, jwt.MissingRequiredClaimError, jwt.DecodeError):
+            self._contar('recusados')
+            return TOKEN_INVALIDO
+        except Exception:
+            self._contar('indecisos')  # JWKS inacessível, chave desconhecida, etc.
+            return None
+        
+        self._contar('locais')
+        return UsuarioToken(claims)
+    
+    def estatisticas(self):
+        with self.lock:
             return {
-                'resposta': resposta,
-                'tokens_usados': response.usage.total_tokens,
-                'tokens_entrada': response.usage.prompt_tokens,
-                'tokens_saida': response.usage.completion_tokens,
-                'modelo_usado': modelo,
-                'cached': False,
-                'categoria': categoria
+                'ativo': self.ativo,
+                'hs256': bool(self.segredo),
+                'jwks': self.jwks is not None,
+                'locais': self.locais,
+                'recusados': self.recusados,
+                'indecisos': self.indecisos
             }
-        
-        # ==================================================================
-        # 🌱 STARTER - SISTEMA HÍBRIDO INTELIGENTE
-        # ==================================================================
-        elif tipo == 'starter':
-            modelo_inicial = 'gpt-4o-mini'
-            max_tokens_inicial = config['max_tokens']
-            
-            system_prompt_base = f"""Você é NatanAI, assistente da NatanSites para clientes STARTER.
 
-**SOBRE SEU PLANO STARTER:**
-Você é um cliente PAGO PREMIUM! 🌟
+VERIFICADOR_JWT = VerificadorJWT(SUPABASE_JWT_SECRET, AUTENTICACAO_CONFIG['jwks_url'], AUTENTICACAO_CONFIG['audiencia'])
+CACHE_TOKENS = CacheRespostas(AUTENTICACAO_CONFIG['max_tokens'], AUTENTICACAO_CONFIG['ttl_token'])
+CACHE_CONTAS = CacheRespostas(AUTENTICACAO_CONFIG['max_contas'], AUTENTICACAO_CONFIG['ttl_conta'])
+
+def limpar_token(token):
+    if token and token.startswith("Bearer "):
+        return token[7:]
+    return token
+
+def chave_cache_token(token):
+    """Hash do token: o cache não guarda credenciais em claro"""
+    return hashlib.sha256(token.encode()).digest()
+
+def validade_cache_token(token, usuario):
+    """Segundos até o `exp` do token (limitado por ttl_token)"""
+    ttl = AUTENTICACAO_CONFIG['ttl_token']
+    expira_em = getattr(usuario, 'expira_em', None)
+    if expira_em is None and jwt is not None:
+        # Usuário vindo do Supabase: lê o `exp` sem verificar (a verificação já foi feita lá)
+        try:
+            expira_em = jwt.decode(token, options={'verify_signature': False}).get('exp')
+        except Exception:
+            pass
+    return min(ttl, expira_em - time.time()) if expira_em else ttl
 
-**BENEFÍCIOS DO SEU PLANO STARTER:**
-💬 **Comunicação Comigo:**
-- 1.250 mensagens/mês comigo (vs 100/semana do Free)
-- Conversas SALVAS e persistentes (não desaparecem!)
-- Histórico completo de chats acessível
-- Respostas mais elaboradas e técnicas
+def consultar_token_local(token):
+    """
+    Caminho sem rede: cache → JWT local. Retorna (chave, usuário), onde o
+    usuário é UsuarioToken, TOKEN_INVALIDO, ou None (consultar o Supabase).
+    """
+    chave = chave_cache_token(token)
+    usuario = CACHE_TOKENS.obter(chave)
+    if usuario is not None:
+        return chave, usuario
+    
+    usuario = VERIFICADOR_JWT.verificar(token)
+    if usuario is not None:
+        guardar_token_cache(chave, token, usuario)
+    return chave, usuario
+
+def guardar_token_cache(chave, token, usuario):
+    if usuario is TOKEN_INVALIDO:
+        CACHE_TOKENS.armazenar(chave, TOKEN_INVALIDO, AUTENTICACAO_CONFIG['ttl_token_invalido'])
+        return
+    ttl = validade_cache_token(token, usuario)
+    if ttl > 0:
+        CACHE_TOKENS.armazenar(chave, usuario, ttl)
+
+def invalidar_token(token):
+    """Hook de logout/revogação: o próximo uso do token volta a ser verificado"""
+    token = limpar_token(token)
+    return CACHE_TOKENS.remover(chave_cache_token(token)) if token else False
+
+def invalidar_cache_usuario(user_id):
+    """Hook de mudança de plano/suspensão: a próxima requisição relê user_accounts"""
+    removidas = [CACHE_CONTAS.remover((projecao, user_id)) for projecao in PROJECOES_CONTAS]
+    return any(removidas)
 
-🌐 **Seu Site Profissional:**
-- Site até 5 páginas (Home, Sobre, Serviços, Contato, etc)
-- Design moderno e responsivo (mobile + desktop)
-- Hospedagem INCLUÍDA por 1 ano
-- Domínio personalizado (seu ou fornecido por nós)
-- SEO básico otimizado (Google-friendly)
-- Uso comercial PERMITIDO
-- Sem marca d'água
-- Formulários de contato funcionais
-- Integração com Google Analytics (opcional)
+def verificar_token_supabase(token):
+    token = limpar_token(token)
+    if not token:
+        return None
+    
+    chave, usuario = consultar_token_local(token)
+    if usuario is None:
+        # Sem como decidir localmente: pergunta ao Supabase (e guarda a resposta)
+        try:
+            if not supabase:
+                return None
+            response = supabase.auth.get_user(token)
+            usuario = response.user if response and response.user else TOKEN_INVALIDO
+        except Exception as e:
+            # Token recusado vira cache negativo; falha de rede não
+            if getattr(e, 'status', None) not in (401, 403):
+                return None
+            usuario = TOKEN_INVALIDO
+        guardar_token_cache(chave, token, usuario)
+    
+    return usuario or None
 
-⚡ **Desenvolvimento:**
-- Prazo: 3-7 dias (sites simples) ou 10-20 dias (complexos)
-- 2 revisões de ajustes incluídas
-- Tecnologias: HTML5, CSS3, JavaScript, React (quando necessário)
-- Performance otimizada (carregamento rápido)
+# 🗄️ user_accounts: colunas que cada uso lê (o resto da linha não trafega)
+PROJECOES_CONTAS = {
+    'plano': ('user_id', 'user_email', 'plan_name', 'plan_type'),
+    'admin': ('user_id', 'user_email', 'plan_name', 'plan_type', 'is_suspended',
+              'account_expires_at', 'dashboard_visits', 'last_visit_at', 'created_at')
+}
+CONTAS_CONFIG = {
+    'lote_in': 100,          # ids por consulta in_() (limite de tamanho da URL)
+    'max_lote_admin': 200    # usuários por chamada de /api/admin/users/stats
+}
 
-📊 **Dashboard e Ferramentas:**
-- Acesso completo ao dashboard NatanSites
-- Página "Meus Sites" com todos seus projetos
-- Página de Suporte direto com Natan
-- Estatísticas de uso visíveis
-- Configurações de personalização
+# Projeções que o banco recusou (coluna inexistente): passam a pedir '*'
+projecoes_recusadas = set()
 
-💰 **Investimento:**
-- Setup único: R$320,00 (pago uma vez)
-- Mensalidade: R$39,99/mês
-- Contrato: 1 ano
-- Renovação: Negociável após 1 ano
+def normalizar_conta(linha):
+    """Nomes da tabela (user_email, plan_name) -> nomes que o código lê (email, plan)"""
+    conta = dict(linha)
+    if not conta.get('email'):
+        conta['email'] = conta.get('user_email') or ''
+    if not conta.get('plan') and conta.get('plan_name'):
+        conta['plan'] = conta['plan_name']
+    return conta
 
-**OUTROS PLANOS (COMPARAÇÃO):**
+def colunas_projecao(projecao):
+    return '*' if projecao in projecoes_recusadas else ','.join(PROJECOES_CONTAS[projecao])
 
-🎁 FREE (R$0,00):
-- 100 mensagens/semana
-- SEM site profissional
-- SEM uso comercial
-- SEM hospedagem
-- SEM domínio
-- Conversas NÃO salvas
+def projecao_recusada(erro, projecao):
+    """Coluna inexistente (42703 / PGRST204): repete a consulta com '*' em vez de falhar o login"""
+    if erro.code not in ('42703', 'PGRST204') or projecao in projecoes_recusadas:
+        return False
+    print(f"⚠️ user_accounts recusou a projeção '{projecao}' ({erro.message}): usando select('*')")
+    projecoes_recusadas.add(projecao)
+    return True
+
+def contas_em_cache(user_ids, projecao):
+    """Separa as contas já em cache dos ids que precisam ir ao banco"""
+    contas, faltando = {}, []
+    for user_id in dict.fromkeys(user_ids):
+        conta = CACHE_CONTAS.obter((projecao, user_id))
+        if conta is None:
+            faltando.append(user_id)
+        else:
+            contas[user_id] = dict(conta)
+    return contas, faltando
 
-💎 PROFESSIONAL (R$530 + R$79,99/mês):
-- 5.000 mensagens/mês (4x mais que Starter!)
-- Páginas ILIMITADAS
-- Design 100% PERSONALIZADO
-- Hospedagem + Domínio inclusos
-- SEO AVANÇADO
-- Blog/E-commerce opcionais
-- IA integrada no site (opcional)
-- Suporte PRIORITÁRIO
-- 5 revisões inclusas
+def guardar_contas(contas, linhas, projecao):
+    for linha in linhas:
+        conta = normalizar_conta(linha)
+        CACHE_CONTAS.armazenar((projecao, conta['user_id']), conta)
+        contas[conta['user_id']] = dict(conta)
 
-**INFORMAÇÕES TÉCNICAS:**
-- Frontend: HTML5, CSS3, JavaScript, React
-- Backend: Node.js, Python, APIs
-- Banco: Supabase, PostgreSQL
-- Hospedagem: Vercel, Netlify, Render
-- SEO: Meta tags, sitemap.xml, robots.txt, schema.org
+def buscar_contas(user_ids, projecao='plano'):
+    """
+    {user_id: conta} com uma consulta select(colunas).in_('user_id', ...) por
+    lote de ids. As que já estão em cache não vão ao banco.
+    """
+    contas, faltando = contas_em_cache(user_ids, projecao)
+    if not faltando or not supabase:
+        return contas
+    
+    lote = CONTAS_CONFIG['lote_in']
+    for i in range(0, len(faltando), lote):
+        ids = faltando[i:i + lote]
+        try:
+            resposta = supabase.table('user_accounts').select(colunas_projecao(projecao)).in_('user_id', ids).execute()
+        except APIError as e:
+            if not projecao_recusada(e, projecao):
+                raise
+            resposta = supabase.table('user_accounts').select('*').in_('user_id', ids).execute()
+        guardar_contas(contas, resposta.data or [], projecao)
+    return contas
+
+def obter_dados_usuario_completos(user_id, projecao='plano'):
+    try:
+        return buscar_contas([user_id], projecao).get(user_id)
+    except:
+        return None
 
-**PRAZOS E PROCESSO:**
-1. Briefing: Você descreve o que precisa
-2. Desenvolvimento: 3-20 dias (conforme complexidade)
-3. Revisão: Até 2 ajustes incluídos
-4. Entrega: Site online e funcionando
-5. Suporte: Disponível via plataforma
+def obter_estatisticas_autenticacao():
+    return {
+        'jwt_local': VERIFICADOR_JWT.estatisticas(),
+        'cache_tokens': CACHE_TOKENS.estatisticas(),
+        'cache_contas': CACHE_CONTAS.estatisticas()
+    }
 
-**CONTATO DIRETO:**
-- 📱 WhatsApp: (21) 99282-6074
-- 📧 Email: borgesnatan09@gmail.com
-- 💬 Suporte: Página dedicada na plataforma
+def extrair_nome_usuario(user_info, user_data=None):
+    try:
+        if user_data and user_data.get('user_name'):
+            nome = user_data['user_name'].strip()
+            if nome and len(nome) > 1:
+                return nome
+        
+        if user_data and user_data.get('name'):
+            nome = user_data['name'].strip()
+            if nome and len(nome) > 1:
+                return nome
+        
+        if user_info and user_info.user_metadata:
+            nome = user_info.user_metadata.get('name', '').strip()
+            if nome and len(nome) > 1:
+                return nome
+        
+        if user_info and user_info.email:
+            nome = user_info.email.split('@')[0].strip()
+            return nome.capitalize()
+        
+        if user_data and user_data.get('email'):
+            nome = user_data['email'].split('@')[0].strip()
+            return nome.capitalize()
+        
+        return "Cliente"
+        
+    except Exception as e:
+        print(f"⚠️ Erro ao extrair nome: {e}")
+        return "Cliente"
 
-**PORTFÓLIO DO NATAN:**
-- espacofamiliares.com.br
-- natansites.com.br
-- mathworkftv.netlify.app
-- tafsemtabu.com.br
+def determinar_tipo_usuario(user_data, user_info=None):
+    try:
+        email = user_data.get('email', '').lower().strip()
+        plan = str(user_data.get('plan', 'starter')).lower().strip()
+        plan_type = str(user_data.get('plan_type', 'paid')).lower().strip()
+        nome = extrair_nome_usuario(user_info, user_data)
+        
+        # ADMIN
+        if email == ADMIN_EMAIL.lower():
+            return {
+                'tipo': 'admin',
+                'nome_display': 'Admin',
+                'plano': 'Admin',
+                'nome_real': 'Natan',
+                'modelo': MODELOS_POR_PLANO['admin']
+            }
+        
+        # FREE ACCESS
+        if plan_type == 'free':
+            return {
+                'tipo': 'free',
+                'nome_display': 'Free Access',
+                'plano': 'Free (teste)',
+                'nome_real': nome,
+                'modelo': MODELOS_POR_PLANO['free']
+            }
+        
+        # PROFESSIONAL
+        if plan == 'professional':
+            return {
+                'tipo': 'professional',
+                'nome_display': 'Professional',
+                'plano': 'Professional',
+                'nome_real': nome,
+                'modelo': MODELOS_POR_PLANO['professional']
+            }
+        
+        # STARTER (padrão)
+        return {
+            'tipo': 'starter',
+            'nome_display': 'Starter',
+            'plano': 'Starter',
+            'nome_real': nome,
+            'modelo': MODELOS_POR_PLANO['starter']
+        }
+        
+    except Exception as e:
+        print(f"⚠️ Erro em determinar_tipo_usuario: {e}")
+        return {
+            'tipo': 'starter',
+            'nome_display': 'Starter',
+            'plano': 'Starter',
+            'nome_real': 'Cliente',
+            'modelo': MODELOS_POR_PLANO['starter']
+        }
 
-REGRAS:
-- {config['instrucao']}
-- Seja claro e prestativo
-- Destaque os benefícios do plano Starter
-- Sugira Professional apenas quando apropriado
-- Sem asteriscos ou formatação markdown
-- Tom profissional e amigável
+# =============================================================================
+# 🧠 SISTEMA DE MEMÓRIA INTELIGENTE
+# =============================================================================
 
-Você está conversando com: {nome} (Cliente STARTER - Plano Pago Premium)"""
+def obter_user_id(user_info, user_data):
+    if user_info and hasattr(user_info, 'id'):
+        return user_info.id
+    if user_data and user_data.get('user_id'):
+        return user_data['user_id']
+    if user_data and user_data.get('email'):
+        return hashlib.md5(user_data['email'].encode()).hexdigest()
+    return 'anonimo'
 
-            messages_inicial = [{"role": "system", "content": system_prompt_base}]
-            messages_inicial.extend(historico_memoria[-5:])
-            messages_inicial.append({"role": "user", "content": mensagem})
-            
-            response_inicial = client.chat.completions.create(
-                model=modelo_inicial,
-                messages=messages_inicial,
-                max_tokens=max_tokens_inicial,
-                temperature=0.7
-            )
-            
-            resposta_inicial = response_inicial.choices[0].message.content.strip()
-            tokens_inicial = response_inicial.usage.total_tokens
-            
-            # Detecta se precisa de refinamento com GPT-4O
-            msg_lower = mensagem.lower().strip()
-            
-            keywords_refinamento = [
-                'como funciona', 'me explica', 'detalhes', 'completo', 'diferença', 'comparar',
-                'qual escolher', 'melhor', 'processo', 'etapas', 'passo a passo', 'tecnologia',
-                'stack', 'framework', 'prazo', 'tempo', 'quanto tempo', 'seo', 'otimização',
-                'google', 'hospedagem', 'domínio', 'servidor', 'blog', 'e-commerce', 'loja virtual',
-                'design', 'layout', 'personalização', 'upgrade', 'professional', 'diferença planos'
-            ]
-            
-            precisa_refinamento = any(kw in msg_lower for kw in keywords_refinamento)
-            
-            if not precisa_refinamento or len(resposta_inicial.split()) < 30:
-                resposta_final = limpar_formatacao_markdown(resposta_inicial)
-                
-                return {
-                    'resposta': resposta_final,
-                    'tokens_usados': tokens_inicial,
-                    'tokens_entrada': response_inicial.usage.prompt_tokens,
-                    'tokens_saida': response_inicial.usage.completion_tokens,
-                    'modelo_usado': f'{modelo_inicial} (direto)',
-                    'cached': False,
-                    'categoria': categoria,
-                    'sistema_hibrido': 'mini_apenas'
-                }
-            
-            # Refinamento com GPT-4O
-            modelo_refinamento = 'gpt-4o'
-            max_tokens_refinamento = min(config['max_tokens'] * 2, 600)
-            
-            prompt_refinamento = f"""Você é NatanAI em modo de refinamento. Melhore e expanda esta resposta mantendo as informações corretas mas adicionando mais contexto, detalhes técnicos e clareza.
+def gravar_memoria_usuario(user_id, estado):
+    """Regrava a memória inteira no backend (só exporta se houver backend). Chamar com o usuarios_lock."""
+    if ARMAZEM_ESTADO.ativo:
+        ARMAZEM_ESTADO.substituir('memoria', user_id, estado.exportar_memoria())
 
-RESPOSTA INICIAL (gpt-4o-mini):
-{resposta_inicial}
+def anotar_turno(user_id, estado, role, content):
+    """
+    Acrescenta o turno à conversa (uma vencida recomeça do zero), marca o acesso
+    na LRU e tira algumas conversas vencidas de outros usuários. Chamar com o usuarios_lock.
+    """
+    if estado.turnos is not None and CONVERSAS.vencida(estado):
+        estado.descartar_memoria()
+    estado.adicionar_turno(role, content)
+    CONVERSAS.tocar(user_id)
+    CONVERSAS.expirar(MEMORIA_CONFIG['lote_por_acesso'])
+    gravar_memoria_usuario(user_id, estado)
 
-PERGUNTA DO USUÁRIO:
-{mensagem}
+def adicionar_mensagem_memoria(user_id, role, content):
+    with usuarios_lock:
+        anotar_turno(user_id, estado_usuario(user_id), role, content)
+
+def registrar_pergunta_memoria(user_id, mensagem):
+    """Salva a pergunta na memória e devolve o contexto da conversa (uma consulta, um lock)"""
+    ARMAZEM_ESTADO.sincronizar(user_id, ('memoria',))
+    with usuarios_lock:
+        estado = estado_usuario(user_id)
+        anotar_turno(user_id, estado, 'user', mensagem)
+        agendar = precisa_resumo(estado)
+        contexto = montar_contexto_memoria(estado)
+    
+    # Nunca espera pelo resumo: usa o anterior (ou só as mensagens recentes) e agenda um novo
+    if agendar:
+        FILA_RESUMOS.agendar(user_id)
+    
+    return contexto
 
-CONTEXTO: Cliente Starter (plano pago R$39,99/mês)
+def registrar_resposta_usuario(user_id, tipo_plano, resposta, resultado, reserva=None, contar=True):
+    """
+    Resposta entregue: memória, contador de mensagens (confirmando a reserva)
+    e tokens no mesmo registro, num só lock. Retorna o total de mensagens usadas.
+    """
+    iniciais = novo_contador_mensagens(tipo_plano)
+    somado_no_backend = contar and MOTOR_COTAS.confirmar_no_backend(reserva, iniciais)
+    valores = valores_tokens(
+        resultado.get('tokens_entrada', 0),
+        resultado.get('tokens_saida', 0),
+        resultado['tokens_usados'],
+        resultado.get('tokens_cache', 0),
+        resultado.get('coalescido', False)
+    )
+    
+    with usuarios_lock:
+        estado = estado_usuario(user_id)
+        anotar_turno(user_id, estado, 'assistant', resposta)
+        if contar:
+            contar_mensagem_usuario(user_id, estado, tipo_plano, somado_no_backend, iniciais)
+        somar_tokens_usuario(user_id, estado, valores, resultado['modelo_usado'])
+        total = estado.total
+    
+    if contar:
+        MOTOR_COTAS.confirmar(reserva)
+    return total
+
+def formatar_mensagens_resumo(mensagens):
+    return "\n".join(
+        f"{'Usuário' if m['role'] == 'user' else 'Assistente'}: {m['content']}"
+        for m in mensagens
+    )
+
+def gerar_resumo_conversa(novas, resumo_anterior='', modelo='gpt-4o-mini'):
+    """Incorpora as mensagens novas ao resumo anterior (custo proporcional às novas)"""
+    if not client or not novas:
+        return ""
+    
+    try:
+        prompt_resumo = f"""Resumo atual da conversa:
+{resumo_anterior or '(vazio)'}
 
-INSTRUÇÕES:
-- Mantenha TODAS as informações corretas da resposta inicial
-- Adicione mais detalhes técnicos e contexto relevante
-- Torne a explicação mais completa e profissional
-- {config['instrucao']} (mas pode ser um pouco mais extenso)
-- Sem asteriscos ou formatação markdown
-- Tom prestativo, claro e profissional
-- Destaque os benefícios do plano Starter quando relevante
+Novas mensagens:
+{formatar_mensagens_resumo(novas)}
 
-MELHORE E EXPANDA A RESPOSTA:"""
+Atualize o resumo em 2-3 frases curtas incorporando as novas mensagens, focando nos tópicos principais.
 
-            messages_refinamento = [{"role": "system", "content": prompt_refinamento}]
-            
-            response_refinamento = client.chat.completions.create(
-                model=modelo_refinamento,
-                messages=messages_refinamento,
-                max_tokens=max_tokens_refinamento,
-                temperature=0.7
-            )
-            
-            resposta_refinada = response_refinamento.choices[0].message.content.strip()
-            tokens_refinamento = response_refinamento.usage.total_tokens
-            tokens_total = tokens_inicial + tokens_refinamento
-            
-            resposta_final = limpar_formatacao_markdown(resposta_refinada)
-            
-            return {
-                'resposta': resposta_final,
-                'tokens_usados': tokens_total,
-                'tokens_entrada': response_inicial.usage.prompt_tokens + response_refinamento.usage.prompt_tokens,
-                'tokens_saida': response_inicial.usage.completion_tokens + response_refinamento.usage.completion_tokens,
-                'modelo_usado': f'híbrido ({modelo_inicial} → {modelo_refinamento})',
-                'cached': False,
-                'categoria': categoria,
-                'sistema_hibrido': 'mini_plus_4o',
-                'tokens_mini': tokens_inicial,
-                'tokens_4o': tokens_refinamento
-            }
+Resumo objetivo (máx 50 palavras):"""
 
-        # ==================================================================
-        # 💎 PROFESSIONAL - SISTEMA HÍBRIDO INTELIGENTE PREMIUM
-        # ==================================================================
-        elif tipo == 'professional':
-            modelo_inicial = 'gpt-4o-mini'
-            max_tokens_inicial = config['max_tokens']
-            
-            system_prompt_base = f"""Você é NatanAI, assistente premium para clientes PROFESSIONAL.
+        response = client.chat.completions.create(
+            model=modelo,
+            messages=[{"role": "user", "content": prompt_resumo}],
+            max_tokens=RESUMOS_CONFIG['max_tokens_resumo'],
+            temperature=0.3
+        )
+        
+        resumo = response.choices[0].message.content.strip()
+        return resumo
+        
+    except Exception as e:
+        print(f"⚠️ Erro ao gerar resumo: {e}")
+        return ""
 
-**SOBRE SEU PLANO PROFESSIONAL:**
-Você é um cliente PREMIUM TOP TIER! 💎✨
+def precisa_resumo(estado):
+    return estado.turnos is not None and len(estado.turnos) > 5 and bool(estado.nao_resumidas)
 
-**BENEFÍCIOS EXCLUSIVOS DO SEU PLANO PROFESSIONAL:**
+def montar_contexto_memoria(estado):
+    """Contexto enviado ao modelo: resumo (se houver) + últimas mensagens"""
+    turnos = estado.turnos
+    
+    if len(turnos) <= 5:
+        return turnos_como_mensagens(turnos)
+    
+    contexto = []
+    
+    if estado.resumo:
+        contexto.append({
+            'role': 'system',
+            'content': f"Contexto anterior: {estado.resumo}"
+        })
+    
+    recentes = itertools.islice(turnos, len(turnos) - MENSAGENS_RECENTES_CONTEXTO, None)
+    contexto.extend(turnos_como_mensagens(recentes))
+    
+    return contexto
 
-💬 **Comunicação Comigo (NatanAI):**
-- 5.000 mensagens/mês (vs 1.250 do Starter!)
-- Conversas SALVAS e persistentes
-- Histórico completo ilimitado
-- Respostas AVANÇADAS e técnicas detalhadas
-- Prioridade no processamento
+def limpar_memoria_antiga():
+    """
+    Tira da RAM as conversas vencidas em rodadas de até `lote_fundo`, soltando o
+    lock entre elas: o chat nunca espera uma varredura de todos os usuários
+    (no backend persistente elas vencem pelo TTL)
+    """
+    total = 0
+    while True:
+        with usuarios_lock:
+            removidas = CONVERSAS.expirar(MEMORIA_CONFIG['lote_fundo'])
+            CONVERSAS.rodadas += 1
+        total += removidas
+        if removidas < MEMORIA_CONFIG['lote_fundo']:
+            return total
+        time.sleep(0)  # as requisições pegam o lock entre uma rodada e outra
 
-🌐 **Seu Site Profissional PREMIUM:**
-- Páginas ILIMITADAS (sem restrição!)
-- Design 100% PERSONALIZADO (único, exclusivo)
-- Animações e interatividade avançadas
-- Hospedagem PREMIUM incluída por 1 ano
-- Domínio personalizado (.com, .com.br, etc) INCLUSO
-- SEO AVANÇADO com keywords estratégicas
-- Blog completo (opcional)
-- E-commerce/Loja Virtual (opcional)
-- Integração de APIs customizadas
-- Sistema de CMS para você editar conteúdo (opcional)
-- Formulários avançados com validação
-- Google Analytics + Search Console integrados
-- Certificado SSL premium
-- CDN para velocidade global
-- Backup automático diário
-- Uso comercial TOTAL
+def thread_limpeza_memoria():
+    while True:
+        time.sleep(MEMORIA_CONFIG['intervalo_fundo'])
+        limpar_memoria_antiga()
 
-⚡ **Desenvolvimento Premium:**
-- Prazo: 10-30 dias (conforme complexidade)
-- 5 REVISÕES inclusas (vs 2 do Starter)
-- Reuniões de alinhamento via vídeo
-- Prototipação prévia (mockups)
-- Testes em múltiplos dispositivos
-- Tecnologias de ponta: React, Next.js, TypeScript, Tailwind CSS
-- Performance máxima otimizada
-- Código limpo e documentado
+threading.Thread(target=thread_limpeza_memoria, daemon=True).start()
 
-🤖 **IA Integrada no Site (OPCIONAL):**
-- Chatbot com IA (GPT-4) no seu site
-- Respostas automatizadas personalizadas
-- Treinamento específico para seu negócio
-- Integração com WhatsApp (opcional)
+# =============================================================================
+# 🧵 RESUMOS EM SEGUNDO PLANO
+# =============================================================================
 
-📊 **Dashboard e Ferramentas PREMIUM:**
-- Acesso completo ao dashboard NatanSites
-- Página "Meus Sites" com todos seus projetos
-- Suporte PRIORITÁRIO direto com Natan
-- Estatísticas avançadas de uso
-- Configurações de personalização total
-- Relatórios mensais de performance
+RESUMOS_CONFIG = {
+    'lote_maximo': int(os.getenv('RESUMOS_LOTE', '8')),
+    'intervalo_segundos': float(os.getenv('RESUMOS_INTERVALO', '1.0')),
+    'paralelismo': int(os.getenv('RESUMOS_PARALELISMO', '4')),
+    'modo': os.getenv('RESUMOS_MODO', 'auto'),  # auto | extrativo | api
+    'extrativo_ate_mensagens': int(os.getenv('RESUMOS_EXTRATIVO_ATE', '20')),
+    'max_tokens_resumo': int(os.getenv('RESUMOS_MAX_TOKENS', '100'))
+}
 
-🎨 **Design e Personalização:**
-- Paleta de cores exclusiva para sua marca
-- Tipografia profissional selecionada
-- Logotipo integrado (se tiver)
-- Identidade visual consistente
-- UX/UI design premium
-- Micro-interações e animações suaves
-- Loading screens personalizadas
+PADRAO_FIM_FRASE = re.compile(r'(?<=[.!?])\s+|\n+')
 
-🔧 **Integrações Disponíveis:**
-- APIs de pagamento (Stripe, PayPal, Mercado Pago)
-- CRMs (HubSpot, Salesforce, RD Station)
-- Email marketing (Mailchimp, SendGrid)
-- Redes sociais (Facebook, Instagram, LinkedIn)
-- Google Maps, YouTube, Vimeo
-- Webhooks customizados
-- Qualquer API REST ou GraphQL
+def termos_resumo(frase):
+    brutas = re.findall(r'\w+', normalizar_mensagem_cache(frase))
+    return [p for p in brutas if len(p) > 2 and p not in STOPWORDS_SEMANTICO]
 
-💰 **Investimento:**
-- Setup único: R$530,00 (pago uma vez)
-- Mensalidade: R$79,99/mês
-- Contrato: 1 ano
-- Renovação: Negociável após 1 ano
-- ROI: Site paga a si mesmo rapidamente
+def resumo_extrativo(novas, resumo_anterior='', limite_tokens=None):
+    """
+    Resumo local (sem API): as frases do resumo anterior e das mensagens novas
+    disputam o limite de tokens por TF-IDF (normalizado pela raiz do tamanho), com leve bônus para as mais
+    recentes. As escolhidas voltam na ordem original.
+    """
+    limite_tokens = limite_tokens or RESUMOS_CONFIG['max_tokens_resumo']
+    
+    frases = [f for f in PADRAO_FIM_FRASE.split(resumo_anterior) if f.strip()]
+    for m in novas:
+        autor = 'Usuário' if m['role'] == 'user' else 'Assistente'
+        frases.extend(f"{autor}: {f.strip()}" for f in PADRAO_FIM_FRASE.split(m['content']) if f.strip())
+    
+    if not frases:
+        return resumo_anterior
+    
+    termos = [termos_resumo(f) for f in frases]
+    documentos = {}
+    for lista in termos:
+        for termo in set(lista):
+            documentos[termo] = documentos.get(termo, 0) + 1
+    
+    total = len(frases)
+    pontuadas = []
+    for i, lista in enumerate(termos):
+        if lista:
+            frequencias = {}
+            for termo in lista:
+                frequencias[termo] = frequencias.get(termo, 0) + 1
+            tfidf = sum(qtd * math.log(1 + total / documentos[t]) for t, qtd in frequencias.items())
+            pontuacao = tfidf / math.sqrt(len(lista))
+        else:
+            pontuacao = 0.0
+        pontuadas.append((pontuacao * (1 + 0.2 * i / total), i))
+    
+    escolhidas, usados = [], 0
+    for _, i in sorted(pontuadas, reverse=True):
+        tokens = contar_tokens(frases[i])
+        if usados + tokens > limite_tokens:
+            if escolhidas:
+                continue
+            frases[i] = truncar_texto_tokens(frases[i], limite_tokens)
+            tokens = limite_tokens
+        escolhidas.append(i)
+        usados += tokens
+    
+    return ' '.join(frases[i].rstrip() for i in sorted(escolhidas))
 
-**COMPARAÇÃO COM OUTROS PLANOS:**
+def usar_resumo_extrativo(contador_mensagens):
+    modo = RESUMOS_CONFIG['modo']
+    if modo == 'extrativo' or not client:
+        return True
+    if modo == 'api':
+        return False
+    return contador_mensagens <= RESUMOS_CONFIG['extrativo_ate_mensagens']
 
-🎁 FREE (R$0,00):
-- 100 mensagens/semana
-- SEM site profissional
-- SEM uso comercial
-- SEM hospedagem
-- Conversas NÃO salvas
+class FilaResumos:
+    """Usuários com mensagens a incorporar ao resumo; o worker atualiza em lotes, fora do usuarios_lock"""
+    
+    def __init__(self, lote_maximo, intervalo_segundos, paralelismo):
+        self.lote_maximo = lote_maximo
+        self.intervalo_segundos = intervalo_segundos
+        self.pendentes = OrderedDict()
+        self.em_andamento = set()
+        self.condicao = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=paralelismo, thread_name_prefix='resumo')
+        self.agendados = 0
+        self.gerados = 0
+        self.extrativos = 0
+        self.via_api = 0
+        self.falhas = 0
+        self.descartados = 0
+        self.mensagens_incorporadas = 0
+        self.lotes = 0
+    
+    def agendar(self, user_id):
+        with self.condicao:
+            if user_id in self.pendentes or user_id in self.em_andamento:
+                return
+            self.pendentes[user_id] = time.time()
+            self.agendados += 1
+            self.condicao.notify()
+    
+    def proximo_lote(self):
+        with self.condicao:
+            while not self.pendentes:
+                self.condicao.wait()
+            lote = []
+            while self.pendentes and len(lote) < self.lote_maximo:
+                lote.append(self.pendentes.popitem(last=False)[0])
+            self.em_andamento.update(lote)
+            return lote
+    
+    def atualizar_resumo(self, resumo_anterior, novas, contador_mensagens):
+        """Retorna (resumo, modo); a API só entra em conversas longas e com o mini disponível"""
+        if not usar_resumo_extrativo(contador_mensagens) and disjuntor_modelo('gpt-4o-mini').disponivel():
+            resumo = gerar_resumo_conversa(novas, resumo_anterior)
+            if resumo:
+                return resumo, 'api'
+            with self.condicao:
+                self.falhas += 1
+        return resumo_extrativo(novas, resumo_anterior), 'extrativo'
+    
+    def processar_lote(self, lote):
+        """
+        Copia resumo + mensagens novas sob o lock, resume em paralelo e grava sob o lock.
+        O deque de turnos copiado junto identifica a conversa: se ela venceu e
+        recomeçou (ou foi relida do backend) enquanto o resumo era gerado, o
+        resultado é descartado em vez de ir para a conversa nova.
+        """
+        copias, conversas = {}, {}
+        with usuarios_lock:
+            for user_id in lote:
+                estado = USUARIOS.get(user_id)
+                if estado is not None and precisa_resumo(estado):
+                    copias[user_id] = (estado.resumo, turnos_como_mensagens(estado.nao_resumidas),
+                                       estado.contador_memoria)
+                    conversas[user_id] = estado.turnos
+        
+        with self.condicao:
+            self.descartados += len(lote) - len(copias)
+            self.lotes += 1
+        
+        futuros = {user_id: self.executor.submit(self.atualizar_resumo, *copia)
+                   for user_id, copia in copias.items()}
+        
+        reagendar = []
+        for user_id, futuro in futuros.items():
+            resumo, modo = futuro.result()
+            incorporadas = len(copias[user_id][1])
+            with usuarios_lock:
+                estado = USUARIOS.get(user_id)
+                mesma_conversa = estado is not None and estado.turnos is conversas[user_id]
+                if mesma_conversa:
+                    estado.resumo = resumo
+                    del estado.nao_resumidas[:incorporadas]
+                    gravar_memoria_usuario(user_id, estado)
+                    if precisa_resumo(estado):
+                        reagendar.append(user_id)
+                elif estado is not None and precisa_resumo(estado):
+                    reagendar.append(user_id)  # a conversa nova também tem o que resumir
+            with self.condicao:
+                if not mesma_conversa:
+                    self.descartados += 1
+                elif modo == 'api':
+                    self.via_api += 1
+                else:
+                    self.extrativos += 1
+                if mesma_conversa:
+                    self.gerados += 1
+                    self.mensagens_incorporadas += incorporadas
+        
+        with self.condicao:
+            self.em_andamento.difference_update(lote)
+        for user_id in reagendar:
+            self.agendar(user_id)
+    
+    def executar(self):
+        while True:
+            lote = self.proximo_lote()
+            try:
+                self.processar_lote(lote)
+            except Exception as e:
+                print(f"⚠️ Erro no worker de resumos: {e}")
+                with self.condicao:
+                    self.em_andamento.difference_update(lote)
+            time.sleep(self.intervalo_segundos)
+    
+    def estatisticas(self):
+        with self.condicao:
+            return {
+                'pendentes': len(self.pendentes),
+                'em_andamento': len(self.em_andamento),
+                'agendados': self.agendados,
+                'gerados': self.gerados,
+                'extrativos': self.extrativos,
+                'via_api': self.via_api,
+                'falhas_api': self.falhas,
+                'descartados': self.descartados,
+                'mensagens_incorporadas': self.mensagens_incorporadas,
+                'lotes': self.lotes,
+                'lote_maximo': self.lote_maximo,
+                'modo': RESUMOS_CONFIG['modo'],
+                'intervalo_segundos': self.intervalo_segundos
+            }
 
-🌱 STARTER (R$320 + R$39,99/mês):
-- 1.250 mensagens/mês
-- Até 5 páginas apenas
-- Design padrão moderno
-- SEO básico
-- 2 revisões
-- SEM blog ou e-commerce
+FILA_RESUMOS = FilaResumos(
+    lote_maximo=RESUMOS_CONFIG['lote_maximo'],
+    intervalo_segundos=RESUMOS_CONFIG['intervalo_segundos'],
+    paralelismo=RESUMOS_CONFIG['paralelismo']
+)
 
-💎 PROFESSIONAL (VOCÊ - R$530 + R$79,99/mês):
-- 5.000 mensagens/mês (4x mais!)
-- Páginas ILIMITADAS
-- Design 100% PERSONALIZADO
-- SEO AVANÇADO
-- Blog/E-commerce SIM
-- IA integrada opcional
-- 5 revisões inclusas
-- Suporte PRIORITÁRIO
-- Integrações ilimitadas
+threading.Thread(target=FILA_RESUMOS.executar, daemon=True, name='worker-resumos').start()
 
-**STACK TECNOLÓGICO AVANÇADO:**
-- Frontend: React, Next.js, Vue.js, TypeScript, Tailwind CSS, Framer Motion
-- Backend: Node.js, Python, Express.js, Django, Flask, APIs RESTful/GraphQL
-- Mobile: React Native (apps iOS/Android nativos)
-- Banco de Dados: Supabase, PostgreSQL, MongoDB, MySQL, Firebase
-- IA: OpenAI GPT-4, Claude, LangChain, integração completa
-- SEO: Schema.org, sitemap.xml, robots.txt, Open Graph, meta tags avançadas
-- DevOps: Git, CI/CD, Vercel, Netlify, AWS, Google Cloud
-- Analytics: Google Analytics 4, Search Console, Hotjar, heatmaps
+# =============================================================================
+# 🛡️ VALIDAÇÃO ANTI-ALUCINAÇÃO
+# =============================================================================
 
-**PROCESSO DE DESENVOLVIMENTO PREMIUM:**
-1. **Briefing Detalhado** (reunião de 1-2h):
-   - Objetivos do negócio
-   - Público-alvo
-   - Referências visuais
-   - Funcionalidades desejadas
+PALAVRAS_PROIBIDAS = [
+    "garantimos primeiro lugar", "100% de conversão", "sucesso garantido",
+    "site pronto em 1 hora", "empresa com 10 anos"
+]
 
-2. **Prototipação** (3-5 dias):
-   - Wireframes
-   - Mockups de design
-   - Revisão e aprovação
+# Em minúsculas: são comparados com a resposta em minúsculas
+PADROES_SUSPEITOS = [
+    r'garantimos?\s+\d+%',
+    r'\d+\s+anos\s+de\s+experiência',
+    r'certificação\s+iso'
+]
 
-3. **Desenvolvimento** (10-30 dias):
-   - Codificação frontend
-   - Backend e integrações
-   - Testes em múltiplos dispositivos
+# FREE ACCESS: validação super relaxada, só promessas não realistas
+PALAVRAS_PROIBIDAS_FREE = ["garantimos 100%", "sucesso garantido"]
 
-4. **Revisões** (até 5 inclusas):
-   - Ajustes de design
-   - Correções de funcionalidade
-   - Refinamentos de UX
+# Quantos caracteres do fim do texto já verificado entram na próxima checagem
+# do stream (frase proibida quebrada entre dois chunks)
+JANELA_VALIDACAO_STREAM = 64
 
-5. **Entrega e Treinamento**:
-   - Site 100% funcional online
-   - Documentação completa
-   - Treinamento de uso (se CMS)
-   - Suporte pós-lançamento
+class RespostaBloqueada(Exception):
+    """Uma regra anti-alucinação casou durante o streaming: a geração foi interrompida"""
+    
+    def __init__(self, problemas, texto, uso):
+        super().__init__(', '.join(problemas))
+        self.problemas = problemas
+        self.texto = texto  # gerado até aqui, incluindo o trecho proibido
+        self.uso = uso
 
-6. **Suporte Contínuo**:
-   - Atualizações de segurança
-   - Backups automáticos
-   - Monitoramento de performance
+class ValidadorResposta:
+    """
+    Regras anti-alucinação compiladas numa única regex, aplicada ao texto em
+    minúsculas. Cada alternativa termina num grupo vazio que identifica a regra
+    (grupo no início impediria o re de descartar a alternativa pelo 1º caractere).
+    Valida a resposta inteira ou, via VerificacaoStream, os pedaços do streaming.
+    Conta as violações por regra para /api/admin/stats.
+    """
+    
+    def __init__(self, regras):
+        # regras: [(nome da regra, problema reportado, regex em minúsculas)]
+        self.regras = regras
+        self.padrao = re.compile('|'.join(
+            f'(?:{regex})(?P<r{i}>)' for i, (_, _, regex) in enumerate(regras)
+        ))
+        self.violacoes = {nome: 0 for nome, _, _ in regras}
+        self.streams_abortados = 0
+        self.lock = threading.Lock()
+    
+    def regras_violadas(self, texto, inicio=0):
+        """Índices das regras que casam terminando depois de `inicio` (sem repetição)"""
+        violadas = []
+        for match in self.padrao.finditer(texto.lower()):
+            indice = int(match.lastgroup[1:])
+            if match.end() > inicio and indice not in violadas:
+                violadas.append(indice)
+        return violadas
+    
+    def problemas(self, indices):
+        problemas = []
+        for i in indices:
+            if self.regras[i][1] not in problemas:
+                problemas.append(self.regras[i][1])
+        return problemas
+    
+    def validar(self, texto, registrar=True):
+        """Problemas encontrados no texto inteiro (e registra as violações)"""
+        indices = self.regras_violadas(texto)
+        if indices and registrar:
+            with self.lock:
+                for i in indices:
+                    self.violacoes[self.regras[i][0]] += 1
+        return self.problemas(indices)
+    
+    def verificacao(self):
+        return VerificacaoStream(self)
+    
+    def registrar_stream_abortado(self):
+        with self.lock:
+            self.streams_abortados += 1
+    
+    def estatisticas(self):
+        with self.lock:
+            return {
+                'violacoes_por_regra': dict(self.violacoes),
+                'streams_abortados': self.streams_abortados
+            }
 
-**CONTATO PRIORITÁRIO:**
-- 📱 WhatsApp: (21) 99282-6074 (atendimento prioritário)
-- 📧 Email: borgesnatan09@gmail.com
-- 💬 Suporte: Página dedicada na plataforma (resposta rápida)
+class VerificacaoStream:
+    """
+    Checagem incremental de uma resposta em streaming: cada pedaço é verificado
+    junto com o fim do texto anterior, então o custo não cresce com a resposta.
+    As violações só são contadas na validação final (validar_resposta).
+    """
+    
+    def __init__(self, validador):
+        self.validador = validador
+        self.partes = []
+        self.cauda = ''
+    
+    def alimentar(self, pedaco):
+        """Problemas completados por este pedaço (lista vazia = tudo certo)"""
+        self.partes.append(pedaco)
+        texto = self.cauda + pedaco
+        indices = self.validador.regras_violadas(texto, len(self.cauda))
+        self.cauda = texto[-JANELA_VALIDACAO_STREAM:]
+        return self.validador.problemas(indices)
+    
+    def texto(self):
+        return ''.join(self.partes)
+
+VALIDADOR_PAGOS = ValidadorResposta(
+    [(palavra, f"Proibida: {palavra}", re.escape(palavra.lower())) for palavra in PALAVRAS_PROIBIDAS] +
+    [(padrao, "Padrão suspeito", padrao) for padrao in PADROES_SUSPEITOS]
+)
+VALIDADOR_FREE = ValidadorResposta(
+    [(palavra, "Promessa não realista", re.escape(palavra.lower())) for palavra in PALAVRAS_PROIBIDAS_FREE]
+)
+
+def validador_do_plano(tipo_usuario):
+    """Regras do plano (None = sem validação: admin e visitantes)"""
+    tipo = tipo_usuario.lower().strip()
+    if tipo == 'free':
+        return VALIDADOR_FREE
+    if tipo in ('admin', 'visitante'):
+        return None
+    return VALIDADOR_PAGOS
 
-**PORTFÓLIO PREMIUM DO NATAN:**
-- Espaço Familiares (espacofamiliares.com.br) - Site institucional
-- NatanSites (natansites.com.br) - Landing page profissional
-- MathWork (mathworkftv.netlify.app) - Aplicação web
-- TAF Sem Tabu (tafsemtabu.com.br) - Blog + E-commerce
+def verificacao_do_plano(tipo_usuario):
+    """Nova checagem incremental para um stream do plano (ou None)"""
+    validador = validador_do_plano(tipo_usuario)
+    return validador.verificacao() if validador else None
 
-**DIFERENCIAIS PROFESSIONAL:**
-✓ Código proprietário e otimizado
-✓ Performance de loading < 2 segundos
-✓ Score Google PageSpeed > 90
-✓ Mobile-first design
-✓ Acessibilidade (WCAG 2.1)
-✓ SEO técnico avançado
-✓ Segurança reforçada
-✓ Escalabilidade garantida
+def validar_resposta(resposta, tipo_usuario='starter', registrar=True):
+    """Validação RELAXADA para Free Access (registrar=False: não conta nas estatísticas)"""
+    validador = validador_do_plano(tipo_usuario)
+    
+    # ADMIN: Sem validação
+    if validador is None:
+        return True, []
+    
+    problemas = validador.validar(resposta, registrar)
+    
+    # FREE ACCESS: só as promessas não realistas
+    if validador is VALIDADOR_FREE:
+        return len(problemas) == 0, problemas
+    
+    # PAGOS: Validação normal
+    resp_lower = resposta.lower()
+    if "whatsapp" in resp_lower or "telefone" in resp_lower:
+        if "99282-6074" not in resposta and "(21) 9" in resposta:
+            problemas.append("WhatsApp incorreto")
+    
+    return len(problemas) == 0, problemas
 
-REGRAS:
-- {config['instrucao']}
-- Seja técnico quando apropriado
-- Destaque TODOS os benefícios premium
-- Sem asteriscos ou formatação markdown
-- Tom profissional, consultivo e premium
-- Faça o cliente se sentir VIP
+def obter_estatisticas_validacao():
+    return {
+        'pagos': VALIDADOR_PAGOS.estatisticas(),
+        'free': VALIDADOR_FREE.estatisticas()
+    }
 
-Você está conversando com: {nome} (Cliente PROFESSIONAL - Premium TOP TIER 💎)"""
+# =============================================================================
+# ✨ LIMPEZA DE FORMATAÇÃO
+# =============================================================================
 
-            messages_inicial = [{"role": "system", "content": system_prompt_base}]
-            messages_inicial.extend(historico_memoria[-5:])
-            messages_inicial.append({"role": "user", "content": mensagem})
-            
-            response_inicial = client.chat.completions.create(
-                model=modelo_inicial,
-                messages=messages_inicial,
-                max_tokens=max_tokens_inicial,
-                temperature=0.7
-            )
-            
-            resposta_inicial = response_inicial.choices[0].message.content.strip()
-            tokens_inicial = response_inicial.usage.total_tokens
-            
-            # Detecta refinamento (Professional tem critérios mais amplos)
-            msg_lower = mensagem.lower().strip()
-            
-            keywords_refinamento = [
-                'como funciona', 'me explica', 'detalhes', 'completo', 'diferença', 'comparar',
-                'melhor', 'processo', 'etapas', 'tecnologia', 'stack', 'framework', 'prazo',
-                'seo', 'hospedagem', 'blog', 'e-commerce', 'design', 'personalização', 'ia',
-                'inteligência artificial', 'api', 'integração', 'cms', 'performance', 'otimização',
-                'mobile', 'responsivo', 'analytics', 'conversão', 'landing page', 'checkout',
-                'pagamento', 'stripe', 'crm', 'automação', 'webhook', 'graphql', 'react',
-                'next.js', 'typescript', 'advanced', 'avançado', 'custom', 'customização'
-            ]
-            
-            precisa_refinamento = any(kw in msg_lower for kw in keywords_refinamento)
-            
-            if not precisa_refinamento or len(resposta_inicial.split()) < 30:
-                resposta_final = limpar_formatacao_markdown(resposta_inicial)
-                
-                return {
-                    'resposta': resposta_final,
-                    'tokens_usados': tokens_inicial,
-                    'tokens_entrada': response_inicial.usage.prompt_tokens,
-                    'tokens_saida': response_inicial.usage.completion_tokens,
-                    'modelo_usado': f'{modelo_inicial} (direto)',
-                    'cached': False,
-                    'categoria': categoria,
-                    'sistema_hibrido': 'mini_apenas'
-                }
-            
-            # Refinamento com GPT-4O (Professional tem tokens maiores)
-            modelo_refinamento = 'gpt-4o'
-            max_tokens_refinamento = min(config['max_tokens'] * 2, 800)
-            
-            prompt_refinamento = f"""Você é NatanAI em modo de refinamento PREMIUM. Melhore e expanda esta resposta com máximo de detalhes técnicos e profissionalismo.
+# Um único tokenizador: cada alternativa é um trecho a preservar ou um
+# marcador a remover. Todas começam por um caractere literal (`, *, _, ~, ^,
+# ´, ¨, \n) fora de grupo, o que deixa o re pular direto para esses pontos.
+# _ ~ ^ entre letras ou logo depois de / (snake_case, contato_site@...,
+# site.com/~natan/pagina_1) são literais: não abrem nem fecham ênfase, como
+# no CommonMark. Grupos vazios no fim marcam o que fazer; sem grupo = remover.
+PADRAO_MARKDOWN = re.compile(r"""
+    ```[\w+-]*\n?(?P<bloco>.*?)```
+  | `(?P<codigo>[^`]+)`
+  | \*\*(?P<negrito>[^*]+)\*\*
+  | \*(?P<italico>[^*]+)\*
+  | _(?:(?<=[^\W_]_)(?=[^\W_])|(?<=/_))(?P<literal_sublinhado>)
+  | __(?P<negrito2>[^_]+)__(?![^\W_])
+  | _(?P<italico2>[^_]+)_(?![^\W_])
+  | ~~(?P<riscado>[^~]+)~~
+  | ~(?:(?<=[^\W_]~)(?=[^\W_])|(?<=/~))(?P<literal_til>)
+  | \^(?:(?<=[^\W_]\^)(?=[^\W_])|(?<=/\^))(?P<literal_circunflexo>)
+  | ~ | \^ | ´ | ¨
+  | \n\n\n+(?P<quebras>)
+""", re.VERBOSE | re.DOTALL)
+
+GRUPOS_LITERAIS = {'literal_sublinhado', 'literal_til', 'literal_circunflexo'}
+GRUPOS_ENFASE = {'negrito', 'negrito2', 'riscado', 'italico', 'italico2'}
+
+# Há algo para limpar dentro da ênfase (aninhada, código, símbolo)?
+PADRAO_CARACTERE_MARKDOWN = re.compile(r'[*_`~´^¨]|\n\n\n')
+
+# Marcador que sobra depois da limpeza ainda pode fechar com texto que não chegou
+PADRAO_MARCADOR_ABERTO = re.compile(r'[*`]|~~|(?<![^\W_])_|_(?![^\W_])')
+
+def _substituir_marcador(match):
+    grupo = match.lastgroup
+    if grupo is None:
+        return ''  # ´ ~ ^ ¨ soltos
+    if grupo in GRUPOS_LITERAIS:
+        return match.group()
+    if grupo == 'quebras':
+        return '\n\n'
+    conteudo = match.group(grupo)
+    if grupo in GRUPOS_ENFASE and PADRAO_CARACTERE_MARKDOWN.search(conteudo):
+        return PADRAO_MARKDOWN.sub(_substituir_marcador, conteudo)
+    return conteudo
+
+def remover_marcadores_markdown(texto):
+    """Remove asteriscos e caracteres especiais de formatação (sem aparar as bordas)"""
+    return PADRAO_MARKDOWN.sub(_substituir_marcador, texto)
 
-RESPOSTA INICIAL (gpt-4o-mini):
-{resposta_inicial}
+def limpar_formatacao_markdown(texto):
+    """Remove asteriscos e caracteres especiais de formatação"""
+    if not texto:
+        return texto
+    
+    return remover_marcadores_markdown(texto).strip()
 
-PERGUNTA DO USUÁRIO:
-{mensagem}
+class LimpadorMarkdownIncremental:
+    """
+    Limpeza de markdown para respostas em streaming.
+    Acumula os pedaços recebidos e só libera trechos que terminam antes do último
+    espaço em branco e sem marcadores (**, *, __, _, ~~, `) abertos, para
+    que o texto enviado seja o mesmo que limpar_formatacao_markdown daria no total.
+    """
+    
+    # Acima disso o trecho é liberado mesmo com marcadores abertos
+    MAX_PENDENTE = 500
+    
+    # Último bloco de espaços em branco (+ palavra incompleta) do buffer
+    PADRAO_ULTIMO_ESPACO = re.compile(r'\s+\S*$')
+    
+    def __init__(self):
+        self.pendente = ''
+        self.inicio = True
+        self.quebras_finais = 0  # '\n' seguidos no fim do que já foi enviado
+    
+    def alimentar(self, pedaco):
+        """Recebe um pedaço do stream e retorna o texto limpo pronto para envio ('' se nada)"""
+        self.pendente += pedaco
+        match = self.PADRAO_ULTIMO_ESPACO.search(self.pendente)
+        if not match or match.start() == 0:
+            return ''
+        
+        trecho = self.pendente[:match.start()]
+        if self._marcadores_abertos(trecho) and len(self.pendente) < self.MAX_PENDENTE:
+            return ''
+        
+        self.pendente = self.pendente[match.start():]
+        return self._limpar(trecho)
+    
+    def finalizar(self):
+        """Libera o que sobrou no buffer ao fim do stream"""
+        trecho, self.pendente = self.pendente, ''
+        return self._limpar(trecho).rstrip()
+    
+    @staticmethod
+    def _marcadores_abertos(trecho):
+        return PADRAO_MARCADOR_ABERTO.search(remover_marcadores_markdown(trecho)) is not None
+    
+    def _limpar(self, trecho):
+        texto = remover_marcadores_markdown(trecho)
+        if self.inicio:
+            texto = texto.lstrip()
+            if texto:
+                self.inicio = False
+        
+        # Mantém no máximo 2 quebras de linha seguidas entre um trecho e outro
+        iniciais = len(texto) - len(texto.lstrip('\n'))
+        excesso = self.quebras_finais + iniciais - 2
+        if iniciais and excesso > 0:
+            texto = texto[min(excesso, iniciais):]
+        
+        if texto and not texto.strip('\n'):
+            self.quebras_finais += len(texto)
+        elif texto:
+            self.quebras_finais = len(texto) - len(texto.rstrip('\n'))
+        return texto
 
-CONTEXTO: Cliente Professional (plano premium R$79,99/mês) - TOP TIER 💎
+# =============================================================================
+# 🆘 SISTEMA DE RESPOSTA ALTERNATIVA (SEM IA)
+# =============================================================================
 
-INSTRUÇÕES:
-- Mantenha TODAS as informações corretas da resposta inicial
-- Adicione DETALHES TÉCNICOS AVANÇADOS
-- Seja CONSULTIVO e demonstre expertise
-- Mencione benefícios premium quando relevante
-- {config['instrucao']} (pode ser extenso, cliente premium merece)
-- Sem asteriscos ou formatação markdown
-- Tom profissional, consultivo e premium
-- Faça o cliente sentir que tem o MELHOR serviço
+def gerar_resposta_alternativa_inteligente(pergunta, tipo_usuario):
+    """
+    Sistema de respostas automáticas quando limite de IA acaba.
+    Usa padrões e keywords para responder sem consumir API.
+    """
+    msg_lower = pergunta.lower().strip()
+    nome = tipo_usuario.get('nome_real', 'Cliente')
+    tipo = tipo_usuario.get('tipo', 'starter')
+    
+    # SAUDAÇÕES
+    if any(kw in msg_lower for kw in ['oi', 'olá', 'ola', 'hey', 'bom dia', 'boa tarde', 'boa noite', 'e ai', 'eai']):
+        return f"Oi {nome}! Seus créditos de IA acabaram este mês, mas posso te ajudar com informações básicas. Como posso ajudar?"
+    
+    # DESPEDIDAS
+    if any(kw in msg_lower for kw in ['tchau', 'até', 'falou', 'obrigado', 'obrigada', 'valeu']):
+        return f"Até logo {nome}! Seus créditos de IA renovam no próximo mês. Vibrações Positivas! ✨"
+    
+    # PLANOS E PREÇOS
+    if any(kw in msg_lower for kw in ['plano', 'preço', 'valor', 'custo', 'quanto custa', 'mensalidade', 'contratar']):
+        return f"""Olá {nome}! Aqui estão nossos planos:
 
-MELHORE E EXPANDA A RESPOSTA PREMIUM:"""
+FREE - R$0,00 (teste 1 ano)
+- 100 mensagens/semana comigo
+- Sites básicos sem uso comercial
 
-            messages_refinamento = [{"role": "system", "content": prompt_refinamento}]
-            
-            response_refinamento = client.chat.completions.create(
-                model=modelo_refinamento,
-                messages=messages_refinamento,
-                max_tokens=max_tokens_refinamento,
-                temperature=0.7
-            )
-            
-            resposta_refinada = response_refinamento.choices[0].message.content.strip()
-            tokens_refinamento = response_refinamento.usage.total_tokens
-            tokens_total = tokens_inicial + tokens_refinamento
-            
-            resposta_final = limpar_formatacao_markdown(resposta_refinada)
-            
-            return {
-                'resposta': resposta_final,
-                'tokens_usados': tokens_total,
-                'tokens_entrada': response_inicial.usage.prompt_tokens + response_refinamento.usage.prompt_tokens,
-                'tokens_saida': response_inicial.usage.completion_tokens + response_refinamento.usage.completion_tokens,
-                'modelo_usado': f'híbrido premium ({modelo_inicial} → {modelo_refinamento})',
-                'cached': False,
-                'categoria': categoria,
-                'sistema_hibrido': 'mini_plus_4o_premium',
-                'tokens_mini': tokens_inicial,
-                'tokens_4o': tokens_refinamento
-            }
-
-        # ==================================================================
-        # 👑 ADMIN - GPT-4O PURO + CONHECIMENTO TOTAL DO SISTEMA (CORRIGIDO)
-        # ==================================================================
-        elif tipo == 'admin':
-            modelo = 'gpt-4o'
-            max_tokens = 1000
-            
-            system_prompt = f"""Você é NatanAI no modo ADMINISTRADOR para Natan (criador da plataforma).
+STARTER - R$320 (setup) + R$39,99/mês
+- 1.250 mensagens/mês comigo
+- Site até 5 páginas
+- Hospedagem inclusa
 
-**VOCÊ TEM ACESSO TOTAL E IRRESTRITO:**
-- Modelo: GPT-4O puro (mais poderoso)
-- Mensagens: ILIMITADAS
-- Conhecimento: COMPLETO da plataforma + mundo
-- Capacidades: Análise, debugging, melhorias, estatísticas
+PROFESSIONAL - R$530 (setup) + R$79,99/mês
+- 5.000 mensagens/mês comigo
+- Páginas ilimitadas
+- Design personalizado
 
-**CONHECIMENTO COMPLETO DA PLATAFORMA NATANSITES:**
+Contato:
+WhatsApp: (21) 99282-6074
+Site: https://natansites.com.br"""
+    
+    # CONTATO
+    if any(kw in msg_lower for kw in ['contato', 'whatsapp', 'telefone', 'email', 'falar']):
+        return f"""Fale com Natan diretamente:
 
-🏗️ **ARQUITETURA DO SISTEMA:**
+WhatsApp: (21) 99282-6074
+Email: borgesnatan09@gmail.com
+Site: https://natansites.com.br
 
-**Frontend:**
-- HTML5, CSS3, JavaScript nativo
-- Páginas: home.html, login.html, dashboard.html, websites.html, suporte.html, natanai.html, settings.html
-- Páginas de cadastro: starter.html, professional.html
-- CSS: Space Grotesk (texto), Sora (títulos)
-- Tema: Light mode (padrão) + Dark mode (dourado #D4AF37)
-- Responsivo: Mobile-first com breakpoints 480px, 768px, 1024px
+Atendimento pessoal para clientes!"""
+    
+    # PORTFÓLIO
+    if any(kw in msg_lower for kw in ['portfolio', 'portfólio', 'projetos', 'trabalhos']):
+        return f"""Confira alguns projetos do Natan:
 
-**Backend:**
-- Python Flask (main.py)
-- API REST: /api/chat (NatanAI), /api/health, /ping
-- Deploy: Render.com (auto-deploy via GitHub)
-- Auto-ping: Mantém servidor ativo (5 em 5 minutos)
+1. Espaço Familiares - espacofamiliares.com.br
+2. NatanSites - natansites.com.br
+3. MathWork - mathworkftv.netlify.app
+4. TAF Sem Tabu - tafsemtabu.com.br
 
-**Banco de Dados (Supabase):**
-- PostgreSQL hospedado no Supabase
-- Tabelas principais:
-  * `user_accounts`: Dados dos usuários (user_id, user_email, plan_name, plan_type, is_suspended, account_expires_at, first_login_at, dashboard_visits, last_visit_at, created_at)
-  * `user_settings`: Configurações personalizadas (user_id, settings JSON, created_at, updated_at)
-  * `user_websites`: Sites cadastrados por cliente (id, user_id, user_email, site_name, site_url, image_url, created_at, created_by)
-  * `support_messages`: Sistema de suporte (id, sender_email, sender_name, receiver_email, message, read, created_at)
-  * `chat_sessions`: Sessões de chat da NatanAI (id, user_id, title, is_active, message_count, created_at, updated_at)
-  * `chat_messages`: Mensagens do chat NatanAI (id, session_id, user_id, content, is_user, metadata JSON, created_at)
-  * `free_access_config`: Configuração do acesso gratuito permanente (id, is_active, started_at, expires_at, free_account_email, free_account_password, free_account_user_id, created_by, updated_at)
-  * `free_access_users`: Usuários usando acesso gratuito (id, user_id, user_email, joined_at, expires_at, is_expired)
+Visite natansites.com.br para ver todos!"""
+    
+    # RESPOSTA PADRÃO
+    return f"""Olá {nome}!
 
-**Autenticação:**
-- Supabase Auth (email/senha)
-- Row Level Security (RLS) ativo
-- Admin: natan@natandev.com
-- Conta Free padrão: free@natandev.com / natanfree2025
+Seus créditos de IA acabaram este mês. Para informações detalhadas:
 
-**Sistema de Planos:**
-1. **FREE (R$ 0,00 - Permanente)**:
-   - Acesso completo ao dashboard
-   - NatanAI: 100 mensagens/semana
-   - Sites apenas para teste/portfólio
-   - SEM uso comercial
-   - SEM hospedagem profissional
-   - SEM domínio personalizado
-   - Conversas NÃO salvas (temporárias)
-   - Marca d'água presente
-   - Contrato: Permanente enquanto ativo
+📞 WhatsApp: (21) 99282-6074
+📧 Email: borgesnatan09@gmail.com
+🌐 Site: https://natansites.com.br
 
-2. **STARTER (R$ 320 setup + R$ 39,99/mês)**:
-   - NatanAI: 1.250 mensagens/mês
-   - Site até 5 páginas
-   - Design moderno responsivo
-   - Hospedagem incluída 1 ano
-   - SEO básico otimizado
-   - Uso comercial PERMITIDO
-   - 2 revisões inclusas
-   - Conversas salvas e persistentes
-   - Suporte 24/7 via plataforma
-   - Contrato: 1 ano
+Posso responder sobre:
+- Planos e preços
+- Contato
+- Portfólio
+- Cadastro
 
-3. **PROFESSIONAL (R$ 530 setup + R$ 79,99/mês)**:
-   - NatanAI: 5.000 mensagens/mês
-   - Páginas ILIMITADAS
-   - Design 100% PERSONALIZADO
-   - Hospedagem + Domínio inclusos 1 ano
-   - SEO AVANÇADO com keywords
-   - Blog/E-commerce opcionais
-   - IA integrada no site (opcional)
-   - 5 revisões inclusas
-   - Suporte PRIORITÁRIO 24/7
-   - Conversas salvas e persistentes
-   - Uso comercial PERMITIDO
-   - Contrato: 1 ano
+Seus créditos renovam no próximo mês!
 
-**Fluxo de Cadastro:**
-1. Usuário preenche formulário (starter.html ou professional.html)
-2. Dados: Nome completo, Data de nascimento, CPF
-3. Pagamento via PIX (QR Code ou código copia-e-cola)
-4. Email enviado via EmailJS para borgesnatan09@gmail.com
-5. Admin cria conta manualmente em settings.html (seção admin)
-6. Prazo: 10 minutos a 2 horas
-7. Cliente recebe confirmação e credenciais
+Vibrações Positivas! ✨"""
 
-**Sistema de Acesso Gratuito Permanente:**
-- Admin pode ativar/desativar em settings.html
-- Quando ATIVO:
-  * Cria automaticamente conta free@natandev.com
-  * Senha padrão: natanfree2025
-  * Botão "Acessar Gratuitamente" aparece em login.html
-  * Qualquer pessoa pode usar SEM cadastro
-  * Dashboard completo + IA + Suporte liberados
-  * Sites apenas para teste (sem uso comercial)
-  * Conversas NÃO são salvas (desaparecem ao sair)
-  * Permanece ativo até admin desativar manualmente
-- Quando INATIVO:
-  * Botão de acesso gratuito some
-  * Conta free é deletada automaticamente
-  * Apenas clientes pagos/cadastrados podem acessar
+# =============================================================================
+# 🤖 PROCESSAMENTO OPENAI v8.2 - SISTEMA HÍBRIDO OTIMIZADO COM CONTEXTO COMPLETO
+# =============================================================================
 
-**Funcionalidades Admin (settings.html):**
-- Criar novas contas (email, senha, nome, plano)
-- Buscar e gerenciar contas existentes
-- Reativar contas suspensas (adiciona +1 ano)
-- Suspender contas manualmente
-- Adicionar sites aos clientes (nome, URL, imagem)
-- Listar e remover sites cadastrados
-- Ativar/Desativar acesso gratuito permanente
-- Visualizar estatísticas completas
+# =============================================================================
+# 🔢 CONTAGEM LOCAL DE TOKENS + HISTÓRICO POR ORÇAMENTO
+# =============================================================================
+# Com tiktoken (o200k_base, o BPE do gpt-4o/gpt-4o-mini) a contagem é exata.
+# Sem ele (ou sem o arquivo BPE em cache local) entra um estimador por pedaços:
+# cada palavra conta 1 token + 1 a cada 4 caracteres extras, pontuação e emoji
+# contam à parte, e o total recebe MARGEM_ESTIMADOR_TOKENS para errar para cima.
+
+TOKENS_POR_MENSAGEM = 4  # overhead do formato de chat por mensagem
+TOKENS_POR_RESPOSTA = 3  # priming da resposta do assistente
+MARGEM_ESTIMADOR_TOKENS = 1.15
+
+# Orçamento do histórico (resumo + mensagens anteriores) por plano
+ORCAMENTO_HISTORICO_TOKENS = {
+    'free': int(os.getenv('ORCAMENTO_HISTORICO_FREE', '600')),
+    'starter': int(os.getenv('ORCAMENTO_HISTORICO_STARTER', '1500')),
+    'professional': int(os.getenv('ORCAMENTO_HISTORICO_PROFESSIONAL', '2500')),
+    'admin': int(os.getenv('ORCAMENTO_HISTORICO_ADMIN', '6000'))
+}
 
-**NatanAI (natanai.html):**
-- Sistema híbrido inteligente:
-  * FREE: gpt-4o-mini direto (básico)
-  * STARTER/PROFESSIONAL: gpt-4o-mini → gpt-4o (refinamento quando necessário)
-  * ADMIN: gpt-4o puro (ilimitado)
-- Detecção automática de categoria:
-  * Casual: respostas curtas
-  * Técnica: detalhadas com contexto
-  * Complexa: máximo detalhamento
-- Sistema de sessões:
-  * FREE: Conversas temporárias (não salvas)
-  * STARTER/PROFESSIONAL: Conversas salvas e persistentes
-  * Histórico completo acessível
-  * Criação de novas sessões
-  * Renomear/deletar conversas
-- Contexto completo da plataforma incluído
-- Validação anti-alucinação ativa
-- Metadata de cada resposta (modelo, tokens, tipo usuário)
+# Teto de mensagens que cada plano já usava (o orçamento pode reduzir, nunca ampliar)
+MAX_MENSAGENS_HISTORICO = {'free': 3, 'starter': 5, 'professional': 5, 'admin': 10}
 
-**Suporte (suporte.html):**
-- Sistema de mensagens diretas com admin
-- Clientes FREE NÃO têm acesso (apenas dashboard/IA)
-- Clientes PAID: Chat direto com Natan
-- Admin vê lista de todas as conversas
-- Realtime via Supabase + Polling de backup
-- Notificações de mensagens não lidas
-- Histórico completo salvo no banco
+MAX_TOKENS_TURNO_HISTORICO = int(os.getenv('MAX_TOKENS_TURNO_HISTORICO', '400'))
+MAX_TOKENS_MENSAGEM = int(os.getenv('MAX_TOKENS_MENSAGEM', '2000'))  # pergunta atual (acima disso: 413)
+MARCADOR_TRUNCADO = ' [...] '
 
-**Dashboard (dashboard.html):**
-- Cards informativos:
-  * Tempo de uso (calculado desde first_login_at)
-  * Plano atual (Free/Starter/Professional)
-  * Sites criados (contagem automática)
-  * Visitas ao dashboard (contador incremental)
-- Alertas:
-  * Acesso gratuito ativo (quando FREE)
-  * Conta suspensa (se expired ou suspended)
-  * Plano expirando (últimos 30 dias)
-- Status da conta:
-  * FREE: Card verde com "∞ Permanente" ou dias restantes
-  * PAID: Cálculo automático de tempo usado/restante
-  * SUSPENDED: Card vermelho com alerta
+PADRAO_PEDACOS_TOKEN = re.compile(r"\w+|[^\w\s]")
 
-**Websites (websites.html):**
-- Lista todos os sites do usuário
-- Busca na tabela `user_websites` por user_email
-- Empty states diferentes:
-  * FREE: Botão WhatsApp para contratar
-  * PAID sem sites: Botão para Suporte
-- Cards com imagem, nome, URL e botão "Visitar Site"
-- Carregamento dinâmico via Supabase
+def carregar_codificador_tokens():
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.get_encoding('o200k_base')
+    except Exception as e:
+        print(f"⚠️ tiktoken sem BPE o200k_base ({e.__class__.__name__}): usando estimador local de tokens")
+        return None
 
-**Settings (settings.html):**
-- Configurações gerais:
-  * Tema escuro (dark mode com ouro #D4AF37)
-  * Sons (digitação, envio, apagar, clique)
-  * Notificações desktop
-  * Economia de dados
-- Sincronização automática:
-  * localStorage (local)
-  * Supabase user_settings (remoto)
-  * Polling 1s para sincronizar entre abas
-- Seções Admin (apenas para natan@natandev.com):
-  * Criar contas
-  * Gerenciar contas
-  * Adicionar/remover sites
-  * Controlar acesso gratuito permanente
+CODIFICADOR_TOKENS = carregar_codificador_tokens()
 
-**Login (login.html):**
-- Autenticação via Supabase Auth
-- Botão "Acessar Gratuitamente" (apenas se FREE ativo)
-- Login automático com free@natandev.com ao clicar no botão
-- Verificação de email_confirmed (contornada se necessário)
-- Redirecionamento para dashboard.html após login
+def contar_tokens(texto):
+    """Tokens de um texto (exato com tiktoken, estimativa conservadora sem ele)"""
+    if not texto:
+        return 0
+    
+    if CODIFICADOR_TOKENS is not None:
+        return len(CODIFICADOR_TOKENS.encode(texto))
+    
+    total = sum(1 + (len(pedaco) - 1) // 4 for pedaco in PADRAO_PEDACOS_TOKEN.findall(texto))
+    return math.ceil(total * MARGEM_ESTIMADOR_TOKENS)
 
-**Proteções de Segurança:**
-- Verificação de plano em TODAS as páginas
-- FREE bloqueado de: suporte.html
-- Redirecionamento automático se acesso negado
-- Admin tem acesso TOTAL e IRRESTRITO sempre
-- RLS no Supabase protege dados entre usuários
+def contar_tokens_mensagens(messages):
+    """Tokens de entrada de uma chamada de chat (conteúdo + overhead por mensagem)"""
+    return sum(contar_tokens(m['content']) + TOKENS_POR_MENSAGEM for m in messages) + TOKENS_POR_RESPOSTA
 
-**Tecnologias Stack:**
-- Frontend: HTML5, CSS3, JavaScript vanilla
-- Backend: Python Flask (main.py - Render.com)
-- Banco: Supabase (PostgreSQL + Auth + Realtime)
-- IA: OpenAI API (gpt-4o-mini + gpt-4o)
-- Email: EmailJS (cadastros)
-- Hospedagem: Render (backend), Netlify/Vercel (frontend)
+def truncar_texto_tokens(texto, limite):
+    """Corta um texto para ~limite tokens mantendo o começo (2/3) e o fim (1/3)"""
+    total = contar_tokens(texto)
+    if total <= limite:
+        return texto
+    
+    caracteres = len(texto)
+    cortado = texto
+    while total > limite and caracteres > 2:
+        caracteres = max(int(caracteres * limite / total) - len(MARCADOR_TRUNCADO), 2)
+        inicio = texto[:caracteres * 2 // 3].rstrip()
+        fim = texto[len(texto) - caracteres // 3:].lstrip()
+        cortado = inicio + MARCADOR_TRUNCADO + fim
+        total = contar_tokens(cortado)
+    return cortado
+
+def montar_historico_orcamento(historico, mensagem, tipo):
+    """
+    Escolhe o histórico que cabe no orçamento de tokens do plano, das mensagens
+    mais recentes para as mais antigas (o resumo tem prioridade). A pergunta atual,
+    que chat() já gravou na memória, não é repetida. Retorna (historico, tokens).
+    """
+    orcamento = ORCAMENTO_HISTORICO_TOKENS.get(tipo, ORCAMENTO_HISTORICO_TOKENS['starter'])
+    max_mensagens = MAX_MENSAGENS_HISTORICO.get(tipo, 5)
+    
+    historico = list(historico)
+    if historico and historico[-1]['role'] == 'user' and historico[-1]['content'].strip() == mensagem.strip():
+        historico.pop()
+    
+    sistema = [m for m in historico if m['role'] == 'system']
+    turnos = [m for m in historico if m['role'] != 'system'][-max_mensagens:]
+    
+    selecionadas = []
+    recentes = []
+    usados = 0
+    
+    for destino, mensagens in ((selecionadas, sistema), (recentes, reversed(turnos))):
+        for m in mensagens:
+            conteudo = truncar_texto_tokens(m['content'], MAX_TOKENS_TURNO_HISTORICO)
+            custo = contar_tokens(conteudo) + TOKENS_POR_MENSAGEM
+            if usados + custo > orcamento:
+                break
+            destino.append({'role': m['role'], 'content': conteudo})
+            usados += custo
+    
+    recentes.reverse()
+    return selecionadas + recentes, usados
 
-**Endpoints API Python:**
-- POST /api/chat: Processa mensagens da NatanAI
-- GET /ping: Health check (mantém servidor ativo)
-- GET /api/health: Status da API
+def anotar_tamanho_prompt(chamada, tokens_historico=0):
+    """Mede o prompt antes de enviar (tamanho fica em chamada['tokens_prompt'])"""
+    chamada['tokens_prompt'] = contar_tokens_mensagens(chamada['messages'])
+    chamada['tokens_historico'] = tokens_historico
+    print(f"📏 Prompt: ~{chamada['tokens_prompt']} tokens (histórico: {tokens_historico})")
+    return chamada
 
-**Regras de Comportamento Admin:**
-- Acesso total e irrestrito
-- Conhecimento completo do sistema
-- Pode criar/modificar/deletar qualquer recurso
-- Respostas técnicas e detalhadas
-- Ajuda com debugging e melhorias
-- Análise de logs e estatísticas
+# =============================================================================
+# 🧱 PROMPTS DE SISTEMA - CORPO ESTÁTICO POR PLANO (PREFIXO ESTÁVEL)
+# =============================================================================
+# O corpo de cada prompt é idêntico para todos os usuários do plano e vai
+# sempre como a PRIMEIRA mensagem: assim a OpenAI reaproveita o prefixo entre
+# requisições (prompt caching, tokens de entrada cobrados pela metade).
+# Tudo que varia por usuário/mensagem (nome, plano, instrução da categoria)
+# vai numa mensagem de contexto no final, logo antes da pergunta.
 
-**Informações de Contato:**
-- WhatsApp: (21) 99282-6074
-- Email: borgesnatan09@gmail.com
-- Site: natansites.com.br
+PROMPT_SISTEMA_FREE = """Você é NatanAI, assistente virtual da NatanSites (natansites.com.br).
 
-**Portfólio:**
+**SOBRE SEU PLANO FREE:**
+Você está usando o ACESSO GRATUITO PERMANENTE da plataforma! 🎉
+
+**CARACTERÍSTICAS DO SEU PLANO FREE:**
+- 🎁 TOTALMENTE GRATUITO e PERMANENTE
+- 💬 100 mensagens por semana comigo (reseta toda segunda-feira)
+- 🌐 Acesso COMPLETO ao dashboard da plataforma
+- 🤖 NatanAI inclusa (você está conversando comigo agora!)
+- 💬 Suporte via plataforma disponível
+- ⚙️ Configurações de personalização ativadas
+- 📊 Estatísticas de uso visíveis
+
+**LIMITAÇÕES DO PLANO FREE:**
+- 🚫 NÃO pode criar sites para uso comercial
+- 🚫 NÃO inclui hospedagem profissional
+- 🚫 NÃO inclui domínio personalizado
+- 🚫 Sites demo apenas para testes/portfólio pessoal
+- 📝 Conversas comigo NÃO são salvas (desaparecem ao fechar)
+
+**PLANOS PAGOS DISPONÍVEIS (UPGRADE):**
+
+📦 STARTER - R$320 (setup único) + R$39,99/mês
+- 1.250 mensagens/mês comigo (12.5x mais que Free!)
+- Site profissional até 5 páginas
+- Hospedagem incluída por 1 ano
+- Domínio .com.br ou .com (seu ou fornecido)
+- SEO básico otimizado
+- Design moderno responsivo
+- Uso comercial PERMITIDO
+- Conversas salvas e persistentes
+- Suporte via plataforma 24/7
+- Contrato de 1 ano
+
+💎 PROFESSIONAL - R$530 (setup único) + R$79,99/mês
+- 5.000 mensagens/mês comigo (50x mais que Free!)
+- Páginas ILIMITADAS
+- Design 100% PERSONALIZADO (exclusivo)
+- Hospedagem + Domínio inclusos por 1 ano
+- SEO AVANÇADO com keywords
+- Animações e interatividade premium
+- Blog ou E-commerce OPCIONAIS
+- Integração de APIs customizadas
+- 5 revisões de design inclusas
+- Formulários de contato avançados
+- Suporte PRIORITÁRIO 24/7
+- IA Inclusa opcional no site
+- Conversas salvas e persistentes
+- Uso comercial PERMITIDO
+- Contrato de 1 ano
+
+**PROCESSO DE UPGRADE:**
+1. Escolha seu plano (Starter ou Professional)
+2. Acesse a página do plano no menu lateral
+3. Preencha o formulário com: Nome completo, Data de nascimento, CPF
+4. Efetue o pagamento via PIX (R$320 Starter ou R$530 Professional)
+5. Aguarde 10 minutos a 2 horas para criação da conta
+6. Você receberá confirmação por email quando estiver pronto!
+
+**CONTATO PARA DÚVIDAS:**
+- 📱 WhatsApp: (21) 99282-6074
+- 📧 Email: borgesnatan09@gmail.com
+- 🌐 Site: https://natansites.com.br
+
+**PORTFÓLIO (TRABALHOS DO NATAN):**
+- Espaço Familiares - espacofamiliares.com.br
+- NatanSites - natansites.com.br
+- MathWork - mathworkftv.netlify.app
+- TAF Sem Tabu - tafsemtabu.com.br
+
+**TECNOLOGIAS QUE O NATAN DOMINA:**
+- Frontend: HTML5, CSS3, JavaScript, React, Vue.js, Next.js, TypeScript, Tailwind CSS
+- Backend: Node.js, Python, Express.js, Django, Flask, APIs RESTful
+- Mobile: React Native (apps iOS/Android)
+- Banco de Dados: Supabase, PostgreSQL, MongoDB, MySQL
+- Inteligência Artificial: OpenAI GPT-4, Claude, integração de IA em sites
+- SEO: Otimização completa para Google (técnico e on-page)
+- DevOps: Git, GitHub, CI/CD, Vercel, Netlify, Render
+
+REGRAS DE COMPORTAMENTO:
+- Seja direto e objetivo
+- Incentive upgrade para planos pagos quando relevante
+- Siga a INSTRUÇÃO DE RESPOSTA do contexto da conversa
+- Sem asteriscos ou formatação markdown
+- Tom amigável e prestativo
+- SEMPRE mencione que o plano FREE é PERMANENTE e GRATUITO
+- Explique claramente as limitações do Free vs benefícios dos pagos
+- Seja transparente sobre preços e processos"""
+
+PROMPT_SISTEMA_STARTER = """Você é NatanAI, assistente da NatanSites para clientes STARTER.
+
+**SOBRE SEU PLANO STARTER:**
+Você é um cliente PAGO PREMIUM! 🌟
+
+**BENEFÍCIOS DO SEU PLANO STARTER:**
+💬 **Comunicação Comigo:**
+- 1.250 mensagens/mês comigo (vs 100/semana do Free)
+- Conversas SALVAS e persistentes (não desaparecem!)
+- Histórico completo de chats acessível
+- Respostas mais elaboradas e técnicas
+
+🌐 **Seu Site Profissional:**
+- Site até 5 páginas (Home, Sobre, Serviços, Contato, etc)
+- Design moderno e responsivo (mobile + desktop)
+- Hospedagem INCLUÍDA por 1 ano
+- Domínio personalizado (seu ou fornecido por nós)
+- SEO básico otimizado (Google-friendly)
+- Uso comercial PERMITIDO
+- Sem marca d'água
+- Formulários de contato funcionais
+- Integração com Google Analytics (opcional)
+
+⚡ **Desenvolvimento:**
+- Prazo: 3-7 dias (sites simples) ou 10-20 dias (complexos)
+- 2 revisões de ajustes incluídas
+- Tecnologias: HTML5, CSS3, JavaScript, React (quando necessário)
+- Performance otimizada (carregamento rápido)
+
+📊 **Dashboard e Ferramentas:**
+- Acesso completo ao dashboard NatanSites
+- Página "Meus Sites" com todos seus projetos
+- Página de Suporte direto com Natan
+- Estatísticas de uso visíveis
+- Configurações de personalização
+
+💰 **Investimento:**
+- Setup único: R$320,00 (pago uma vez)
+- Mensalidade: R$39,99/mês
+- Contrato: 1 ano
+- Renovação: Negociável após 1 ano
+
+**OUTROS PLANOS (COMPARAÇÃO):**
+
+🎁 FREE (R$0,00):
+- 100 mensagens/semana
+- SEM site profissional
+- SEM uso comercial
+- SEM hospedagem
+- SEM domínio
+- Conversas NÃO salvas
+
+💎 PROFESSIONAL (R$530 + R$79,99/mês):
+- 5.000 mensagens/mês (4x mais que Starter!)
+- Páginas ILIMITADAS
+- Design 100% PERSONALIZADO
+- Hospedagem + Domínio inclusos
+- SEO AVANÇADO
+- Blog/E-commerce opcionais
+- IA integrada no site (opcional)
+- Suporte PRIORITÁRIO
+- 5 revisões inclusas
+
+**INFORMAÇÕES TÉCNICAS:**
+- Frontend: HTML5, CSS3, JavaScript, React
+- Backend: Node.js, Python, APIs
+- Banco: Supabase, PostgreSQL
+- Hospedagem: Vercel, Netlify, Render
+- SEO: Meta tags, sitemap.xml, robots.txt, schema.org
+
+**PRAZOS E PROCESSO:**
+1. Briefing: Você descreve o que precisa
+2. Desenvolvimento: 3-20 dias (conforme complexidade)
+3. Revisão: Até 2 ajustes incluídos
+4. Entrega: Site online e funcionando
+5. Suporte: Disponível via plataforma
+
+**CONTATO DIRETO:**
+- 📱 WhatsApp: (21) 99282-6074
+- 📧 Email: borgesnatan09@gmail.com
+- 💬 Suporte: Página dedicada na plataforma
+
+**PORTFÓLIO DO NATAN:**
 - espacofamiliares.com.br
 - natansites.com.br
 - mathworkftv.netlify.app
 - tafsemtabu.com.br
 
-REGRAS ADMIN:
-- Respostas COMPLETAS e BEM FUNDAMENTADAS
-- Acesso total ao código-fonte e logs
-- Pode sugerir melhorias e otimizações
-- Conhecimento técnico profundo
-- {config['instrucao']} (pode ser extenso se necessário)
+REGRAS:
+- Siga a INSTRUÇÃO DE RESPOSTA do contexto da conversa
+- Seja claro e prestativo
+- Destaque os benefícios do plano Starter
+- Sugira Professional apenas quando apropriado
 - Sem asteriscos ou formatação markdown
-- Tom técnico, direto e profissional
+- Tom profissional e amigável"""
+
+PROMPT_SISTEMA_PROFESSIONAL = """Você é NatanAI, assistente premium para clientes PROFESSIONAL.
+
+**SOBRE SEU PLANO PROFESSIONAL:**
+Você é um cliente PREMIUM TOP TIER! 💎✨
+
+**BENEFÍCIOS EXCLUSIVOS DO SEU PLANO PROFESSIONAL:**
+
+💬 **Comunicação Comigo (NatanAI):**
+- 5.000 mensagens/mês (vs 1.250 do Starter!)
+- Conversas SALVAS e persistentes
+- Histórico completo ilimitado
+- Respostas AVANÇADAS e técnicas detalhadas
+- Prioridade no processamento
+
+🌐 **Seu Site Profissional PREMIUM:**
+- Páginas ILIMITADAS (sem restrição!)
+- Design 100% PERSONALIZADO (único, exclusivo)
+- Animações e interatividade avançadas
+- Hospedagem PREMIUM incluída por 1 ano
+- Domínio personalizado (.com, .com.br, etc) INCLUSO
+- SEO AVANÇADO com keywords estratégicas
+- Blog completo (opcional)
+- E-commerce/Loja Virtual (opcional)
+- Integração de APIs customizadas
+- Sistema de CMS para você editar conteúdo (opcional)
+- Formulários avançados com validação
+- Google Analytics + Search Console integrados
+- Certificado SSL premium
+- CDN para velocidade global
+- Backup automático diário
+- Uso comercial TOTAL
+
+⚡ **Desenvolvimento Premium:**
+- Prazo: 10-30 dias (conforme complexidade)
+- 5 REVISÕES inclusas (vs 2 do Starter)
+- Reuniões de alinhamento via vídeo
+- Prototipação prévia (mockups)
+- Testes em múltiplos dispositivos
+- Tecnologias de ponta: React, Next.js, TypeScript, Tailwind CSS
+- Performance máxima otimizada
+- Código limpo e documentado
+
+🤖 **IA Integrada no Site (OPCIONAL):**
+- Chatbot com IA (GPT-4) no seu site
+- Respostas automatizadas personalizadas
+- Treinamento específico para seu negócio
+- Integração com WhatsApp (opcional)
+
+📊 **Dashboard e Ferramentas PREMIUM:**
+- Acesso completo ao dashboard NatanSites
+- Página "Meus Sites" com todos seus projetos
+- Suporte PRIORITÁRIO direto com Natan
+- Estatísticas avançadas de uso
+- Configurações de personalização total
+- Relatórios mensais de performance
+
+🎨 **Design e Personalização:**
+- Paleta de cores exclusiva para sua marca
+- Tipografia profissional selecionada
+- Logotipo integrado (se tiver)
+- Identidade visual consistente
+- UX/UI design premium
+- Micro-interações e animações suaves
+- Loading screens personalizadas
+
+🔧 **Integrações Disponíveis:**
+- APIs de pagamento (Stripe, PayPal, Mercado Pago)
+- CRMs (HubSpot, Salesforce, RD Station)
+- Email marketing (Mailchimp, SendGrid)
+- Redes sociais (Facebook, Instagram, LinkedIn)
+- Google Maps, YouTube, Vimeo
+- Webhooks customizados
+- Qualquer API REST ou GraphQL
+
+💰 **Investimento:**
+- Setup único: R$530,00 (pago uma vez)
+- Mensalidade: R$79,99/mês
+- Contrato: 1 ano
+- Renovação: Negociável após 1 ano
+- ROI: Site paga a si mesmo rapidamente
+
+**COMPARAÇÃO COM OUTROS PLANOS:**
+
+🎁 FREE (R$0,00):
+- 100 mensagens/semana
+- SEM site profissional
+- SEM uso comercial
+- SEM hospedagem
+- Conversas NÃO salvas
+
+🌱 STARTER (R$320 + R$39,99/mês):
+- 1.250 mensagens/mês
+- Até 5 páginas apenas
+- Design padrão moderno
+- SEO básico
+- 2 revisões
+- SEM blog ou e-commerce
+
+💎 PROFESSIONAL (VOCÊ - R$530 + R$79,99/mês):
+- 5.000 mensagens/mês (4x mais!)
+- Páginas ILIMITADAS
+- Design 100% PERSONALIZADO
+- SEO AVANÇADO
+- Blog/E-commerce SIM
+- IA integrada opcional
+- 5 revisões inclusas
+- Suporte PRIORITÁRIO
+- Integrações ilimitadas
+
+**STACK TECNOLÓGICO AVANÇADO:**
+- Frontend: React, Next.js, Vue.js, TypeScript, Tailwind CSS, Framer Motion
+- Backend: Node.js, Python, Express.js, Django, Flask, APIs RESTful/GraphQL
+- Mobile: React Native (apps iOS/Android nativos)
+- Banco de Dados: Supabase, PostgreSQL, MongoDB, MySQL, Firebase
+- IA: OpenAI GPT-4, Claude, LangChain, integração completa
+- SEO: Schema.org, sitemap.xml, robots.txt, Open Graph, meta tags avançadas
+- DevOps: Git, CI/CD, Vercel, Netlify, AWS, Google Cloud
+- Analytics: Google Analytics 4, Search Console, Hotjar, heatmaps
+
+**PROCESSO DE DESENVOLVIMENTO PREMIUM:**
+1. **Briefing Detalhado** (reunião de 1-2h):
+   - Objetivos do negócio
+   - Público-alvo
+   - Referências visuais
+   - Funcionalidades desejadas
+
+2. **Prototipação** (3-5 dias):
+   - Wireframes
+   - Mockups de design
+   - Revisão e aprovação
+
+3. **Desenvolvimento** (10-30 dias):
+   - Codificação frontend
+   - Backend e integrações
+   - Testes em múltiplos dispositivos
+
+4. **Revisões** (até 5 inclusas):
+   - Ajustes de design
+   - Correções de funcionalidade
+   - Refinamentos de UX
+
+5. **Entrega e Treinamento**:
+   - Site 100% funcional online
+   - Documentação completa
+   - Treinamento de uso (se CMS)
+   - Suporte pós-lançamento
+
+6. **Suporte Contínuo**:
+   - Atualizações de segurança
+   - Backups automáticos
+   - Monitoramento de performance
+
+**CONTATO PRIORITÁRIO:**
+- 📱 WhatsApp: (21) 99282-6074 (atendimento prioritário)
+- 📧 Email: borgesnatan09@gmail.com
+- 💬 Suporte: Página dedicada na plataforma (resposta rápida)
+
+**PORTFÓLIO PREMIUM DO NATAN:**
+- Espaço Familiares (espacofamiliares.com.br) - Site institucional
+- NatanSites (natansites.com.br) - Landing page profissional
+- MathWork (mathworkftv.netlify.app) - Aplicação web
+- TAF Sem Tabu (tafsemtabu.com.br) - Blog + E-commerce
+
+**DIFERENCIAIS PROFESSIONAL:**
+✓ Código proprietário e otimizado
+✓ Performance de loading < 2 segundos
+✓ Score Google PageSpeed > 90
+✓ Mobile-first design
+✓ Acessibilidade (WCAG 2.1)
+✓ SEO técnico avançado
+✓ Segurança reforçada
+✓ Escalabilidade garantida
+
+REGRAS:
+- Siga a INSTRUÇÃO DE RESPOSTA do contexto da conversa
+- Seja técnico quando apropriado
+- Destaque TODOS os benefícios premium
+- Sem asteriscos ou formatação markdown
+- Tom profissional, consultivo e premium
+- Faça o cliente se sentir VIP"""
+
+PROMPT_SISTEMA_ADMIN = """Você é NatanAI no modo ADMINISTRADOR para Natan (criador da plataforma).
+
+**VOCÊ TEM ACESSO TOTAL E IRRESTRITO:**
+- Modelo: GPT-4O puro (mais poderoso)
+- Mensagens: ILIMITADAS
+- Conhecimento: COMPLETO da plataforma + mundo
+- Capacidades: Análise, debugging, melhorias, estatísticas
+
+**CONHECIMENTO COMPLETO DA PLATAFORMA NATANSITES:**
+
+🏗️ **ARQUITETURA DO SISTEMA:**
+
+**Frontend:**
+- HTML5, CSS3, JavaScript nativo
+- Páginas: home.html, login.html, dashboard.html, websites.html, suporte.html, natanai.html, settings.html
+- Páginas de cadastro: starter.html, professional.html
+- CSS: Space Grotesk (texto), Sora (títulos)
+- Tema: Light mode (padrão) + Dark mode (dourado #D4AF37)
+- Responsivo: Mobile-first com breakpoints 480px, 768px, 1024px
+
+**Backend:**
+- Python Flask (main.py)
+- API REST: /api/chat (NatanAI), /api/health, /ping
+- Deploy: Render.com (auto-deploy via GitHub)
+- Auto-ping: Mantém servidor ativo (5 em 5 minutos)
+
+**Banco de Dados (Supabase):**
+- PostgreSQL hospedado no Supabase
+- Tabelas principais:
+  * `user_accounts`: Dados dos usuários (user_id, user_email, plan_name, plan_type, is_suspended, account_expires_at, first_login_at, dashboard_visits, last_visit_at, created_at)
+  * `user_settings`: Configurações personalizadas (user_id, settings JSON, created_at, updated_at)
+  * `user_websites`: Sites cadastrados por cliente (id, user_id, user_email, site_name, site_url, image_url, created_at, created_by)
+  * `support_messages`: Sistema de suporte (id, sender_email, sender_name, receiver_email, message, read, created_at)
+  * `chat_sessions`: Sessões de chat da NatanAI (id, user_id, title, is_active, message_count, created_at, updated_at)
+  * `chat_messages`: Mensagens do chat NatanAI (id, session_id, user_id, content, is_user, metadata JSON, created_at)
+  * `free_access_config`: Configuração do acesso gratuito permanente (id, is_active, started_at, expires_at, free_account_email, free_account_password, free_account_user_id, created_by, updated_at)
+  * `free_access_users`: Usuários usando acesso gratuito (id, user_id, user_email, joined_at, expires_at, is_expired)
+
+**Autenticação:**
+- Supabase Auth (email/senha)
+- Row Level Security (RLS) ativo
+- Admin: natan@natandev.com
+- Conta Free padrão: free@natandev.com / natanfree2025
+
+**Sistema de Planos:**
+1. **FREE (R$ 0,00 - Permanente)**:
+   - Acesso completo ao dashboard
+   - NatanAI: 100 mensagens/semana
+   - Sites apenas para teste/portfólio
+   - SEM uso comercial
+   - SEM hospedagem profissional
+   - SEM domínio personalizado
+   - Conversas NÃO salvas (temporárias)
+   - Marca d'água presente
+   - Contrato: Permanente enquanto ativo
+
+2. **STARTER (R$ 320 setup + R$ 39,99/mês)**:
+   - NatanAI: 1.250 mensagens/mês
+   - Site até 5 páginas
+   - Design moderno responsivo
+   - Hospedagem incluída 1 ano
+   - SEO básico otimizado
+   - Uso comercial PERMITIDO
+   - 2 revisões inclusas
+   - Conversas salvas e persistentes
+   - Suporte 24/7 via plataforma
+   - Contrato: 1 ano
+
+3. **PROFESSIONAL (R$ 530 setup + R$ 79,99/mês)**:
+   - NatanAI: 5.000 mensagens/mês
+   - Páginas ILIMITADAS
+   - Design 100% PERSONALIZADO
+   - Hospedagem + Domínio inclusos 1 ano
+   - SEO AVANÇADO com keywords
+   - Blog/E-commerce opcionais
+   - IA integrada no site (opcional)
+   - 5 revisões inclusas
+   - Suporte PRIORITÁRIO 24/7
+   - Conversas salvas e persistentes
+   - Uso comercial PERMITIDO
+   - Contrato: 1 ano
+
+**Fluxo de Cadastro:**
+1. Usuário preenche formulário (starter.html ou professional.html)
+2. Dados: Nome completo, Data de nascimento, CPF
+3. Pagamento via PIX (QR Code ou código copia-e-cola)
+4. Email enviado via EmailJS para borgesnatan09@gmail.com
+5. Admin cria conta manualmente em settings.html (seção admin)
+6. Prazo: 10 minutos a 2 horas
+7. Cliente recebe confirmação e credenciais
+
+**Sistema de Acesso Gratuito Permanente:**
+- Admin pode ativar/desativar em settings.html
+- Quando ATIVO:
+  * Cria automaticamente conta free@natandev.com
+  * Senha padrão: natanfree2025
+  * Botão "Acessar Gratuitamente" aparece em login.html
+  * Qualquer pessoa pode usar SEM cadastro
+  * Dashboard completo + IA + Suporte liberados
+  * Sites apenas para teste (sem uso comercial)
+  * Conversas NÃO são salvas (desaparecem ao sair)
+  * Permanece ativo até admin desativar manualmente
+- Quando INATIVO:
+  * Botão de acesso gratuito some
+  * Conta free é deletada automaticamente
+  * Apenas clientes pagos/cadastrados podem acessar
+
+**Funcionalidades Admin (settings.html):**
+- Criar novas contas (email, senha, nome, plano)
+- Buscar e gerenciar contas existentes
+- Reativar contas suspensas (adiciona +1 ano)
+- Suspender contas manualmente
+- Adicionar sites aos clientes (nome, URL, imagem)
+- Listar e remover sites cadastrados
+- Ativar/Desativar acesso gratuito permanente
+- Visualizar estatísticas completas
+
+**NatanAI (natanai.html):**
+- Sistema híbrido inteligente:
+  * FREE: gpt-4o-mini direto (básico)
+  * STARTER/PROFESSIONAL: gpt-4o-mini → gpt-4o (refinamento quando necessário)
+  * ADMIN: gpt-4o puro (ilimitado)
+- Detecção automática de categoria:
+  * Casual: respostas curtas
+  * Técnica: detalhadas com contexto
+  * Complexa: máximo detalhamento
+- Sistema de sessões:
+  * FREE: Conversas temporárias (não salvas)
+  * STARTER/PROFESSIONAL: Conversas salvas e persistentes
+  * Histórico completo acessível
+  * Criação de novas sessões
+  * Renomear/deletar conversas
+- Contexto completo da plataforma incluído
+- Validação anti-alucinação ativa
+- Metadata de cada resposta (modelo, tokens, tipo usuário)
+
+**Suporte (suporte.html):**
+- Sistema de mensagens diretas com admin
+- Clientes FREE NÃO têm acesso (apenas dashboard/IA)
+- Clientes PAID: Chat direto com Natan
+- Admin vê lista de todas as conversas
+- Realtime via Supabase + Polling de backup
+- Notificações de mensagens não lidas
+- Histórico completo salvo no banco
+
+**Dashboard (dashboard.html):**
+- Cards informativos:
+  * Tempo de uso (calculado desde first_login_at)
+  * Plano atual (Free/Starter/Professional)
+  * Sites criados (contagem automática)
+  * Visitas ao dashboard (contador incremental)
+- Alertas:
+  * Acesso gratuito ativo (quando FREE)
+  * Conta suspensa (se expired ou suspended)
+  * Plano expirando (últimos 30 dias)
+- Status da conta:
+  * FREE: Card verde com "∞ Permanente" ou dias restantes
+  * PAID: Cálculo automático de tempo usado/restante
+  * SUSPENDED: Card vermelho com alerta
+
+**Websites (websites.html):**
+- Lista todos os sites do usuário
+- Busca na tabela `user_websites` por user_email
+- Empty states diferentes:
+  * FREE: Botão WhatsApp para contratar
+  * PAID sem sites: Botão para Suporte
+- Cards com imagem, nome, URL e botão "Visitar Site"
+- Carregamento dinâmico via Supabase
+
+**Settings (settings.html):**
+- Configurações gerais:
+  * Tema escuro (dark mode com ouro #D4AF37)
+  * Sons (digitação, envio, apagar, clique)
+  * Notificações desktop
+  * Economia de dados
+- Sincronização automática:
+  * localStorage (local)
+  * Supabase user_settings (remoto)
+  * Polling 1s para sincronizar entre abas
+- Seções Admin (apenas para natan@natandev.com):
+  * Criar contas
+  * Gerenciar contas
+  * Adicionar/remover sites
+  * Controlar acesso gratuito permanente
+
+**Login (login.html):**
+- Autenticação via Supabase Auth
+- Botão "Acessar Gratuitamente" (apenas se FREE ativo)
+- Login automático com free@natandev.com ao clicar no botão
+- Verificação de email_confirmed (contornada se necessário)
+- Redirecionamento para dashboard.html após login
+
+**Proteções de Segurança:**
+- Verificação de plano em TODAS as páginas
+- FREE bloqueado de: suporte.html
+- Redirecionamento automático se acesso negado
+- Admin tem acesso TOTAL e IRRESTRITO sempre
+- RLS no Supabase protege dados entre usuários
+
+**Tecnologias Stack:**
+- Frontend: HTML5, CSS3, JavaScript vanilla
+- Backend: Python Flask (main.py - Render.com)
+- Banco: Supabase (PostgreSQL + Auth + Realtime)
+- IA: OpenAI API (gpt-4o-mini + gpt-4o)
+- Email: EmailJS (cadastros)
+- Hospedagem: Render (backend), Netlify/Vercel (frontend)
+
+**Endpoints API Python:**
+- POST /api/chat: Processa mensagens da NatanAI
+- GET /ping: Health check (mantém servidor ativo)
+- GET /api/health: Status da API
+
+**Regras de Comportamento Admin:**
+- Acesso total e irrestrito
+- Conhecimento completo do sistema
+- Pode criar/modificar/deletar qualquer recurso
+- Respostas técnicas e detalhadas
+- Ajuda com debugging e melhorias
+- Análise de logs e estatísticas
+
+**Informações de Contato:**
+- WhatsApp: (21) 99282-6074
+- Email: borgesnatan09@gmail.com
+- Site: natansites.com.br
+
+**Portfólio:**
+- espacofamiliares.com.br
+- natansites.com.br
+- mathworkftv.netlify.app
+- tafsemtabu.com.br
+
+REGRAS ADMIN:
+- Respostas COMPLETAS e BEM FUNDAMENTADAS
+- Acesso total ao código-fonte e logs
+- Pode sugerir melhorias e otimizações
+- Conhecimento técnico profundo
+- Siga a INSTRUÇÃO DE RESPOSTA do contexto da conversa
+- Sem asteriscos ou formatação markdown
+- Tom técnico, direto e profissional"""
+
+def compilar_prompts_sistema(fontes):
+    """
+    Normaliza os corpos estáticos uma única vez na inicialização e garante que
+    nenhum deles tenha interpolação dinâmica (que quebraria o prefixo em cache).
+    """
+    compilados = {}
+    for plano, texto in fontes.items():
+        corpo = '\n'.join(linha.rstrip() for linha in texto.strip().splitlines())
+        if re.search(r"\{[\w\[\]'\"]+\}", corpo):
+            raise ValueError(f"Prompt '{plano}' contém interpolação dinâmica")
+        compilados[plano] = corpo
+    
+    resumo = ', '.join(f"{plano} ~{len(corpo) // 4}" for plano, corpo in compilados.items())
+    print(f"🧱 Prompts compilados (tokens estáticos): {resumo}")
+    return compilados
+
+PROMPTS_SISTEMA = compilar_prompts_sistema({
+    'visitante': PROMPT_SISTEMA_VISITANTE,
+    'free': PROMPT_SISTEMA_FREE,
+    'starter': PROMPT_SISTEMA_STARTER,
+    'professional': PROMPT_SISTEMA_PROFESSIONAL,
+    'admin': PROMPT_SISTEMA_ADMIN
+})
+
+def montar_contexto_dinamico(conversando_com, config, complemento=''):
+    """Parte variável do prompt (usuário + categoria da mensagem)"""
+    return f"""CONTEXTO DA CONVERSA:
+- Você está conversando com: {conversando_com}
+- INSTRUÇÃO DE RESPOSTA: {config['instrucao']}{complemento}"""
+
+def montar_mensagens_prompt(plano, contexto_dinamico, historico, mensagem):
+    """[corpo estático do plano] + histórico + [contexto dinâmico] + pergunta"""
+    messages = [{"role": "system", "content": PROMPTS_SISTEMA[plano]}]
+    messages.extend(historico)
+    messages.append({"role": "system", "content": contexto_dinamico})
+    messages.append({"role": "user", "content": mensagem})
+    return messages
+
+def preparar_chamada_openai(mensagem, tipo_usuario, historico_memoria):
+    """
+    Monta a primeira chamada OpenAI de um usuário autenticado conforme o plano
+    (modelo, mensagens, limite de tokens e se o plano usa o sistema híbrido).
+    Retorna None para tipos de usuário não reconhecidos.
+    """
+    tipo = tipo_usuario.get('tipo', 'starter').lower()
+    nome = tipo_usuario.get('nome_real', 'Cliente')
+    plano = tipo_usuario.get('plano', 'Starter')
+    
+    # Categoria e palavras de refinamento numa única passada pela mensagem
+    analise = analisar_mensagem(mensagem)
+    categoria, config = analise['categoria'], analise['config']
+    
+    # Histórico por orçamento de tokens do plano (sem repetir a pergunta atual)
+    historico, tokens_historico = montar_historico_orcamento(historico_memoria, mensagem, tipo)
+    
+    # ==================================================================
+    # 🎁 FREE ACCESS - GPT-4O-MINI (BÁSICO) - ACESSO GRATUITO PERMANENTE
+    # ==================================================================
+    if tipo == 'free':
+        modelo = 'gpt-4o-mini'
+        max_tokens = config['max_tokens']
+        
+        messages = montar_mensagens_prompt(
+            'free',
+            montar_contexto_dinamico(f'{nome} (Plano {plano} - Gratuito Permanente)', config),
+            historico,
+            mensagem
+        )
+        
+        return anotar_tamanho_prompt({
+            'tipo': tipo,
+            'categoria': categoria,
+            'config': config,
+            'modelo': modelo,
+            'messages': messages,
+            'max_tokens': max_tokens,
+            'hibrido': False,
+            'modelo_usado': modelo
+        }, tokens_historico)
+    
+    # ==================================================================
+    # 🌱 STARTER - SISTEMA HÍBRIDO INTELIGENTE
+    # ==================================================================
+    elif tipo == 'starter':
+        modelo_inicial = 'gpt-4o-mini'
+        max_tokens_inicial = config['max_tokens']
+        
+        messages_inicial = montar_mensagens_prompt(
+            'starter',
+            montar_contexto_dinamico(f'{nome} (Cliente STARTER - Plano Pago Premium)', config),
+            historico,
+            mensagem
+        )
+        
+        # Detecta se precisa de refinamento com GPT-4O
+        precisa_refinamento = 'starter' in analise['refinamento']
+        
+        return anotar_tamanho_prompt({
+            'tipo': tipo,
+            'categoria': categoria,
+            'config': config,
+            'modelo': modelo_inicial,
+            'messages': messages_inicial,
+            'max_tokens': max_tokens_inicial,
+            'hibrido': True,
+            'precisa_refinamento': precisa_refinamento,
+            'modelo_usado': f'{modelo_inicial} (direto)'
+        }, tokens_historico)
+    
+    # ==================================================================
+    # 💎 PROFESSIONAL - SISTEMA HÍBRIDO INTELIGENTE PREMIUM
+    # ==================================================================
+    elif tipo == 'professional':
+        modelo_inicial = 'gpt-4o-mini'
+        max_tokens_inicial = config['max_tokens']
+        
+        messages_inicial = montar_mensagens_prompt(
+            'professional',
+            montar_contexto_dinamico(f'{nome} (Cliente PROFESSIONAL - Premium TOP TIER 💎)', config),
+            historico,
+            mensagem
+        )
+        
+        # Detecta refinamento (Professional tem critérios mais amplos)
+        precisa_refinamento = 'professional' in analise['refinamento']
+        
+        return anotar_tamanho_prompt({
+            'tipo': tipo,
+            'categoria': categoria,
+            'config': config,
+            'modelo': modelo_inicial,
+            'messages': messages_inicial,
+            'max_tokens': max_tokens_inicial,
+            'hibrido': True,
+            'precisa_refinamento': precisa_refinamento,
+            'modelo_usado': f'{modelo_inicial} (direto)'
+        }, tokens_historico)
+    
+    # ==================================================================
+    # 👑 ADMIN - GPT-4O PURO + CONHECIMENTO TOTAL DO SISTEMA (CORRIGIDO)
+    # ==================================================================
+    elif tipo == 'admin':
+        modelo = 'gpt-4o'
+        max_tokens = 1000
+        
+        messages = montar_mensagens_prompt(
+            'admin',
+            montar_contexto_dinamico('Natan (ADMIN - Criador da Plataforma)', config,
+                ' (pode ser extenso se necessário)'),
+            historico,
+            mensagem
+        )
+        
+        # ✅ CORREÇÃO: Removida a verificação de precisa_search (variável indefinida)
+        # A detecção de necessidade de web search foi removida pois não está implementada
+        
+        return anotar_tamanho_prompt({
+            'tipo': tipo,
+            'categoria': categoria,
+            'config': config,
+            'modelo': modelo,
+            'messages': messages,
+            'max_tokens': max_tokens,
+            'hibrido': False,
+            'modelo_usado': modelo
+        }, tokens_historico)
+    
+    return None
+
+def precisa_chamar_refinamento(chamada, resposta_inicial):
+    """Sistema híbrido: só refina com GPT-4O perguntas complexas com resposta inicial longa"""
+    return (
+        chamada['hibrido']
+        and chamada['precisa_refinamento']
+        and len(resposta_inicial.split()) >= 30
+    )
+
+def preparar_refinamento(chamada, mensagem, resposta_inicial):
+    """Monta a chamada de refinamento com GPT-4O do sistema híbrido (Starter/Professional)"""
+    config = chamada['config']
+    modelo_inicial = chamada['modelo']
+    modelo_refinamento = 'gpt-4o'
+    
+    if chamada['tipo'] == 'professional':
+        # Professional tem tokens maiores
+        max_tokens_refinamento = min(config['max_tokens'] * 2, 800)
+        
+        prompt_refinamento = f"""Você é NatanAI em modo de refinamento PREMIUM. Melhore e expanda esta resposta com máximo de detalhes técnicos e profissionalismo.
+
+RESPOSTA INICIAL (gpt-4o-mini):
+{resposta_inicial}
+
+PERGUNTA DO USUÁRIO:
+{mensagem}
+
+CONTEXTO: Cliente Professional (plano premium R$79,99/mês) - TOP TIER 💎
+
+INSTRUÇÕES:
+- Mantenha TODAS as informações corretas da resposta inicial
+- Adicione DETALHES TÉCNICOS AVANÇADOS
+- Seja CONSULTIVO e demonstre expertise
+- Mencione benefícios premium quando relevante
+- {config['instrucao']} (pode ser extenso, cliente premium merece)
+- Sem asteriscos ou formatação markdown
+- Tom profissional, consultivo e premium
+- Faça o cliente sentir que tem o MELHOR serviço
+
+MELHORE E EXPANDA A RESPOSTA PREMIUM:"""
+
+        modelo_usado = f'híbrido premium ({modelo_inicial} → {modelo_refinamento})'
+        sistema_hibrido = 'mini_plus_4o_premium'
+    else:
+        max_tokens_refinamento = min(config['max_tokens'] * 2, 600)
+        
+        prompt_refinamento = f"""Você é NatanAI em modo de refinamento. Melhore e expanda esta resposta mantendo as informações corretas mas adicionando mais contexto, detalhes técnicos e clareza.
+
+RESPOSTA INICIAL (gpt-4o-mini):
+{resposta_inicial}
+
+PERGUNTA DO USUÁRIO:
+{mensagem}
+
+CONTEXTO: Cliente Starter (plano pago R$39,99/mês)
+
+INSTRUÇÕES:
+- Mantenha TODAS as informações corretas da resposta inicial
+- Adicione mais detalhes técnicos e contexto relevante
+- Torne a explicação mais completa e profissional
+- {config['instrucao']} (mas pode ser um pouco mais extenso)
+- Sem asteriscos ou formatação markdown
+- Tom prestativo, claro e profissional
+- Destaque os benefícios do plano Starter quando relevante
+
+MELHORE E EXPANDA A RESPOSTA:"""
+
+        modelo_usado = f'híbrido ({modelo_inicial} → {modelo_refinamento})'
+        sistema_hibrido = 'mini_plus_4o'
+    
+    return {
+        'modelo': modelo_refinamento,
+        'messages': [{"role": "system", "content": prompt_refinamento}],
+        'max_tokens': max_tokens_refinamento,
+        'modelo_usado': modelo_usado,
+        'sistema_hibrido': sistema_hibrido
+    }
+
+def montar_resultado_openai(chamada, resposta, uso_inicial, refinamento=None, uso_refinamento=None):
+    """Monta o dicionário de resultado (resposta + tokens) usado por /api/chat"""
+    if refinamento is None:
+        resultado = {
+            'resposta': resposta,
+            'tokens_usados': uso_inicial['total_tokens'],
+            'tokens_entrada': uso_inicial['prompt_tokens'],
+            'tokens_saida': uso_inicial['completion_tokens'],
+            'tokens_cache': uso_inicial.get('cached_tokens', 0),
+            'modelo_usado': chamada['modelo_usado'],
+            'cached': False,
+            'categoria': chamada['categoria']
+        }
+        if chamada.get('sistema_hibrido'):
+            resultado['sistema_hibrido'] = chamada['sistema_hibrido']
+        elif chamada['hibrido']:
+            resultado['sistema_hibrido'] = 'mini_apenas'
+        return resultado
+    
+    return {
+        'resposta': resposta,
+        'tokens_usados': uso_inicial['total_tokens'] + uso_refinamento['total_tokens'],
+        'tokens_entrada': uso_inicial['prompt_tokens'] + uso_refinamento['prompt_tokens'],
+        'tokens_saida': uso_inicial['completion_tokens'] + uso_refinamento['completion_tokens'],
+        'tokens_cache': uso_inicial.get('cached_tokens', 0) + uso_refinamento.get('cached_tokens', 0),
+        'modelo_usado': refinamento['modelo_usado'],
+        'cached': False,
+        'categoria': chamada['categoria'],
+        'sistema_hibrido': refinamento['sistema_hibrido'],
+        'tokens_mini': uso_inicial['total_tokens'],
+        'tokens_4o': uso_refinamento['total_tokens']
+    }
+
+def extrair_uso(response):
+    """Converte response.usage da OpenAI em dicionário simples"""
+    return {
+        'prompt_tokens': response.usage.prompt_tokens,
+        'completion_tokens': response.usage.completion_tokens,
+        'total_tokens': response.usage.total_tokens,
+        'cached_tokens': tokens_em_cache(response.usage)
+    }
+
+def tokens_em_cache(usage):
+    """Tokens de entrada servidos pelo prompt caching da OpenAI (prefixo reaproveitado)"""
+    detalhes = getattr(usage, 'prompt_tokens_details', None)
+    return (getattr(detalhes, 'cached_tokens', 0) or 0) if detalhes else 0
+
+def uso_completo(uso):
+    """Garante as chaves de tokens mesmo quando o stream não retornou usage"""
+    return {
+        'prompt_tokens': uso.get('prompt_tokens', 0),
+        'completion_tokens': uso.get('completion_tokens', 0),
+        'total_tokens': uso.get('total_tokens', 0),
+        'cached_tokens': uso.get('cached_tokens', 0)
+    }
+
+def transmitir_completion(modelo, messages, max_tokens, uso, prazo=None, verificacao=None):
+    """
+    Chamada OpenAI em streaming: gera os pedaços de texto conforme chegam.
+    Ao final preenche `uso` com os tokens informados no último chunk (include_usage).
+    A abertura do stream passa pelo disjuntor do modelo (com repetição dentro do prazo).
+    Com `verificacao` (VerificacaoStream), um pedaço que completa uma frase
+    proibida não é repassado: o stream é encerrado na hora (para de gerar tokens)
+    e sobe RespostaBloqueada.
+    """
+    stream = executar_com_disjuntor(modelo, lambda: client.chat.completions.create(
+        model=modelo,
+        messages=messages,
+        max_tokens=max_tokens,
+        temperature=0.7,
+        stream=True,
+        stream_options={"include_usage": True},
+        timeout=timeout_prazo(prazo)
+    ), prazo)
+    
+    try:
+        for chunk in stream:
+            if chunk.usage:
+                uso['prompt_tokens'] = chunk.usage.prompt_tokens
+                uso['completion_tokens'] = chunk.usage.completion_tokens
+                uso['total_tokens'] = chunk.usage.total_tokens
+                uso['cached_tokens'] = tokens_em_cache(chunk.usage)
+            
+            if chunk.choices and chunk.choices[0].delta.content:
+                conteudo = chunk.choices[0].delta.content
+                if verificacao is not None:
+                    problemas = verificacao.alimentar(conteudo)
+                    if problemas:
+                        raise resposta_bloqueada(verificacao, problemas, messages)
+                yield conteudo
+    except ERROS_TRANSITORIOS_OPENAI as e:
+        if not timeout_do_prazo(e, prazo):
+            disjuntor_modelo(modelo).registrar_falha(e)
+        raise
+    finally:
+        # Cliente desconectou ou erro: encerra a conexão com a OpenAI
+        stream.close()
+
+def resposta_bloqueada(verificacao, problemas, messages):
+    """Interrompe a geração: tokens estimados localmente (o chunk de usage não chega)"""
+    verificacao.validador.registrar_stream_abortado()
+    print(f"🛡️ Geração interrompida pela validação: {problemas}")
+    
+    texto = verificacao.texto()
+    entrada = contar_tokens_mensagens(messages)
+    saida = contar_tokens(texto)
+    return RespostaBloqueada(problemas, texto, {
+        'prompt_tokens': entrada,
+        'completion_tokens': saida,
+        'total_tokens': entrada + saida,
+        'cached_tokens': 0
+    })
+
+def resultado_resposta_bloqueada(erro, modelo_usado, categoria='geral'):
+    """
+    Resultado de uma geração interrompida pela validação. A resposta traz o texto
+    até o trecho proibido: a validação final (finalizar_requisicao_chat) a
+    substitui pela mensagem padrão e conta a violação. Nunca vai para o cache.
+    """
+    return {
+        'resposta': limpar_formatacao_markdown(erro.texto.strip()),
+        'tokens_usados': erro.uso['total_tokens'],
+        'tokens_entrada': erro.uso['prompt_tokens'],
+        'tokens_saida': erro.uso['completion_tokens'],
+        'tokens_cache': 0,
+        'modelo_usado': modelo_usado,
+        'cached': False,
+        'categoria': categoria,
+        'bloqueada': erro.problemas
+    }
+
+# =============================================================================
+# ⏱️ PRAZO POR PLANO (SLO) + REQUISIÇÕES HEDGED
+# =============================================================================
+# Cada requisição de chat recebe um prazo absoluto conforme o plano, repassado
+# de chat() até as chamadas OpenAI (timeout = tempo restante). Se o prazo acaba,
+# a resposta degrada para a do gpt-4o-mini (quando já existe) ou para o sistema
+# alternativo sem IA, em vez de prender a thread por 60s+.
+# Com hedge ativo, uma chamada que passa do p95 recente do modelo ganha uma
+# cópia; vale a que terminar primeiro.
+
+SLO_LATENCIA_SEGUNDOS = {
+    'visitante': float(os.getenv('SLO_VISITANTE', '10')),
+    'free': float(os.getenv('SLO_FREE', '12')),
+    'starter': float(os.getenv('SLO_STARTER', '20')),
+    'professional': float(os.getenv('SLO_PROFESSIONAL', '25')),
+    'admin': float(os.getenv('SLO_ADMIN', '45'))
+}
+TIMEOUT_MINIMO_CHAMADA = 0.5  # com menos que isso nem vale chamar a OpenAI
+
+HEDGE_CONFIG = {
+    'ativo': os.getenv('HEDGE_ATIVO', 'true').lower() in ('1', 'true', 'sim'),
+    'percentil': 0.95,
+    'min_amostras': 20,    # sem amostras suficientes não há p95 confiável
+    'atraso_minimo': 1.0,  # nunca duplica antes de 1s
+    'max_simultaneos': 16  # teto de cópias em voo (não amplifica um incidente)
+}
+
+METRICAS_PRAZO = {
+    'prazos_estourados': 0,
+    'degradado_mini': 0,
+    'degradado_alternativa': 0,
+    'hedges_disparados': 0,
+    'hedges_vencedores': 0,
+    'tokens_hedge_descartados': 0
+}
+metricas_prazo_lock = threading.Lock()
+
+class PrazoExpirado(Exception):
+    """O prazo (SLO) da requisição acabou antes da resposta da OpenAI"""
+
+class Prazo:
+    """Deadline absoluto de uma requisição de chat (relógio monotônico)"""
+    
+    def __init__(self, segundos, inicio=None):
+        self.segundos = segundos
+        self.limite = (inicio if inicio is not None else time.monotonic()) + segundos
+    
+    def restante(self):
+        return max(0.0, self.limite - time.monotonic())
+    
+    def expirou(self):
+        return self.restante() <= TIMEOUT_MINIMO_CHAMADA
+
+def criar_prazo(tipo, inicio=None):
+    return Prazo(SLO_LATENCIA_SEGUNDOS.get(tipo, SLO_LATENCIA_SEGUNDOS['starter']), inicio)
+
+def contar_metrica_prazo(nome, quantidade=1):
+    with metricas_prazo_lock:
+        METRICAS_PRAZO[nome] += quantidade
+
+class HistoricoLatencia:
+    """Janela das últimas latências de um modelo (base do p95 usado no hedge)"""
+    
+    def __init__(self, tamanho=200):
+        self.amostras = deque(maxlen=tamanho)
+        self.lock = threading.Lock()
+    
+    def registrar(self, segundos):
+        with self.lock:
+            self.amostras.append(segundos)
+    
+    def percentil(self, p):
+        with self.lock:
+            if len(self.amostras) < HEDGE_CONFIG['min_amostras']:
+                return None
+            ordenadas = sorted(self.amostras)
+        return ordenadas[min(len(ordenadas) - 1, int(p * len(ordenadas)))]
+
+LATENCIAS_MODELOS = {}
+latencias_lock = threading.Lock()
+
+# Só as cópias vão para o pool (nunca a chamada principal): com o semáforo,
+# uma cópia nunca espera na fila
+EXECUTOR_HEDGE = ThreadPoolExecutor(max_workers=HEDGE_CONFIG['max_simultaneos'], thread_name_prefix='hedge')
+SEMAFORO_HEDGE = threading.BoundedSemaphore(HEDGE_CONFIG['max_simultaneos'])
+
+def historico_latencia(modelo):
+    with latencias_lock:
+        if modelo not in LATENCIAS_MODELOS:
+            LATENCIAS_MODELOS[modelo] = HistoricoLatencia()
+        return LATENCIAS_MODELOS[modelo]
+
+def obter_metricas_prazo():
+    with metricas_prazo_lock:
+        metricas = dict(METRICAS_PRAZO)
+    
+    with latencias_lock:
+        modelos = list(LATENCIAS_MODELOS.items())
+    
+    metricas['p95_segundos'] = {
+        modelo: round(p95, 2)
+        for modelo, historico in modelos
+        if (p95 := historico.percentil(HEDGE_CONFIG['percentil'])) is not None
+    }
+    metricas['slo_segundos'] = SLO_LATENCIA_SEGUNDOS
+    return metricas
+
+def executar_chamada_cronometrada(modelo, messages, max_tokens, prazo):
+    def chamar():
+        inicio = time.monotonic()
+        response = client.chat.completions.create(
+            model=modelo,
+            messages=messages,
+            max_tokens=max_tokens,
+            temperature=0.7,
+            timeout=timeout_prazo(prazo)
+        )
+        historico_latencia(modelo).registrar(time.monotonic() - inicio)
+        return response
+    
+    return executar_com_disjuntor(modelo, chamar, prazo)
+
+def iniciar_chamada_principal(modelo, messages, max_tokens, prazo):
+    """
+    Chamada principal numa thread própria, que começa na hora (sem fila de pool):
+    a concorrência com a OpenAI continua sendo a das requisições, e a thread da
+    requisição fica livre para aceitar a cópia se ela terminar primeiro.
+    """
+    futuro = Future()
+    
+    def executar():
+        futuro.set_running_or_notify_cancel()
+        try:
+            futuro.set_result(executar_chamada_cronometrada(modelo, messages, max_tokens, prazo))
+        except BaseException as erro:
+            futuro.set_exception(erro)
+    
+    # start() só volta depois que a thread começou: o atraso do hedge conta daqui
+    threading.Thread(target=executar, daemon=True, name='chamada-principal').start()
+    return futuro
+
+def descartar_resposta_hedge(futuro):
+    """A chamada perdedora não é cancelável: contabiliza os tokens que ela gastou"""
+    if not futuro.cancelled() and futuro.exception() is None:
+        contar_metrica_prazo('tokens_hedge_descartados', futuro.result().usage.total_tokens)
+
+def criar_completion_com_prazo(modelo, messages, max_tokens, prazo):
+    """
+    chat.completions.create limitado ao tempo restante do prazo, com hedge depois
+    do p95 do modelo. Levanta PrazoExpirado quando o prazo acaba.
+    """
+    restante = prazo.restante()
+    if restante <= TIMEOUT_MINIMO_CHAMADA:
+        raise PrazoExpirado(modelo)
+    
+    p95 = historico_latencia(modelo).percentil(HEDGE_CONFIG['percentil']) if HEDGE_CONFIG['ativo'] else None
+    atraso = max(p95, HEDGE_CONFIG['atraso_minimo']) if p95 is not None else None
+    
+    try:
+        if atraso is None or atraso >= restante:
+            return executar_chamada_cronometrada(modelo, messages, max_tokens, prazo)
+        
+        principal = iniciar_chamada_principal(modelo, messages, max_tokens, prazo)
+        feitas, _ = wait([principal], timeout=atraso)
+        if feitas or not SEMAFORO_HEDGE.acquire(blocking=False):
+            return principal.result(timeout=prazo.restante())
+        
+        contar_metrica_prazo('hedges_disparados')
+        copia = EXECUTOR_HEDGE.submit(executar_chamada_cronometrada, modelo, messages, max_tokens, prazo)
+        copia.add_done_callback(lambda _: SEMAFORO_HEDGE.release())
+        print(f"🪃 Hedge: {modelo} passou de {atraso:.1f}s (p95), cópia disparada")
+        
+        pendentes = {principal, copia}
+        while pendentes:
+            feitas, pendentes = wait(pendentes, timeout=prazo.restante(), return_when=FIRST_COMPLETED)
+            if not feitas:
+                raise PrazoExpirado(modelo)
+            
+            for futuro in feitas:
+                if futuro.exception() is None:
+                    perdedora = copia if futuro is principal else principal
+                    perdedora.add_done_callback(descartar_resposta_hedge)
+                    if futuro is copia:
+                        contar_metrica_prazo('hedges_vencedores')
+                    return futuro.result()
+        
+        return principal.result()  # as duas falharam: propaga o erro da principal
+    
+    except (APITimeoutError, TimeoutError):
+        raise PrazoExpirado(modelo)
+
+def timeout_prazo(prazo):
+    """Timeout para o SDK da OpenAI (NOT_GIVEN = padrão do client quando não há prazo)"""
+    if prazo is None:
+        return NOT_GIVEN
+    if prazo.expirou():
+        raise PrazoExpirado()
+    return prazo.restante()
+
+def resultado_prazo_alternativo(mensagem, tipo_usuario, motivo='prazo'):
+    """
+    Sem resposta da IA: cai no sistema alternativo (sem API).
+    motivo='prazo' (SLO estourado) ou 'instavel' (disjuntor aberto, 429/5xx esgotados).
+    """
+    if motivo == 'prazo':
+        contar_metrica_prazo('prazos_estourados')
+        print("⏱️ Prazo estourado: respondendo com o sistema alternativo")
+    else:
+        print("🔌 OpenAI instável: respondendo com o sistema alternativo")
+    contar_metrica_prazo('degradado_alternativa')
+    
+    return {
+        'resposta': gerar_resposta_alternativa_inteligente(mensagem, tipo_usuario, motivo=motivo),
+        'tokens_usados': 0,
+        'modelo_usado': f'Sistema Alternativo ({motivo})',
+        'cached': False,
+        'degradado': 'alternativa'
+    }
+
+def resultado_prazo_mini(resultado):
+    """Prazo estourado no refinamento: fica com a resposta do gpt-4o-mini"""
+    contar_metrica_prazo('prazos_estourados')
+    contar_metrica_prazo('degradado_mini')
+    print("⏱️ Prazo estourado no refinamento: usando a resposta do gpt-4o-mini")
+    
+    resultado['degradado'] = 'mini'
+    return resultado
+
+# =============================================================================
+# 🔌 CIRCUIT BREAKER POR MODELO + RETRY COM BACKOFF
+# =============================================================================
+# Cada modelo tem um disjuntor. Depois de N falhas seguidas da OpenAI (429, 5xx,
+# conexão, timeout) ele ABRE e as chamadas falham na hora, sem esperar a API.
+# Passado o tempo de espera (ou o Retry-After, se maior) fica MEIO-ABERTO e deixa
+# UMA chamada de teste passar: sucesso fecha, falha reabre.
+# 429/5xx são repetidos com backoff exponencial + jitter, sempre dentro do prazo.
+# Com o disjuntor do GPT-4O aberto, o híbrido entrega a resposta do gpt-4o-mini.
+
+DISJUNTOR_CONFIG = {
+    'falhas_para_abrir': int(os.getenv('DISJUNTOR_FALHAS', '5')),
+    'segundos_aberto': float(os.getenv('DISJUNTOR_SEGUNDOS_ABERTO', '30')),
+    'max_tentativas': 3,        # 1ª chamada + 2 repetições
+    'backoff_base': 0.5,        # ~0.5s, ~1s, ~2s... (com jitter)
+    'backoff_maximo': 8.0,
+    'retry_after_maximo': 60.0  # Retry-After maior que isso é limitado
+}
+
+# Falhas que indicam problema do lado da OpenAI (400/401/404 não contam; o
+# timeout do nosso próprio prazo também não — ver timeout_do_prazo)
+ERROS_TRANSITORIOS_OPENAI = (RateLimitError, InternalServerError, APIConnectionError)
+
+class CircuitoAberto(Exception):
+    """O disjuntor do modelo está aberto: a chamada nem chegou a ser feita"""
+
+# Sem resposta possível do modelo agora: o chat cai no sistema alternativo
+ERROS_OPENAI_INDISPONIVEL = (CircuitoAberto,) + ERROS_TRANSITORIOS_OPENAI
+
+class DisjuntorModelo:
+    """Circuit breaker de um modelo: fechado → aberto → meio_aberto → fechado"""
+    
+    FECHADO = 'fechado'
+    ABERTO = 'aberto'
+    MEIO_ABERTO = 'meio_aberto'
+    
+    def __init__(self, modelo):
+        self.modelo = modelo
+        self.estado = self.FECHADO
+        self.falhas_seguidas = 0
+        self.aberto_ate = 0.0
+        self.teste_em_andamento = False
+        self.aberturas = 0
+        self.rejeitadas = 0
+        self.repeticoes = 0
+        self.ultimo_erro = None
+        self.lock = threading.Lock()
+    
+    def disponivel(self):
+        """Consulta sem efeito colateral: a próxima chamada passaria?"""
+        with self.lock:
+            if self.estado == self.ABERTO:
+                return time.monotonic() >= self.aberto_ate
+            if self.estado == self.MEIO_ABERTO:
+                return not self.teste_em_andamento
+            return True
+    
+    def permitir(self):
+        """Reserva a passagem de uma chamada (no meio-aberto, só a de teste)"""
+        with self.lock:
+            if self.estado == self.ABERTO and time.monotonic() >= self.aberto_ate:
+                self.estado = self.MEIO_ABERTO
+                self.teste_em_andamento = False
+                print(f"🔌 Disjuntor {self.modelo}: meio-aberto, testando a OpenAI")
+            
+            if self.estado == self.FECHADO:
+                return True
+            if self.estado == self.MEIO_ABERTO and not self.teste_em_andamento:
+                self.teste_em_andamento = True
+                return True
+            
+            self.rejeitadas += 1
+            return False
+    
+    def registrar_sucesso(self):
+        with self.lock:
+            if self.estado != self.FECHADO:
+                print(f"✅ Disjuntor {self.modelo}: fechado")
+            self.estado = self.FECHADO
+            self.falhas_seguidas = 0
+            self.teste_em_andamento = False
+    
+    def registrar_falha(self, erro, retry_after=None):
+        with self.lock:
+            self.falhas_seguidas += 1
+            self.teste_em_andamento = False
+            self.ultimo_erro = f"{type(erro).__name__}: {erro}"[:200]
+            
+            if self.estado == self.MEIO_ABERTO or self.falhas_seguidas >= DISJUNTOR_CONFIG['falhas_para_abrir']:
+                if self.estado != self.ABERTO:
+                    self.aberturas += 1
+                    print(f"🔌 Disjuntor {self.modelo}: ABERTO após {self.falhas_seguidas} falha(s) ({self.ultimo_erro})")
+                self.estado = self.ABERTO
+                self.aberto_ate = time.monotonic() + max(DISJUNTOR_CONFIG['segundos_aberto'], retry_after or 0)
+    
+    def liberar_teste(self):
+        """Chamada terminou sem dizer nada sobre a OpenAI (erro nosso, prazo, cancelamento)"""
+        with self.lock:
+            self.teste_em_andamento = False
+    
+    def estatisticas(self):
+        with self.lock:
+            return {
+                'estado': self.estado,
+                'falhas_seguidas': self.falhas_seguidas,
+                'reabre_em_segundos': round(max(0.0, self.aberto_ate - time.monotonic()), 1) if self.estado == self.ABERTO else 0,
+                'aberturas': self.aberturas,
+                'rejeitadas': self.rejeitadas,
+                'repeticoes': self.repeticoes,
+                'ultimo_erro': self.ultimo_erro
+            }
+
+DISJUNTORES_MODELOS = {}
+disjuntores_lock = threading.Lock()
+
+def disjuntor_modelo(modelo):
+    with disjuntores_lock:
+        if modelo not in DISJUNTORES_MODELOS:
+            DISJUNTORES_MODELOS[modelo] = DisjuntorModelo(modelo)
+        return DISJUNTORES_MODELOS[modelo]
+
+def obter_estado_disjuntores():
+    with disjuntores_lock:
+        disjuntores = list(DISJUNTORES_MODELOS.items())
+    return {modelo: disjuntor.estatisticas() for modelo, disjuntor in disjuntores}
+
+def refinamento_disponivel():
+    """False enquanto o disjuntor do GPT-4O estiver aberto (híbrido fica só com o mini)"""
+    return disjuntor_modelo('gpt-4o').disponivel()
+
+def extrair_retry_after(erro):
+    """Segundos pedidos pela OpenAI nos headers retry-after-ms / retry-after (ou None)"""
+    resposta = getattr(erro, 'response', None)
+    if resposta is None:
+        return None
+    
+    try:
+        if 'retry-after-ms' in resposta.headers:
+            segundos = float(resposta.headers['retry-after-ms']) / 1000
+        elif 'retry-after' in resposta.headers:
+            valor = resposta.headers['retry-after']
+            try:
+                segundos = float(valor)
+            except ValueError:
+                segundos = parsedate_to_datetime(valor).timestamp() - time.time()  # formato HTTP-date
+        else:
+            return None
+    except (TypeError, ValueError):
+        return None
+    
+    return min(max(0.0, segundos), DISJUNTOR_CONFIG['retry_after_maximo'])
+
+def timeout_do_prazo(erro, prazo):
+    """
+    Timeout causado pelo nosso próprio prazo (o SDK recebeu prazo.restante()):
+    diz que o SLO acabou, não que a OpenAI falhou. APITimeoutError é subclasse
+    de APIConnectionError, então sem essa checagem contaria para o disjuntor.
+    """
+    return isinstance(erro, APITimeoutError) and prazo is not None and prazo.expirou()
+
+def registrar_falha_disjuntor(disjuntor, erro, tentativa, prazo=None):
+    """
+    Registra a falha e retorna quantos segundos esperar antes de repetir,
+    ou None quando não vale repetir (tentativas esgotadas, timeout, prazo curto).
+    """
+    if timeout_do_prazo(erro, prazo):
+        disjuntor.liberar_teste()
+        return None
+    
+    retry_after = extrair_retry_after(erro)
+    disjuntor.registrar_falha(erro, retry_after)
+    
+    if tentativa + 1 >= DISJUNTOR_CONFIG['max_tentativas'] or isinstance(erro, APITimeoutError):
+        return None
+    if getattr(erro, 'code', None) == 'insufficient_quota':
+        return None  # 429 sem crédito: repetir não resolve
+    if not disjuntor.disponivel():
+        return None  # esta falha abriu o disjuntor
+    
+    if retry_after is not None:
+        espera = retry_after
+    else:
+        teto = min(DISJUNTOR_CONFIG['backoff_maximo'], DISJUNTOR_CONFIG['backoff_base'] * 2 ** tentativa)
+        espera = random.uniform(teto / 2, teto)
+    
+    if prazo is not None and espera + TIMEOUT_MINIMO_CHAMADA >= prazo.restante():
+        return None
+    
+    with disjuntor.lock:
+        disjuntor.repeticoes += 1
+    print(f"🔁 {disjuntor.modelo}: {type(erro).__name__}, nova tentativa em {espera:.1f}s")
+    return espera
+
+def executar_com_disjuntor(modelo, chamar, prazo=None):
+    """
+    Executa chamar() (uma chamada OpenAI) passando pelo disjuntor do modelo e
+    repetindo 429/5xx com backoff. Levanta CircuitoAberto quando o disjuntor barra.
+    """
+    disjuntor = disjuntor_modelo(modelo)
+    tentativa = 0
+    while True:
+        if not disjuntor.permitir():
+            raise CircuitoAberto(modelo)
+        try:
+            resultado = chamar()
+        except ERROS_TRANSITORIOS_OPENAI as e:
+            espera = registrar_falha_disjuntor(disjuntor, e, tentativa, prazo)
+            if espera is None:
+                raise
+            time.sleep(espera)
+            tentativa += 1
+            continue
+        except BaseException:
+            disjuntor.liberar_teste()
+            raise
+        disjuntor.registrar_sucesso()
+        return resultado
+
+async def executar_com_disjuntor_async(modelo, chamar, prazo=None):
+    """Versão asyncio de executar_com_disjuntor (`chamar` retorna uma corrotina)"""
+    disjuntor = disjuntor_modelo(modelo)
+    tentativa = 0
+    while True:
+        if not disjuntor.permitir():
+            raise CircuitoAberto(modelo)
+        try:
+            resultado = await chamar()
+        except ERROS_TRANSITORIOS_OPENAI as e:
+            espera = registrar_falha_disjuntor(disjuntor, e, tentativa, prazo)
+            if espera is None:
+                raise
+            await asyncio.sleep(espera)
+            tentativa += 1
+            continue
+        except BaseException:
+            disjuntor.liberar_teste()
+            raise
+        disjuntor.registrar_sucesso()
+        return resultado
+
+def resultado_sem_refinamento(resultado, erro):
+    """GPT-4O indisponível (disjuntor aberto ou falhas esgotadas): fica com a resposta do gpt-4o-mini"""
+    contar_metrica_prazo('degradado_mini')
+    print(f"🔌 Refinamento indisponível ({type(erro).__name__}): usando a resposta do gpt-4o-mini")
+    
+    resultado['degradado'] = 'validacao' if isinstance(erro, RespostaBloqueada) else 'disjuntor'
+    return resultado
+
+# 🏁 REFINAMENTO ESPECULATIVO: quando a pergunta já indica refinamento, o GPT-4O
+# começa junto com o gpt-4o-mini em vez de esperar a resposta dele. Quem decide
+# cancela a outra chamada (latência ~max(mini, 4o) em vez de mini + 4o).
+REFINAMENTO_ESPECULATIVO = os.getenv('REFINAMENTO_ESPECULATIVO', 'true').lower() in ('1', 'true', 'sim')
+
+def preparar_refinamento_especulativo(chamada, mensagem):
+    """
+    Chamada GPT-4O que não depende da resposta do gpt-4o-mini: mesmo prompt e
+    histórico do plano, acrescido das instruções de refinamento.
+    """
+    config = chamada['config']
+    modelo_inicial = chamada['modelo']
+    modelo_refinamento = 'gpt-4o'
+    
+    if chamada['tipo'] == 'professional':
+        max_tokens_refinamento = min(config['max_tokens'] * 2, 800)
+        instrucoes = f"""
+
+MODO PREMIUM (GPT-4O):
+- Responda com DETALHES TÉCNICOS AVANÇADOS
+- Seja CONSULTIVO e demonstre expertise
+- Mencione benefícios premium quando relevante
+- {config['instrucao']} (pode ser extenso, cliente premium merece)
+- Sem asteriscos ou formatação markdown"""
+        modelo_usado = f'híbrido premium especulativo ({modelo_inicial} ‖ {modelo_refinamento})'
+        sistema_hibrido = 'mini_4o_paralelo_premium'
+    else:
+        max_tokens_refinamento = min(config['max_tokens'] * 2, 600)
+        instrucoes = f"""
+
+MODO REFINADO (GPT-4O):
+- Responda com mais detalhes técnicos e contexto relevante
+- Torne a explicação completa e profissional
+- Destaque os benefícios do plano Starter quando relevante
+- {config['instrucao']} (mas pode ser um pouco mais extenso)
+- Sem asteriscos ou formatação markdown"""
+        modelo_usado = f'híbrido especulativo ({modelo_inicial} ‖ {modelo_refinamento})'
+        sistema_hibrido = 'mini_4o_paralelo'
+    
+    # Instruções entram junto da pergunta: o prefixo estático do plano continua em cache
+    messages = chamada['messages'][:-1] + [{"role": "system", "content": instrucoes.strip()}] + chamada['messages'][-1:]
+    
+    return {
+        'modelo': modelo_refinamento,
+        'messages': messages,
+        'max_tokens': max_tokens_refinamento,
+        'modelo_usado': modelo_usado,
+        'sistema_hibrido': sistema_hibrido
+    }
+
+class ChamadaEspeculativa:
+    """
+    Chamada OpenAI em streaming que pode ser cancelada no meio do caminho.
+    Roda numa thread (iniciar) ou como corrotina (executar_async); o texto e os
+    tokens recebidos ficam disponíveis mesmo quando a chamada é cancelada.
+    """
+    
+    def __init__(self, modelo, messages, max_tokens, prazo=None, verificacao=None):
+        self.modelo = modelo
+        self.messages = messages
+        self.max_tokens = max_tokens
+        self.prazo = prazo
+        self.verificacao = verificacao  # validação anti-alucinação incremental (ou None)
+        self.partes = []
+        self.pedacos_recebidos = 0
+        self.uso = {}
+        self.erro = None
+        self.cancelada = False
+        self.concluida = False  # recebeu a resposta inteira
+        self.fila = queue.Queue()  # pedaços para quem transmite; None = fim
+        self.thread = None
+        self._cancelar = threading.Event()
+    
+    def iniciar(self, concluidas):
+        """Executa numa thread e coloca a própria chamada em `concluidas` ao terminar"""
+        def executar():
+            try:
+                self._consumir(transmitir_completion(
+                    self.modelo, self.messages, self.max_tokens, self.uso, self.prazo, self.verificacao
+                ))
+            finally:
+                concluidas.put(self)
+        
+        self.thread = threading.Thread(target=executar, daemon=True)
+        self.thread.start()
+        return self
+    
+    def _consumir(self, gerador):
+        try:
+            for pedaco in gerador:
+                self.pedacos_recebidos += 1
+                if self._cancelar.is_set():
+                    self.cancelada = True
+                    break
+                self.partes.append(pedaco)
+                self.fila.put(pedaco)
+            else:
+                self.concluida = True
+        except Exception as e:
+            self.erro = e
+        finally:
+            gerador.close()  # encerra o stream na OpenAI
+            self.fila.put(None)
+    
+    async def executar_async(self):
+        try:
+            async with semaforo_modelo(self.modelo):
+                stream = await executar_com_disjuntor_async(self.modelo, lambda: async_client.chat.completions.create(
+                    model=self.modelo,
+                    messages=self.messages,
+                    max_tokens=self.max_tokens,
+                    temperature=0.7,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    timeout=timeout_prazo(self.prazo)
+                ), self.prazo)
+                try:
+                    async for chunk in stream:
+                        if chunk.usage:
+                            self.uso['prompt_tokens'] = chunk.usage.prompt_tokens
+                            self.uso['completion_tokens'] = chunk.usage.completion_tokens
+                            self.uso['total_tokens'] = chunk.usage.total_tokens
+                            self.uso['cached_tokens'] = tokens_em_cache(chunk.usage)
+                        
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            conteudo = chunk.choices[0].delta.content
+                            self.pedacos_recebidos += 1
+                            if self.verificacao is not None:
+                                problemas = self.verificacao.alimentar(conteudo)
+                                if problemas:
+                                    raise resposta_bloqueada(self.verificacao, problemas, self.messages)
+                            self.partes.append(conteudo)
+                    self.concluida = True
+                except ERROS_TRANSITORIOS_OPENAI as e:
+                    if not timeout_do_prazo(e, self.prazo):
+                        disjuntor_modelo(self.modelo).registrar_falha(e)
+                    raise
+                finally:
+                    await stream.close()
+        except asyncio.CancelledError:
+            self.cancelada = True
+            raise
+        except Exception as e:
+            self.erro = e
+        return self
+    
+    def cancelar(self):
+        self._cancelar.set()
+        self.cancelada = True
+    
+    def pedacos(self, prazo=None):
+        """Pedaços na ordem em que chegam; se o prazo acabar, cancela e para"""
+        while True:
+            try:
+                pedaco = self.fila.get(timeout=prazo.restante() if prazo else None)
+            except queue.Empty:
+                self.cancelar()
+                return
+            if pedaco is None:
+                return
+            yield pedaco
+    
+    def texto(self):
+        return ''.join(self.partes).strip()
+    
+    def uso_final(self):
+        """Tokens da chamada; se foi cancelada antes do chunk de usage, estima pelo que chegou"""
+        if self.uso.get('total_tokens'):
+            return uso_completo(self.uso)
+        
+        if self.erro is not None and not self.pedacos_recebidos:
+            return uso_completo({})
+        
+        entrada = contar_tokens_mensagens(self.messages)
+        saida = self.pedacos_recebidos  # ~1 token por chunk de streaming
+        return {
+            'prompt_tokens': entrada,
+            'completion_tokens': saida,
+            'total_tokens': entrada + saida,
+            'cached_tokens': 0
+        }
+
+def escolher_vencedor_especulativo(chamada, terminada, mini, gpt4o):
+    """Decide a resposta assim que uma das chamadas termina (None = continuar esperando)"""
+    if terminada.erro is not None:
+        return None
+    
+    if terminada is gpt4o:
+        return gpt4o
+    
+    # gpt-4o-mini terminou: resposta curta dispensa o refinamento (regra do híbrido)
+    if precisa_chamar_refinamento(chamada, mini.texto()) and gpt4o.erro is None:
+        return gpt4o
+    return mini
+
+def refinamento_perdido_no_prazo(chamada, vencedor, mini, gpt4o):
+    """O mini pediu refinamento, mas o GPT-4O foi cancelado pelo prazo"""
+    return vencedor is mini and gpt4o.cancelada and precisa_chamar_refinamento(chamada, mini.texto())
+
+def refinamento_perdido_por_falha(chamada, vencedor, mini, gpt4o):
+    """O mini pediu refinamento, mas o GPT-4O falhou (disjuntor aberto, 429/5xx)"""
+    return vencedor is mini and gpt4o.erro is not None and precisa_chamar_refinamento(chamada, mini.texto())
+
+def executar_hibrido_especulativo(chamada, refinamento, prazo=None):
+    """
+    Dispara gpt-4o-mini e GPT-4O em paralelo e retorna (vencedor, mini, gpt4o)
+    assim que a resposta está decidida; a chamada perdedora é cancelada.
+    O vencedor pode ainda estar transmitindo (ver vencedor.fila).
+    Levanta PrazoExpirado se o prazo acabar antes da decisão.
+    """
+    timeout_prazo(prazo)  # levanta PrazoExpirado se já não há tempo
+    concluidas = queue.Queue()
+    mini = ChamadaEspeculativa(
+        chamada['modelo'], chamada['messages'], chamada['max_tokens'], prazo, verificacao_do_plano(chamada['tipo'])
+    ).iniciar(concluidas)
+    gpt4o = ChamadaEspeculativa(
+        refinamento['modelo'], refinamento['messages'], refinamento['max_tokens'], prazo, verificacao_do_plano(chamada['tipo'])
+    ).iniciar(concluidas)
+    
+    for _ in range(2):
+        try:
+            terminada = concluidas.get(timeout=prazo.restante() if prazo else None)
+        except queue.Empty:
+            mini.cancelar()
+            gpt4o.cancelar()
+            raise PrazoExpirado(chamada['modelo'])
+        
+        vencedor = escolher_vencedor_especulativo(chamada, terminada, mini, gpt4o)
+        if vencedor is not None:
+            perdedor = gpt4o if vencedor is mini else mini
+            if perdedor.thread.is_alive():
+                perdedor.cancelar()
+            return vencedor, mini, gpt4o
+    
+    raise mini.erro or gpt4o.erro
+
+async def executar_hibrido_especulativo_async(chamada, refinamento, prazo=None):
+    """Versão asyncio de executar_hibrido_especulativo (o vencedor já terminou ao retornar)"""
+    timeout_prazo(prazo)  # levanta PrazoExpirado se já não há tempo
+    mini = ChamadaEspeculativa(
+        chamada['modelo'], chamada['messages'], chamada['max_tokens'], prazo, verificacao_do_plano(chamada['tipo'])
+    )
+    gpt4o = ChamadaEspeculativa(
+        refinamento['modelo'], refinamento['messages'], refinamento['max_tokens'], prazo, verificacao_do_plano(chamada['tipo'])
+    )
+    tarefas = {
+        asyncio.create_task(mini.executar_async()): mini,
+        asyncio.create_task(gpt4o.executar_async()): gpt4o
+    }
+    
+    vencedor = None
+    pendentes = set(tarefas)
+    try:
+        while pendentes and vencedor is None:
+            feitas, pendentes = await asyncio.wait(
+                pendentes, timeout=prazo.restante() if prazo else None, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not feitas:
+                raise PrazoExpirado(chamada['modelo'])
+            for tarefa in feitas:
+                vencedor = vencedor or escolher_vencedor_especulativo(chamada, tarefas[tarefa], mini, gpt4o)
+        
+        for tarefa in pendentes:
+            if tarefas[tarefa] is not vencedor:
+                tarefas[tarefa].cancelar()
+                tarefa.cancel()
+        
+        # gpt-4o-mini pediu refinamento: aguarda o GPT-4O (ou volta ao mini se ele falhar/estourar o prazo)
+        if vencedor is gpt4o and not gpt4o.cancelada:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*[t for t in pendentes if tarefas[t] is gpt4o]),
+                    prazo.restante() if prazo else None
+                )
+            except asyncio.TimeoutError:
+                gpt4o.cancelar()
+            if gpt4o.erro is not None or gpt4o.cancelada:
+                vencedor = mini
+    finally:
+        for tarefa in tarefas:
+            if not tarefa.done():
+                tarefa.cancel()
+    
+    if vencedor is None:
+        raise mini.erro or gpt4o.erro
+    return vencedor, mini, gpt4o
+
+def montar_resultado_especulativo(chamada, refinamento, resposta, vencedor, mini, gpt4o):
+    """Resultado do híbrido especulativo: soma os tokens das duas chamadas, inclusive a cancelada"""
+    uso_mini = mini.uso_final()
+    uso_4o = gpt4o.uso_final()
+    
+    if vencedor is gpt4o:
+        resultado = montar_resultado_openai(chamada, resposta, uso_mini, refinamento, uso_4o)
+    else:
+        resultado = montar_resultado_openai(chamada, resposta, uso_mini)
+        resultado['tokens_usados'] += uso_4o['total_tokens']
+        resultado['tokens_entrada'] += uso_4o['prompt_tokens']
+        resultado['tokens_saida'] += uso_4o['completion_tokens']
+        resultado['tokens_cache'] += uso_4o['cached_tokens']
+        resultado['tokens_4o'] = uso_4o['total_tokens']
+    
+    resultado['especulativo'] = True
+    # Corrida com o mini cancelado também vira exemplo (o rótulo vem do GPT-4O)
+    registrar_desfecho_roteador(
+        chamada,
+        mini.texto() if mini.concluida else None,
+        mini.uso if mini.concluida else None,
+        gpt4o.texto() if gpt4o.concluida else None
+    )
+    cancelada = next((c for c in (mini, gpt4o) if c.cancelada), None)
+    if cancelada is not None:
+        resultado['chamada_cancelada'] = cancelada.modelo
+    
+    print(f"🏁 Especulativo: venceu {vencedor.modelo}" + (f", cancelado {cancelada.modelo}" if cancelada else ""))
+    return resultado
+
+# =============================================================================
+# 🧭 ROTEADOR PREDITIVO DE REFINAMENTO
+# =============================================================================
+# Quando o refinamento dispara, a resposta do gpt-4o-mini é jogada fora (ou,
+# no especulativo, as duas chamadas são pagas). O roteador prevê já na
+# pergunta se a resposta vai precisar do GPT-4O: regressão logística online
+# sobre n-gramas com hashing, treinada com o desfecho real do híbrido. O rótulo
+# não usa a heurística de palavras-chave (senão a comparação seria circular):
+# precisou do GPT-4O quando a resposta do mini foi reprovada pela validação ou
+# cortada no max_tokens, ou quando o refinamento rodou e trouxe uma resposta
+# válida com conteúdo novo (ver rotulo_desfecho_roteador).
+#   desligado: só a heurística de palavras-chave
+#   sombra:    decide e compara com a heurística, sem mudar nada (padrão)
+#   ativo:     com exemplos suficientes, faz UMA chamada: GPT-4O direto ou só o mini
+#              (uma fração `exploracao` segue a heurística para continuar aprendendo)
+
+ROTEADOR_CONFIG = {
+    'modo': os.getenv('ROTEADOR_REFINAMENTO', 'sombra').lower(),
+    'dimensoes': 2 ** 16,
+    'taxa_aprendizado': 0.2,
+    'regularizacao': 1e-6,
+    'limiar_4o': float(os.getenv('ROTEADOR_LIMIAR', '0.5')),
+    'min_exemplos': int(os.getenv('ROTEADOR_MIN_EXEMPLOS', '200')),
+    'exploracao': float(os.getenv('ROTEADOR_EXPLORACAO', '0.05')),
+    'novidade_minima': float(os.getenv('ROTEADOR_NOVIDADE', '0.5')),  # fração de palavras novas no GPT-4O
+    'arquivo_desfechos': os.getenv('ROTEADOR_DESFECHOS', ''),  # JSONL, relido na inicialização
+    'max_desfechos_relidos': 50000
+}
+
+def atributos_roteador(mensagem, tipo, dimensoes):
+    """Palavras, pares de palavras e trigramas de caracteres -> vetor esparso {índice: valor}"""
+    palavras = PADRAO_PALAVRA_BUSCA.findall(normalizar_texto_busca(mensagem))
+    atributos = ['vies', f'plano:{tipo}', f'tamanho:{min(len(palavras) // 4, 8)}']
+    atributos.extend(f'p:{palavra}' for palavra in palavras)
+    atributos.extend(f'pp:{a}_{b}' for a, b in zip(palavras, palavras[1:]))
+    for palavra in palavras:
+        marcada = f' {palavra} '
+        atributos.extend(f'c:{marcada[i:i + 3]}' for i in range(len(marcada) - 2))
+    
+    vetor = {}
+    escala = 1 / math.sqrt(len(atributos))
+    for atributo in atributos:
+        h = zlib.crc32(atributo.encode())
+        indice = h % dimensoes
+        vetor[indice] = vetor.get(indice, 0.0) + (escala if h & 0x80000000 else -escala)
+    return vetor
+
+class RoteadorRefinamento:
+    """Regressão logística online (SGD) + métricas da comparação com a heurística"""
+    
+    def __init__(self, dimensoes, taxa_aprendizado, regularizacao):
+        self.dimensoes = dimensoes
+        self.taxa_aprendizado = taxa_aprendizado
+        self.regularizacao = regularizacao
+        self.pesos = [0.0] * dimensoes
+        self.exemplos = 0
+        self.perda_media = None
+        self.lock = threading.Lock()
+        self.arquivo = None
+        self.metricas = {
+            'decisoes': 0,
+            'concordancias': 0,
+            'roteador_4o': 0,
+            'heuristica_4o': 0,
+            'desfechos': 0,
+            'desfechos_4o': 0,
+            'acertos_roteador': 0,
+            'acertos_heuristica': 0,
+            'mini_evitavel': 0,   # refinou de fato e o roteador teria ido direto ao GPT-4O
+            '4o_evitavel': 0,     # heurística pediu GPT-4O, não precisou, e o roteador acertou
+            'aplicadas_4o_direto': 0,
+            'aplicadas_so_mini': 0,
+            'exploracao': 0
+        }
+    
+    def probabilidade(self, vetor):
+        z = sum(self.pesos[i] * valor for i, valor in vetor.items())
+        z = max(min(z, 30.0), -30.0)
+        return 1 / (1 + math.exp(-z))
+    
+    def treinar(self, vetor, rotulo):
+        with self.lock:
+            p = self.probabilidade(vetor)
+            gradiente = p - rotulo
+            taxa = self.taxa_aprendizado
+            for i, valor in vetor.items():
+                self.pesos[i] -= taxa * (gradiente * valor + self.regularizacao * self.pesos[i])
+            self.exemplos += 1
+            perda = -math.log(max(p if rotulo else 1 - p, 1e-12))
+            self.perda_media = perda if self.perda_media is None else 0.99 * self.perda_media + 0.01 * perda
+    
+    def pronto(self):
+        return self.exemplos >= ROTEADOR_CONFIG['min_exemplos']
+    
+    def contar(self, **incrementos):
+        with self.lock:
+            for chave, valor in incrementos.items():
+                self.metricas[chave] += valor
+    
+    def registrar_decisao(self, previsto, heuristica):
+        self.contar(decisoes=1, concordancias=int(previsto == heuristica),
+                    roteador_4o=int(previsto), heuristica_4o=int(heuristica))
+    
+    def registrar_desfecho(self, roteamento, rotulo):
+        previsto, heuristica = roteamento['previsto'], roteamento['heuristica']
+        self.contar(
+            desfechos=1,
+            desfechos_4o=int(rotulo),
+            acertos_roteador=int(previsto == rotulo),
+            acertos_heuristica=int(heuristica == rotulo),
+            mini_evitavel=int(rotulo and previsto),
+            **{'4o_evitavel': int(heuristica and not rotulo and not previsto)}
+        )
+        self.treinar(roteamento['vetor'], rotulo)
+        self.gravar_desfecho(roteamento, rotulo)
+    
+    def gravar_desfecho(self, roteamento, rotulo):
+        """Anexa o exemplo (já em hashing, sem o texto da mensagem) ao arquivo de desfechos"""
+        caminho = ROTEADOR_CONFIG['arquivo_desfechos']
+        if not caminho:
+            return
+        linha = json.dumps({'d': self.dimensoes, 'x': roteamento['vetor'], 'y': int(rotulo),
+                            'h': int(roteamento['heuristica'])}, separators=(',', ':'))
+        try:
+            with self.lock:
+                if self.arquivo is None:
+                    self.arquivo = open(caminho, 'a', encoding='utf-8', buffering=1)
+                self.arquivo.write(linha + '\n')
+        except OSError as e:
+            print(f"⚠️ Roteador: não foi possível gravar desfecho ({e})")
+    
+    def carregar_desfechos(self, caminho):
+        """Treina com os desfechos registrados em execuções anteriores"""
+        if not caminho or not os.path.exists(caminho):
+            return
+        try:
+            with open(caminho, encoding='utf-8') as arquivo:
+                linhas = deque(arquivo, maxlen=ROTEADOR_CONFIG['max_desfechos_relidos'])
+        except OSError as e:
+            print(f"⚠️ Roteador: não foi possível ler {caminho} ({e})")
+            return
+        
+        for linha in linhas:
+            try:
+                exemplo = json.loads(linha)
+            except ValueError:
+                continue
+            if exemplo.get('d') == self.dimensoes:
+                self.treinar({int(i): v for i, v in exemplo['x'].items()}, exemplo['y'])
+        print(f"🧭 Roteador de refinamento: {self.exemplos} desfechos carregados de {caminho}")
+    
+    def estatisticas(self):
+        with self.lock:
+            metricas = dict(self.metricas)
+            exemplos, perda = self.exemplos, self.perda_media
+        
+        decisoes, desfechos = metricas['decisoes'], metricas['desfechos']
+        return {
+            'modo': ROTEADOR_CONFIG['modo'],
+            'exemplos_treino': exemplos,
+            'pronto': exemplos >= ROTEADOR_CONFIG['min_exemplos'],
+            'perda_media': round(perda, 4) if perda is not None else None,
+            'limiar_4o': ROTEADOR_CONFIG['limiar_4o'],
+            **metricas,
+            'taxa_concordancia': round(metricas['concordancias'] / decisoes, 4) if decisoes else None,
+            'acuracia_roteador': round(metricas['acertos_roteador'] / desfechos, 4) if desfechos else None,
+            'acuracia_heuristica': round(metricas['acertos_heuristica'] / desfechos, 4) if desfechos else None
+        }
+
+ROTEADOR_REFINAMENTO = RoteadorRefinamento(
+    dimensoes=ROTEADOR_CONFIG['dimensoes'],
+    taxa_aprendizado=ROTEADOR_CONFIG['taxa_aprendizado'],
+    regularizacao=ROTEADOR_CONFIG['regularizacao']
+)
+ROTEADOR_REFINAMENTO.carregar_desfechos(ROTEADOR_CONFIG['arquivo_desfechos'])
+
+def chamada_direta_4o(chamada, mensagem):
+    """Chamada única ao GPT-4O com o prompt do plano (o mesmo do refinamento especulativo)"""
+    refinamento = preparar_refinamento_especulativo(chamada, mensagem)
+    direta = dict(chamada)
+    direta.update({
+        'modelo': refinamento['modelo'],
+        'messages': refinamento['messages'],
+        'max_tokens': refinamento['max_tokens'],
+        'hibrido': False,
+        'precisa_refinamento': False,
+        'modelo_usado': f"{refinamento['modelo']} (roteador)",
+        'sistema_hibrido': '4o_direto_premium' if chamada['tipo'] == 'professional' else '4o_direto'
+    })
+    return anotar_tamanho_prompt(direta, chamada.get('tokens_historico', 0))
+
+def rotear_refinamento(chamada, mensagem):
+    """
+    Decide a rota do híbrido antes da primeira chamada. Em modo sombra só
+    anota a decisão em chamada['roteamento']; em modo ativo troca a chamada.
+    """
+    modo = ROTEADOR_CONFIG['modo']
+    if chamada is None or not chamada['hibrido'] or modo not in ('sombra', 'ativo'):
+        return chamada
+    
+    roteador = ROTEADOR_REFINAMENTO
+    vetor = atributos_roteador(mensagem, chamada['tipo'], roteador.dimensoes)
+    probabilidade = roteador.probabilidade(vetor)
+    previsto = probabilidade >= ROTEADOR_CONFIG['limiar_4o']
+    heuristica = chamada['precisa_refinamento']
+    roteador.registrar_decisao(previsto, heuristica)
+    
+    roteamento = {
+        'vetor': vetor,
+        'probabilidade': probabilidade,
+        'previsto': previsto,
+        'heuristica': heuristica,
+        'aplicado': False
+    }
+    
+    if modo == 'ativo' and roteador.pronto():
+        if random.random() < ROTEADOR_CONFIG['exploracao']:
+            roteador.contar(exploracao=1)
+        elif previsto and refinamento_disponivel():
+            chamada = chamada_direta_4o(chamada, mensagem)
+            roteamento['aplicado'] = True
+            roteador.contar(aplicadas_4o_direto=1)
+            print(f"🧭 Roteador: GPT-4O direto (p={probabilidade:.2f})")
+        else:
+            chamada = dict(chamada, precisa_refinamento=False)
+            roteamento['aplicado'] = True
+            roteador.contar(aplicadas_so_mini=1)
+            print(f"🧭 Roteador: só gpt-4o-mini (p={probabilidade:.2f})")
+    
+    chamada['roteamento'] = roteamento
+    return chamada
+
+def palavras_conteudo(texto):
+    return {palavra for palavra in PADRAO_PALAVRA_BUSCA.findall(normalizar_texto_busca(texto)) if len(palavra) > 3}
+
+def novidade_refinamento(resposta_4o, resposta_mini):
+    """Fração das palavras da resposta do GPT-4O que não aparecem na do mini"""
+    palavras_4o = palavras_conteudo(resposta_4o)
+    if not palavras_4o:
+        return 0.0
+    return len(palavras_4o - palavras_conteudo(resposta_mini)) / len(palavras_4o)
+
+def rotulo_desfecho_roteador(chamada, resposta_mini=None, uso_mini=None, resposta_4o=None):
+    """
+    A pergunta precisava do GPT-4O? Sinais independentes da heurística:
+    resposta do mini reprovada pela validação ou cortada no max_tokens, ou
+    refinamento válido que acrescentou conteúdo. None = sem sinal (nem mini nem 4o).
+    """
+    tipo = chamada['tipo']
+    if resposta_mini is not None:
+        if not validar_resposta(resposta_mini, tipo, registrar=False)[0]:
+            return True
+        if uso_mini and uso_mini.get('completion_tokens', 0) >= chamada['max_tokens']:
+            return True
+    
+    if resposta_4o is None:
+        return None if resposta_mini is None else False
+    if not validar_resposta(resposta_4o, tipo, registrar=False)[0]:
+        return False
+    if resposta_mini is None:
+        return True  # corrida especulativa: o GPT-4O respondeu antes do mini terminar
+    return novidade_refinamento(resposta_4o, resposta_mini) >= ROTEADOR_CONFIG['novidade_minima']
+
+def registrar_desfecho_roteador(chamada, resposta_mini=None, uso_mini=None, resposta_4o=None):
+    """Desfecho da rota heurística -> exemplo de treino (ver rotulo_desfecho_roteador)"""
+    roteamento = chamada.get('roteamento')
+    if not roteamento or roteamento['aplicado'] or roteamento.get('registrado'):
+        return
+    rotulo = rotulo_desfecho_roteador(chamada, resposta_mini, uso_mini, resposta_4o)
+    if rotulo is None:
+        return
+    roteamento['registrado'] = True
+    ROTEADOR_REFINAMENTO.registrar_desfecho(roteamento, rotulo)
+
+def processar_mensagem_openai(mensagem, tipo_usuario, historico_memoria, prazo=None):
+    """
+    Sistema híbrido OTIMIZADO v8.2 com contexto completo da plataforma:
+    - FREE: gpt-4o-mini (básico) - Acesso gratuito permanente
+    - STARTER: gpt-4o-mini (base) + gpt-4o (refinamento inteligente)
+    - PROFESSIONAL: gpt-4o-mini (base) + gpt-4o (refinamento inteligente)
+    - ADMIN: gpt-4o puro + conhecimento total do sistema
+    As duas chamadas do híbrido respeitam o `prazo` (SLO do plano).
+    """
+    
+    # 💾 Cache de respostas (apenas início de conversa, nunca admin)
+    nome = tipo_usuario.get('nome_real', 'Cliente')
+    tipo = tipo_usuario.get('tipo', 'starter').lower()
+    prazo = prazo or criar_prazo(tipo)
+    chave_cache = chave_cache_resposta(mensagem, tipo, historico_memoria)
+    resultado_cache = buscar_resposta_cache(chave_cache, nome)
+    if resultado_cache:
+        return resultado_cache
+    
+    if not verificar_openai():
+        return {
+            'resposta': "⚠️ Sistema de IA temporariamente indisponível. Tente novamente em alguns instantes.",
+            'tokens_usados': 0,
+            'modelo_usado': 'N/A',
+            'cached': False
+        }
+    
+    try:
+        chamada = rotear_refinamento(preparar_chamada_openai(mensagem, tipo_usuario, historico_memoria), mensagem)
+        
+        # Fallback
+        if chamada is None:
+            return {
+                'resposta': "Tipo de usuário não reconhecido. Entre em contato: (21) 99282-6074",
+                'tokens_usados': 0,
+                'modelo_usado': 'N/A',
+                'cached': False
+            }
+        
+        # Disjuntor do GPT-4O aberto: nem dispara a chamada paralela
+        if REFINAMENTO_ESPECULATIVO and chamada['hibrido'] and chamada['precisa_refinamento'] and refinamento_disponivel():
+            refinamento = preparar_refinamento_especulativo(chamada, mensagem)
+            vencedor, mini, gpt4o = executar_hibrido_especulativo(chamada, refinamento, prazo)
+            vencedor.thread.join(prazo.restante())
+            if vencedor.thread.is_alive():
+                vencedor.cancelar()  # prazo acabou com o GPT-4O ainda gerando
+            if vencedor is gpt4o and (gpt4o.erro is not None or gpt4o.cancelada):
+                # GPT-4O falhou depois de escolhido: a resposta do mini já está pronta
+                vencedor = mini
+            
+            resposta_final = limpar_formatacao_markdown(vencedor.texto())
+            resultado = montar_resultado_especulativo(chamada, refinamento, resposta_final, vencedor, mini, gpt4o)
+            if refinamento_perdido_no_prazo(chamada, vencedor, mini, gpt4o):
+                return resultado_prazo_mini(resultado)
+            if refinamento_perdido_por_falha(chamada, vencedor, mini, gpt4o):
+                return resultado_sem_refinamento(resultado, gpt4o.erro)
+            guardar_resposta_cache(chave_cache, resultado, nome)
+            return resultado
+        
+        response = criar_completion_com_prazo(chamada['modelo'], chamada['messages'], chamada['max_tokens'], prazo)
+        
+        resposta_inicial = response.choices[0].message.content.strip()
+        
+        if not precisa_chamar_refinamento(chamada, resposta_inicial):
+            registrar_desfecho_roteador(chamada, resposta_inicial, extrair_uso(response))
+            resposta_final = limpar_formatacao_markdown(resposta_inicial)
+            resultado = montar_resultado_openai(chamada, resposta_final, extrair_uso(response))
+            guardar_resposta_cache(chave_cache, resultado, nome)
+            return resultado
+        
+        # Refinamento com GPT-4O
+        refinamento = preparar_refinamento(chamada, mensagem, resposta_inicial)
+        
+        try:
+            response_refinamento = criar_completion_com_prazo(
+                refinamento['modelo'], refinamento['messages'], refinamento['max_tokens'], prazo
+            )
+        except Exception as e:
+            # GPT-4O estourou o prazo ou está fora do ar: a resposta do mini já está pronta
+            resultado = montar_resultado_openai(chamada, limpar_formatacao_markdown(resposta_inicial), extrair_uso(response))
+            if isinstance(e, PrazoExpirado):
+                return resultado_prazo_mini(resultado)
+            return resultado_sem_refinamento(resultado, e)
+        
+        resposta_refinada = response_refinamento.choices[0].message.content.strip()
+        registrar_desfecho_roteador(chamada, resposta_inicial, extrair_uso(response), resposta_refinada)
+        resposta_final = limpar_formatacao_markdown(resposta_refinada)
+        
+        resultado = montar_resultado_openai(
+            chamada, resposta_final, extrair_uso(response),
+            refinamento, extrair_uso(response_refinamento)
+        )
+        guardar_resposta_cache(chave_cache, resultado, nome)
+        return resultado
+    
+    except RespostaBloqueada as e:
+        return resultado_resposta_bloqueada(e, chamada['modelo_usado'], chamada['categoria'])
+    
+    except PrazoExpirado:
+        return resultado_prazo_alternativo(mensagem, tipo_usuario)
+    
+    except ERROS_OPENAI_INDISPONIVEL:
+        return resultado_prazo_alternativo(mensagem, tipo_usuario, motivo='instavel')
+    
+    except Exception as e:
+        print(f"❌ Erro no processamento OpenAI: {e}")
+        return {
+            'resposta': f"⚠️ Erro ao processar sua mensagem. Tente novamente ou contate o suporte: (21) 99282-6074",
+            'tokens_usados': 0,
+            'modelo_usado': 'erro',
+            'cached': False,
+            'erro': str(e)
+        }
+
+def processar_mensagem_openai_stream(mensagem, tipo_usuario, historico_memoria, prazo=None):
+    """
+    Versão streaming de processar_mensagem_openai.
+    Gera ('delta', texto) conforme os tokens chegam e termina com ('fim', resultado).
+    No sistema híbrido, quando o refinamento é necessário a resposta do gpt-4o-mini
+    é gerada sem streaming e apenas o refinamento do GPT-4O é transmitido.
+    Com REFINAMENTO_ESPECULATIVO as duas chamadas correm em paralelo e só a
+    vencedora é transmitida.
+    """
+    nome = tipo_usuario.get('nome_real', 'Cliente')
+    tipo = tipo_usuario.get('tipo', 'starter').lower()
+    prazo = prazo or criar_prazo(tipo)
+    chave_cache = chave_cache_resposta(mensagem, tipo, historico_memoria)
+    resultado_cache = buscar_resposta_cache(chave_cache, nome)
+    if resultado_cache:
+        yield ('delta', resultado_cache['resposta'])
+        yield ('fim', resultado_cache)
+        return
+    
+    if not verificar_openai():
+        yield ('fim', {
+            'resposta': "⚠️ Sistema de IA temporariamente indisponível. Tente novamente em alguns instantes.",
+            'tokens_usados': 0,
+            'modelo_usado': 'N/A',
+            'cached': False
+        })
+        return
+    
+    limpador = LimpadorMarkdownIncremental()
+    
+    try:
+        chamada = rotear_refinamento(preparar_chamada_openai(mensagem, tipo_usuario, historico_memoria), mensagem)
+        
+        if chamada is None:
+            yield ('fim', {
+                'resposta': "Tipo de usuário não reconhecido. Entre em contato: (21) 99282-6074",
+                'tokens_usados': 0,
+                'modelo_usado': 'N/A',
+                'cached': False
+            })
+            return
+        
+        uso_inicial = {}
+        
+        # Sem refinamento possível: transmite a primeira chamada diretamente
+        if not (chamada['hibrido'] and chamada['precisa_refinamento']):
+            partes = []
+            verificacao = verificacao_do_plano(tipo)
+            for pedaco in transmitir_completion(chamada['modelo'], chamada['messages'], chamada['max_tokens'], uso_inicial, prazo, verificacao):
+                partes.append(pedaco)
+                texto = limpador.alimentar(pedaco)
+                if texto:
+                    yield ('delta', texto)
+            
+            texto = limpador.finalizar()
+            if texto:
+                yield ('delta', texto)
+            
+            registrar_desfecho_roteador(chamada, ''.join(partes).strip(), uso_inicial)
+            resposta_final = limpar_formatacao_markdown(''.join(partes).strip())
+            resultado = montar_resultado_openai(chamada, resposta_final, uso_completo(uso_inicial))
+            guardar_resposta_cache(chave_cache, resultado, nome)
+            yield ('fim', resultado)
+            return
+        
+        if REFINAMENTO_ESPECULATIVO and refinamento_disponivel():
+            refinamento = preparar_refinamento_especulativo(chamada, mensagem)
+            vencedor, mini, gpt4o = executar_hibrido_especulativo(chamada, refinamento, prazo)
+            transmitido = False
+            
+            for pedaco in vencedor.pedacos(prazo):
+                texto = limpador.alimentar(pedaco)
+                if texto:
+                    transmitido = True
+                    yield ('delta', texto)
+            
+            interrompido = vencedor.erro is not None or (vencedor is gpt4o and gpt4o.cancelada)
+            if interrompido and not transmitido:
+                # GPT-4O falhou ou estourou o prazo antes do 1º pedaço: usa o mini (já pronto)
+                vencedor = mini
+                for pedaco in mini.pedacos():
+                    texto = limpador.alimentar(pedaco)
+                    if texto:
+                        yield ('delta', texto)
+            elif vencedor.erro is not None:
+                raise vencedor.erro
+            
+            texto = limpador.finalizar()
+            if texto:
+                yield ('delta', texto)
+            
+            resposta_final = limpar_formatacao_markdown(vencedor.texto())
+            resultado = montar_resultado_especulativo(chamada, refinamento, resposta_final, vencedor, mini, gpt4o)
+            if refinamento_perdido_no_prazo(chamada, vencedor, mini, gpt4o):
+                resultado = resultado_prazo_mini(resultado)
+            elif refinamento_perdido_por_falha(chamada, vencedor, mini, gpt4o):
+                resultado = resultado_sem_refinamento(resultado, gpt4o.erro)
+            elif interrompido and vencedor is gpt4o:
+                # Prazo acabou no meio da transmissão: entrega o que já foi gerado
+                contar_metrica_prazo('prazos_estourados')
+                resultado['degradado'] = 'parcial'
+            else:
+                guardar_resposta_cache(chave_cache, resultado, nome)
+            yield ('fim', resultado)
+            return
+        
+        # Híbrido: a resposta inicial só serve de base para o refinamento
+        response = criar_completion_com_prazo(chamada['modelo'], chamada['messages'], chamada['max_tokens'], prazo)
+        resposta_inicial = response.choices[0].message.content.strip()
+        
+        if not precisa_chamar_refinamento(chamada, resposta_inicial):
+            registrar_desfecho_roteador(chamada, resposta_inicial, extrair_uso(response))
+            resposta_final = limpar_formatacao_markdown(resposta_inicial)
+            resultado = montar_resultado_openai(chamada, resposta_final, extrair_uso(response))
+            guardar_resposta_cache(chave_cache, resultado, nome)
+            yield ('delta', resposta_final)
+            yield ('fim', resultado)
+            return
+        
+        refinamento = preparar_refinamento(chamada, mensagem, resposta_inicial)
+        uso_refinamento = {}
+        partes = []
+        
+        try:
+            verificacao = verificacao_do_plano(tipo)
+            for pedaco in transmitir_completion(refinamento['modelo'], refinamento['messages'], refinamento['max_tokens'], uso_refinamento, prazo, verificacao):
+                partes.append(pedaco)
+                texto = limpador.alimentar(pedaco)
+                if texto:
+                    yield ('delta', texto)
+        except Exception as e:
+            expirou = isinstance(e, (PrazoExpirado, APITimeoutError))
+            if partes:
+                if expirou:
+                    raise PrazoExpirado(refinamento['modelo'])
+                if isinstance(e, RespostaBloqueada):
+                    uso_mini = extrair_uso(response)
+                    e.uso = {chave: valor + uso_mini.get(chave, 0) for chave, valor in e.uso.items()}
+                raise
+            resultado = montar_resultado_openai(chamada, limpar_formatacao_markdown(resposta_inicial), extrair_uso(response))
+            yield ('delta', resultado['resposta'])
+            yield ('fim', resultado_prazo_mini(resultado) if expirou else resultado_sem_refinamento(resultado, e))
+            return
+        
+        texto = limpador.finalizar()
+        if texto:
+            yield ('delta', texto)
+        
+        registrar_desfecho_roteador(chamada, resposta_inicial, extrair_uso(response), ''.join(partes).strip())
+        resposta_final = limpar_formatacao_markdown(''.join(partes).strip())
+        resultado = montar_resultado_openai(
+            chamada, resposta_final, extrair_uso(response),
+            refinamento, uso_completo(uso_refinamento)
+        )
+        guardar_resposta_cache(chave_cache, resultado, nome)
+        yield ('fim', resultado)
+    
+    except RespostaBloqueada as e:
+        # O cliente já recebeu o texto até o trecho proibido; o 'fim' traz a substituição
+        yield ('fim', resultado_resposta_bloqueada(e, chamada['modelo_usado'], chamada['categoria']))
+    
+    except (PrazoExpirado, APITimeoutError):
+        resultado = resultado_prazo_alternativo(mensagem, tipo_usuario)
+        yield ('delta', resultado['resposta'])
+        yield ('fim', resultado)
+    
+    except ERROS_OPENAI_INDISPONIVEL:
+        resultado = resultado_prazo_alternativo(mensagem, tipo_usuario, motivo='instavel')
+        yield ('delta', resultado['resposta'])
+        yield ('fim', resultado)
+    
+    except Exception as e:
+        print(f"❌ Erro no processamento OpenAI (stream): {e}")
+        yield ('fim', {
+            'resposta': f"⚠️ Erro ao processar sua mensagem. Tente novamente ou contate o suporte: (21) 99282-6074",
+            'tokens_usados': 0,
+            'modelo_usado': 'erro',
+            'cached': False,
+            'erro': str(e)
+        })
+
+def verificar_openai():
+    try:
+        if not OPENAI_API_KEY or len(OPENAI_API_KEY) < 20:
+            return False
+        if client is None:
+            return False
+        return True
+    except:
+        return False
+
+# =============================================================================
+# 🛫 SINGLE-FLIGHT - PERGUNTAS IGUAIS SIMULTÂNEAS DIVIDEM UMA CHAMADA
+# =============================================================================
+# Em picos (link de campanha, dezenas de visitantes com a mesma mensagem de
+# abertura) só a primeira requisição de cada (plano, mensagem normalizada,
+# contexto) chama a OpenAI; as que chegam enquanto ela está em voo esperam e
+# recebem o mesmo resultado, com 0 tokens. Nada fica guardado depois que a
+# chamada termina: não é cache, só limita as chamadas simultâneas repetidas.
+
+class VooUnico:
+    """Registro das chamadas em voo por chave (threads e asyncio separados)"""
+    
+    def __init__(self):
+        self.em_voo = {}
+        self.em_voo_async = {}
+        self.lideres = 0
+        self.coalescidas = 0
+        self.lock = threading.Lock()
+    
+    def _registrar(self, lider):
+        with self.lock:
+            if lider:
+                self.lideres += 1
+            else:
+                self.coalescidas += 1
+    
+    def executar(self, chave, funcao, prazo=None):
+        """
+        Executa funcao() uma vez por chave em voo. Retorna (resultado, coalescida).
+        Quem espera respeita o próprio prazo (levanta PrazoExpirado).
+        """
+        with self.lock:
+            voo = self.em_voo.get(chave)
+            lider = voo is None
+            if lider:
+                voo = {'pronto': threading.Event(), 'resultado': None, 'erro': None}
+                self.em_voo[chave] = voo
+        self._registrar(lider)
+        
+        if not lider:
+            if not voo['pronto'].wait(prazo.restante() if prazo else None):
+                raise PrazoExpirado()
+            if voo['erro'] is not None:
+                raise voo['erro']
+            return voo['resultado'], True
+        
+        try:
+            voo['resultado'] = funcao()
+            return voo['resultado'], False
+        except Exception as e:
+            voo['erro'] = e
+            raise
+        finally:
+            with self.lock:
+                del self.em_voo[chave]
+            voo['pronto'].set()
+    
+    async def executar_async(self, chave, criar_corrotina, prazo=None):
+        """Versão asyncio: a chamada vira uma task compartilhada (só mexida pelo event loop)"""
+        tarefa = self.em_voo_async.get(chave)
+        lider = tarefa is None
+        if lider:
+            tarefa = asyncio.ensure_future(criar_corrotina())
+            self.em_voo_async[chave] = tarefa
+            tarefa.add_done_callback(lambda _: self.em_voo_async.pop(chave, None))
+        self._registrar(lider)
+        
+        # shield: quem desiste (prazo, desconexão) não cancela a chamada dos outros
+        try:
+            resultado = await asyncio.wait_for(asyncio.shield(tarefa), prazo.restante() if prazo else None)
+        except asyncio.TimeoutError:
+            raise PrazoExpirado()
+        return resultado, not lider
+    
+    def estatisticas(self):
+        with self.lock:
+            total = self.lideres + self.coalescidas
+            return {
+                'em_voo': len(self.em_voo) + len(self.em_voo_async),
+                'chamadas_lider': self.lideres,
+                'coalescidas': self.coalescidas,
+                'taxa_coalescencia': round(self.coalescidas / total, 4) if total else 0.0
+            }
+
+VOO_UNICO = VooUnico()
+
+def chave_voo_unico(contexto):
+    """(plano, mensagem normalizada, hash do contexto); None = não coalescer (admin)"""
+    if contexto['visitante']:
+        return ('visitante', normalizar_mensagem_cache(contexto['mensagem']), '')
+    
+    tipo_usuario = contexto['tipo_usuario']
+    if contexto['tipo'] == 'admin':
+        return None
+    
+    historico = json.dumps(contexto.get('historico_memoria') or [], ensure_ascii=False, sort_keys=True)
+    return (
+        f"{contexto['tipo']}:{tipo_usuario.get('plano', '')}",
+        normalizar_mensagem_cache(contexto['mensagem']),
+        hashlib.sha1(historico.encode('utf-8')).hexdigest()
+    )
+
+def resultado_coalescido(resultado, nome_lider, nome):
+    """Cópia do resultado do líder para quem esperou: nome trocado e 0 tokens (cobrados uma vez)"""
+    copia = dict(resultado)
+    if nome_lider and nome and nome != nome_lider:
+        copia['resposta'] = re.sub(rf'\b{re.escape(nome_lider)}\b', lambda _: nome, copia['resposta'])
+    copia['tokens_usados'] = 0
+    copia['tokens_entrada'] = 0
+    copia['tokens_saida'] = 0
+    copia['tokens_cache'] = 0
+    copia['coalescido'] = True
+    return copia
+
+# =============================================================================
+# 📨 ENDPOINT PRINCIPAL - /api/chat (CORRIGIDO)
+# =============================================================================
+
+def autenticar_token_chat(token):
+    """
+    Busca usuário e conta no Supabase a partir do token.
+    Retorna (user_info, user_data, None, None) ou (None, None, payload_erro, status).
+    """
+    user_info = verificar_token_supabase(token)
+    if not user_info:
+        print("❌ Token inválido")
+        return None, None, {'error': 'Token inválido'}, 401
+    
+    user_data = obter_dados_usuario_completos(user_info.id)
+    if not user_data:
+        print("❌ Usuário não encontrado no banco")
+        return None, None, {'error': 'Usuário não encontrado'}, 404
+    
+    return user_info, user_data, None, None
+
+def preparar_requisicao_chat(data, token, autenticacao=None, ip=None):
+    """
+    Etapa comum a /api/chat e /api/chat/stream: valida a mensagem, identifica o
+    usuário (visitante anônimo ou autenticado) e verifica os limites.
+    `autenticacao` permite passar o resultado de autenticar_token_chat já obtido
+    (modo assíncrono); sem ele a autenticação por token é feita aqui.
+    `ip` (cliente) alimenta o limite de rajada dos visitantes.
+    Retorna (contexto, None, None) quando a mensagem deve ir para a IA, ou
+    (None, payload, status) quando a requisição já tem resposta pronta.
+    """
+    inicio = time.monotonic()  # ⏱️ o prazo (SLO) conta desde a chegada da requisição
+    mensagem = data.get('message', '').strip()
+    browser_id = data.get('browser_id')  # 🆕 ID único do navegador
+    
+    print("\n" + "="*80)
+    print("📨 NOVA REQUISIÇÃO /api/chat")
+    print("="*80)
+    print(f"📝 Mensagem: {mensagem[:50]}...")
+    print(f"🔐 Token presente: {bool(token)}")
+    print(f"🌐 Browser ID presente: {bool(browser_id)}")
+    print(f"📦 Body completo: {data}")
+    
+    if not mensagem:
+        print("❌ Mensagem vazia")
+        return None, {'error': 'Mensagem vazia'}, 400
+    
+    tokens_mensagem = contar_tokens(mensagem)
+    if tokens_mensagem > MAX_TOKENS_MENSAGEM:
+        print(f"❌ Mensagem muito longa: ~{tokens_mensagem} tokens (máx {MAX_TOKENS_MENSAGEM})")
+        return None, {
+            'error': 'Mensagem muito longa',
+            'tokens_mensagem': tokens_mensagem,
+            'max_tokens_mensagem': MAX_TOKENS_MENSAGEM
+        }, 413
+    
+    # =================================================================
+    # 🌐 VISITANTE ANÔNIMO (SEM TOKEN, COM BROWSER_ID)
+    # =================================================================
+    if browser_id and not token:
+        print("🌐 Processando como VISITANTE ANÔNIMO")
+        
+        # 🚦 Rajada por IP antes de qualquer estado do visitante (ids aleatórios não passam daqui)
+        espera = RAJADA_IP.permitir(ip or 'desconhecido')
+        if espera:
+            print(f"🚦 Rajada do IP {ip}: tente em {espera:.1f}s")
+            return None, {
+                'error': 'Muitas requisições. Aguarde alguns segundos.',
+                'tentar_novamente_em': math.ceil(espera)
+            }, 429
+        
+        # Verifica limite de 50 mensagens/24h
+        pode_enviar, msgs_usadas, limite, tempo_restante = verificar_limite_visitante(browser_id)
+        
+        # 🎟️ Reserva a mensagem antes da chamada: paralelas não passam do limite
+        # (visitante do transbordo não tem contador exato: vale só o sketch)
+        reserva, em_andamento = None, 0
+        if pode_enviar and visitante_exato(browser_id):
+            reserva, msgs_usadas, em_andamento = MOTOR_COTAS.reservar('visitantes', browser_id, limite)
+            pode_enviar = reserva is not None
+        
+        print(f"📊 Visitante: {msgs_usadas}/{limite} mensagens, {em_andamento} em andamento (Renova em: {tempo_restante})")
+        
+        if not pode_enviar:
+            print("🚫 Visitante atingiu limite de 50 mensagens")
+            mensagem_limite = gerar_mensagem_limite_visitante(msgs_usadas, limite, tempo_restante)
+            
+            return None, {
+                'response': mensagem_limite,
+                'user_name': 'Visitante',
+                'user_type': 'Visitante Anônimo',
+                'plan': 'Teste Gratuito (50 msgs/24h)',
+                'modelo_usado': 'Sistema de Limite',
+                'limite_atingido': True,
+                'mensagens_usadas': msgs_usadas,
+                'limite_total': limite,
+                'mensagens_restantes': 0,
+                'tempo_para_renovar': tempo_restante,
+                'tokens_usados': 0,
+                'categoria': 'limite_visitante'
+            }, 200
+        
+        return {
+            'visitante': True,
+            'mensagem': mensagem,
+            'browser_id': browser_id,
+            'reserva': reserva,
+            'prazo': criar_prazo('visitante', inicio)
+        }, None, None
+    
+    # =================================================================
+    # 👤 USUÁRIOS AUTENTICADOS (COMPORTAMENTO NORMAL)
+    # =================================================================
+    
+    # 🆕 NOVA LÓGICA: Aceita user_data do body OU busca via token
+    user_data_from_body = data.get('user_data')
+    
+    if user_data_from_body:
+        # Frontend enviou user_data completo no body
+        print("✅ Usando user_data do body")
+        user_info = type('obj', (object,), {
+            'id': user_data_from_body.get('user_id'),
+            'email': user_data_from_body.get('email'),
+            'user_metadata': {'name': user_data_from_body.get('name', 'Cliente')}
+        })()
+        
+        user_data = {
+            'user_id': user_data_from_body.get('user_id'),
+            'email': user_data_from_body.get('email'),
+            'plan': user_data_from_body.get('plan', 'starter'),
+            'plan_type': user_data_from_body.get('plan_type', 'paid'),
+            'user_name': user_data_from_body.get('name'),
+            'name': user_data_from_body.get('name')
+        }
+        
+    else:
+        # Fallback: buscar via token (comportamento antigo)
+        print("🔐 Buscando via token Supabase")
+        
+        # 🚨 CORREÇÃO: Se NÃO tem token e NÃO tem browser_id, retorna erro
+        if not token:
+            print("❌ Sem token e sem browser_id")
+            return None, {'error': 'Não autenticado. Envie browser_id ou token.'}, 401
+        
+        if autenticacao is None:
+            autenticacao = autenticar_token_chat(token)
+        
+        user_info, user_data, payload_erro, status = autenticacao
+        if payload_erro:
+            return None, payload_erro, status
+    
+    print(f"✅ User ID: {user_data.get('user_id', 'N/A')[:8]}...")
+    print(f"✅ Email: {user_data.get('email', 'N/A')}")
+    print(f"✅ Plan: {user_data.get('plan', 'N/A')}")
+    print(f"✅ Plan Type: {user_data.get('plan_type', 'N/A')}")
+    
+    # 👤 Dados do usuário
+    tipo_usuario = determinar_tipo_usuario(user_data, user_info)
+    user_id = obter_user_id(user_info, user_data)
+    tipo = tipo_usuario['tipo']
+    nome = tipo_usuario['nome_real']
+    
+    print(f"👤 Tipo: {tipo} | Nome: {nome}")
+    
+    # 📊 Verifica limite de mensagens
+    pode_enviar, msgs_usadas, limite, msgs_restantes = verificar_limite_mensagens(user_id, tipo)
+    
+    # 🎟️ Reserva a mensagem antes da chamada (admin é ilimitado: sem reserva)
+    reserva = None
+    if pode_enviar and limite != float('inf'):
+        reserva, msgs_usadas, em_andamento = MOTOR_COTAS.reservar('mensagens', user_id, limite, renovacao_janela(tipo))
+        pode_enviar = reserva is not None
+        print(f"🎟️ Cota: {msgs_usadas} usadas + {em_andamento} em andamento / {limite}")
+    
+    print(f"📊 Mensagens: {msgs_usadas}/{limite} (Restantes: {msgs_restantes})")
+    
+    if not pode_enviar:
+        print("🚫 Limite de mensagens atingido")
+        resposta_alt = gerar_resposta_alternativa_inteligente(mensagem, tipo_usuario)
+        
+        return None, {
+            'response': resposta_alt,
+            'user_name': nome,
+            'user_type': tipo_usuario['nome_display'],
+            'plan': tipo_usuario['plano'],
+            'modelo_usado': 'Sistema Alternativo (sem IA)',
+            'limite_atingido': True,
+            'mensagens_usadas': msgs_usadas,
+            'limite_total': limite,
+            'mensagens_restantes': 0,
+            'tempo_para_renovar': tempo_para_renovar_mensagens(tipo),
+            'tokens_usados': 0,
+            'categoria': 'alternativa'
+        }, 200
+    
+    return {
+        'visitante': False,
+        'mensagem': mensagem,
+        'tipo_usuario': tipo_usuario,
+        'user_id': user_id,
+        'tipo': tipo,
+        'nome': nome,
+        'reserva': reserva,
+        'prazo': criar_prazo(tipo, inicio)
+    }, None, None
+
+def carregar_memoria_chat(contexto):
+    """🧠 Salva a mensagem do usuário na memória e carrega o histórico para o contexto"""
+    if contexto['visitante']:
+        return
+    
+    contexto['historico_memoria'] = registrar_pergunta_memoria(contexto['user_id'], contexto['mensagem'])
+    
+    print(f"🧠 Histórico: {len(contexto['historico_memoria'])} mensagens em contexto")
+
+def processar_mensagem_chat(contexto):
+    """🤖 Processa com OpenAI; pedidos iguais simultâneos dividem a mesma chamada (single-flight)"""
+    if contexto['visitante']:
+        print("🤖 Processando com GPT-4O-MINI (visitante)...")
+        processar = lambda: processar_mensagem_visitante_anonimo(contexto['mensagem'], contexto['prazo'])
+        tipo_usuario = TIPO_USUARIO_VISITANTE
+    else:
+        print("🤖 Processando com OpenAI...")
+        tipo_usuario = contexto['tipo_usuario']
+        processar = lambda: dict(processar_mensagem_openai(
+            contexto['mensagem'], tipo_usuario, contexto['historico_memoria'], contexto['prazo']
+        ), nome_lider=tipo_usuario.get('nome_real', 'Cliente'))
+    
+    chave = chave_voo_unico(contexto)
+    if chave is None:
+        return processar()
+    
+    try:
+        resultado, coalescida = VOO_UNICO.executar(chave, processar, contexto['prazo'])
+    except PrazoExpirado:
+        return resultado_prazo_alternativo(contexto['mensagem'], tipo_usuario)
+    
+    if coalescida:
+        print("🛫 Single-flight: resposta dividida com uma chamada idêntica em andamento")
+        return resultado_coalescido(resultado, resultado.get('nome_lider'), tipo_usuario.get('nome_real'))
+    return resultado
+
+def finalizar_requisicao_chat(contexto, resultado):
+    """
+    Etapa final comum a /api/chat e /api/chat/stream: valida a resposta, salva na
+    memória, registra contadores (uma única vez por mensagem) e monta o payload.
+    """
+    resposta = resultado['resposta']
+    tokens_usados = resultado['tokens_usados']
+    modelo_usado = resultado['modelo_usado']
+    
+    print(f"✅ Resposta gerada: {len(resposta)} caracteres")
+    print(f"📊 Tokens usados: {tokens_usados}")
+    print(f"🤖 Modelo: {modelo_usado}")
+    
+    # 🎟️ Erro da IA não consome cota: a reserva volta
+    falhou = 'erro' in resultado
+    if falhou:
+        MOTOR_COTAS.liberar(contexto.get('reserva'))
+    
+    if contexto['visitante']:
+        browser_id = contexto['browser_id']
+        
+        # Incrementa contador do visitante (confirma a reserva)
+        if not falhou:
+            incrementar_contador_visitante(browser_id, resultado.get('coalescido', False), contexto.get('reserva'))
+        
+        # Atualiza para próxima verificação
+        pode_enviar_prox, msgs_usadas_prox, limite_prox, tempo_restante_prox = verificar_limite_visitante(browser_id)
+        
+        print("✅ Resposta enviada com sucesso (visitante)")
+        print("="*80 + "\n")
+        
+        return {
+            'response': resposta,
+            'user_name': 'Visitante',
+            'user_type': 'Visitante Anônimo',
+            'plan': 'Teste Gratuito (50 msgs/24h)',
+            'modelo_usado': modelo_usado,
+            'tokens_usados': tokens_usados,
+            'categoria': resultado.get('categoria', 'geral'),
+            'mensagens_usadas': msgs_usadas_prox,
+            'limite_total': limite_prox,
+            'mensagens_restantes': limite_prox - msgs_usadas_prox,
+            'tempo_para_renovar': tempo_restante_prox,
+            'limite_atingido': False,
+            'timestamp': datetime.now().isoformat(),
+            'tipo_usuario': 'visitante_anonimo'
+        }
+    
+    user_id = contexto['user_id']
+    tipo = contexto['tipo']
+    nome = contexto['nome']
+    tipo_usuario = contexto['tipo_usuario']
+    
+    # 🛡️ Validação anti-alucinação
+    valido, problemas = validar_resposta(resposta, tipo)
+    if valido and resultado.get('bloqueada'):
+        # Geração interrompida no stream (o trecho proibido pode ter sido cortado na limpeza)
+        valido, problemas = False, resultado['bloqueada']
+    if not valido:
+        print(f"⚠️ Resposta inválida: {problemas}")
+        resposta = f"Desculpe {nome}, detectei informações imprecisas na minha resposta. Por favor, entre em contato: WhatsApp (21) 99282-6074"
+    
+    # 💾 Salva na memória e registra contadores e tokens (confirma a reserva)
+    total_mensagens = registrar_resposta_usuario(
+        user_id, tipo, resposta, resultado, contexto.get('reserva'), contar=not falhou
+    )
+    
+    # 📊 Atualiza para próxima verificação
+    pode_enviar_prox, msgs_usadas_prox, limite_prox, msgs_restantes_prox = situacao_limite_mensagens(tipo, total_mensagens)
+    
+    print("✅ Resposta enviada com sucesso")
+    print("="*80 + "\n")
+    
+    # 📤 Resposta final
+    return {
+        'response': resposta,
+        'user_name': nome,
+        'user_type': tipo_usuario['nome_display'],
+        'plan': tipo_usuario['plano'],
+        'modelo_usado': modelo_usado,
+        'tokens_usados': tokens_usados,
+        'categoria': resultado.get('categoria', 'geral'),
+        'tipo_processamento': resultado.get('sistema_hibrido', 'N/A'),
+        'web_search_sugerido': resultado.get('web_search_sugerido', False),
+        'mensagens_usadas': msgs_usadas_prox,
+        'limite_total': limite_prox if limite_prox != float('inf') else 'ilimitado',
+        'mensagens_restantes': msgs_restantes_prox if msgs_restantes_prox != float('inf') else 'ilimitado',
+        'tempo_para_renovar': tempo_para_renovar_mensagens(tipo) if limite_prox != float('inf') else None,
+        'limite_atingido': False,
+        'timestamp': datetime.now().isoformat()
+    }
+
+def registrar_etapa(etapas, nome, marca):
+    """Guarda a duração (ms) da etapa desde `marca` e retorna a nova marca"""
+    agora = time.monotonic()
+    etapas[nome] = round((agora - marca) * 1000, 1)
+    return agora
+
+def cabecalho_server_timing(etapas):
+    """Header Server-Timing: tempo de cada etapa do /api/chat (lido pelo teste de carga)"""
+    return ', '.join(f'{nome};dur={duracao}' for nome, duracao in etapas.items())
+
+def imprimir_erro_chat(e):
+    print("="*80)
+    print("❌ ERRO NO ENDPOINT /api/chat")
+    print("="*80)
+    print(f"Tipo: {type(e).__name__}")
+    print(f"Mensagem: {str(e)}")
+    print(f"Stack trace:")
+    import traceback
+    traceback.print_exc()
+    print("="*80 + "\n")
+
+def ip_requisicao_flask():
+    return ip_da_requisicao(request.headers.get('X-Forwarded-For'), request.remote_addr)
+
+def liberar_reserva_chat(contexto):
+    """Devolve a cota reservada se a requisição não chegou a ser contada (erro/desconexão)"""
+    if contexto is not None:
+        MOTOR_COTAS.liberar(contexto.get('reserva'))
+
+@app.route('/api/chat', methods=['POST'])
+def chat():
+    contexto = None
+    try:
+        data = request.get_json()
+        token = request.headers.get('Authorization', '')
+        
+        # 📡 Modo streaming opcional no mesmo endpoint
+        if data.get('stream'):
+            return responder_chat_stream(data, token)
+        
+        etapas = {}
+        marca = time.monotonic()
+        contexto, payload, status = preparar_requisicao_chat(data, token, ip=ip_requisicao_flask())
+        marca = registrar_etapa(etapas, 'preparo', marca)
+        if contexto is None:
+            return jsonify(payload), status, {'Server-Timing': cabecalho_server_timing(etapas)}
+        
+        carregar_memoria_chat(contexto)
+        marca = registrar_etapa(etapas, 'memoria', marca)
+        resultado = processar_mensagem_chat(contexto)
+        marca = registrar_etapa(etapas, 'ia', marca)
+        payload = finalizar_requisicao_chat(contexto, resultado)
+        registrar_etapa(etapas, 'finalizacao', marca)
+        
+        return jsonify(payload), 200, {'Server-Timing': cabecalho_server_timing(etapas)}
+    
+    except Exception as e:
+        imprimir_erro_chat(e)
+        
+        return jsonify({
+            'error': 'Erro interno do servidor',
+            'details': str(e)
+        }), 500
+    
+    finally:
+        liberar_reserva_chat(contexto)
+
+# =============================================================================
+# 📡 STREAMING (SERVER-SENT EVENTS) - /api/chat/stream
+# =============================================================================
+
+def formatar_evento_sse(evento, dados):
+    """Serializa um evento no formato Server-Sent Events"""
+    return f"event: {evento}\ndata: {json.dumps(dados, ensure_ascii=False)}\n\n"
+
+def gerar_eventos_chat(contexto):
+    """
+    Gera os eventos SSE de uma mensagem:
+    - 'delta': {'texto': ...} a cada trecho de resposta já limpo de markdown
+    - 'fim': mesmo payload de /api/chat (contadores e metadados), enviado uma vez
+    - 'erro': falha inesperada (nenhum contador é atualizado)
+    O campo 'response' do evento 'fim' é a resposta definitiva; se a validação
+    anti-alucinação substituir o texto, 'resposta_substituida' vem True.
+    """
+    try:
+        if contexto['visitante']:
+            print("🤖 Processando com GPT-4O-MINI (visitante, stream)...")
+            eventos = processar_mensagem_visitante_anonimo_stream(contexto['mensagem'], contexto['prazo'])
+        else:
+            print("🤖 Processando com OpenAI (stream)...")
+            eventos = processar_mensagem_openai_stream(
+                contexto['mensagem'], contexto['tipo_usuario'], contexto['historico_memoria'], contexto['prazo']
+            )
+        
+        for tipo_evento, dados in eventos:
+            if tipo_evento == 'delta':
+                yield formatar_evento_sse('delta', {'texto': dados})
+                continue
+            
+            payload = finalizar_requisicao_chat(contexto, dados)
+            payload['resposta_substituida'] = payload['response'] != dados['resposta']
+            yield formatar_evento_sse('fim', payload)
+    
+    except Exception as e:
+        imprimir_erro_chat(e)
+        yield formatar_evento_sse('erro', {
+            'error': 'Erro interno do servidor',
+            'details': str(e)
+        })
+    
+    finally:
+        # Cliente desconectou (GeneratorExit) ou falhou antes do 'fim': a cota volta
+        liberar_reserva_chat(contexto)
 
-Você está conversando com: Natan (ADMIN - Criador da Plataforma)"""
+def responder_chat_stream(data, token):
+    """Resposta SSE para /api/chat/stream (ou /api/chat com "stream": true)"""
+    contexto, payload, status = preparar_requisicao_chat(data, token, ip=ip_requisicao_flask())
+    
+    if contexto is None:
+        # Erros continuam como JSON; respostas prontas (limite) viram um único evento 'fim'
+        if status != 200:
+            return jsonify(payload), status
+        return Response(
+            formatar_evento_sse('fim', payload),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache'}
+        )
+    
+    try:
+        carregar_memoria_chat(contexto)
+    except Exception:
+        liberar_reserva_chat(contexto)
+        raise
+    
+    return Response(
+        stream_with_context(gerar_eventos_chat(contexto)),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # evita buffer de proxies (Render/nginx)
+        }
+    )
 
-            messages = [{"role": "system", "content": system_prompt}]
-            messages.extend(historico_memoria[-10:])
-            messages.append({"role": "user", "content": mensagem})
-            
-            response = client.chat.completions.create(
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream():
+    try:
+        data = request.get_json()
+        token = request.headers.get('Authorization', '')
+        return responder_chat_stream(data, token)
+    
+    except Exception as e:
+        imprimir_erro_chat(e)
+        
+        return jsonify({
+            'error': 'Erro interno do servidor',
+            'details': str(e)
+        }), 500
+    
+# =============================================================================
+# ⚡ MODO ASSÍNCRONO (ASGI) - AsyncOpenAI + CONCORRÊNCIA LIMITADA POR MODELO
+# =============================================================================
+# Com MODO_SERVIDOR=asgi (ou `uvicorn main:asgi_app`) o POST /api/chat roda como
+# corrotina: as chamadas OpenAI e Supabase não prendem uma thread cada, então um
+# processo sustenta centenas de conversas simultâneas. As demais rotas (e o modo
+# streaming) continuam sendo servidas pelo Flask via WsgiToAsgi.
+
+# Chamadas simultâneas permitidas por modelo (o excedente espera na fila)
+LIMITES_CONCORRENCIA_MODELOS = {
+    'gpt-4o-mini': int(os.getenv('CONCORRENCIA_GPT4O_MINI', '256')),
+    'gpt-4o': int(os.getenv('CONCORRENCIA_GPT4O', '64'))
+}
+CONCORRENCIA_PADRAO = int(os.getenv('CONCORRENCIA_PADRAO', '64'))
+
+SEMAFOROS_MODELOS = {}
+supabase_async = None
+
+def semaforo_modelo(modelo):
+    """Semáforo do modelo (criado sob demanda dentro do event loop)"""
+    semaforo = SEMAFOROS_MODELOS.get(modelo)
+    if semaforo is None:
+        semaforo = asyncio.Semaphore(LIMITES_CONCORRENCIA_MODELOS.get(modelo, CONCORRENCIA_PADRAO))
+        SEMAFOROS_MODELOS[modelo] = semaforo
+    return semaforo
+
+async def criar_completion_async(modelo, messages, max_tokens, temperature=0.7, prazo=None):
+    """Chamada OpenAI assíncrona; com `prazo`, a espera na fila do semáforo também conta"""
+    timeout_prazo(prazo)  # levanta PrazoExpirado se já não há tempo
+    
+    async def chamar():
+        # Uma tentativa por vez no semáforo: a espera do backoff não segura vaga
+        async with semaforo_modelo(modelo):
+            return await async_client.chat.completions.create(
                 model=modelo,
                 messages=messages,
                 max_tokens=max_tokens,
-                temperature=0.7
+                temperature=temperature,
+                timeout=timeout_prazo(prazo)
             )
-            
-            resposta = response.choices[0].message.content.strip()
-            resposta = limpar_formatacao_markdown(resposta)
-            
-            # ✅ CORREÇÃO: Removida a verificação de precisa_search (variável indefinida)
-            # A detecção de necessidade de web search foi removida pois não está implementada
-            
-            return {
-                'resposta': resposta,
-                'tokens_usados': response.usage.total_tokens,
-                'tokens_entrada': response.usage.prompt_tokens,
-                'tokens_saida': response.usage.completion_tokens,
-                'modelo_usado': modelo,
-                'cached': False,
-                'categoria': categoria
-            }
+    
+    if prazo is None:
+        return await executar_com_disjuntor_async(modelo, chamar)
+    
+    try:
+        return await asyncio.wait_for(executar_com_disjuntor_async(modelo, chamar, prazo), prazo.restante())
+    except (asyncio.TimeoutError, APITimeoutError):
+        raise PrazoExpirado(modelo)
+
+async def obter_supabase_async():
+    """Cliente Supabase assíncrono, criado na primeira utilização"""
+    global supabase_async, TRANSPORTE_SUPABASE_ASYNC
+    if supabase_async is None and SUPABASE_URL and SUPABASE_KEY:
+        try:
+            if TRANSPORTE_SUPABASE_ASYNC is None:
+                TRANSPORTE_SUPABASE_ASYNC = criar_transporte_supabase(httpx.AsyncHTTPTransport)
+            supabase_async = await ClienteSupabaseAsync.create(SUPABASE_URL, SUPABASE_KEY)
+        except Exception as e:
+            print(f"⚠️ Erro Supabase (async): {e}")
+    return supabase_async
+
+async def verificar_token_supabase_async(token):
+    token = limpar_token(token)
+    if not token:
+        return None
+    
+    chave, usuario = consultar_token_local(token)
+    if usuario is None:
+        try:
+            cliente = await obter_supabase_async()
+            if not cliente:
+                return None
+            response = await cliente.auth.get_user(token)
+            usuario = response.user if response and response.user else TOKEN_INVALIDO
+        except Exception as e:
+            if getattr(e, 'status', None) not in (401, 403):
+                return None
+            usuario = TOKEN_INVALIDO
+        guardar_token_cache(chave, token, usuario)
+    
+    return usuario or None
+
+async def buscar_contas_async(user_ids, projecao='plano'):
+    contas, faltando = contas_em_cache(user_ids, projecao)
+    cliente = await obter_supabase_async() if faltando else None
+    if not cliente:
+        return contas
+    
+    lote = CONTAS_CONFIG['lote_in']
+    for i in range(0, len(faltando), lote):
+        ids = faltando[i:i + lote]
+        try:
+            resposta = await cliente.table('user_accounts').select(colunas_projecao(projecao)).in_('user_id', ids).execute()
+        except APIError as e:
+            if not projecao_recusada(e, projecao):
+                raise
+            resposta = await cliente.table('user_accounts').select('*').in_('user_id', ids).execute()
+        guardar_contas(contas, resposta.data or [], projecao)
+    return contas
+
+async def obter_dados_usuario_completos_async(user_id, projecao='plano'):
+    try:
+        return (await buscar_contas_async([user_id], projecao)).get(user_id)
+    except:
+        return None
+
+async def autenticar_token_chat_async(token):
+    user_info = await verificar_token_supabase_async(token)
+    if not user_info:
+        print("❌ Token inválido")
+        return None, None, {'error': 'Token inválido'}, 401
+    
+    user_data = await obter_dados_usuario_completos_async(user_info.id)
+    if not user_data:
+        print("❌ Usuário não encontrado no banco")
+        return None, None, {'error': 'Usuário não encontrado'}, 404
+    
+    return user_info, user_data, None, None
+
+async def carregar_memoria_chat_async(contexto):
+    if contexto['visitante']:
+        return
+    
+    contexto['historico_memoria'] = await asyncio.to_thread(
+        registrar_pergunta_memoria, contexto['user_id'], contexto['mensagem']
+    )
+    
+    print(f"🧠 Histórico: {len(contexto['historico_memoria'])} mensagens em contexto")
+
+async def processar_mensagem_chat_async(contexto):
+    """Versão assíncrona de processar_mensagem_chat (single-flight entre corrotinas)"""
+    if contexto['visitante']:
+        print("🤖 Processando com GPT-4O-MINI (visitante, async)...")
+        processar = lambda: processar_mensagem_visitante_anonimo_async(contexto['mensagem'], contexto['prazo'])
+        tipo_usuario = TIPO_USUARIO_VISITANTE
+    else:
+        print("🤖 Processando com OpenAI (async)...")
+        tipo_usuario = contexto['tipo_usuario']
         
-        # Fallback
-        else:
-            return {
-                'resposta': "Tipo de usuário não reconhecido. Entre em contato: (21) 99282-6074",
-                'tokens_usados': 0,
-                'modelo_usado': 'N/A',
-                'cached': False
-            }
+        async def processar():
+            resultado = await processar_mensagem_openai_async(
+                contexto['mensagem'], tipo_usuario, contexto['historico_memoria'], contexto['prazo']
+            )
+            return dict(resultado, nome_lider=tipo_usuario.get('nome_real', 'Cliente'))
+    
+    chave = chave_voo_unico(contexto)
+    if chave is None:
+        return await processar()
+    
+    try:
+        resultado, coalescida = await VOO_UNICO.executar_async(chave, processar, contexto['prazo'])
+    except PrazoExpirado:
+        return resultado_prazo_alternativo(contexto['mensagem'], tipo_usuario)
+    
+    if coalescida:
+        print("🛫 Single-flight: resposta dividida com uma chamada idêntica em andamento")
+        return resultado_coalescido(resultado, resultado.get('nome_lider'), tipo_usuario.get('nome_real'))
+    return resultado
+
+async def buscar_resposta_cache_async(chave, nome=None):
+    # Backend de embedding remoto faz I/O bloqueante: roda fora do event loop
+    if CACHE_SEMANTICO is not None and CACHE_SEMANTICO.backend.nome != 'local':
+        return await asyncio.to_thread(buscar_resposta_cache, chave, nome)
+    return buscar_resposta_cache(chave, nome)
+
+async def guardar_resposta_cache_async(chave, resultado, nome=None):
+    if CACHE_SEMANTICO is not None and CACHE_SEMANTICO.backend.nome != 'local':
+        await asyncio.to_thread(guardar_resposta_cache, chave, resultado, nome)
+    else:
+        guardar_resposta_cache(chave, resultado, nome)
+
+async def processar_mensagem_visitante_anonimo_async(mensagem, prazo=None):
+    """Versão assíncrona de processar_mensagem_visitante_anonimo"""
+    prazo = prazo or criar_prazo('visitante')
+    chave_cache = chave_cache_resposta(mensagem, 'visitante')
+    resultado_cache = await buscar_resposta_cache_async(chave_cache)
+    if resultado_cache:
+        return resultado_cache
+    
+    if not verificar_openai() or async_client is None:
+        return {
+            'resposta': "⚠️ Sistema de IA temporariamente indisponível. Tente novamente em alguns instantes.",
+            'tokens_usados': 0,
+            'modelo_usado': 'N/A',
+            'cached': False
+        }
+    
+    try:
+        chamada = preparar_chamada_visitante(mensagem)
+        response = await criar_completion_async(chamada['modelo'], chamada['messages'], chamada['max_tokens'], prazo=prazo)
+        
+        resposta = limpar_formatacao_markdown(response.choices[0].message.content.strip())
+        
+        resultado = {
+            'resposta': resposta,
+            'tokens_usados': response.usage.total_tokens,
+            'tokens_entrada': response.usage.prompt_tokens,
+            'tokens_saida': response.usage.completion_tokens,
+            'tokens_cache': tokens_em_cache(response.usage),
+            'modelo_usado': chamada['modelo_usado'],
+            'cached': False,
+            'categoria': chamada['categoria']
+        }
+        await guardar_resposta_cache_async(chave_cache, resultado)
+        return resultado
+    
+    except PrazoExpirado:
+        return resultado_prazo_alternativo(mensagem, TIPO_USUARIO_VISITANTE)
     
+    except ERROS_OPENAI_INDISPONIVEL:
+        return resultado_prazo_alternativo(mensagem, TIPO_USUARIO_VISITANTE, motivo='instavel')
+        
     except Exception as e:
-        print(f"❌ Erro no processamento OpenAI: {e}")
+        print(f"❌ Erro ao processar visitante: {e}")
         return {
-            'resposta': f"⚠️ Erro ao processar sua mensagem. Tente novamente ou contate o suporte: (21) 99282-6074",
+            'resposta': "⚠️ Erro ao processar sua mensagem. Tente novamente ou contate: (21) 99282-6074",
             'tokens_usados': 0,
             'modelo_usado': 'erro',
             'cached': False,
             'erro': str(e)
         }
 
-def verificar_openai():
-    try:
-        if not OPENAI_API_KEY or len(OPENAI_API_KEY) < 20:
-            return False
-        if client is None:
-            return False
-        return True
-    except:
-        return False
-
-# =============================================================================
-# 📨 ENDPOINT PRINCIPAL - /api/chat (CORRIGIDO)
-# =============================================================================
-
-@app.route('/api/chat', methods=['POST'])
-def chat():
+async def processar_mensagem_openai_async(mensagem, tipo_usuario, historico_memoria, prazo=None):
+    """Versão assíncrona de processar_mensagem_openai (mesmos prompts, sistema híbrido e prazo)"""
+    nome = tipo_usuario.get('nome_real', 'Cliente')
+    tipo = tipo_usuario.get('tipo', 'starter').lower()
+    prazo = prazo or criar_prazo(tipo)
+    chave_cache = chave_cache_resposta(mensagem, tipo, historico_memoria)
+    resultado_cache = await buscar_resposta_cache_async(chave_cache, nome)
+    if resultado_cache:
+        return resultado_cache
+    
+    if not verificar_openai() or async_client is None:
+        return {
+            'resposta': "⚠️ Sistema de IA temporariamente indisponível. Tente novamente em alguns instantes.",
+            'tokens_usados': 0,
+            'modelo_usado': 'N/A',
+            'cached': False
+        }
+    
     try:
-        data = request.get_json()
-        mensagem = data.get('message', '').strip()
-        token = request.headers.get('Authorization', '')
-        browser_id = data.get('browser_id')  # 🆕 ID único do navegador
-        
-        print("\n" + "="*80)
-        print("📨 NOVA REQUISIÇÃO /api/chat")
-        print("="*80)
-        print(f"📝 Mensagem: {mensagem[:50]}...")
-        print(f"🔐 Token presente: {bool(token)}")
-        print(f"🌐 Browser ID presente: {bool(browser_id)}")
-        print(f"📦 Body completo: {data}")
-        
-        if not mensagem:
-            print("❌ Mensagem vazia")
-            return jsonify({'error': 'Mensagem vazia'}), 400
-        
-        # =================================================================
-        # 🌐 VISITANTE ANÔNIMO (SEM TOKEN, COM BROWSER_ID)
-        # =================================================================
-        if browser_id and not token:
-            print("🌐 Processando como VISITANTE ANÔNIMO")
-            
-            # Verifica limite de 50 mensagens/24h
-            pode_enviar, msgs_usadas, limite, tempo_restante = verificar_limite_visitante(browser_id)
-            
-            print(f"📊 Visitante: {msgs_usadas}/{limite} mensagens (Renova em: {tempo_restante})")
-            
-            if not pode_enviar:
-                print("🚫 Visitante atingiu limite de 50 mensagens")
-                mensagem_limite = gerar_mensagem_limite_visitante(msgs_usadas, limite, tempo_restante)
-                
-                return jsonify({
-                    'response': mensagem_limite,
-                    'user_name': 'Visitante',
-                    'user_type': 'Visitante Anônimo',
-                    'plan': 'Teste Gratuito (50 msgs/24h)',
-                    'modelo_usado': 'Sistema de Limite',
-                    'limite_atingido': True,
-                    'mensagens_usadas': msgs_usadas,
-                    'limite_total': limite,
-                    'mensagens_restantes': 0,
-                    'tempo_para_renovar': tempo_restante,
-                    'tokens_usados': 0,
-                    'categoria': 'limite_visitante'
-                })
-            
-            # Processa mensagem do visitante
-            print("🤖 Processando com GPT-4O-MINI (visitante)...")
-            resultado = processar_mensagem_visitante_anonimo(mensagem)
-            
-            resposta = resultado['resposta']
-            tokens_usados = resultado['tokens_usados']
-            modelo_usado = resultado['modelo_usado']
-            
-            print(f"✅ Resposta gerada: {len(resposta)} caracteres")
-            print(f"📊 Tokens usados: {tokens_usados}")
-            print(f"🤖 Modelo: {modelo_usado}")
-            
-            # Incrementa contador do visitante
-            incrementar_contador_visitante(browser_id)
-            
-            # Atualiza para próxima verificação
-            pode_enviar_prox, msgs_usadas_prox, limite_prox, tempo_restante_prox = verificar_limite_visitante(browser_id)
-            
-            print("✅ Resposta enviada com sucesso (visitante)")
-            print("="*80 + "\n")
-            
-            return jsonify({
-                'response': resposta,
-                'user_name': 'Visitante',
-                'user_type': 'Visitante Anônimo',
-                'plan': 'Teste Gratuito (50 msgs/24h)',
-                'modelo_usado': modelo_usado,
-                'tokens_usados': tokens_usados,
-                'categoria': resultado.get('categoria', 'geral'),
-                'mensagens_usadas': msgs_usadas_prox,
-                'limite_total': limite_prox,
-                'mensagens_restantes': limite_prox - msgs_usadas_prox,
-                'tempo_para_renovar': tempo_restante_prox,
-                'limite_atingido': False,
-                'timestamp': datetime.now().isoformat(),
-                'tipo_usuario': 'visitante_anonimo'
-            })
+        chamada = rotear_refinamento(preparar_chamada_openai(mensagem, tipo_usuario, historico_memoria), mensagem)
         
-        # =================================================================
-        # 👤 USUÁRIOS AUTENTICADOS (COMPORTAMENTO NORMAL)
-        # =================================================================
-        
-        # 🆕 NOVA LÓGICA: Aceita user_data do body OU busca via token
-        user_data_from_body = data.get('user_data')
-        
-        if user_data_from_body:
-            # Frontend enviou user_data completo no body
-            print("✅ Usando user_data do body")
-            user_info = type('obj', (object,), {
-                'id': user_data_from_body.get('user_id'),
-                'email': user_data_from_body.get('email'),
-                'user_metadata': {'name': user_data_from_body.get('name', 'Cliente')}
-            })()
-            
-            user_data = {
-                'user_id': user_data_from_body.get('user_id'),
-                'email': user_data_from_body.get('email'),
-                'plan': user_data_from_body.get('plan', 'starter'),
-                'plan_type': user_data_from_body.get('plan_type', 'paid'),
-                'user_name': user_data_from_body.get('name'),
-                'name': user_data_from_body.get('name')
+        if chamada is None:
+            return {
+                'resposta': "Tipo de usuário não reconhecido. Entre em contato: (21) 99282-6074",
+                'tokens_usados': 0,
+                'modelo_usado': 'N/A',
+                'cached': False
             }
-            
-        else:
-            # Fallback: buscar via token (comportamento antigo)
-            print("🔐 Buscando via token Supabase")
-            
-            # 🚨 CORREÇÃO: Se NÃO tem token e NÃO tem browser_id, retorna erro
-            if not token:
-                print("❌ Sem token e sem browser_id")
-                return jsonify({'error': 'Não autenticado. Envie browser_id ou token.'}), 401
-            
-            user_info = verificar_token_supabase(token)
-            if not user_info:
-                print("❌ Token inválido")
-                return jsonify({'error': 'Token inválido'}), 401
-            
-            user_data = obter_dados_usuario_completos(user_info.id)
-            if not user_data:
-                print("❌ Usuário não encontrado no banco")
-                return jsonify({'error': 'Usuário não encontrado'}), 404
         
-        print(f"✅ User ID: {user_data.get('user_id', 'N/A')[:8]}...")
-        print(f"✅ Email: {user_data.get('email', 'N/A')}")
-        print(f"✅ Plan: {user_data.get('plan', 'N/A')}")
-        print(f"✅ Plan Type: {user_data.get('plan_type', 'N/A')}")
+        # Disjuntor do GPT-4O aberto: nem dispara a chamada paralela
+        if REFINAMENTO_ESPECULATIVO and chamada['hibrido'] and chamada['precisa_refinamento'] and refinamento_disponivel():
+            refinamento = preparar_refinamento_especulativo(chamada, mensagem)
+            vencedor, mini, gpt4o = await executar_hibrido_especulativo_async(chamada, refinamento, prazo)
+            resposta_final = limpar_formatacao_markdown(vencedor.texto())
+            resultado = montar_resultado_especulativo(chamada, refinamento, resposta_final, vencedor, mini, gpt4o)
+            if refinamento_perdido_no_prazo(chamada, vencedor, mini, gpt4o):
+                return resultado_prazo_mini(resultado)
+            if refinamento_perdido_por_falha(chamada, vencedor, mini, gpt4o):
+                return resultado_sem_refinamento(resultado, gpt4o.erro)
+            await guardar_resposta_cache_async(chave_cache, resultado, nome)
+            return resultado
         
-        # 👤 Dados do usuário
-        tipo_usuario = determinar_tipo_usuario(user_data, user_info)
-        user_id = obter_user_id(user_info, user_data)
-        tipo = tipo_usuario['tipo']
-        nome = tipo_usuario['nome_real']
-        
-        print(f"👤 Tipo: {tipo} | Nome: {nome}")
-        
-        # 📊 Verifica limite de mensagens
-        pode_enviar, msgs_usadas, limite, msgs_restantes = verificar_limite_mensagens(user_id, tipo)
-        
-        print(f"📊 Mensagens: {msgs_usadas}/{limite} (Restantes: {msgs_restantes})")
-        
-        if not pode_enviar:
-            print("🚫 Limite de mensagens atingido")
-            resposta_alt = gerar_resposta_alternativa_inteligente(mensagem, tipo_usuario)
-            
-            return jsonify({
-                'response': resposta_alt,
-                'user_name': nome,
-                'user_type': tipo_usuario['nome_display'],
-                'plan': tipo_usuario['plano'],
-                'modelo_usado': 'Sistema Alternativo (sem IA)',
-                'limite_atingido': True,
-                'mensagens_usadas': msgs_usadas,
-                'limite_total': limite,
-                'mensagens_restantes': 0,
-                'tokens_usados': 0,
-                'categoria': 'alternativa'
-            })
+        response = await criar_completion_async(chamada['modelo'], chamada['messages'], chamada['max_tokens'], prazo=prazo)
+        resposta_inicial = response.choices[0].message.content.strip()
         
-        # 🧠 Memória e contexto
-        inicializar_memoria_usuario(user_id)
-        adicionar_mensagem_memoria(user_id, 'user', mensagem)
-        historico_memoria = obter_contexto_memoria(user_id)
+        if not precisa_chamar_refinamento(chamada, resposta_inicial):
+            registrar_desfecho_roteador(chamada, resposta_inicial, extrair_uso(response))
+            resposta_final = limpar_formatacao_markdown(resposta_inicial)
+            resultado = montar_resultado_openai(chamada, resposta_final, extrair_uso(response))
+            await guardar_resposta_cache_async(chave_cache, resultado, nome)
+            return resultado
         
-        print(f"🧠 Histórico: {len(historico_memoria)} mensagens em contexto")
+        # Refinamento com GPT-4O
+        refinamento = preparar_refinamento(chamada, mensagem, resposta_inicial)
+        try:
+            response_refinamento = await criar_completion_async(
+                refinamento['modelo'], refinamento['messages'], refinamento['max_tokens'], prazo=prazo
+            )
+        except Exception as e:
+            resultado = montar_resultado_openai(chamada, limpar_formatacao_markdown(resposta_inicial), extrair_uso(response))
+            if isinstance(e, PrazoExpirado):
+                return resultado_prazo_mini(resultado)
+            return resultado_sem_refinamento(resultado, e)
         
-        # 🤖 Processa com OpenAI
-        print("🤖 Processando com OpenAI...")
-        resultado = processar_mensagem_openai(mensagem, tipo_usuario, historico_memoria)
-        
-        resposta = resultado['resposta']
-        tokens_usados = resultado['tokens_usados']
-        modelo_usado = resultado['modelo_usado']
-        
-        print(f"✅ Resposta gerada: {len(resposta)} caracteres")
-        print(f"📊 Tokens usados: {tokens_usados}")
-        print(f"🤖 Modelo: {modelo_usado}")
-        
-        # 🛡️ Validação anti-alucinação
-        valido, problemas = validar_resposta(resposta, tipo)
-        if not valido:
-            print(f"⚠️ Resposta inválida: {problemas}")
-            resposta = f"Desculpe {nome}, detectei informações imprecisas na minha resposta. Por favor, entre em contato: WhatsApp (21) 99282-6074"
-        
-        # 💾 Salva na memória
-        adicionar_mensagem_memoria(user_id, 'assistant', resposta)
-        
-        # 📊 Registra contadores
-        incrementar_contador(user_id, tipo)
-        registrar_tokens_usados(
-            user_id,
-            resultado.get('tokens_entrada', 0),
-            resultado.get('tokens_saida', 0),
-            tokens_usados,
-            modelo_usado
+        resposta_refinada = response_refinamento.choices[0].message.content.strip()
+        registrar_desfecho_roteador(chamada, resposta_inicial, extrair_uso(response), resposta_refinada)
+        resposta_final = limpar_formatacao_markdown(resposta_refinada)
+        resultado = montar_resultado_openai(
+            chamada, resposta_final, extrair_uso(response),
+            refinamento, extrair_uso(response_refinamento)
         )
+        await guardar_resposta_cache_async(chave_cache, resultado, nome)
+        return resultado
+    
+    except RespostaBloqueada as e:
+        return resultado_resposta_bloqueada(e, chamada['modelo_usado'], chamada['categoria'])
+    
+    except PrazoExpirado:
+        return resultado_prazo_alternativo(mensagem, tipo_usuario)
+    
+    except ERROS_OPENAI_INDISPONIVEL:
+        return resultado_prazo_alternativo(mensagem, tipo_usuario, motivo='instavel')
+    
+    except Exception as e:
+        print(f"❌ Erro no processamento OpenAI: {e}")
+        return {
+            'resposta': f"⚠️ Erro ao processar sua mensagem. Tente novamente ou contate o suporte: (21) 99282-6074",
+            'tokens_usados': 0,
+            'modelo_usado': 'erro',
+            'cached': False,
+            'erro': str(e)
+        }
+
+async def chat_async(data, token, etapas=None, ip=None):
+    """
+    Versão assíncrona de chat(). Retorna (status, payload).
+    `etapas` (dict opcional) recebe os tempos de cada etapa, como no Server-Timing.
+    """
+    etapas = {} if etapas is None else etapas
+    contexto = None
+    try:
+        marca = time.monotonic()
+        autenticacao = None
+        if token and not data.get('user_data') and data.get('message', '').strip():
+            autenticacao = await autenticar_token_chat_async(token)
         
-        # 📊 Atualiza para próxima verificação
-        pode_enviar_prox, msgs_usadas_prox, limite_prox, msgs_restantes_prox = verificar_limite_mensagens(user_id, tipo)
+        # Preparo e finalização leem/gravam a cota no backend de estado (I/O
+        # bloqueante): rodam numa thread para não travar o event loop
+        contexto, payload, status = await asyncio.to_thread(preparar_requisicao_chat, data, token, autenticacao, ip)
+        marca = registrar_etapa(etapas, 'preparo', marca)
+        if contexto is None:
+            return status, payload
         
-        print("✅ Resposta enviada com sucesso")
-        print("="*80 + "\n")
+        await carregar_memoria_chat_async(contexto)
+        marca = registrar_etapa(etapas, 'memoria', marca)
+        resultado = await processar_mensagem_chat_async(contexto)
+        marca = registrar_etapa(etapas, 'ia', marca)
+        payload = await asyncio.to_thread(finalizar_requisicao_chat, contexto, resultado)
+        registrar_etapa(etapas, 'finalizacao', marca)
         
-        # 📤 Resposta final
-        return jsonify({
-            'response': resposta,
-            'user_name': nome,
-            'user_type': tipo_usuario['nome_display'],
-            'plan': tipo_usuario['plano'],
-            'modelo_usado': modelo_usado,
-            'tokens_usados': tokens_usados,
-            'categoria': resultado.get('categoria', 'geral'),
-            'tipo_processamento': resultado.get('sistema_hibrido', 'N/A'),
-            'web_search_sugerido': resultado.get('web_search_sugerido', False),
-            'mensagens_usadas': msgs_usadas_prox,
-            'limite_total': limite_prox if limite_prox != float('inf') else 'ilimitado',
-            'mensagens_restantes': msgs_restantes_prox if msgs_restantes_prox != float('inf') else 'ilimitado',
-            'limite_atingido': False,
-            'timestamp': datetime.now().isoformat()
-        })
+        return 200, payload
     
     except Exception as e:
-        print("="*80)
-        print("❌ ERRO NO ENDPOINT /api/chat")
-        print("="*80)
-        print(f"Tipo: {type(e).__name__}")
-        print(f"Mensagem: {str(e)}")
-        print(f"Stack trace:")
-        import traceback
-        traceback.print_exc()
-        print("="*80 + "\n")
-        
-        return jsonify({
+        imprimir_erro_chat(e)
+        return 500, {
             'error': 'Erro interno do servidor',
             'details': str(e)
-        }), 500
+        }
+    
+    finally:
+        if contexto is not None:
+            await asyncio.to_thread(liberar_reserva_chat, contexto)
+
+async def ler_corpo_asgi(receive):
+    corpo = b''
+    while True:
+        mensagem = await receive()
+        corpo += mensagem.get('body', b'')
+        if not mensagem.get('more_body'):
+            return corpo
+
+async def enviar_json_asgi(send, status, payload, etapas=None):
+    corpo = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    cabecalhos = [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(corpo)).encode()),
+        (b'access-control-allow-origin', b'*')  # mesmo comportamento do CORS(app)
+    ]
+    if etapas:
+        cabecalhos.append((b'server-timing', cabecalho_server_timing(etapas).encode()))
+    
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': cabecalhos
+    })
+    await send({'type': 'http.response.body', 'body': corpo})
+
+flask_asgi = WsgiToAsgi(app) if WsgiToAsgi else None
+
+async def asgi_app(scope, receive, send):
+    """
+    Aplicação ASGI: POST /api/chat (sem streaming) roda em corrotina; todo o
+    resto é repassado ao Flask. Uso: uvicorn main:asgi_app
+    """
+    if scope['type'] == 'lifespan':
+        while True:
+            mensagem = await receive()
+            if mensagem['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif mensagem['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    
+    if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/api/chat':
+        corpo = await ler_corpo_asgi(receive)
+        try:
+            data = json.loads(corpo or b'{}')
+        except ValueError:
+            await enviar_json_asgi(send, 400, {'error': 'JSON inválido'})
+            return
+        
+        if not data.get('stream'):
+            cabecalhos = dict(scope['headers'])
+            token = cabecalhos.get(b'authorization', b'').decode('latin-1')
+            ip = ip_da_requisicao(
+                cabecalhos.get(b'x-forwarded-for', b'').decode('latin-1'),
+                (scope.get('client') or (None,))[0]
+            )
+            etapas = {}
+            status, payload = await chat_async(data, token, etapas, ip)
+            await enviar_json_asgi(send, status, payload, etapas)
+            return
+        
+        # Streaming segue pelo Flask: reentrega o corpo já lido
+        corpo_lido = {'type': 'http.request', 'body': corpo, 'more_body': False}
+        async def receive_repetido():
+            nonlocal corpo_lido
+            if corpo_lido:
+                mensagem, corpo_lido = corpo_lido, None
+                return mensagem
+            return await receive()
+        receive = receive_repetido
+    
+    if flask_asgi is None:
+        raise RuntimeError("Modo ASGI requer o pacote asgiref (pip install asgiref)")
+    await flask_asgi(scope, receive, send)
     
 # =============================================================================
 # 📊 ENDPOINTS DE ADMINISTRAÇÃO
@@ -2329,22 +7792,15 @@ def admin_stats():
         if not user_info or user_info.email.lower() != ADMIN_EMAIL.lower():
             return jsonify({'error': 'Acesso negado'}), 403
         
-        with contador_lock:
-            total_usuarios = len(CONTADOR_MENSAGENS)
-            total_mensagens = sum(c['total'] for c in CONTADOR_MENSAGENS.values())
-            
-            stats_por_plano = {}
-            for user_id, contador in CONTADOR_MENSAGENS.items():
-                tipo = contador['tipo_plano']
-                if tipo not in stats_por_plano:
-                    stats_por_plano[tipo] = {'usuarios': 0, 'mensagens': 0}
-                stats_por_plano[tipo]['usuarios'] += 1
-                stats_por_plano[tipo]['mensagens'] += contador['total']
-        
-        with tokens_lock:
-            total_tokens = sum(c['total_geral'] for c in CONTADOR_TOKENS.values())
-            total_tokens_entrada = sum(c['total_entrada'] for c in CONTADOR_TOKENS.values())
-            total_tokens_saida = sum(c['total_saida'] for c in CONTADOR_TOKENS.values())
+        totais = totais_usuarios()
+        total_usuarios = totais['usuarios_com_contador']
+        total_mensagens = totais['mensagens_enviadas']
+        stats_por_plano = totais['por_plano']
+        total_tokens = totais['tokens']['total_geral']
+        total_tokens_entrada = totais['tokens']['total_entrada']
+        total_tokens_saida = totais['tokens']['total_saida']
+        total_tokens_cache = totais['tokens']['total_cache']
+        total_coalescidas = totais['tokens']['mensagens_coalescidas']
         
         with historico_lock:
             ultimas_conversas = HISTORICO_CONVERSAS[-10:]
@@ -2355,8 +7811,12 @@ def admin_stats():
             'total_tokens': total_tokens,
             'total_tokens_entrada': total_tokens_entrada,
             'total_tokens_saida': total_tokens_saida,
+            'total_tokens_cache': total_tokens_cache,
+            'taxa_cache_prompt': round(total_tokens_cache / total_tokens_entrada * 100, 1) if total_tokens_entrada > 0 else 0,
+            'mensagens_coalescidas': total_coalescidas,
             'media_tokens_por_mensagem': round(total_tokens / total_mensagens, 2) if total_mensagens > 0 else 0,
             'stats_por_plano': stats_por_plano,
+            'validacao_anti_alucinacao': obter_estatisticas_validacao(),
             'ultimas_conversas': ultimas_conversas,
             'timestamp': datetime.now().isoformat()
         })
@@ -2364,6 +7824,40 @@ def admin_stats():
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+def montar_estatisticas_usuario(user_id, user_data):
+    """Mensagens, tokens, memória e conta de um usuário (painel do admin)"""
+    tipo_info = determinar_tipo_usuario(user_data)
+    stats_mensagens = obter_contador_mensagens(user_id, tipo_info['tipo'])
+    stats_tokens = obter_estatisticas_tokens(user_id)
+    
+    pode_enviar, msgs_usadas, limite, msgs_restantes = verificar_limite_mensagens(user_id, tipo_info['tipo'])
+    
+    with usuarios_lock:
+        memoria_info = None
+        estado = USUARIOS.get(user_id)
+        if estado is not None and estado.turnos is not None:
+            memoria_info = {
+                'mensagens_armazenadas': len(estado.turnos),
+                'tem_resumo': bool(estado.resumo),
+                'ultima_atualizacao': datetime.fromtimestamp(epoch_de_monotonico(estado.atualizado_em)).isoformat(),
+                'contador_mensagens': estado.contador_memoria
+            }
+    
+    return {
+        'user_id': user_id[:8] + '...',
+        'tipo_usuario': tipo_info,
+        'conta': {campo: user_data.get(campo) for campo in PROJECOES_CONTAS['admin'] if campo != 'user_id'},
+        'mensagens': {
+            'total': stats_mensagens['total'],
+            'resetado_em': datetime.fromtimestamp(stats_mensagens['resetado_em']).isoformat(),
+            'limite': limite if limite != float('inf') else 'ilimitado',
+            'restantes': msgs_restantes if msgs_restantes != float('inf') else 'ilimitado',
+            'pode_enviar': pode_enviar
+        },
+        'tokens': stats_tokens,
+        'memoria': memoria_info
+    }
+
 @app.route('/api/admin/user/<user_id>/stats', methods=['GET'])
 def admin_user_stats(user_id):
     """Estatísticas de um usuário específico (apenas admin)"""
@@ -2374,39 +7868,64 @@ def admin_user_stats(user_id):
         if not user_info or user_info.email.lower() != ADMIN_EMAIL.lower():
             return jsonify({'error': 'Acesso negado'}), 403
         
-        user_data = obter_dados_usuario_completos(user_id)
+        user_data = obter_dados_usuario_completos(user_id, 'admin')
         if not user_data:
             return jsonify({'error': 'Usuário não encontrado'}), 404
         
-        tipo_info = determinar_tipo_usuario(user_data)
-        stats_mensagens = obter_contador_mensagens(user_id)
-        stats_tokens = obter_estatisticas_tokens(user_id)
-        
-        pode_enviar, msgs_usadas, limite, msgs_restantes = verificar_limite_mensagens(user_id, tipo_info['tipo'])
-        
-        with memoria_lock:
-            memoria_info = None
-            if user_id in MEMORIA_USUARIOS:
-                memoria = MEMORIA_USUARIOS[user_id]
-                memoria_info = {
-                    'mensagens_armazenadas': len(memoria['mensagens']),
-                    'tem_resumo': bool(memoria['resumo']),
-                    'ultima_atualizacao': memoria['ultima_atualizacao'],
-                    'contador_mensagens': memoria['contador_mensagens']
-                }
+        stats = montar_estatisticas_usuario(user_id, user_data)
+        stats['timestamp'] = datetime.now().isoformat()
+        return jsonify(stats)
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/users/stats', methods=['POST'])
+def admin_users_stats():
+    """
+    Estatísticas de vários usuários numa chamada (apenas admin).
+    Body: {"user_ids": [...]} — as contas vêm numa consulta in_() por lote.
+    """
+    try:
+        token = request.headers.get('Authorization', '')
+        user_info = verificar_token_supabase(token)
+        
+        if not user_info or user_info.email.lower() != ADMIN_EMAIL.lower():
+            return jsonify({'error': 'Acesso negado'}), 403
+        
+        user_ids = (request.get_json(silent=True) or {}).get('user_ids') or []
+        if not isinstance(user_ids, list) or not all(isinstance(u, str) for u in user_ids):
+            return jsonify({'error': 'user_ids deve ser uma lista de ids'}), 400
+        if len(user_ids) > CONTAS_CONFIG['max_lote_admin']:
+            return jsonify({'error': f"Máximo de {CONTAS_CONFIG['max_lote_admin']} usuários por chamada"}), 400
+        
+        contas = buscar_contas(user_ids, 'admin')
         
         return jsonify({
+            'usuarios': {user_id: montar_estatisticas_usuario(user_id, conta) for user_id, conta in contas.items()},
+            'nao_encontrados': [user_id for user_id in dict.fromkeys(user_ids) if user_id not in contas],
+            'timestamp': datetime.now().isoformat()
+        })
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/admin/user/<user_id>/invalidate_cache', methods=['POST'])
+def admin_invalidar_cache_usuario(user_id):
+    """Descarta a conta em cache (chamar depois de mudar plano/suspensão no Supabase)"""
+    try:
+        token = request.headers.get('Authorization', '')
+        user_info = verificar_token_supabase(token)
+        
+        if not user_info or user_info.email.lower() != ADMIN_EMAIL.lower():
+            return jsonify({'error': 'Acesso negado'}), 403
+        
+        removida = invalidar_cache_usuario(user_id)
+        print(f"🔐 Cache da conta {user_id[:8]}... invalidado (estava em cache: {removida})")
+        
+        return jsonify({
+            'success': True,
             'user_id': user_id[:8] + '...',
-            'tipo_usuario': tipo_info,
-            'mensagens': {
-                'total': stats_mensagens['total'],
-                'resetado_em': stats_mensagens['resetado_em'],
-                'limite': limite if limite != float('inf') else 'ilimitado',
-                'restantes': msgs_restantes if msgs_restantes != float('inf') else 'ilimitado',
-                'pode_enviar': pode_enviar
-            },
-            'tokens': stats_tokens,
-            'memoria': memoria_info,
+            'estava_em_cache': removida,
             'timestamp': datetime.now().isoformat()
         })
     
@@ -2423,15 +7942,13 @@ def admin_reset_all():
         if not user_info or user_info.email.lower() != ADMIN_EMAIL.lower():
             return jsonify({'error': 'Acesso negado'}), 403
         
-        with contador_lock:
-            usuarios_resetados = len(CONTADOR_MENSAGENS)
-            CONTADOR_MENSAGENS.clear()
+        with usuarios_lock:
+            usuarios_resetados = sum(1 for estado in USUARIOS.values() if estado.janela_inicio is not None)
+            USUARIOS.clear()
+            CONVERSAS.limpar()
         
-        with tokens_lock:
-            CONTADOR_TOKENS.clear()
-        
-        with memoria_lock:
-            MEMORIA_USUARIOS.clear()
+        for tabela in TABELAS_USUARIO:
+            ARMAZEM_ESTADO.limpar(tabela)
         
         print(f"🔄 RESET COMPLETO: {usuarios_resetados} usuários resetados")
         
@@ -2448,25 +7965,38 @@ def admin_reset_all():
 # 🆘 SISTEMA DE RESPOSTA ALTERNATIVA QUANDO LIMITE ACABA
 # =============================================================================
 
-def gerar_resposta_alternativa_inteligente(pergunta, tipo_usuario):
+def gerar_resposta_alternativa_inteligente(pergunta, tipo_usuario, motivo='limite'):
     """
-    Sistema de respostas automáticas quando limite de IA acaba.
+    Sistema de respostas automáticas quando limite de IA acaba
+    (ou, com motivo='prazo', quando a OpenAI não respondeu dentro do SLO;
+    com motivo='instavel', quando o disjuntor do modelo está aberto).
     Usa padrões e keywords para responder sem consumir API.
     """
-    msg_lower = pergunta.lower().strip()
+    intencao = analisar_mensagem(pergunta)['intencao']
     nome = tipo_usuario.get('nome_real', 'Cliente')
     tipo = tipo_usuario.get('tipo', 'starter')
     
+    if motivo == 'prazo':
+        aviso = "A IA está demorando mais que o normal agora"
+        renovacao = "Tente novamente em alguns instantes"
+    elif motivo == 'instavel':
+        aviso = "A IA está instável no momento"
+        renovacao = "Tente novamente em alguns instantes"
+    else:
+        periodo, proximo = TEXTOS_JANELA.get(JANELAS_MENSAGENS.get(tipo), ('neste período', 'na próxima renovação'))
+        aviso = f"Seus créditos de IA acabaram {periodo}"
+        renovacao = f"Seus créditos renovam {proximo} (em {tempo_para_renovar_mensagens(tipo)})"
+    
     # SAUDAÇÕES
-    if any(kw in msg_lower for kw in ['oi', 'olá', 'ola', 'hey', 'bom dia', 'boa tarde', 'boa noite', 'e ai', 'eai']):
-        return f"Oi {nome}! Seus créditos de IA acabaram este mês, mas posso te ajudar com informações básicas. Como posso ajudar?"
+    if intencao == 'saudacao':
+        return f"Oi {nome}! {aviso}, mas posso te ajudar com informações básicas. Como posso ajudar?"
     
     # DESPEDIDAS
-    if any(kw in msg_lower for kw in ['tchau', 'até', 'falou', 'obrigado', 'obrigada', 'valeu']):
-        return f"Até logo {nome}! Seus créditos de IA renovam no próximo mês. Vibrações Positivas! ✨"
+    if intencao == 'despedida':
+        return f"Até logo {nome}! {renovacao}. Vibrações Positivas! ✨"
     
     # PLANOS E PREÇOS
-    if any(kw in msg_lower for kw in ['plano', 'preço', 'valor', 'custo', 'quanto custa', 'mensalidade', 'contratar']):
+    if intencao == 'planos':
         return f"""Olá {nome}! Aqui estão nossos planos:
 
 FREE - R$0,00 (teste 1 ano)
@@ -2488,7 +8018,7 @@ WhatsApp: (21) 99282-6074
 Site: https://natansites.com.br"""
     
     # CONTATO
-    if any(kw in msg_lower for kw in ['contato', 'whatsapp', 'telefone', 'email', 'falar']):
+    if intencao == 'contato':
         return f"""Fale com Natan diretamente:
 
 WhatsApp: (21) 99282-6074
@@ -2498,7 +8028,7 @@ Site: https://natansites.com.br
 Atendimento pessoal para clientes!"""
     
     # PORTFÓLIO
-    if any(kw in msg_lower for kw in ['portfolio', 'portfólio', 'projetos', 'trabalhos']):
+    if intencao == 'portfolio':
         return f"""Confira alguns projetos do Natan:
 
 1. Espaço Familiares - espacofamiliares.com.br
@@ -2511,7 +8041,7 @@ Visite natansites.com.br para ver todos!"""
     # RESPOSTA PADRÃO
     return f"""Olá {nome}!
 
-Seus créditos de IA acabaram este mês. Para informações detalhadas:
+{aviso}. Para informações detalhadas:
 
 📞 WhatsApp: (21) 99282-6074
 📧 Email: borgesnatan09@gmail.com
@@ -2523,7 +8053,7 @@ Posso responder sobre:
 - Portfólio
 - Cadastro
 
-Seus créditos renovam no próximo mês!
+{renovacao}!
 
 Vibrações Positivas! ✨"""
 
@@ -2534,21 +8064,18 @@ Vibrações Positivas! ✨"""
 @app.route('/health', methods=['GET'])
 @app.route('/api/health', methods=['GET'])
 def health():
-    with memoria_lock:
-        usuarios_ativos = len(MEMORIA_USUARIOS)
-        total_mensagens = sum(len(m['mensagens']) for m in MEMORIA_USUARIOS.values())
-    
-    with tokens_lock:
-        total_tokens = sum(c['total_geral'] for c in CONTADOR_TOKENS.values())
-        total_tokens_entrada = sum(c['total_entrada'] for c in CONTADOR_TOKENS.values())
-        total_tokens_saida = sum(c['total_saida'] for c in CONTADOR_TOKENS.values())
-    
-    with contador_lock:
-        total_mensagens_enviadas = sum(c['total'] for c in CONTADOR_MENSAGENS.values())
+    totais = totais_usuarios()
+    with usuarios_lock:
+        estatisticas_conversas = CONVERSAS.estatisticas()
+    usuarios_ativos = totais['usuarios_com_memoria']
+    total_mensagens = totais['mensagens_memoria']
+    total_tokens = totais['tokens']['total_geral']
+    total_tokens_entrada = totais['tokens']['total_entrada']
+    total_tokens_saida = totais['tokens']['total_saida']
+    total_mensagens_enviadas = totais['mensagens_enviadas']
     
     with visitantes_lock:
-        total_visitantes = len(CONTADOR_VISITANTES)
-        total_msgs_visitantes = sum(v['total'] for v in CONTADOR_VISITANTES.values())
+        limitador_visitantes = LIMITADOR_VISITANTES.estatisticas()
 
     return jsonify({
         "status": "online",
@@ -2558,12 +8085,28 @@ def health():
         "supabase": supabase is not None,
         "memoria": {
             "usuarios_ativos": usuarios_ativos,
+            "usuarios_registrados": totais['usuarios'],
             "total_mensagens_memoria": total_mensagens,
-            "max_por_usuario": MAX_MENSAGENS_MEMORIA
+            "max_por_usuario": MAX_MENSAGENS_MEMORIA,
+            "lru": estatisticas_conversas,
+            "resumos": FILA_RESUMOS.estatisticas()
         },
+        "cache_respostas": CACHE_RESPOSTAS.estatisticas(),
+        "cache_semantico": CACHE_SEMANTICO.estatisticas() if CACHE_SEMANTICO else None,
+        "prazos_slo": obter_metricas_prazo(),
+        "disjuntores": obter_estado_disjuntores(),
+        "single_flight": VOO_UNICO.estatisticas(),
+        "roteador_refinamento": ROTEADOR_REFINAMENTO.estatisticas(),
+        "estado": ARMAZEM_ESTADO.estatisticas(),
+        "cotas": MOTOR_COTAS.estatisticas(),
+        "autenticacao": obter_estatisticas_autenticacao(),
+        "validacao": obter_estatisticas_validacao(),
         "visitantes_anonimos": {
-            "total_visitantes": total_visitantes,
-            "total_mensagens": total_msgs_visitantes,
+            "total_visitantes": limitador_visitantes['exatos'],
+            "total_mensagens": limitador_visitantes['mensagens'],
+            "mensagens_coalescidas": limitador_visitantes['coalescidas'],
+            "limitador": limitador_visitantes,
+            "rajada_ip": RAJADA_IP.estatisticas(),
             "limite_por_visitante": VISITANTE_ANONIMO_CONFIG['limite_mensagens'],
             "duracao_limite": f"{VISITANTE_ANONIMO_CONFIG['duracao_limite_horas']}h"
         },
@@ -2603,7 +8146,24 @@ def health():
             "memoria_inteligente",
             "controle_limites_por_plano",
             "resposta_alternativa_sem_ia",
-            "validacao_anti_alucinacao"
+            "validacao_anti_alucinacao",
+            "validacao_incremental_stream",
+            "streaming_sse",
+            "cache_respostas_lru_ttl",
+            "cache_semantico_embeddings",
+            "modo_async_asgi",
+            "refinamento_especulativo",
+            "historico_por_orcamento_tokens",
+            "prazo_slo_hedge",
+            "circuit_breaker_por_modelo",
+            "single_flight_coalescencia",
+            "resumos_em_segundo_plano",
+            "roteador_preditivo_refinamento",
+            "estado_persistente_write_behind",
+            "reserva_atomica_cota",
+            "jwt_local_cache_autenticacao",
+            "registro_compacto_por_usuario",
+            "memoria_lru_ttl_incremental"
         ],
         "timestamp": datetime.now().isoformat()
     })
@@ -3029,4 +8589,9 @@ if __name__ == '__main__':
     print(f"Sistema de Memória: ✅ Ativo")
     print(f"Sistema de Limites: ✅ Ativo\n")
     
-    app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
+    if os.getenv('MODO_SERVIDOR', '').lower() == 'asgi':
+        import uvicorn
+        print("⚡ Modo assíncrono (ASGI) ativo\n")
+        uvicorn.run(asgi_app, host='0.0.0.0', port=int(os.getenv('PORT', '5000')))
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=False, threaded=True)
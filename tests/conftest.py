@@ -0,0 +1,55 @@
+"""
+Testes do main.py (pytest). Rodar da raiz do repositório:
+    pip install -r requirements-dev.txt
+    python -m pytest -q
+Nenhum teste chama a OpenAI nem o Supabase: o que precisa de resposta usa um
+client falso.
+"""
+
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+@pytest.fixture
+def caches(monkeypatch):
+    """Camadas de cache vazias (exata e semântica) só para o teste"""
+    exato = main.CacheRespostas(max_itens=100, ttl_segundos=60)
+    semantico = main.criar_cache_semantico()
+    monkeypatch.setattr(main, 'CACHE_RESPOSTAS', exato)
+    monkeypatch.setattr(main, 'CACHE_SEMANTICO', semantico)
+    return exato, semantico
+
+class CompletionsFalso:
+    """chat.completions do client falso: responde depois de `latencia` s e conta as chamadas"""
+
+    def __init__(self, latencia=0.0, resposta='Resposta do modelo.'):
+        self.latencia = latencia
+        self.resposta = resposta
+        self.chamadas = 0
+        self.lock = threading.Lock()
+
+    def create(self, model, messages, max_tokens, temperature=0.7, timeout=None, **kwargs):
+        with self.lock:
+            self.chamadas += 1
+        time.sleep(self.latencia)
+        uso = SimpleNamespace(prompt_tokens=80, completion_tokens=20, total_tokens=100, prompt_tokens_details=None)
+        mensagem = SimpleNamespace(content=self.resposta)
+        return SimpleNamespace(choices=[SimpleNamespace(message=mensagem)], usage=uso, model=model)
+
+@pytest.fixture
+def cliente_falso(monkeypatch):
+    """Troca o client da OpenAI por um falso (sem hedge: uma chamada por pedido)"""
+    completions = CompletionsFalso()
+    monkeypatch.setattr(main, 'OPENAI_API_KEY', 'sk-teste-' + 'x' * 32)
+    monkeypatch.setattr(main, 'client', SimpleNamespace(chat=SimpleNamespace(completions=completions)))
+    monkeypatch.setitem(main.HEDGE_CONFIG, 'ativo', False)
+    monkeypatch.setattr(main, 'DISJUNTORES_MODELOS', {})
+    return completions
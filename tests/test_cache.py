@@ -0,0 +1,111 @@
+"""Cache de respostas: camada exata e camada semântica"""
+
+import pytest
+
+import main
+
+# Pares rotulados usados para ajustar o vetorizador local e os limiares
+# (CACHE_SEMANTICO_LIMIARES['local']). Só pares da mesma categoria: perguntas
+# de categorias diferentes nunca se encontram (índices separados).
+PARAFRASES = [
+    ("quanto é o plano starter", "qual o preço do starter"),
+    ("quanto custa o plano starter", "qual o preço do starter"),
+    ("qual o valor do plano professional", "quanto custa o professional"),
+    ("quanto custa o professional por mês", "qual a mensalidade do plano professional"),
+    ("quais são os planos", "quais planos vocês têm"),
+    ("quanto custa um site", "qual o preço de um site"),
+    ("qual o telefone de vocês", "qual o número de telefone"),
+    ("qual o whatsapp", "qual o zap de vocês"),
+    ("qual o email de contato", "qual o e-mail de vocês"),
+    ("oi", "olá"),
+    ("obrigado", "muito obrigado"),
+    ("como funciona a hospedagem", "como funciona a hospedagem de vocês"),
+    ("qual o prazo de entrega", "qual o prazo para entregar o site"),
+]
+
+NAO_PARAFRASES = [
+    ("qual o email", "qual o telefone"),
+    ("qual o whatsapp", "qual o email"),
+    ("qual o telefone", "qual o endereço"),
+    ("quanto custa o starter", "quanto custa o professional"),
+    ("qual o preço do starter", "qual o preço do professional"),
+    ("o starter tem hospedagem", "o professional tem hospedagem"),
+    ("como funciona a hospedagem", "como funciona o suporte"),
+    ("o starter tem blog", "o starter tem loja"),
+    ("como cancelo o plano", "como contrato o plano"),
+    ("quanto custa o plano starter", "como cancelo o plano starter"),
+    ("bom dia", "boa noite"),
+    ("posso pagar no pix", "posso pagar no cartão"),
+    ("o site tem ssl", "o site tem seo"),
+]
+
+def responder(pergunta, resposta, tipo='starter'):
+    chave = main.chave_cache_resposta(pergunta, tipo)
+    main.guardar_resposta_cache(chave, {'resposta': resposta, 'modelo_usado': 'gpt-4o-mini'})
+    return chave
+
+def buscar(pergunta, tipo='starter'):
+    return main.buscar_resposta_cache(main.chave_cache_resposta(pergunta, tipo))
+
+@pytest.mark.parametrize('guardada, nova', PARAFRASES)
+def test_parafrase_acerta_na_camada_semantica(caches, guardada, nova):
+    responder(guardada, 'resposta guardada')
+    resultado = buscar(nova)
+    assert resultado is not None, f"{nova!r} deveria reaproveitar {guardada!r}"
+    assert resultado['resposta'] == 'resposta guardada'
+    assert resultado['cached'] is True
+
+@pytest.mark.parametrize('guardada, nova', NAO_PARAFRASES)
+def test_pergunta_diferente_nao_acerta(caches, guardada, nova):
+    responder(guardada, 'resposta guardada')
+    assert buscar(nova) is None, f"{nova!r} não pode receber a resposta de {guardada!r}"
+
+def test_starter_acerta_e_email_nao_recebe_telefone(caches):
+    responder("quanto é o plano starter", "O Starter custa R$ 39,90/mês.")
+    responder("qual o telefone?", "Nosso telefone é (21) 99999-9999.")
+
+    preco = buscar("qual o preço do starter")
+    assert preco['resposta'] == "O Starter custa R$ 39,90/mês."
+    assert preco['cache_camada'] == 'semantico'
+
+    assert buscar("qual o email?") is None
+
+def test_acerto_semantico_nao_vai_para_a_camada_exata(caches):
+    exato, _ = caches
+    responder("quanto custa o plano starter", "resposta do starter")
+
+    chave = main.chave_cache_resposta("qual o preço do starter", 'starter')
+    assert main.buscar_resposta_cache(chave)['cache_camada'] == 'semantico'
+    assert exato.obter(chave) is None
+    assert main.buscar_resposta_cache(chave)['cache_camada'] == 'semantico'
+
+def test_chave_normaliza_maiusculas_acentos_e_pontuacao():
+    assert main.chave_cache_resposta("Qual o PREÇO do  Starter?", 'starter') == \
+        main.chave_cache_resposta("qual o preco do starter", 'starter')
+
+def test_chave_separa_planos():
+    starter = main.chave_cache_resposta("quanto custa um site", 'starter')
+    professional = main.chave_cache_resposta("quanto custa um site", 'professional')
+    assert starter[0] == 'starter' and professional[0] == 'professional'
+    assert starter != professional
+
+def test_sem_chave_para_admin_e_conversa_com_contexto():
+    assert main.chave_cache_resposta("quanto custa um site", 'admin') is None
+    historico = [{'role': 'user', 'content': 'oi'}, {'role': 'assistant', 'content': 'Olá!'}]
+    assert main.chave_cache_resposta("e o preço?", 'starter', historico) is None
+    # Só a pergunta atual na memória: ainda é início de conversa
+    assert main.chave_cache_resposta("e o preço?", 'starter', [{'role': 'user', 'content': 'e o preço?'}]) is not None
+
+def test_acerto_exato_zera_tokens_e_troca_o_nome(caches):
+    chave = main.chave_cache_resposta("quanto custa um site", 'starter')
+    main.guardar_resposta_cache(chave, {'resposta': 'Olá Ana! Custa R$ 39,90.', 'tokens_usados': 120,
+                                        'modelo_usado': 'gpt-4o-mini'}, 'Ana')
+
+    resultado = main.buscar_resposta_cache(main.chave_cache_resposta("Quanto custa um site?", 'starter'), 'Bruno')
+    assert resultado['cache_camada'] == 'exato'
+    assert resultado['tokens_usados'] == 0
+    assert resultado['resposta'] == 'Olá Bruno! Custa R$ 39,90.'
+
+def test_plano_diferente_nao_acerta(caches):
+    responder("quanto custa o plano starter", 'resposta do starter', tipo='starter')
+    assert buscar("quanto custa o plano starter", tipo='professional') is None
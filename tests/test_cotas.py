@@ -0,0 +1,95 @@
+"""MotorCotas: reservar → confirmar/liberar, na memória e no SQLite"""
+
+import threading
+
+import pytest
+
+import main
+
+@pytest.fixture(params=['memoria', 'sqlite'])
+def cotas(request, tmp_path):
+    """Motor próprio (não o MOTOR_COTAS do main.py) sobre um backend novo"""
+    if request.param == 'sqlite':
+        backend = main.BackendEstadoSQLite(str(tmp_path / 'estado.db'), {'mensagens': None})
+    else:
+        backend = main.BackendEstadoMemoria()
+    armazem = main.ArmazemEstado(backend, intervalo_gravacao=0.2, validade_leitura=1.0)
+    contadores, lock = {}, threading.Lock()
+    armazem.registrar_tabela('mensagens', contadores, lock)
+    motor = main.MotorCotas(armazem, shards=8, validade_reserva=60)
+
+    def confirmar(reserva):
+        """Mesmo padrão de incrementar_contador: backend primeiro, local depois, confirma"""
+        somado_no_backend = motor.confirmar_no_backend(reserva, {'total': 0})
+        with lock:
+            contadores.setdefault(reserva.chave, {'total': 0})['total'] += 1
+            if not somado_no_backend:
+                armazem.atualizar('mensagens', reserva.chave, somar={'total': 1}, iniciais={'total': 0})
+        motor.confirmar(reserva)
+
+    return motor, confirmar
+
+def reservar(motor, limite=2, chave='u'):
+    return motor.reservar('mensagens', chave, limite)[0]
+
+def test_reserva_ate_o_limite(cotas):
+    motor, _ = cotas
+    assert reservar(motor) is not None
+    assert reservar(motor) is not None
+    assert reservar(motor) is None
+    assert reservar(motor, chave='outro') is not None  # cada chave tem a sua cota
+
+def test_confirmada_continua_contando(cotas):
+    motor, confirmar = cotas
+    confirmar(reservar(motor))
+    confirmar(reservar(motor))
+    assert reservar(motor) is None
+    assert motor.estatisticas()['confirmadas'] == 2
+
+def test_liberada_devolve_a_unidade(cotas):
+    motor, _ = cotas
+    primeira = reservar(motor)
+    reservar(motor)
+    motor.liberar(primeira)
+    assert primeira.estado == 'liberada'
+    assert reservar(motor) is not None
+
+def test_liberar_duas_vezes_devolve_uma_unidade(cotas):
+    motor, _ = cotas
+    primeira = reservar(motor)
+    reservar(motor)
+    motor.liberar(primeira)
+    motor.liberar(primeira)
+    assert reservar(motor) is not None
+    assert reservar(motor) is None  # a segunda liberação não abriu outra vaga
+    assert motor.estatisticas()['liberadas'] == 1
+
+def test_liberar_depois_de_confirmar_nao_devolve(cotas):
+    motor, confirmar = cotas
+    reserva = reservar(motor, limite=1)
+    confirmar(reserva)
+    motor.liberar(reserva)
+    assert reserva.estado == 'confirmada'
+    assert reservar(motor, limite=1) is None
+
+def test_concorrencia_a_uma_mensagem_do_limite(cotas):
+    motor, confirmar = cotas
+    confirmar(reservar(motor, limite=3))
+    confirmar(reservar(motor, limite=3))
+
+    barreira = threading.Barrier(16)
+    admitidas = []
+
+    def tentar():
+        barreira.wait()
+        reserva = reservar(motor, limite=3)
+        if reserva is not None:
+            confirmar(reserva)
+            admitidas.append(reserva)
+
+    threads = [threading.Thread(target=tentar) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(admitidas) == 1
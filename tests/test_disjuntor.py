@@ -0,0 +1,112 @@
+"""Disjuntor por modelo: fechado → aberto → meio_aberto → fechado"""
+
+import time
+
+import httpx
+import pytest
+from openai import APIConnectionError, APITimeoutError, InternalServerError
+
+import main
+
+REQUISICAO = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+
+def erro_500():
+    resposta = httpx.Response(500, request=REQUISICAO)
+    return InternalServerError('erro interno', response=resposta, body=None)
+
+@pytest.fixture
+def disjuntor(monkeypatch):
+    """Disjuntor novo para um modelo de teste, abrindo com 3 falhas e sem backoff"""
+    monkeypatch.setitem(main.DISJUNTOR_CONFIG, 'falhas_para_abrir', 3)
+    monkeypatch.setitem(main.DISJUNTOR_CONFIG, 'backoff_base', 0.0)
+    monkeypatch.setattr(main, 'DISJUNTORES_MODELOS', {})
+    return main.disjuntor_modelo('modelo-teste')
+
+def reabrir_agora(disjuntor):
+    """Simula o fim do tempo aberto"""
+    disjuntor.aberto_ate = time.monotonic() - 1
+
+def test_abre_depois_das_falhas_seguidas(disjuntor):
+    for _ in range(2):
+        disjuntor.registrar_falha(erro_500())
+    assert disjuntor.estado == main.DisjuntorModelo.FECHADO
+    disjuntor.registrar_falha(erro_500())
+    assert disjuntor.estado == main.DisjuntorModelo.ABERTO
+    assert not disjuntor.permitir()
+    assert disjuntor.estatisticas()['rejeitadas'] == 1
+
+def test_sucesso_zera_as_falhas(disjuntor):
+    disjuntor.registrar_falha(erro_500())
+    disjuntor.registrar_falha(erro_500())
+    disjuntor.registrar_sucesso()
+    disjuntor.registrar_falha(erro_500())
+    assert disjuntor.estado == main.DisjuntorModelo.FECHADO
+
+def test_meio_aberto_deixa_passar_uma_chamada_de_teste(disjuntor):
+    for _ in range(3):
+        disjuntor.registrar_falha(erro_500())
+    reabrir_agora(disjuntor)
+
+    assert disjuntor.disponivel()
+    assert disjuntor.permitir()
+    assert disjuntor.estado == main.DisjuntorModelo.MEIO_ABERTO
+    assert not disjuntor.permitir()  # só uma chamada de teste por vez
+
+    disjuntor.registrar_sucesso()
+    assert disjuntor.estado == main.DisjuntorModelo.FECHADO
+    assert disjuntor.permitir()
+
+def test_falha_no_meio_aberto_reabre(disjuntor):
+    for _ in range(3):
+        disjuntor.registrar_falha(erro_500())
+    reabrir_agora(disjuntor)
+    assert disjuntor.permitir()
+
+    disjuntor.registrar_falha(erro_500())
+    assert disjuntor.estado == main.DisjuntorModelo.ABERTO
+    assert not disjuntor.permitir()
+    assert disjuntor.estatisticas()['aberturas'] == 2
+
+def test_teste_liberado_sem_resposta_da_openai(disjuntor):
+    for _ in range(3):
+        disjuntor.registrar_falha(erro_500())
+    reabrir_agora(disjuntor)
+    assert disjuntor.permitir()
+    disjuntor.liberar_teste()  # ex.: erro nosso antes de chegar à OpenAI
+    assert disjuntor.estado == main.DisjuntorModelo.MEIO_ABERTO
+    assert disjuntor.permitir()
+
+def test_executar_repete_e_barra_com_o_circuito_aberto(disjuntor):
+    chamadas = []
+
+    def falhar():
+        chamadas.append(1)
+        raise erro_500()
+
+    with pytest.raises(InternalServerError):
+        main.executar_com_disjuntor('modelo-teste', falhar)
+    assert len(chamadas) == 3  # 1ª chamada + 2 repetições, e a 3ª falha abre o disjuntor
+    assert disjuntor.estado == main.DisjuntorModelo.ABERTO
+
+    with pytest.raises(main.CircuitoAberto):
+        main.executar_com_disjuntor('modelo-teste', falhar)
+    assert len(chamadas) == 3
+
+def test_timeout_do_proprio_prazo_nao_conta(disjuntor):
+    def estourar_prazo():
+        raise APITimeoutError(REQUISICAO)
+
+    for _ in range(5):
+        with pytest.raises(APITimeoutError):
+            main.executar_com_disjuntor('modelo-teste', estourar_prazo, main.Prazo(0.1))
+    assert disjuntor.estado == main.DisjuntorModelo.FECHADO
+    assert disjuntor.falhas_seguidas == 0
+
+def test_falha_de_conexao_conta(disjuntor):
+    def sem_conexao():
+        raise APIConnectionError(request=REQUISICAO)
+
+    for _ in range(3):
+        with pytest.raises(APIConnectionError):
+            main.executar_com_disjuntor('modelo-teste', sem_conexao, main.Prazo(0.1))
+    assert disjuntor.estado == main.DisjuntorModelo.ABERTO
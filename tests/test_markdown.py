@@ -0,0 +1,47 @@
+"""
+Limpeza de markdown: o tokenizador de uma passada contra a limpeza antiga.
+A referência e os geradores aleatórios são os de bench/bench_markdown.py.
+"""
+
+import random
+
+import pytest
+
+import main
+from bench.bench_markdown import (
+    EMAILS, IDENTIFICADORES, URLS, limpar_antiga, limpar_em_stream, picar,
+    resposta_bem_formada, resposta_com_links
+)
+
+SEMENTES = range(20)
+
+@pytest.mark.parametrize('texto, esperado', [
+    ("O **Starter** custa *R$ 39,90*.", "O Starter custa R$ 39,90."),
+    ("Use __sempre__ o _domínio_ próprio", "Use sempre o domínio próprio"),
+    ("Rode `npm run build`", "Rode npm run build"),
+    ("Linha 1\n\n\n\nLinha 2", "Linha 1\n\nLinha 2"),
+    ("  **oi**  ", "oi"),
+    ("", ""),
+])
+def test_exemplos_iguais_a_limpeza_antiga(texto, esperado):
+    assert main.limpar_formatacao_markdown(texto) == esperado
+    assert limpar_antiga(texto) == esperado
+
+@pytest.mark.parametrize('semente', SEMENTES)
+def test_markdown_bem_formado_igual_a_limpeza_antiga(semente):
+    rng = random.Random(semente)
+    for _ in range(50):
+        texto = resposta_bem_formada(rng, rng.randint(40, 600))
+        assert main.limpar_formatacao_markdown(texto) == limpar_antiga(texto), texto
+
+@pytest.mark.parametrize('protegido', URLS + EMAILS + IDENTIFICADORES)
+def test_urls_emails_e_identificadores_intactos(protegido):
+    texto = f"Veja **isto**: {protegido} e _aquilo_."
+    assert protegido in main.limpar_formatacao_markdown(texto)
+
+@pytest.mark.parametrize('semente', SEMENTES)
+def test_stream_picado_igual_ao_texto_inteiro(semente):
+    rng = random.Random(semente)
+    for _ in range(50):
+        texto = resposta_com_links(rng, rng.randint(40, 600))
+        assert limpar_em_stream(picar(rng, texto)) == main.limpar_formatacao_markdown(texto), texto
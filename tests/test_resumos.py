@@ -0,0 +1,40 @@
+"""Resumo incremental: o worker não grava o resumo numa conversa que recomeçou"""
+
+import main
+
+def conversa(user_id, quantidade, prefixo):
+    with main.usuarios_lock:
+        estado = main.estado_usuario(user_id)
+        for i in range(quantidade):
+            main.anotar_turno(user_id, estado, 'user', f'{prefixo} {i}')
+    return estado
+
+def test_resumo_descartado_quando_a_conversa_recomeca(monkeypatch):
+    fila = main.FilaResumos(lote_maximo=4, intervalo_segundos=0, paralelismo=1)
+    estado = conversa('teste-resumo-recomeca', 8, 'antiga')
+    assert main.precisa_resumo(estado)
+
+    def recomecar_durante_o_resumo(resumo_anterior, novas, contador):
+        # A conversa venceu e o usuário voltou enquanto o resumo era gerado
+        with main.usuarios_lock:
+            estado.descartar_memoria()
+        conversa('teste-resumo-recomeca', 8, 'nova')
+        return 'resumo da conversa antiga', 'extrativo'
+
+    monkeypatch.setattr(fila, 'atualizar_resumo', recomecar_durante_o_resumo)
+    fila.processar_lote(['teste-resumo-recomeca'])
+
+    assert estado.resumo == ''
+    assert [texto for _, texto in estado.nao_resumidas] == [f'nova {i}' for i in range(5)]
+    assert fila.estatisticas()['descartados'] == 1
+    assert 'teste-resumo-recomeca' in fila.pendentes  # a conversa nova é resumida depois
+
+def test_resumo_gravado_na_mesma_conversa(monkeypatch):
+    fila = main.FilaResumos(lote_maximo=4, intervalo_segundos=0, paralelismo=1)
+    estado = conversa('teste-resumo-mesma', 8, 'msg')
+    monkeypatch.setattr(fila, 'atualizar_resumo', lambda *copia: ('resumo', 'extrativo'))
+    fila.processar_lote(['teste-resumo-mesma'])
+
+    assert estado.resumo == 'resumo'
+    assert estado.nao_resumidas == []
+    assert fila.estatisticas()['gerados'] == 1
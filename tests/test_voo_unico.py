@@ -0,0 +1,114 @@
+"""Single-flight: pedidos iguais simultâneos dividem uma chamada"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import main
+
+def simultaneas(quantidade, funcao):
+    """Roda funcao() em `quantidade` threads liberadas juntas; retorna os resultados"""
+    barreira = threading.Barrier(quantidade)
+    resultados, erros = [], []
+
+    def alvo():
+        barreira.wait()
+        try:
+            resultados.append(funcao())
+        except Exception as e:
+            erros.append(e)
+
+    threads = [threading.Thread(target=alvo) for _ in range(quantidade)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return resultados, erros
+
+def test_mesma_chave_vira_uma_chamada():
+    voo = main.VooUnico()
+    chamadas = []
+
+    def chamar():
+        chamadas.append(1)
+        time.sleep(0.2)
+        return {'resposta': 'ok'}
+
+    resultados, erros = simultaneas(8, lambda: voo.executar(('starter', 'oi', ''), chamar))
+    assert not erros
+    assert len(chamadas) == 1
+    assert all(resultado == {'resposta': 'ok'} for resultado, _ in resultados)
+    assert sorted(coalescida for _, coalescida in resultados) == [False] + [True] * 7
+    assert voo.estatisticas()['em_voo'] == 0
+
+def test_chaves_diferentes_nao_coalescem():
+    voo = main.VooUnico()
+    chamadas = []
+
+    def chamar():
+        chamadas.append(1)
+        time.sleep(0.1)
+        return 'ok'
+
+    contador = iter(range(4))
+    simultaneas(4, lambda: voo.executar(('starter', f'pergunta {next(contador)}', ''), chamar))
+    assert len(chamadas) == 4
+    assert voo.estatisticas()['coalescidas'] == 0
+
+def test_erro_do_lider_chega_a_quem_espera():
+    voo = main.VooUnico()
+
+    def falhar():
+        time.sleep(0.2)
+        raise ValueError('falhou')
+
+    resultados, erros = simultaneas(4, lambda: voo.executar('chave', falhar))
+    assert not resultados
+    assert len(erros) == 4 and all(isinstance(e, ValueError) for e in erros)
+    assert voo.estatisticas()['em_voo'] == 0  # a próxima chamada tenta de novo
+
+def test_quem_espera_respeita_o_proprio_prazo():
+    voo = main.VooUnico()
+    lider = threading.Thread(target=voo.executar, args=('chave', lambda: time.sleep(0.5)))
+    lider.start()
+    time.sleep(0.05)
+    with pytest.raises(main.PrazoExpirado):
+        voo.executar('chave', lambda: None, main.Prazo(0.1))
+    lider.join()
+
+def test_versao_async_compartilha_a_task():
+    voo = main.VooUnico()
+    chamadas = []
+
+    async def chamar():
+        chamadas.append(1)
+        await asyncio.sleep(0.1)
+        return 'ok'
+
+    async def disparar():
+        return await asyncio.gather(*(voo.executar_async('chave', chamar) for _ in range(5)))
+
+    resultados = asyncio.run(disparar())
+    assert len(chamadas) == 1
+    assert [resultado for resultado, _ in resultados] == ['ok'] * 5
+    assert sum(coalescida for _, coalescida in resultados) == 4
+
+def test_visitantes_com_a_mesma_pergunta_dividem_a_chamada(monkeypatch, caches, cliente_falso):
+    monkeypatch.setattr(main, 'VOO_UNICO', main.VooUnico())
+    cliente_falso.latencia = 0.3
+
+    def perguntar():
+        contexto = {'visitante': True, 'mensagem': 'Como funciona a NatanSites?',
+                    'prazo': main.criar_prazo('visitante')}
+        return main.processar_mensagem_chat(contexto)
+
+    resultados, erros = simultaneas(6, perguntar)
+    assert not erros
+    assert cliente_falso.chamadas == 1
+    assert all(resultado['resposta'] == 'Resposta do modelo.' for resultado in resultados)
+    coalescidos = [resultado for resultado in resultados if resultado.get('coalescido')]
+    assert len(coalescidos) == 5
+    assert all(resultado['tokens_usados'] == 0 for resultado in coalescidos)
+    assert sum(resultado['tokens_usados'] for resultado in resultados) == 100